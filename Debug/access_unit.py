@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+H.265 access unit assembly
+Groups depacketized NAL units into access units (one per picture). The NAL
+units stay views into the RTP payloads until the access unit is joined, so
+each access unit is copied exactly once on the way to the decoder
+"""
+
+from depacketizer import IRAP_TYPES, START_CODE
+
+# NAL unit types (ITU-T H.265 Table 7-1) that can only start an access unit
+# (7.4.2.4.4): VPS, SPS, PPS, AUD, prefix SEI and reserved 41..44, 48..55
+AU_START_TYPES = frozenset([32, 33, 34, 35, 39, 41, 42, 43, 44] + list(range(48, 56)))
+
+
+def starts_access_unit(nal):
+    """True if nal (a list of buffers, NAL header first) cannot belong to the
+    access unit before it once that access unit has a picture"""
+    first = nal[0]
+    nal_type = (first[0] >> 1) & 0x3F
+    if nal_type >= 32:
+        return nal_type in AU_START_TYPES
+    # VCL: first_slice_segment_in_pic_flag is the first bit after the
+    # 2-byte header, which may be the start of the next buffer
+    if len(first) > 2:
+        return bool(first[2] & 0x80)
+    for chunk in nal[1:2]:
+        if len(chunk):
+            return bool(chunk[0] & 0x80)
+    return False
+
+
+def split_nal_units(data):
+    """Split an Annex-B byte stream into NAL units (without start codes)"""
+    nals = []
+    start = data.find(b'\x00\x00\x01')
+    while start != -1:
+        start += 3
+        end = data.find(b'\x00\x00\x01', start)
+        nal_end = len(data) if end == -1 else end
+        # A 4-byte start code leaves a trailing zero on the previous NAL
+        while nal_end > start and data[nal_end - 1] == 0:
+            nal_end -= 1
+        nals.append(data[start:nal_end])
+        start = end
+    return nals
+
+
+class AccessUnit:
+    """The NAL units of one picture, kept as uncopied buffers until join()"""
+
+    __slots__ = ('chunks', 'size', 'timestamp', 'irap', 'stats')
+
+    def __init__(self, chunks, size, timestamp, irap, stats):
+        self.chunks = chunks  # START_CODE, NAL header and payload buffers, in order
+        self.size = size
+        self.timestamp = timestamp
+        self.irap = irap
+        self.stats = stats
+
+    def join(self):
+        """The access unit as Annex-B bytes"""
+        self.stats['bytes_copied'] += self.size
+        return b''.join(self.chunks)
+
+
+class AccessUnitAssembler:
+    """Collects NAL units into access units.
+
+    An access unit ends at the RTP marker bit, and also when the next NAL
+    cannot belong to it (a slice with first_slice_segment_in_pic_flag, an
+    AUD or a parameter set after the picture's slices) or the RTP timestamp
+    changes, so a lost marker packet does not merge two pictures.
+    """
+
+    def __init__(self):
+        self.stats = {
+            'access_units': 0,
+            'nal_units': 0,
+            'bytes_copied': 0,      # by AccessUnit.join() and the consumer
+            'split_by_header': 0,   # boundaries found without the marker bit
+            'split_by_timestamp': 0,
+        }
+        self.reset()
+
+    def reset(self):
+        """Discard a partially collected access unit (e.g. after packet loss)"""
+        self.chunks = []
+        self.size = 0
+        self.timestamp = None
+        self.has_vcl = False
+        self.irap = False
+
+    @property
+    def bytes_copied_per_frame(self):
+        if not self.stats['access_units']:
+            return 0.0
+        return self.stats['bytes_copied'] / self.stats['access_units']
+
+    def _emit(self):
+        au = AccessUnit(self.chunks, self.size, self.timestamp, self.irap, self.stats)
+        self.stats['access_units'] += 1
+        self.reset()
+        return au
+
+    def push(self, nal, timestamp=None, marker=False):
+        """Add one NAL unit, given as a list of buffers starting with the NAL
+        header (as returned by H265RTPDepacketizer.depacketize). marker ends
+        the access unit after this NAL. Returns the completed access units."""
+        completed = []
+        nal_type = (nal[0][0] >> 1) & 0x3F
+        # Parameter sets and SEI stay with the picture that follows them
+        if self.has_vcl:
+            if timestamp is not None and timestamp != self.timestamp:
+                self.stats['split_by_timestamp'] += 1
+                completed.append(self._emit())
+            elif starts_access_unit(nal):
+                self.stats['split_by_header'] += 1
+                completed.append(self._emit())
+
+        if timestamp is not None:
+            self.timestamp = timestamp
+        self.chunks.append(START_CODE)
+        self.chunks.extend(nal)
+        self.size += 4 + sum(map(len, nal))
+        self.stats['nal_units'] += 1
+        if nal_type < 32:
+            self.has_vcl = True
+            if nal_type in IRAP_TYPES:
+                self.irap = True
+
+        # The sender may set the marker on parameter set packets as well
+        if marker and self.has_vcl:
+            completed.append(self._emit())
+        return completed
+
+    def push_packet(self, nal_units, timestamp=None, marker=False):
+        """push() the NAL units of one RTP packet; marker applies after the last"""
+        completed = []
+        last = len(nal_units) - 1
+        for i, nal in enumerate(nal_units):
+            completed.extend(self.push(nal, timestamp, marker and i == last))
+        return completed
+
+    def flush(self):
+        """End the current access unit (e.g. at the end of the stream)"""
+        return [self._emit()] if self.chunks else []
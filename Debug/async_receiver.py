@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+"""
+asyncio H.265 RTP receiver engine
+Ingest through loop.create_datagram_endpoint, bounded queues with explicit
+drop policies between the stages, and decoding in an executor. Nothing polls:
+jitter buffer deadlines are loop timers, so an idle stream costs no CPU and a
+packet is handled as soon as it arrives. Several receivers can share one
+event loop:
+
+    receiver = AsyncH265Receiver(port=5004)
+    await receiver.start()
+    async for key, frame in receiver.frames():
+        ...
+"""
+
+import asyncio
+import socket
+import time
+
+from rtp import RTPPacket
+from demux import StreamDemuxer
+from metrics import MetricsRegistry, StageMetrics
+from h265_receiver import StreamContext
+from parameter_sets import ParameterSetCache
+
+DROP_POLICIES = ('drop_oldest', 'drop_newest', 'until_irap')
+
+# Latency stages of an access unit, in pipeline order
+LATENCY_STAGES = ('network', 'assembly', 'queue', 'decode', 'delivery')
+
+
+class DropQueue(asyncio.Queue):
+    """Bounded asyncio.Queue whose producer never waits; a full queue applies a drop policy.
+
+    drop_oldest: discard the oldest queued item to make room
+    drop_newest: discard the item being offered
+    until_irap:  discard the item being offered and everything after it up
+                 to the next IRAP, since those pictures reference the dropped
+                 one; an IRAP that finds the queue full replaces its content
+    """
+
+    def __init__(self, maxsize, policy='drop_oldest'):
+        if policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy: {policy}")
+        super().__init__(maxsize)
+        self.policy = policy
+        self.waiting_for_irap = False
+        self.dropped = 0
+
+    def offer(self, item, irap=False):
+        """Queue item without waiting. Returns False if it was dropped."""
+        if self.policy == 'until_irap':
+            if self.waiting_for_irap and not irap:
+                self.dropped += 1
+                return False
+            self.waiting_for_irap = False
+            if self.full():
+                if not irap:
+                    self.waiting_for_irap = True
+                    self.dropped += 1
+                    return False
+                while not self.empty():
+                    self.get_nowait()
+                    self.dropped += 1
+        elif self.full():
+            if self.policy == 'drop_newest':
+                self.dropped += 1
+                return False
+            self.get_nowait()
+            self.dropped += 1
+        self.put_nowait(item)
+        return True
+
+
+class AsyncStream:
+    """Per-stream state of the engine: the shared StreamContext plus its queue and decode task"""
+
+    def __init__(self, context, queue):
+        self.context = context
+        self.queue = queue          # (access unit, first packet arrival, assembled time)
+        self.first_arrival = {}     # RTP timestamp -> arrival of its first packet
+        self.min_transit = None     # lowest arrival - RTP time seen, in seconds
+        self.gap_timer = None
+        self.task = None
+
+
+class _RTPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, receiver):
+        self.receiver = receiver
+
+    def datagram_received(self, data, addr):
+        self.receiver.datagram_received(data, addr)
+
+    def error_received(self, exc):
+        self.receiver.stats['socket_errors'] += 1
+
+
+class AsyncH265Receiver:
+    """H.265 RTP receiver running on an asyncio event loop.
+
+    Packets are demultiplexed, reordered and depacketized on the loop.
+    Completed access units go through a per-stream DropQueue (au_policy) to a
+    decode task that runs H265Decoder in executor (None: the loop's default
+    executor); frames go through one DropQueue (frame_policy) to frames().
+    Decoded frames are DecodedFrame objects unless output='bgr'; preview_width
+    downscales the BGR conversion (on decode for 'bgr', on display otherwise).
+    """
+
+    def __init__(self, port=5004, host='0.0.0.0', jitter_delay_ms=50, adaptive_jitter=False,
+                 wait_for_irap=True, max_streams=16, stream_timeout=10.0,
+                 au_queue_size=8, au_policy='until_irap', frame_queue_size=4,
+                 frame_policy='drop_oldest', output='lazy', decoder_options=None, executor=None,
+                 clock_rate=90000, metrics=None, parameter_sets=None, startup_gate=True, preview_width=0):
+        self.port = port
+        self.host = host
+        self.jitter_delay_ms = jitter_delay_ms
+        self.adaptive_jitter = adaptive_jitter
+        self.wait_for_irap = wait_for_irap
+        self.stream_timeout = stream_timeout
+        self.au_queue_size = au_queue_size
+        self.au_policy = au_policy
+        self.output = output
+        self.preview_width = preview_width
+        self.decoder_options = decoder_options
+        self.executor = executor
+        self.clock_rate = clock_rate
+        self.parameter_sets = parameter_sets if parameter_sets is not None else ParameterSetCache()
+        self.startup_gate = startup_gate
+        self.demuxer = StreamDemuxer(self.create_stream, max_streams=max_streams)
+        self.frame_queue = DropQueue(frame_queue_size, frame_policy)  # (StreamKey, frame, latency record)
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.timer = StageMetrics(self.metrics)
+        self.latency = StageMetrics(self.metrics, 'h265_frame_latency_seconds',
+                                    'Per-frame latency by stage (network relative to the fastest packet)')
+        self.transport = None
+        self.loop = None
+        self.housekeeping = None
+        self.stats = {
+            'packets_received': 0,
+            'bytes_received': 0,
+            'parse_errors': 0,
+            'socket_errors': 0,
+            'access_units': 0,
+            'frames_decoded': 0,
+        }
+        self.register_metrics()
+
+    def register_metrics(self):
+        # Everything runs on the loop, so the plain stats dict is read at export time
+        m = self.metrics
+        for name, key, help in (('h265_packets_received_total', 'packets_received', 'RTP packets received'),
+                                ('h265_bytes_received_total', 'bytes_received', 'UDP payload bytes received'),
+                                ('h265_parse_errors_total', 'parse_errors', 'Datagrams that are not valid RTP'),
+                                ('h265_frames_decoded_total', 'frames_decoded', 'Decoded frames')):
+            m.counter(name, help, fn=lambda key=key: self.stats[key])
+        dropped = 'Items dropped per stage (packets, NAL units, access units or frames)'
+        m.counter('h265_dropped_total', dropped, stage='au_queue',
+                  fn=lambda: sum(stream.queue.dropped for _, stream in list(self.demuxer)))
+        m.counter('h265_dropped_total', dropped, stage='frame_queue', fn=lambda: self.frame_queue.dropped)
+        depth = 'Items waiting in a queue'
+        m.gauge('h265_queue_depth', depth, lambda: sum(stream.queue.qsize() for _, stream in list(self.demuxer)),
+                queue='au_queue')
+        m.gauge('h265_queue_depth', depth, self.frame_queue.qsize, queue='frame_queue')
+        m.gauge('h265_streams', 'Active streams', lambda: len(self.demuxer.streams))
+
+    def create_stream(self, key):
+        print(f"New stream: {key}")
+        context = StreamContext(key, jitter_delay_ms=self.jitter_delay_ms,
+                                adaptive_jitter=self.adaptive_jitter,
+                                wait_for_irap=self.wait_for_irap, output=self.output,
+                                preview_width=self.preview_width, timer=self.timer, decoder_options=self.decoder_options,
+                                parameter_sets=self.parameter_sets if self.startup_gate else None)
+        stream = AsyncStream(context, DropQueue(self.au_queue_size, self.au_policy))
+        stream.task = self.loop.create_task(self._decode_stream(stream))
+        return stream
+
+    async def start(self):
+        """Bind the UDP port and start receiving in the running loop"""
+        self.loop = asyncio.get_running_loop()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Increase receive buffer for high bitrate streams
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        sock.bind((self.host, self.port))
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: _RTPProtocol(self), sock=sock)
+        self.housekeeping = self.loop.call_later(0.5, self._housekeeping)
+
+    async def close(self):
+        if self.housekeeping is not None:
+            self.housekeeping.cancel()
+        if self.transport is not None:
+            self.transport.close()
+        for key, stream in list(self.demuxer):
+            self._close_stream(stream)
+        tasks = [stream.task for _, stream in self.demuxer if stream.task is not None]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def frames(self):
+        """Decoded frames as (StreamKey, frame), as long as the receiver runs"""
+        while True:
+            key, frame, record = await self.frame_queue.get()
+            self._record_delivery(record)
+            yield key, frame
+
+    async def get_frame(self):
+        """The next decoded frame as (StreamKey, frame)"""
+        key, frame, record = await self.frame_queue.get()
+        self._record_delivery(record)
+        return key, frame
+
+    def datagram_received(self, data, addr):
+        arrival = time.time()
+        self.stats['packets_received'] += 1
+        self.stats['bytes_received'] += len(data)
+        try:
+            packet = RTPPacket(data)
+        except ValueError:
+            self.stats['parse_errors'] += 1
+            return
+
+        stream = self.demuxer.lookup(addr[0], addr[1], self.port, packet.ssrc, arrival)
+        if stream is None:
+            return
+        if packet.timestamp not in stream.first_arrival:
+            stream.first_arrival[packet.timestamp] = arrival
+            self._update_transit(stream, packet.timestamp, arrival)
+        self._release(stream, stream.context.receive(packet, arrival, arrival))
+
+    def _update_transit(self, stream, timestamp, arrival):
+        # Lowest (arrival - RTP time) seen approximates the fixed sender + network
+        # delay; the rest is queueing and jitter in front of the receiver
+        transit = arrival - timestamp / self.clock_rate
+        if stream.min_transit is None or transit < stream.min_transit:
+            stream.min_transit = transit
+
+    def _release(self, stream, ready):
+        """Depacketize released packets and queue the access units they complete"""
+        context = stream.context
+        now = time.time()
+        for lost_before, packet in ready:
+            for access_unit in context.assemble(packet, lost_before):
+                self.stats['access_units'] += 1
+                arrival = stream.first_arrival.pop(access_unit.timestamp, now)
+                stream.queue.offer((access_unit, arrival, now), irap=access_unit.irap)
+        if len(stream.first_arrival) > 256:
+            # Timestamps of pictures that never completed
+            for timestamp in list(stream.first_arrival)[:128]:
+                del stream.first_arrival[timestamp]
+
+        if context.jitter_buffer is not None:
+            # Wake up exactly when the jitter buffer gives up on a missing packet
+            deadline = context.jitter_buffer.deadline
+            if stream.gap_timer is not None:
+                stream.gap_timer.cancel()
+                stream.gap_timer = None
+            if deadline is not None:
+                delay = max(0.0, deadline - time.time())
+                stream.gap_timer = self.loop.call_later(delay, self._gap_expired, stream)
+
+    def _gap_expired(self, stream):
+        stream.gap_timer = None
+        now = time.time()
+        self._release(stream, stream.context.receive(None, None, now))
+
+    async def _decode_stream(self, stream):
+        decoder = stream.context.decoder
+        while True:
+            item = await stream.queue.get()
+            if item is None:
+                break
+            access_unit, arrival, assembled = item
+            dequeued = time.time()
+            frames = await self.loop.run_in_executor(self.executor, decoder.decode_access_unit, access_unit)
+            decoded = time.time()
+            stream.context.count_frames(len(frames), decoded)
+            self.stats['frames_decoded'] += len(frames)
+
+            network = 0.0
+            if stream.min_transit is not None and access_unit.timestamp is not None:
+                network = arrival - access_unit.timestamp / self.clock_rate - stream.min_transit
+            record = (network, assembled - arrival, dequeued - assembled, decoded - dequeued, decoded)
+            for frame in frames:
+                self.frame_queue.offer((stream.context.key, frame, record))
+
+    def _record_delivery(self, record):
+        network, assembly, queued, decode, decoded = record
+        delivery = time.time() - decoded
+        for stage, seconds in zip(LATENCY_STAGES, (network, assembly, queued, decode, delivery)):
+            self.latency.add(stage, seconds)
+        self.latency.add('total', network + assembly + queued + decode + delivery)
+
+    def _close_stream(self, stream):
+        if stream.gap_timer is not None:
+            stream.gap_timer.cancel()
+        # Wake the decode task even if the queue is full
+        while stream.queue.full():
+            stream.queue.get_nowait()
+        stream.queue.put_nowait(None)
+
+    def _housekeeping(self):
+        now = time.time()
+        for key, stream in self.demuxer:
+            stream.context.depacketizer.cleanup_old_fragments()
+        streams = dict(self.demuxer.streams)
+        for key in self.demuxer.expire(self.stream_timeout, now):
+            print(f"Stream timed out: {key}")
+            self._close_stream(streams[key])
+        self.housekeeping = self.loop.call_later(0.5, self._housekeeping)
+
+    def latency_report(self):
+        """{stage: (milliseconds per frame, frames)} for network (relative to the
+        fastest packet), assembly, queue, decode, delivery and total"""
+        return self.latency.report()
+
+    def print_statistics(self):
+        print("\n--- Statistics (asyncio) ---")
+        print(f"Packets received: {self.stats['packets_received']}")
+        print(f"Bytes received: {self.stats['bytes_received']:,}")
+        print(f"Access units: {self.stats['access_units']}")
+        print(f"Frames decoded: {self.stats['frames_decoded']}")
+        print(f"Frames dropped (consumer behind): {self.frame_queue.dropped}")
+        for key, stream in self.demuxer:
+            print(f"[{key}]")
+            print(f"  Frames decoded: {stream.context.frames_decoded}")
+            if stream.context.time_to_first_frame is not None:
+                print(f"  Time to first frame: {stream.context.time_to_first_frame * 1000:.0f} ms")
+            print(f"  Access units dropped ({stream.queue.policy}): {stream.queue.dropped}")
+        report = self.latency_report()
+        if report:
+            print("Latency per frame (ms):")
+            for stage in LATENCY_STAGES + ('total',):
+                if stage in report:
+                    print(f"  {stage:<10}{report[stage][0]:8.2f}")
+        print("-----------------\n")
+
+
+async def run(receiver, display=True, stats_interval=5.0):
+    """Run receiver until 'q' is pressed in a preview window (or forever without display)"""
+    await receiver.start()
+    print(f"Receiver started on port {receiver.port} (asyncio)")
+    print("Press 'q' to quit, 's' for statistics")
+    try:
+        if display:
+            await _display(receiver, stats_interval)
+        else:
+            while True:
+                await asyncio.sleep(stats_interval)
+                receiver.print_statistics()
+    finally:
+        await receiver.close()
+
+
+async def _display(receiver, stats_interval):
+    import cv2
+    from frame_output import DecodedFrame, preview_size
+
+    cv2.namedWindow('H.265 Stream', cv2.WINDOW_NORMAL)
+    windows = {}
+    last_stats_time = time.time()
+    while True:
+        try:
+            # The window needs waitKey() regularly even when no frame arrives
+            stream_key, frame = await asyncio.wait_for(receiver.get_frame(), 0.05)
+        except asyncio.TimeoutError:
+            frame = None
+        if frame is not None:
+            window = windows.get(stream_key)
+            if window is None:
+                window = 'H.265 Stream' if not windows else f'H.265 Stream {stream_key}'
+                if windows:
+                    cv2.namedWindow(window, cv2.WINDOW_NORMAL)
+                windows[stream_key] = window
+            if isinstance(frame, DecodedFrame):
+                if receiver.output == 'yuv':
+                    frame = frame.preview(receiver.preview_width)
+                else:
+                    frame = frame.to_bgr(*preview_size(frame.width, frame.height, receiver.preview_width))
+            cv2.imshow(window, frame)
+
+        key = cv2.waitKey(1) & 0xFF
+        if key == ord('q'):
+            break
+        elif key == ord('s'):
+            receiver.print_statistics()
+        if time.time() - last_stats_time > stats_interval:
+            receiver.print_statistics()
+            last_stats_time = time.time()
+    cv2.destroyAllWindows()
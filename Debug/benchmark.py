@@ -0,0 +1,1905 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the H.265 debug tools
+Run `python benchmark.py <name> -h` for the options of each benchmark
+"""
+
+import argparse
+import gc
+import multiprocessing
+import os
+import queue
+import socket
+import statistics
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+
+from replay import make_rtp_packet, packetize_nal
+
+
+def split_access_units(data):
+    """Group the NAL units of an Annex-B stream into access units (Annex-B bytes each)"""
+    from access_unit import AccessUnitAssembler, split_nal_units
+
+    assembler = AccessUnitAssembler()
+    access_units = []
+    for nal in split_nal_units(data):
+        access_units.extend(au.join() for au in assembler.push([nal]))
+    access_units.extend(au.join() for au in assembler.flush())
+    return access_units
+
+
+def synthetic_hevc(width, height, frames, fps=30):
+    """Encode a moving test pattern with libx265 and return its access units (Annex-B bytes each)"""
+    from fractions import Fraction
+    import av
+    import numpy as np
+
+    encoder = av.CodecContext.create('libx265', 'w')
+    encoder.width = width
+    encoder.height = height
+    encoder.pix_fmt = 'yuv420p'
+    encoder.time_base = Fraction(1, fps)
+    encoder.options = {'preset': 'ultrafast', 'x265-params': 'log-level=error'}
+    columns = np.arange(width, dtype=np.uint16)
+    rows = np.arange(height, dtype=np.uint16)[:, None]
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    access_units = []
+    for index in range(frames):
+        image[:, :, 0] = (columns + index * 8) & 0xFF
+        image[:, :, 1] = (rows + index * 4) & 0xFF
+        image[:, :, 2] = ((columns + rows) >> 2) & 0xFF
+        frame = av.VideoFrame.from_ndarray(image, format='bgr24').reformat(format='yuv420p')
+        frame.pts = index
+        access_units.extend(bytes(packet) for packet in encoder.encode(frame))
+    access_units.extend(bytes(packet) for packet in encoder.encode(None))
+    return access_units
+
+
+def _bench_inputs(args):
+    """[(label, access units)] for --input and each --synthetic WxH"""
+    inputs = []
+    if args.input:
+        with open(args.input, 'rb') as f:
+            inputs.append((args.input, split_access_units(f.read())))
+    for size in args.synthetic:
+        width, height = (int(v) for v in size.lower().split('x'))
+        print(f"Encoding {args.frames} synthetic {width}x{height} frames with libx265...")
+        inputs.append((f"{width}x{height}", synthetic_hevc(width, height, args.frames)))
+    return inputs
+
+
+def _blast_udp(port, count, payload_size):
+    """Sender process: send count RTP packets to localhost as fast as possible"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    payload = bytes([0x62, 0x01, 0x01]) + bytes(payload_size - 3)  # FU continuation
+    packets = [make_rtp_packet(seq, seq // 100 * 3000, 0x12345678, payload)
+               for seq in range(1024)]
+    for i in range(count):
+        sock.sendto(packets[i & 1023], ('127.0.0.1', port))
+    sock.close()
+
+
+def _drain(q, running):
+    while running.is_set():
+        try:
+            q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+
+
+def _run_ingest(port, count, payload_size, batch_size):
+    from h265_receiver import H265StreamReceiver
+
+    receiver = H265StreamReceiver(port=port, batch_size=batch_size)
+    receiver.bind()
+    receiver.running = True
+    target = receiver.receive_packets_batched if batch_size > 0 else receiver.receive_packets
+    running = threading.Event()
+    running.set()
+    threads = [threading.Thread(target=target, daemon=True),
+               threading.Thread(target=_drain, args=(receiver.packet_queue, running), daemon=True)]
+    for t in threads:
+        t.start()
+
+    sender = multiprocessing.Process(target=_blast_udp, args=(port, count, payload_size))
+    start = time.perf_counter()
+    sender.start()
+    sender.join()
+
+    # Wait until the receiver stops making progress
+    last = -1
+    while True:
+        time.sleep(0.2)
+        received = receiver.packets_received
+        if received == last or received >= count:
+            break
+        last = received
+    elapsed = time.perf_counter() - start
+
+    receiver.running = False
+    running.clear()
+    for t in threads:
+        t.join()
+    receiver.socket.close()
+    return received, elapsed
+
+
+def bench_ingest(args):
+    """Loopback throughput of receive_packets vs receive_packets_batched"""
+    print(f"Sending {args.count:,} packets of {args.size} bytes per run to 127.0.0.1:{args.port}\n")
+    print(f"{'mode':<20}{'received':>12}{'loss %':>10}{'pkt/s':>14}{'MB/s':>10}")
+    for batch_size in [0] + args.batch:
+        name = 'recvfrom' if batch_size == 0 else f'batched x{batch_size}'
+        received, elapsed = _run_ingest(args.port, args.count, args.size, batch_size)
+        loss = (1 - received / args.count) * 100
+        rate = received / elapsed
+        print(f"{name:<20}{received:>12,}{loss:>10.2f}{rate:>14,.0f}"
+              f"{rate * (args.size + 12) / 1e6:>10.1f}")
+
+
+class _LegacyRTPPacket:
+    """RTPPacket as it was before rtp.py, kept as the baseline for bench_parse"""
+    def __init__(self, data):
+        self.data = data
+        self.parse()
+
+    def parse(self):
+        if len(self.data) < 12:
+            raise ValueError("Invalid RTP packet size")
+        byte0 = self.data[0]
+        self.version = (byte0 >> 6) & 0x03
+        self.padding = (byte0 >> 5) & 0x01
+        self.extension = (byte0 >> 4) & 0x01
+        self.cc = byte0 & 0x0F
+        byte1 = self.data[1]
+        self.marker = (byte1 >> 7) & 0x01
+        self.payload_type = byte1 & 0x7F
+        self.sequence = struct.unpack('!H', self.data[2:4])[0]
+        self.timestamp = struct.unpack('!I', self.data[4:8])[0]
+        self.ssrc = struct.unpack('!I', self.data[8:12])[0]
+        self.header_size = 12 + (self.cc * 4)
+        if self.extension:
+            ext_header_start = self.header_size
+            if ext_header_start + 4 <= len(self.data):
+                ext_length = struct.unpack('!H', self.data[ext_header_start+2:ext_header_start+4])[0]
+                self.header_size += 4 + (ext_length * 4)
+        self.payload = self.data[self.header_size:]
+
+
+def _measure_parse(cls, datagrams):
+    """Return (usec per parse, blocks retained per packet, bytes retained per packet)"""
+    for data in datagrams[:1000]:
+        cls(data)
+
+    start = time.perf_counter()
+    for data in datagrams:
+        cls(data)
+    usec = (time.perf_counter() - start) / len(datagrams) * 1e6
+
+    # Keep the parsed packets alive, as packet_queue does, and count what they hold
+    gc.collect()
+    gc.disable()
+    tracemalloc.start()
+    blocks_before = sys.getallocatedblocks()
+    mem_before = tracemalloc.get_traced_memory()[0]
+    packets = [cls(data) for data in datagrams]
+    mem_after = tracemalloc.get_traced_memory()[0]
+    blocks_after = sys.getallocatedblocks()
+    tracemalloc.stop()
+    gc.enable()
+    count = len(packets)
+    # The list holding the packets is not part of the per-packet cost
+    list_bytes = sys.getsizeof(packets)
+    del packets
+    return usec, (blocks_after - blocks_before - 1) / count, (mem_after - mem_before - list_bytes) / count
+
+
+def bench_parse(args):
+    """RTPPacket parse cost: rtp.RTPPacket vs the legacy per-field parser"""
+    from rtp import RTPPacket
+
+    payload = bytes([0x62, 0x01, 0x01]) + bytes(args.size - 3)
+    datagrams = [make_rtp_packet(seq, seq * 30, 0x12345678, payload) for seq in range(args.count)]
+    views = [memoryview(d) for d in datagrams]
+
+    print(f"{args.count:,} packets, {args.size}-byte payload\n")
+    print(f"{'parser':<28}{'usec/pkt':>10}{'blocks/pkt':>12}{'bytes/pkt':>12}")
+    results = [
+        ('legacy (bytes)', _measure_parse(_LegacyRTPPacket, datagrams)),
+        ('rtp.RTPPacket (bytes)', _measure_parse(RTPPacket, datagrams)),
+        ('rtp.RTPPacket (memoryview)', _measure_parse(RTPPacket, views)),
+    ]
+    for name, (usec, blocks, nbytes) in results:
+        print(f"{name:<28}{usec:>10.3f}{blocks:>12.1f}{nbytes:>12.0f}")
+
+
+class _LegacyFUReassembler:
+    """handle_fu as it was before depacketizer.py, kept as the baseline for bench_reassembly"""
+    def __init__(self):
+        self.fragments = {}
+
+    def handle_fu(self, packet):
+        fu_header = packet.payload[2]
+        start_bit = (fu_header >> 7) & 0x01
+        end_bit = (fu_header >> 6) & 0x01
+        fu_type = fu_header & 0x3F
+        nal_header = struct.unpack('!H', packet.payload[0:2])[0]
+        nal_header = (nal_header & 0x81FF) | (fu_type << 9)
+        if start_bit:
+            key = (packet.ssrc, packet.timestamp, packet.sequence)
+            self.fragments[key] = {
+                'data': struct.pack('!H', nal_header) + packet.payload[3:],
+                'last_seq': packet.sequence,
+                'timestamp': time.time()
+            }
+            return None
+        candidates = [(k, v) for k, v in self.fragments.items()
+                      if k[0] == packet.ssrc and k[1] == packet.timestamp]
+        if not candidates:
+            return None
+        key, state = min(candidates, key=lambda kv: abs(packet.sequence - kv[1]['last_seq'] - 1))
+        state['data'] += packet.payload[3:]
+        state['last_seq'] = packet.sequence
+        state['timestamp'] = time.time()
+        if end_bit:
+            nal_data = state['data']
+            del self.fragments[key]
+            return b'\x00\x00\x00\x01' + nal_data
+        return None
+
+    process_packet = handle_fu
+
+
+def _time_reassembly(reassembler, packets, repeat):
+    best = None
+    for _ in range(repeat):
+        instance = reassembler()
+        start = time.perf_counter()
+        for packet in packets:
+            nal = instance.process_packet(packet)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, nal
+
+
+def bench_reassembly(args):
+    """FU reassembly time against NAL size: chunk list vs legacy bytes +="""
+    from rtp import RTPPacket
+    from depacketizer import H265RTPDepacketizer
+
+    print(f"{'NAL size':>10}{'FUs':>7}{'legacy ms':>12}{'chunked ms':>12}{'chunked MB/s':>14}")
+    for scale in args.scales:
+        size = int(args.size * scale)
+        # IDR_W_RADL NAL header followed by pseudo-random slice data
+        nal = bytes([19 << 1, 0x01]) + bytes(range(256)) * (size // 256)
+        packets = [RTPPacket(p) for p in packetize_nal(nal, 0, 0, 0x12345678)]
+
+        legacy_time, legacy_nal = _time_reassembly(_LegacyFUReassembler, packets, args.repeat)
+        chunked_time, chunked_nal = _time_reassembly(H265RTPDepacketizer, packets, args.repeat)
+        assert legacy_nal == chunked_nal == b'\x00\x00\x00\x01' + nal
+        print(f"{len(nal):>10,}{len(packets):>7}{legacy_time * 1e3:>12.2f}{chunked_time * 1e3:>12.2f}"
+              f"{len(nal) / chunked_time / 1e6:>14.0f}")
+
+
+def _scapy_rtp_payloads(path, port):
+    from scapy.all import rdpcap, UDP
+    count = 0
+    for pkt in rdpcap(path):
+        if pkt.haslayer(UDP) and (pkt[UDP].dport == port or pkt[UDP].sport == port):
+            count += len(bytes(pkt[UDP].payload))
+    return count
+
+
+def _streaming_rtp_payloads(path, port):
+    from pcap_reader import PcapReader
+    count = 0
+    with PcapReader(path) as reader:
+        for datagram in reader.udp_datagrams(port):
+            count += len(datagram.payload)
+    return count
+
+
+def _measure_reader(func, path, port, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        payload_bytes = func(path, port)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    func(path, port)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, payload_bytes
+
+
+def bench_pcap(args):
+    """UDP payload extraction from captures: scapy rdpcap vs pcap_reader"""
+    try:
+        import scapy.all  # noqa: F401
+        have_scapy = True
+    except ImportError:
+        print("scapy is not installed; only pcap_reader is measured\n")
+        have_scapy = False
+
+    print(f"{'capture':<20}{'reader':<10}{'ms':>10}{'peak KB':>10}{'speedup':>10}")
+    for path in args.files:
+        fast, fast_peak, fast_bytes = _measure_reader(_streaming_rtp_payloads, path, args.port, args.repeat)
+        name = path.rsplit('/', 1)[-1]
+        if have_scapy:
+            slow, slow_peak, slow_bytes = _measure_reader(_scapy_rtp_payloads, path, args.port, 1)
+            assert slow_bytes == fast_bytes
+            print(f"{name:<20}{'scapy':<10}{slow * 1e3:>10.1f}{slow_peak / 1024:>10.0f}")
+            print(f"{'':<20}{'streaming':<10}{fast * 1e3:>10.1f}{fast_peak / 1024:>10.0f}{slow / fast:>9.0f}x")
+        else:
+            print(f"{name:<20}{'streaming':<10}{fast * 1e3:>10.1f}{fast_peak / 1024:>10.0f}")
+
+
+class _LegacyFrameBuffer:
+    """H265Decoder's access unit handling before access_unit.py: Annex-B bytes
+    from the depacketizer appended with frame_buffer += until the marker bit"""
+    def __init__(self):
+        self.frame_buffer = b''
+        self.bytes_copied = 0
+
+    def push(self, depacketizer, packet):
+        nal_data = depacketizer.process_packet(packet)
+        if not nal_data:
+            return None
+        self.bytes_copied += len(nal_data)  # start code prefix / FU join
+        self.frame_buffer += nal_data
+        self.bytes_copied += len(self.frame_buffer)
+        if not packet.marker:
+            return None
+        frame, self.frame_buffer = self.frame_buffer, b''
+        self.bytes_copied += len(frame)  # av.Packet(bytes)
+        return frame
+
+
+def _assemble_legacy(packets, av):
+    from depacketizer import H265RTPDepacketizer
+
+    depacketizer = H265RTPDepacketizer()
+    legacy = _LegacyFrameBuffer()
+    frames = []
+    for packet in packets:
+        frame = legacy.push(depacketizer, packet)
+        if frame is not None:
+            frames.append(av.Packet(frame))
+    return frames, legacy.bytes_copied
+
+
+def _assemble_chunked(packets, av):
+    from access_unit import AccessUnitAssembler
+    from depacketizer import H265RTPDepacketizer
+
+    depacketizer = H265RTPDepacketizer()
+    assembler = AccessUnitAssembler()
+    frames = []
+    for packet in packets:
+        nal_units = depacketizer.depacketize(packet)
+        if nal_units:
+            for access_unit in assembler.push_packet(nal_units, packet.timestamp, packet.marker):
+                frames.append(av.Packet(access_unit.join()))
+                assembler.stats['bytes_copied'] += access_unit.size  # av.Packet(bytes)
+    return frames, assembler.stats['bytes_copied']
+
+
+def bench_assembly(args):
+    """Access unit assembly up to av.Packet: frame_buffer += vs AccessUnitAssembler"""
+    import av
+    from rtp import RTPPacket
+    from access_unit import split_nal_units
+
+    with open(args.input, 'rb') as f:
+        access_units = split_access_units(f.read())
+    packets = []
+    sequence = 0
+    for index, au in enumerate(access_units):
+        nals = split_nal_units(au)
+        for i, nal in enumerate(nals):
+            for data in packetize_nal(nal, sequence, index * 3000, 0x12345678, marker=i == len(nals) - 1):
+                packets.append(RTPPacket(data))
+                sequence += 1
+    au_bytes = sum(len(au) for au in access_units) / len(access_units)
+    print(f"{len(access_units)} access units, {len(packets)} packets from {args.input}, "
+          f"{au_bytes:,.0f} bytes per access unit\n")
+    print(f"{'method':<12}{'us/frame':>10}{'copied/frame':>14}{'x AU size':>11}")
+
+    expected = None
+    for name, assemble in (('legacy', _assemble_legacy), ('assembler', _assemble_chunked)):
+        best = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            frames, copied = assemble(packets, av)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        payloads = [bytes(frame) for frame in frames]
+        expected = expected or payloads
+        assert payloads == expected == access_units
+        per_frame = copied / len(frames)
+        print(f"{name:<12}{best / len(frames) * 1e6:>10.1f}{per_frame:>14,.0f}{per_frame / au_bytes:>11.2f}")
+
+
+def bench_output(args):
+    """Per-stage CPU time per frame of the decoded frame output modes"""
+    import av
+    from frame_output import DecodedFrame, preview_size
+
+    inputs = _bench_inputs(args)
+    print(f"\nms per frame, best of {args.repeat}; preview = downscaled to {args.preview_width} px wide\n")
+    print(f"{'input':<16}{'decode':>8}{'bgr':>8}{'preview':>9}{'yuv':>8}"
+          f"{'eager':>8}{'lazy':>8}{'lazy+pv':>9}{'yuv':>8}")
+
+    for label, access_units in inputs:
+        best = {}
+        for _ in range(args.repeat):
+            codec = av.CodecContext.create('hevc', 'r')
+            start = time.perf_counter()
+            frames = [frame for au in access_units for frame in codec.decode(av.Packet(au))]
+            frames.extend(codec.decode(None))
+            times = {'decode': time.perf_counter() - start}
+
+            for stage in ('bgr', 'preview', 'yuv'):
+                start = time.perf_counter()
+                for frame in frames:
+                    decoded = DecodedFrame(frame)
+                    if stage == 'bgr':
+                        decoded.to_bgr()
+                    elif stage == 'preview':
+                        decoded.to_bgr(*preview_size(decoded.width, decoded.height, args.preview_width))
+                    else:
+                        decoded.planes()
+                times[stage] = time.perf_counter() - start
+            for stage, elapsed in times.items():
+                best[stage] = min(best.get(stage, elapsed), elapsed)
+
+        ms = {stage: elapsed * 1e3 / len(frames) for stage, elapsed in best.items()}
+        # Frame CPU cost when only a share of the frames is displayed (the rest is dropped)
+        shown = args.display_share
+        eager = ms['decode'] + ms['bgr']
+        lazy = ms['decode'] + ms['bgr'] * shown
+        lazy_preview = ms['decode'] + ms['preview'] * shown
+        yuv = ms['decode'] + ms['yuv'] * shown
+        print(f"{label:<16}{ms['decode']:>8.2f}{ms['bgr']:>8.2f}{ms['preview']:>9.2f}{ms['yuv']:>8.3f}"
+              f"{eager:>8.2f}{lazy:>8.2f}{lazy_preview:>9.2f}{yuv:>8.2f}")
+    print(f"\neager/lazy/lazy+pv/yuv: decode + conversion with {args.display_share:.0%} of the frames displayed")
+
+
+DECODER_CONFIGS = [
+    ('default (slice, auto threads)', {}),
+    ('1 thread', {'threads': 1}),
+    ('frame x2', {'threads': 2, 'thread_type': 'frame'}),
+    ('frame x4', {'threads': 4, 'thread_type': 'frame'}),
+    ('frame auto', {'thread_type': 'frame'}),
+    ('slice x4', {'threads': 4, 'thread_type': 'slice'}),
+    ('low delay', {'low_delay': True}),
+    ('frame x4 + low delay', {'threads': 4, 'thread_type': 'frame', 'low_delay': True}),
+    ('skip loop filter all', {'skip_loop_filter': 'all'}),
+    ('skip loop filter noref', {'skip_loop_filter': 'noref'}),
+]
+
+
+def _measure_decoder(options, access_units, skip_frame=None, pace=0.0):
+    """Decode access_units, paced at pace fps (0: as fast as possible).
+
+    Returns (access units per second, latencies in ms, held-back access units
+    per frame), where latency runs from handing an access unit to the decoder
+    to getting its picture back, and the hold-back is how many later access
+    units the decoder had taken when it returned the picture (reordering
+    and frame threading both add to it)."""
+    import av
+
+    codec = options.create_codec()
+    if skip_frame:
+        codec.skip_frame = skip_frame
+    submitted = []
+    latencies = []
+    held = []
+    start = time.perf_counter()
+    for index, au in enumerate(access_units):
+        if pace:
+            delay = start + index / pace - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        packet = av.Packet(au)
+        # pts carries the access unit index through reordering and skipping
+        packet.pts = index
+        submitted.append(time.perf_counter())
+        for frame in codec.decode(packet):
+            latencies.append(time.perf_counter() - submitted[frame.pts])
+            held.append(index - frame.pts)
+    # Frames still held back by the decoder only come out when it is flushed
+    for frame in codec.decode(None):
+        latencies.append(time.perf_counter() - submitted[frame.pts])
+        held.append(len(access_units) - 1 - frame.pts)
+    elapsed = time.perf_counter() - start
+    return len(access_units) / elapsed, [l * 1e3 for l in latencies], held
+
+
+def bench_decoder(args):
+    """Throughput and latency of each decoder threading / speed setting"""
+    from decoder_options import DecoderOptions
+
+    inputs = _bench_inputs(args)
+    configs = [(name, DecoderOptions(**kwargs), None) for name, kwargs in DECODER_CONFIGS]
+    configs.append(('skip_frame nonref', DecoderOptions(), 'NONREF'))
+    configs.append(('skip_frame nonkey', DecoderOptions(), 'NONKEY'))
+
+    pacing = f"paced at {args.pace:g} fps" if args.pace else "as fast as possible"
+    for label, access_units in inputs:
+        print(f"\n{label}: {len(access_units)} access units {pacing}, {os.cpu_count()} CPUs, "
+              f"best of {args.repeat}")
+        print(f"{'setting':<32}{'AU/s':>8}{'frames':>8}{'held':>6}{'lat avg':>9}{'p95':>8}{'max':>8}  ms")
+        for name, options, skip_frame in configs:
+            best = None
+            for _ in range(args.repeat):
+                result = _measure_decoder(options, access_units, skip_frame, args.pace)
+                if best is None or result[0] > best[0]:
+                    best = result
+            rate, latencies, held = best
+            latencies.sort()
+            frames = len(latencies)
+            p95 = latencies[int(frames * 0.95)] if frames else 0.0
+            average = sum(latencies) / frames if frames else 0.0
+            held_average = sum(held) / frames if frames else 0.0
+            print(f"{name:<32}{rate:>8.1f}{frames:>8}{held_average:>6.1f}{average:>9.2f}{p95:>8.2f}"
+                  f"{(latencies[-1] if frames else 0.0):>8.2f}")
+
+
+def _consume_frames(pool, expected, counter, done):
+    while counter[0] < expected and not done.is_set():
+        frame = pool.get_frame(timeout=0.1)
+        if frame is not None:
+            frame.release()
+            counter[0] += 1
+
+
+def bench_decode_pool(args):
+    """Decoded frames per second of DecodePool against worker count"""
+    from decode_pool import DecodePool
+
+    with open(args.input, 'rb') as f:
+        access_units = split_access_units(f.read())
+    per_stream = access_units * args.loops
+    expected = len(per_stream) * args.streams
+    print(f"{args.streams} streams x {len(per_stream)} access units from {args.input}, "
+          f"{os.cpu_count()} CPUs\n")
+    print(f"{'workers':>8}{'frames':>9}{'sec':>8}{'fps':>9}{'scaling':>9}  worker CPU s")
+
+    base_fps = None
+    for workers in args.workers:
+        pool = DecodePool(workers=workers, slots_per_worker=8)
+        pool.start()
+        counter = [0]
+        done = threading.Event()
+        consumer = threading.Thread(target=_consume_frames, args=(pool, expected, counter, done))
+        start = time.perf_counter()
+        consumer.start()
+        for au in per_stream:
+            for stream in range(args.streams):
+                pool.submit(stream, au, block=True)
+        for stream in range(args.streams):
+            pool.close_stream(stream)
+        consumer.join(timeout=600)
+        elapsed = time.perf_counter() - start
+        done.set()
+        cpu = ' '.join(f"{w['cpu_time']:.1f}" for w in pool.worker_stats())
+        lost = pool.stats['frames_dropped']
+        pool.stop()
+
+        fps = counter[0] / elapsed
+        base_fps = base_fps or fps
+        note = f"  ({lost} dropped)" if lost else ''
+        print(f"{workers:>8}{counter[0]:>9}{elapsed:>8.2f}{fps:>9.1f}{fps / base_fps:>8.2f}x  {cpu}{note}")
+
+
+def _replay_capture(port, path, capture_port, speed, sent):
+    """Sender process: replay the RTP packets of a capture to localhost paced by
+    their RTP timestamps, and report when the last packet of each picture left"""
+    from replay import build_streams, load_datagrams, send
+
+    schedule, _ = build_streams(load_datagrams(path, capture_port))
+    send_times, _ = send(schedule, port=port, speed=speed)
+    sent.put(send_times)
+
+
+def _frame_latencies(send_times, received):
+    """Milliseconds from the last packet of an access unit to its frame reaching
+    the consumer; send_times and received are keyed by (SSRC, RTP timestamp)"""
+    return sorted((arrival - send_times[key]) * 1000.0
+                  for key, arrival in received if key in send_times)
+
+
+def _run_threaded_engine(args, sent):
+    from h265_receiver import H265StreamReceiver
+
+    receiver = H265StreamReceiver(port=args.port, output='lazy', display_mode='fifo')
+    receiver.bind()
+    receiver.running = True
+    received = []
+
+    def consume():
+        while receiver.running:
+            try:
+                key, frame = receiver.presenter.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            received.append(((key.ssrc, frame.timestamp), time.time()))
+
+    threads = [threading.Thread(target=receiver.receive_packets, daemon=True),
+               threading.Thread(target=receiver.process_packets, daemon=True),
+               threading.Thread(target=consume, daemon=True)]
+    for t in threads:
+        t.start()
+
+    cpu = time.process_time()
+    time.sleep(args.idle)
+    idle_cpu = time.process_time() - cpu
+
+    sender = multiprocessing.Process(target=_replay_capture,
+                                     args=(args.port, args.input, args.capture_port, args.speed, sent))
+    cpu = time.process_time()
+    sender.start()
+    send_times = sent.get()
+    sender.join()
+    time.sleep(0.5)
+    busy_cpu = time.process_time() - cpu
+
+    receiver.running = False
+    for t in threads:
+        t.join()
+    receiver.socket.close()
+    return idle_cpu, busy_cpu, _frame_latencies(send_times, received)
+
+
+async def _run_async_engine(args, sent):
+    import asyncio
+    from async_receiver import AsyncH265Receiver
+
+    receiver = AsyncH265Receiver(port=args.port, output='lazy')
+    await receiver.start()
+    received = []
+
+    async def consume():
+        async for key, frame in receiver.frames():
+            received.append(((key.ssrc, frame.timestamp), time.time()))
+
+    consumer = asyncio.ensure_future(consume())
+    cpu = time.process_time()
+    await asyncio.sleep(args.idle)
+    idle_cpu = time.process_time() - cpu
+
+    loop = asyncio.get_running_loop()
+    sender = multiprocessing.Process(target=_replay_capture,
+                                     args=(args.port, args.input, args.capture_port, args.speed, sent))
+    cpu = time.process_time()
+    sender.start()
+    send_times = await loop.run_in_executor(None, sent.get)
+    await loop.run_in_executor(None, sender.join)
+    await asyncio.sleep(0.5)
+    busy_cpu = time.process_time() - cpu
+
+    consumer.cancel()
+    await receiver.close()
+    return idle_cpu, busy_cpu, _frame_latencies(send_times, received)
+
+
+def bench_engine(args):
+    """Idle CPU and frame latency of the threaded and asyncio receiver engines"""
+    import asyncio
+
+    print(f"Replaying {args.input} (port {args.capture_port}) at {args.speed}x to 127.0.0.1:{args.port}, "
+          f"{args.idle:.0f} s idle first\n")
+    print(f"{'engine':<10}{'idle CPU %':>12}{'busy CPU s':>12}{'frames':>8}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'max ms':>9}")
+    sent = multiprocessing.Queue()
+    for engine in args.engines:
+        if engine == 'threads':
+            idle_cpu, busy_cpu, latencies = _run_threaded_engine(args, sent)
+        else:
+            idle_cpu, busy_cpu, latencies = asyncio.run(_run_async_engine(args, sent))
+        if latencies:
+            p50 = latencies[len(latencies) // 2]
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            worst = latencies[-1]
+        else:
+            p50 = p95 = worst = float('nan')
+        print(f"{engine:<10}{idle_cpu / args.idle * 100:>12.2f}{busy_cpu:>12.2f}{len(latencies):>8}"
+              f"{p50:>9.1f}{p95:>9.1f}{worst:>9.1f}")
+    print("\nLatency: last packet of an access unit sent -> frame handed to the consumer "
+          "(includes any frames the decoder holds back for reordering)")
+
+
+class _DiscardPool:
+    """Stands in for DecodePool so the packet path can be timed without decoding"""
+
+    def submit(self, stream_id, access_unit, block=False):
+        return True
+
+
+def _repeat_capture(datagrams, loops):
+    """The capture loops times over, with sequence numbers and RTP timestamps
+    continuing across the repeats so the receiver sees one long stream"""
+    first_ts = struct.unpack_from('!I', datagrams[0][0], 4)[0]
+    last_ts = struct.unpack_from('!I', datagrams[-1][0], 4)[0]
+    span = (last_ts - first_ts + 3000) & 0xFFFFFFFF
+    repeated = []
+    for loop in range(loops):
+        for data, addr in datagrams:
+            sequence, timestamp = struct.unpack_from('!HI', data, 2)
+            header = struct.pack('!HI', (sequence + loop * len(datagrams)) & 0xFFFF,
+                                 (timestamp + loop * span) & 0xFFFFFFFF)
+            repeated.append((data[:2] + header + data[8:], addr))
+    return repeated
+
+
+def _replay_receiver(datagrams, enabled, stage):
+    """CPU seconds for one H265StreamReceiver to take datagrams from
+    handle_datagram through the packet queue, and for stage 'packet' / 'decode'
+    on through dispatch to discarded access units / decoded frames"""
+    from h265_receiver import H265StreamReceiver
+    from metrics import MetricsRegistry
+
+    receiver = H265StreamReceiver(metrics=MetricsRegistry(enabled=enabled), display_mode='fifo')
+    if stage == 'packet':
+        receiver.decode_pool = _DiscardPool()
+    packet_queue = receiver.packet_queue
+    presenter = receiver.presenter
+    gc.collect()
+    # CPU time: less disturbed by other load than wall time, and it includes
+    # the decoder's own threads
+    start = time.process_time()
+    for data, addr in datagrams:
+        receiver.handle_datagram(data, addr)
+        arrival, addr, packet = packet_queue.get_nowait()
+        if stage != 'receive':
+            receiver.dispatch(arrival, addr, packet, time.time())
+            while not presenter.empty():
+                presenter.get_nowait()
+    return time.process_time() - start
+
+
+def bench_metrics(args):
+    """Cost of the metrics (counters, stage histograms, RTP delay) on the receive path"""
+    import timeit
+    from metrics import MetricsRegistry
+    from pcap_reader import PcapReader
+
+    with PcapReader(args.input) as reader:
+        datagrams = [(bytes(d.payload), (d.src, d.sport)) for d in reader.udp_datagrams(args.capture_port)]
+    print(f"{len(datagrams)} packets from {args.input}, {args.repeat} off/on run pairs per path\n")
+
+    registry = MetricsRegistry()
+    counter = registry.counter('bench_total', 'benchmark counter')
+    histogram = registry.histogram('bench_seconds', 'benchmark histogram')
+    number = 200000
+    inc_ns = timeit.timeit(counter.inc, number=number) / number * 1e9
+    record_ns = timeit.timeit(lambda: histogram.record(0.0012), number=number) / number * 1e9
+    print(f"Counter.inc {inc_ns:.0f} ns, Histogram.record {record_ns:.0f} ns (incl. call overhead)\n")
+
+    print(f"{'path (CPU time)':<36}{'packets':>9}{'off us/pkt':>12}{'on us/pkt':>12}{'overhead':>10}")
+    for name, stage, loops in (('receive (parse + queue)', 'receive', args.loops),
+                               ('+ jitter buffer, depacketize, AUs', 'packet', args.loops),
+                               ('+ decode', 'decode', args.decode_loops)):
+        packets = _repeat_capture(datagrams, loops)
+        _replay_receiver(packets[:100], True, stage)  # imports and first-use costs
+        times = {False: [], True: []}
+        ratios = []
+        for run in range(args.repeat):
+            # Back-to-back pairs in alternating order: the median of the pair
+            # ratios is robust against load that drifts between runs
+            pair = {}
+            for enabled in ((False, True) if run % 2 == 0 else (True, False)):
+                pair[enabled] = _replay_receiver(packets, enabled, stage)
+                times[enabled].append(pair[enabled])
+            ratios.append(pair[True] / pair[False])
+        off = statistics.median(times[False]) / len(packets) * 1e6
+        on = statistics.median(times[True]) / len(packets) * 1e6
+        overhead = (statistics.median(ratios) - 1) * 100
+        print(f"{name:<36}{len(packets):>9}{off:>12.2f}{on:>12.2f}{overhead:>9.2f}%")
+    print("\nus/pkt: median run; overhead: median of the on/off ratios of back-to-back runs")
+
+
+def _multi_stream_capture(datagrams, streams, loops):
+    """The capture repeated loops times by each of streams senders (own SSRC and
+    source port), with the packets of the senders interleaved"""
+    repeated = _repeat_capture(datagrams, loops)
+    senders = []
+    for index in range(streams):
+        ssrc = struct.pack('!I', 0x5E000000 + index)
+        addr = ('127.0.0.1', 40000 + index)
+        senders.append([(data[:8] + ssrc + data[12:], addr) for data, _ in repeated])
+    return [item for packets in zip(*senders) for item in packets]
+
+
+def _record_pass(datagrams, streams, record):
+    """CPU seconds for one H265StreamReceiver to take datagrams to files (record)
+    or to decoded BGR frames (record=None), and the receiver"""
+    from h265_receiver import H265StreamReceiver
+    from metrics import MetricsRegistry
+
+    receiver = H265StreamReceiver(jitter_delay_ms=0, max_streams=streams,
+                                  metrics=MetricsRegistry(enabled=False), record=record, display_mode='fifo')
+    packet_queue = receiver.packet_queue
+    presenter = receiver.presenter
+    gc.collect()
+    start = time.process_time()
+    for data, addr in datagrams:
+        receiver.handle_datagram(data, addr)
+        arrival, addr, packet = packet_queue.get_nowait()
+        receiver.dispatch(arrival, addr, packet, arrival)
+        while not presenter.empty():
+            # The colour conversion the display does before imshow
+            presenter.get_nowait()[1].to_bgr()
+    for key in list(receiver.recorders):
+        receiver.close_recorder(key)
+    return time.process_time() - start, receiver
+
+
+def bench_record(args):
+    """Headless recording vs decode and display: packets per CPU second and streams per core"""
+    import tempfile
+    from pcap_reader import PcapReader
+    from recorder import RecordOptions
+
+    with PcapReader(args.input) as reader:
+        captured = [(d.timestamp, bytes(d.payload), (d.src, d.sport))
+                    for d in reader.udp_datagrams(args.capture_port)]
+    duration = captured[-1][0] - captured[0][0]
+    stream_rate = len(captured) / duration
+    datagrams = _multi_stream_capture([(data, addr) for _, data, addr in captured], args.streams, args.loops)
+    print(f"{args.input}: {len(captured)} packets in {duration:.1f} s ({stream_rate:.0f} packets/s per stream); "
+          f"{args.streams} streams x {args.loops} loops = {len(datagrams)} packets\n")
+
+    print(f"{'path':<18}{'CPU s':>8}{'packets/s':>11}{'pictures/s':>12}{'streams/core':>14}{'writes':>8}{'MB on disk':>12}")
+    for path in args.paths:
+        with tempfile.TemporaryDirectory() as directory:
+            record = None
+            if path != 'decode':
+                record = RecordOptions(directory, format=path, buffer_size=args.write_buffer * 1024)
+            _record_pass(datagrams[:200], args.streams, record)  # imports and first-use costs
+            best = None
+            for _ in range(args.repeat):
+                for name in os.listdir(directory):
+                    os.remove(os.path.join(directory, name))
+                cpu, receiver = _record_pass(datagrams, args.streams, record)
+                if best is None or cpu < best[0]:
+                    on_disk = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+                    best = (cpu, receiver, on_disk)
+        cpu, receiver, on_disk = best
+        if record is None:
+            pictures = receiver._sum_streams(lambda stream: stream.frames_decoded)
+            writes, label = '-', 'decode + display'
+        else:
+            pictures, writes, label = receiver.recorded['access_units'], receiver.recorded['writes'], f"record {path}"
+            if path != 'annexb':
+                writes = '-'
+        rate = len(datagrams) / cpu
+        print(f"{label:<18}{cpu:>8.2f}{rate:>11.0f}{pictures / cpu:>12.0f}{rate / stream_rate:>14.1f}"
+              f"{writes:>8}{on_disk / 1e6:>12.2f}")
+    print("\nCPU time of the receive, depacketize and output path in one process (best run); "
+          "streams/core: copies of the capture one core keeps up with in real time")
+
+
+
+def _monitor_pass(datagrams, streams, monitor):
+    """CPU seconds for one H265StreamReceiver to take datagrams to BGR frames
+    of every picture (monitor=None), or to keyframe thumbnails and the mosaic
+    the monitor window shows, and the receiver"""
+    from h265_receiver import H265StreamReceiver
+    from metrics import MetricsRegistry
+
+    receiver = H265StreamReceiver(jitter_delay_ms=0, max_streams=streams, metrics=MetricsRegistry(enabled=False),
+                                  display_mode='fifo', monitor=monitor)
+    packet_queue = receiver.packet_queue
+    presenter = receiver.presenter
+    mosaic = receiver.mosaic
+    gc.collect()
+    start = time.process_time()
+    for data, addr in datagrams:
+        receiver.handle_datagram(data, addr)
+        arrival, addr, packet = packet_queue.get_nowait()
+        receiver.dispatch(arrival, addr, packet, arrival)
+        if mosaic is None:
+            while not presenter.empty():
+                presenter.get_nowait()[1].to_bgr()
+        elif mosaic.changed:
+            # Every new thumbnail redraws the mosaic (the window does it at most 10 times a second)
+            mosaic.render()
+    return time.process_time() - start, receiver
+
+
+def bench_monitor(args):
+    """Keyframe-only monitoring vs full decode: CPU per stream and streams per core"""
+    from monitor import MonitorOptions
+    from pcap_reader import PcapReader
+
+    with PcapReader(args.input) as reader:
+        captured = [(d.timestamp, bytes(d.payload), (d.src, d.sport))
+                    for d in reader.udp_datagrams(args.capture_port)]
+    duration = captured[-1][0] - captured[0][0]
+    datagrams = _multi_stream_capture([(data, addr) for _, data, addr in captured], args.streams, args.loops)
+    video = duration * args.loops * args.streams
+    print(f"{args.input}: {len(captured)} packets in {duration:.1f} s; {args.streams} streams x {args.loops} loops "
+          f"= {len(datagrams)} packets, {video:.0f} stream-seconds\n")
+
+    print(f"{'mode':<22}{'CPU s':>8}{'pictures':>10}{'CPU ms/stream-s':>17}{'streams/core':>14}{'vs full':>9}")
+    runs = [('full decode + BGR', None)]
+    for rate in args.keyframe_rates:
+        label = f"keyframes {rate:g}/s" if rate > 0 else 'keyframes, all'
+        runs.append((label, MonitorOptions(keyframe_rate=rate, thumbnail_width=args.thumbnail_width)))
+    full = None
+    for label, monitor in runs:
+        _monitor_pass(datagrams[:200], args.streams, monitor)  # imports and first-use costs
+        cpu, receiver = min((_monitor_pass(datagrams, args.streams, monitor) for _ in range(args.repeat)),
+                            key=lambda result: result[0])
+        pictures = receiver._sum_streams(lambda stream: stream.frames_decoded)
+        if full is None:
+            full = cpu
+        print(f"{label:<22}{cpu:>8.2f}{pictures:>10}{cpu / video * 1000:>17.1f}{video / cpu:>14.1f}"
+              f"{cpu / full * 100:>8.0f}%")
+    print("\nCPU time of the receive, depacketize, decode and output path in one process (best run); "
+          "streams/core: copies of the capture one core keeps up with in real time")
+
+
+def _e2e_sender(port, args, impairment, speed, fast, sent):
+    """Sender process for bench_e2e: replay.py streams, then (send times, send stats)"""
+    from replay import build_streams, load_datagrams, send
+
+    datagrams = load_datagrams(args.input, args.capture_port, args.fps)
+    schedule, impairments = build_streams(datagrams, args.streams, args.loops, impairment, args.seed)
+    send_times, stats = send(schedule, port=port, speed=speed, fast=fast, streams=args.streams)
+    stats['injected_loss'] = sum(i.stats['dropped'] for i in impairments)
+    sent.put((send_times, stats))
+
+
+def _e2e_run(args, impairment, speed, fast):
+    """One replay into a threaded receiver whose consumer converts every frame
+    like the display does. Returns the counters of both ends and the latencies."""
+    from h265_receiver import H265StreamReceiver
+
+    receiver = H265StreamReceiver(port=args.port, batch_size=args.batch, jitter_delay_ms=args.jitter_delay,
+                                  max_streams=max(16, args.streams), output='lazy', display_mode='fifo')
+    receiver.bind()
+    receiver.running = True
+    received = []
+
+    def consume():
+        while receiver.running:
+            try:
+                key, frame = receiver.presenter.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            frame.to_bgr()
+            received.append(((key.ssrc, frame.timestamp), time.time()))
+
+    ingest = receiver.receive_packets_batched if args.batch else receiver.receive_packets
+    threads = [threading.Thread(target=ingest, daemon=True),
+               threading.Thread(target=receiver.process_packets, daemon=True),
+               threading.Thread(target=consume, daemon=True)]
+    for t in threads:
+        t.start()
+
+    sent = multiprocessing.Queue()
+    sender = multiprocessing.Process(target=_e2e_sender, args=(args.port, args, impairment, speed, fast, sent))
+    sender.start()
+    send_times, stats = sent.get()
+    sender.join()
+    # Let the receiver finish what is queued (decoding can lag behind a fast sender)
+    deadline = time.time() + 10.0
+    while time.time() < deadline:
+        before = receiver.packets_processed, len(received)
+        time.sleep(0.5)
+        if (receiver.packets_processed, len(received)) == before and receiver.packet_queue.empty():
+            break
+
+    receiver.running = False
+    for t in threads:
+        t.join()
+    receiver.socket.close()
+    return {
+        'sent': stats['packets'],
+        'rate': stats['rate'],
+        # First packet sent to the last frame at the consumer
+        'seconds': (received[-1][1] if received else time.time()) - stats['started'],
+        'received': receiver.packets_received,
+        'queue_dropped': receiver.packet_queue_dropped.value,
+        'frame_dropped': receiver.presenter.dropped,
+        'decoded': receiver.frames_decoded.value,
+        'displayed': len(received),
+        'latencies': _frame_latencies(send_times, received),
+    }
+
+
+def bench_e2e(args):
+    """Loopback replay into the receiver: sustainable packet rate, frame rate, drops and latency"""
+    from replay import NetworkImpairment, load_datagrams
+
+    impairment = NetworkImpairment(loss=args.loss / 100, burst=args.burst, reorder=args.reorder / 100,
+                                   duplicate=args.duplicate / 100, jitter_ms=args.jitter)
+    datagrams = load_datagrams(args.input, args.capture_port, args.fps)
+    print(f"{args.input}: {len(datagrams)} packets x {args.loops} loops x {args.streams} streams "
+          f"to 127.0.0.1:{args.port}, impairment: {impairment}")
+    print(f"Receiver: jitter buffer {args.jitter_delay} ms, " + (f"batch {args.batch}" if args.batch else 'recvfrom'))
+    print(f"Sustainable: at most {args.tolerance:g}% of the packets lost at the socket or dropped by the "
+          f"receiver and of the frames dropped before the consumer, p99 latency up to {args.max_latency:g} ms\n")
+
+    print(f"{'speed':>6}{'sent/s':>9}{'lost':>7}{'dropped':>9}{'frames':>8}{'fps':>7}{'fr.drop':>9}"
+          f"{'p50 ms':>8}{'p95 ms':>8}{'p99 ms':>8}{'max ms':>8}  ok")
+    best = None
+    runs = [(speed, False) for speed in args.speeds] + ([(0, True)] if args.fast else [])
+    for speed, fast in runs:
+        r = _e2e_run(args, impairment, speed, fast)
+        lost = max(0, r['sent'] - r['received'])
+        dropped = r['queue_dropped']
+        latencies = r['latencies']
+        ok = ((lost + dropped) * 100.0 <= args.tolerance * r['sent']
+              and r['frame_dropped'] * 100.0 <= args.tolerance * max(1, r['decoded'])
+              and bool(latencies) and latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] <= args.max_latency)
+        if ok and (best is None or r['rate'] > best[1]):
+            best = ('fast' if fast else f"{speed:g}x", r['rate'])
+        if latencies:
+            p50, p95, p99 = (latencies[min(len(latencies) - 1, int(len(latencies) * q))] for q in (0.5, 0.95, 0.99))
+            worst = latencies[-1]
+        else:
+            p50 = p95 = p99 = worst = float('nan')
+        label = 'fast' if fast else f"{speed:g}x"
+        print(f"{label:>6}{r['rate']:>9.0f}{lost:>7}{dropped:>9}{r['displayed']:>8}"
+              f"{r['displayed'] / r['seconds']:>7.1f}{r['frame_dropped']:>9}"
+              f"{p50:>8.1f}{p95:>8.1f}{p99:>8.1f}{worst:>8.1f}  {'yes' if ok else 'no'}")
+    if best is None:
+        print("\nNo run was sustainable")
+    else:
+        print(f"\nMaximum sustainable packet rate: {best[1]:.0f} packets/s ({best[0]})")
+    print("lost: sent but never received (socket buffer overflow); dropped: receiver packet queue full; "
+          "fps: frames reaching the consumer per second; latency: last packet of a picture sent "
+          "-> frame at the consumer")
+
+
+def bench_index(args):
+    """NAL indexing speed, seek latency vs decoding from the start, parallel segment decoding"""
+    import mmap
+    import tempfile
+    import numpy as np
+    from access_unit import split_nal_units
+    from decoder_options import DecoderOptions
+    from nal_index import SCAN_METHODS, NalIndex, decode_from, decode_parallel, save_index, scan
+
+    with open(args.input, 'rb') as f:
+        original = f.read()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'replicated.h265')
+        with open(path, 'wb') as f:
+            for _ in range(args.copies):
+                f.write(original)
+        size = os.path.getsize(path)
+        print(f"{args.input} x {args.copies} = {size / 1e6:.1f} MB\n")
+
+        print(f"{'scan':<16}{'s':>8}{'MB/s':>9}{'NAL units':>11}")
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            entries = None
+            for method in sorted(SCAN_METHODS):
+                best = min(_timed(lambda: scan(data, fps=args.fps, method=method)) for _ in range(args.repeat))
+                index = scan(data, fps=args.fps, method=method)
+                assert entries is None or np.array_equal(index, entries)
+                entries = index
+                print(f"{method:<16}{best:>8.3f}{size / best / 1e6:>9.0f}{len(index):>11}")
+            best = min(_timed(lambda: split_nal_units(data)) for _ in range(args.repeat))
+            print(f"{'split_nal_units':<16}{best:>8.3f}{size / best / 1e6:>9.0f}{len(split_nal_units(data)):>11}")
+            save_index(path, entries)
+            del index, entries
+
+        print(f"\n{'seek to':<10}{'from IRAP ms':>14}{'from start ms':>15}")
+        decoder = DecoderOptions(threads=1)
+        with NalIndex(path, fps=args.fps) as index:
+            for fraction in (0.25, 0.5, 0.75):
+                seconds = index.duration * fraction
+                seek = _timed(lambda: decode_from(index, seconds, decoder_options=decoder))
+                # Decoding from the start: seek with no IRAP but the first one
+                linear = _timed(lambda: _decode_through(index, seconds, decoder))
+                print(f"{seconds:<10.2f}{seek * 1000:>14.1f}{linear * 1000:>15.1f}")
+
+        print(f"\n{'processes':<11}{'segments':>9}{'s':>8}{'fps':>9}{'speedup':>9}")
+        baseline = None
+        for workers in args.workers:
+            start = time.perf_counter()
+            results = decode_parallel(path, workers)
+            elapsed = time.perf_counter() - start
+            frames = sum(r[1] for r in results)
+            segments = len(results)
+            baseline = baseline or elapsed
+            print(f"{workers:<11}{segments:>9}{elapsed:>8.2f}{frames / elapsed:>9.1f}{baseline / elapsed:>9.2f}")
+    print(f"\n{os.cpu_count()} CPUs; segments are split at the IRAP nearest to equal byte shares")
+
+
+def _startup_run(schedule, first, cache, lose_parameter_sets):
+    """Join the stream at packet first; returns (seconds of stream time to the
+    first frame or None, FFmpeg messages and decode errors, StartupGate stats)"""
+    import av.logging
+    from demux import StreamKey
+    from h265_receiver import StreamContext
+    from parameter_sets import PARAMETER_SET_TYPES
+    from rtp import RTPPacket
+
+    ssrc = struct.unpack_from('!I', schedule[first][1], 8)[0]
+    context = StreamContext(StreamKey('127.0.0.1', 5004, 5004, ssrc), jitter_delay_ms=0, output='lazy',
+                            parameter_sets=cache)
+    start = schedule[first][0]
+    elapsed = None
+    with av.logging.Capture() as logs:
+        for due, data in schedule[first:]:
+            packet = RTPPacket(data)
+            if lose_parameter_sets:
+                nal_type = (packet.payload[0] >> 1) & 0x3F
+                if nal_type in PARAMETER_SET_TYPES or nal_type == 48:
+                    continue
+                if nal_type == 49 and 16 <= (packet.payload[2] & 0x3F) <= 21:
+                    # Only the parameter sets in front of the first IRAP are lost
+                    lose_parameter_sets = False
+            for _, ready in context.receive(packet, due, due):
+                if context.handle_packet(ready) and elapsed is None:
+                    elapsed = due - start
+            if elapsed is not None:
+                break
+    messages = sum(1 for level, _, _ in logs if level <= av.logging.WARNING) + context.decoder.errors
+    return elapsed, messages, context.startup.stats if context.startup else None
+
+
+def bench_startup(args):
+    """Time to first frame when joining a stream, with and without the parameter-set cache and SDP"""
+    import av.logging
+    from parameter_sets import ParameterSetCache
+    from replay import load_datagrams, rtp_schedule, stream_parameter_sets
+
+    datagrams = load_datagrams(args.input, args.capture_port, args.fps)
+    schedule = rtp_schedule(datagrams)
+    duration = schedule[-1][0]
+    # Join points spread over the first 60% so that an IRAP always follows
+    joins = [int(len(schedule) * 0.6 * i / args.joins) for i in range(args.joins)]
+    sdp = stream_parameter_sets(datagrams)
+    print(f"{args.input}: {len(datagrams)} packets, {duration:.1f} s; {len(joins)} join points\n")
+
+    av.logging.set_level(av.logging.WARNING)
+    print(f"{'scenario':<26}{'receiver':<16}{'first frame ms':>15}{'max ms':>8}{'FFmpeg msgs':>12}"
+          f"{'dropped':>9}{'no frame':>9}")
+    try:
+        for scenario, lose in (('join', False), ('join, parameter sets lost', True)):
+            for variant in ('no gate', 'cache', 'cache + SDP'):
+                times, messages, dropped, missed = [], 0, 0, 0
+                for first in joins:
+                    cache = None
+                    if variant != 'no gate':
+                        cache = ParameterSetCache()
+                        if variant == 'cache + SDP':
+                            cache.seed(sdp)
+                    elapsed, count, stats = _startup_run(schedule, first, cache, lose)
+                    messages += count
+                    if stats:
+                        dropped += stats['dropped_leading'] + stats['dropped_rasl']
+                    if elapsed is None:
+                        missed += 1
+                    else:
+                        times.append(elapsed * 1000)
+                mean = statistics.mean(times) if times else float('nan')
+                worst = max(times) if times else float('nan')
+                print(f"{scenario:<26}{variant:<16}{mean:>15.0f}{worst:>8.0f}{messages / len(joins):>12.1f}"
+                      f"{dropped / len(joins):>9.1f}{missed:>9}")
+    finally:
+        av.logging.set_level(None)
+    print("\nStream time from the first packet to the first decoded frame (mean over the join points); "
+          "FFmpeg msgs: warnings/errors logged per join; dropped: access units the gate kept from the decoder")
+
+
+def _feedback_sender(port, args, loss, sent):
+    """Sender process for bench_feedback: live_sender.py, then (frame send times, sender stats)"""
+    from live_sender import LiveSender
+
+    width, height = (int(v) for v in args.size.split('x'))
+    sender = LiveSender('127.0.0.1', port, width, height, args.fps, args.keyframe_interval, loss,
+                        seed=args.seed)
+    try:
+        sender.run(args.seconds)
+    finally:
+        sender.close()
+    sent.put((sender.frame_times, sender.stats))
+
+
+def _feedback_run(args, loss, nack, keyframe_request):
+    """One live stream into a threaded receiver with the given RTCP feedback.
+    Returns the sender stats, the receiver's stream feedback stats and the
+    RTP timestamps sent and displayed."""
+    from h265_receiver import H265StreamReceiver
+    from rtcp import RtcpSession
+
+    rtcp = None
+    if nack or keyframe_request:
+        rtcp = RtcpSession(args.port + 1, nack=nack, keyframe_request=keyframe_request)
+    receiver = H265StreamReceiver(port=args.port, jitter_delay_ms=args.jitter_delay, output='lazy', rtcp=rtcp,
+                                  display_mode='fifo')
+    receiver.bind()
+    receiver.running = True
+    displayed = set()
+
+    def consume():
+        while receiver.running:
+            try:
+                key, frame = receiver.presenter.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            displayed.add(frame.timestamp)
+
+    threads = [threading.Thread(target=receiver.receive_packets, daemon=True),
+               threading.Thread(target=receiver.process_packets, daemon=True),
+               threading.Thread(target=consume, daemon=True)]
+    for t in threads:
+        t.start()
+    sent = multiprocessing.Queue()
+    sender = multiprocessing.Process(target=_feedback_sender, args=(args.port, args, loss, sent))
+    sender.start()
+    frame_times, sender_stats = sent.get()
+    sender.join()
+    time.sleep(0.5)
+    receiver.running = False
+    for t in threads:
+        t.join()
+    feedback = {}
+    for stream in receiver.demuxer.streams.values():
+        if stream.feedback is not None:
+            feedback = stream.feedback.stats
+    if rtcp is not None:
+        rtcp.stop()
+    receiver.socket.close()
+    return sender_stats, feedback, sorted(frame_times, key=frame_times.get), displayed
+
+
+def _freezes(sent, displayed, fps):
+    """(seconds, longest seconds) of the frames sent that were not displayed:
+    the last good picture (or nothing, before the first) stays up for those"""
+    total = longest = run = 0
+    for timestamp in sent:
+        if timestamp in displayed:
+            run = 0
+        else:
+            run += 1
+            total += 1
+            longest = max(longest, run)
+    return total / fps, longest / fps
+
+
+def bench_feedback(args):
+    """RTCP feedback against a live sender with packet loss: frames lost to freezes with and without NACK/PLI"""
+    variants = [('off', False, None), ('nack', True, None), ('pli', False, 'pli'),
+                ('nack + pli', True, 'pli'), ('nack + fir', True, 'fir')]
+    print(f"Live {args.size}@{args.fps} test pattern for {args.seconds:g} s, IDR every {args.keyframe_interval:g} s, "
+          f"receiver jitter buffer {args.jitter_delay} ms\n")
+    print(f"{'loss':>5}  {'feedback':<12}{'frames':>7}{'shown':>7}{'frozen s':>9}{'longest ms':>11}"
+          f"{'NACKed':>8}{'resent':>8}{'recovered':>10}{'requests':>9}{'forced IDR':>11}")
+    for loss in args.loss:
+        for label, nack, keyframe_request in variants:
+            sender, feedback, sent, displayed = _feedback_run(args, loss / 100, nack, keyframe_request)
+            frozen, longest = _freezes(sent, displayed, args.fps)
+            shown = sum(1 for timestamp in sent if timestamp in displayed)
+            print(f"{loss:>4g}%  {label:<12}{len(sent):>7}{shown:>7}{frozen:>9.2f}{longest * 1000:>11.0f}"
+                  f"{feedback.get('nacked_packets', 0):>8}{sender['retransmitted']:>8}"
+                  f"{feedback.get('recovered', 0):>10}{feedback.get('keyframe_requests', 0):>9}"
+                  f"{sender['forced_keyframes']:>11}")
+    print("\nfrozen s: frames sent that never reached the display, including those before the first one "
+          "shown; requests: PLI/FIR sent; forced IDR: keyframes the sender made for them")
+
+
+def _write_pcap(path, schedule, port=5004):
+    """Classic pcap (Ethernet / IPv4 / UDP) of a build_streams() schedule,
+    stream i sent from 10.0.0.1:(40000 + i)"""
+    ethernet = b'\x02\x00\x00\x00\x00\x02\x02\x00\x00\x00\x00\x01\x08\x00'
+    with open(path, 'wb', buffering=1024 * 1024) as f:
+        f.write(struct.pack('<IHHiIII', 0xA1B2C3D4, 2, 4, 0, 0, 65535, 1))
+        for due, index, _, data in schedule:
+            udp = struct.pack('!HHHH', 40000 + index, port, 8 + len(data), 0)
+            ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 28 + len(data), 0, 0, 64, 17, 0,
+                             bytes([10, 0, 0, 1]), bytes([10, 0, 0, 2]))
+            frame = ethernet + ip + udp + data
+            seconds = 1_700_000_000 + due
+            f.write(struct.pack('<IIII', int(seconds), int(seconds % 1 * 1e6), len(frame), len(frame)))
+            f.write(frame)
+
+
+def _per_packet_stats(path, port):
+    """The per-packet equivalent of rtp_batch.summarize: RTPPacket and
+    rtcp.ReceptionStats for every datagram. Returns {ssrc: (lost, frames, jitter)}."""
+    from pcap_reader import PcapReader
+    from rtcp import ReceptionStats
+    from rtp import RTPPacket
+
+    streams = {}
+    with PcapReader(path) as reader:
+        for datagram in reader.udp_datagrams(port):
+            packet = RTPPacket(datagram.payload)
+            state = streams.get(packet.ssrc)
+            if state is None:
+                state = streams[packet.ssrc] = [ReceptionStats(), set(), None, 0]
+            stats = state[0]
+            extended = stats.update(packet.sequence, packet.timestamp, datagram.timestamp)
+            state[1].add(extended)
+            if packet.timestamp != state[2]:
+                state[2] = packet.timestamp
+                state[3] += 1
+    result = {}
+    for ssrc, (stats, seen, _, frames) in streams.items():
+        expected = max(seen) - min(seen) + 1
+        result[ssrc] = (expected - len(seen), frames, stats.jitter)
+    return result
+
+
+def bench_rtp_batch(args):
+    """Per-packet RTP parsing vs the vectorized rtp_batch decoding of a large capture"""
+    import tempfile
+    from replay import NetworkImpairment, build_streams, load_datagrams
+    from rtp_batch import read_capture, summarize
+
+    datagrams = load_datagrams(args.input, args.capture_port)
+    impairment = NetworkImpairment(loss=args.loss / 100, reorder=args.reorder / 100)
+    schedule, impairments = build_streams(datagrams, args.streams, args.loops, impairment, seed=1)
+    injected = sum(i.stats['dropped'] for i in impairments)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'synthetic.pcap')
+        _write_pcap(path, schedule, args.capture_port)
+        size = os.path.getsize(path)
+        del schedule
+        print(f"{args.input} x {args.loops} loops x {args.streams} streams: {size / 1e6:.0f} MB, "
+              f"impairment: {impairment} ({injected} packets dropped)\n")
+
+        reference = {}
+        per_packet = min(_timed(lambda: reference.update(_per_packet_stats(path, args.capture_port)))
+                         for _ in range(args.repeat))
+        summary = {}
+
+        def batch():
+            packets = read_capture(path, args.capture_port)
+            summary.update(summarize(packets))
+            return packets
+
+        vectorized = min(_timed(batch) for _ in range(args.repeat))
+        packets = len(read_capture(path, args.capture_port))
+
+    print(f"{'path':<24}{'s':>8}{'packets/s':>12}{'MB/s':>8}")
+    for label, seconds in (('RTPPacket per packet', per_packet), ('rtp_batch (NumPy)', vectorized)):
+        print(f"{label:<24}{seconds:>8.3f}{packets / seconds:>12,.0f}{size / seconds / 1e6:>8.0f}")
+    print(f"\nSpeedup: {per_packet / vectorized:.1f}x")
+
+    lost = sum(s['lost'] for s in summary.values())
+    reference_lost = sum(r[0] for r in reference.values())
+    reordered = sum(s['reordered'] for s in summary.values())
+    mismatched = 0
+    for (_, _, ssrc), s in summary.items():
+        expected_lost, frames, jitter = reference[ssrc]
+        if s['lost'] != expected_lost or s['frames'] != frames or abs(s['jitter_ms'] - jitter / 90.0) > 0.01:
+            mismatched += 1
+    print(f"Lost {lost} (per packet: {reference_lost}), reordered {reordered}; "
+          f"{mismatched} of {len(summary)} streams differ in loss, frames or jitter")
+    print("Per packet: pcap_reader + RTPPacket + rtcp.ReceptionStats (loss, jitter) and frame counting; "
+          "rtp_batch: headers of all packets decoded with NumPy, statistics as array operations")
+
+
+def bench_analyze(args):
+    """extract_h265.py --analyze (stream_analysis.py) on synthetic captures of
+    growing length: throughput and peak memory, against a plain extraction"""
+    import contextlib
+    import io
+    import tempfile
+    from extract_h265 import extract_h265_stream
+    from replay import NetworkImpairment, build_streams, load_datagrams
+    from stream_analysis import analyze_capture
+
+    datagrams = load_datagrams(args.input, args.capture_port)
+    impairment = NetworkImpairment(loss=args.loss / 100, reorder=args.reorder / 100)
+    print(f"{args.input} x {args.streams} streams, impairment: {impairment}\n")
+    print(f"{'loops':>6}{'MB':>7}{'capture h':>11}{'mode':>10}{'s':>8}{'MB/s':>8}{'peak MB':>9}")
+    for loops in args.loops:
+        schedule, _ = build_streams(datagrams, args.streams, loops, impairment, seed=1)
+        hours = schedule[-1][0] / 3600 if schedule else 0.0
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'synthetic.pcap')
+            _write_pcap(path, schedule, args.capture_port)
+            del schedule
+            size = os.path.getsize(path)
+            output = os.path.join(directory, 'stream.h265')
+
+            def extract():
+                with contextlib.redirect_stdout(io.StringIO()):
+                    extract_h265_stream(path, output, args.capture_port)
+
+            modes = [('analyze', lambda: analyze_capture(path, args.capture_port, args.batch_size))]
+            if not args.skip_extract:
+                modes.append(('extract', extract))
+            for mode, func in modes:
+                seconds = min(_timed(func) for _ in range(args.repeat))
+                tracemalloc.start()
+                func()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                print(f"{loops:>6}{size / 1e6:>7.0f}{hours:>11.2f}{mode:>10}{seconds:>8.2f}"
+                      f"{size / seconds / 1e6:>8.0f}{peak / 1e6:>9.1f}")
+    print("\nanalyze: aggregated counters per stream (one timeline row per second); "
+          "extract: extract_h265_stream writing the elementary streams. "
+          "Peak MB is Python and NumPy allocations (tracemalloc); the capture itself is mapped, not read")
+
+
+def _extract_process(path, output, port, release, results):
+    """Child of bench_extract: one extraction, then its peak RSS"""
+    import contextlib
+    import io
+    import extract_h265
+    from pcap_reader import PcapReader
+
+    if not release:
+        PcapReader.release = lambda self, end: None
+    # The stream (stdout mode) and the log go to /dev/null
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    start = time.perf_counter()
+    with contextlib.redirect_stderr(io.StringIO()):
+        extract_h265.extract_h265_stream(path, output, port)
+    seconds = time.perf_counter() - start
+    # VmHWM, not ru_maxrss: that keeps the parent's peak across fork + exec
+    with open('/proc/self/status') as f:
+        peak = next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmHWM'))
+    results.put((seconds, peak))
+
+
+def bench_extract(args):
+    """extract_h265_stream on synthetic captures of growing length: peak
+    resident memory of a fresh process per run"""
+    import tempfile
+    from replay import NetworkImpairment, build_streams, load_datagrams
+
+    context = multiprocessing.get_context('spawn')
+    datagrams = load_datagrams(args.input, args.capture_port)
+    impairment = NetworkImpairment(loss=args.loss / 100)
+    print(f"{args.input} x {args.streams} streams, impairment: {impairment}\n")
+    print(f"{'loops':>6}{'capture MB':>12}{'output':>12}{'s':>8}{'MB/s':>8}{'peak RSS MB':>13}")
+    modes = [('file', True), ('-', True)]
+    if args.no_release:
+        modes.append(('file', False))
+    for loops in args.loops:
+        schedule, _ = build_streams(datagrams, args.streams, loops, impairment, seed=1)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'synthetic.pcap')
+            _write_pcap(path, schedule, args.capture_port)
+            del schedule
+            size = os.path.getsize(path)
+            for output, release in modes:
+                results = context.Queue()
+                target = os.path.join(directory, 'stream.h265') if output == 'file' else '-'
+                process = context.Process(target=_extract_process,
+                                          args=(path, target, args.capture_port, release, results))
+                process.start()
+                seconds, peak = results.get()
+                process.join()
+                label = ('file' if release else 'no-release') if output == 'file' else 'stdout'
+                print(f"{loops:>6}{size / 1e6:>12.0f}{label:>12}{seconds:>8.2f}{size / seconds / 1e6:>8.0f}"
+                      f"{peak / 1e6:>13.1f}")
+    print("\nPeak RSS of a fresh process (interpreter and imports included). NAL units are written as they "
+          "are completed; the capture is mapped and its pages are released behind the read position "
+          "(no-release: they stay resident)")
+
+
+
+def _display_run(args, mode, display_ms):
+    """One paced replay into a threaded receiver whose display loop converts
+    each frame and then stays busy for display_ms (imshow and a slow screen).
+    Returns the frames shown, the presenter stats and the send times."""
+    from h265_receiver import DISPLAY_POLL, H265StreamReceiver
+    from replay import NetworkImpairment
+
+    receiver = H265StreamReceiver(port=args.port, jitter_delay_ms=args.jitter_delay,
+                                  max_streams=max(16, args.streams), output='lazy',
+                                  display_mode=mode, display_delay_ms=args.display_delay)
+    receiver.bind()
+    receiver.running = True
+    presenter = receiver.presenter
+    shown = []  # ((SSRC, RTP timestamp), time shown)
+
+    def display():
+        while receiver.running:
+            presenter.wait(DISPLAY_POLL)
+            for key, frame, timestamp in presenter.take():
+                frame.to_bgr()
+                time.sleep(display_ms / 1000.0)
+                shown.append(((key.ssrc, timestamp), time.time()))
+
+    threads = [threading.Thread(target=receiver.receive_packets, daemon=True),
+               threading.Thread(target=receiver.process_packets, daemon=True),
+               threading.Thread(target=display, daemon=True)]
+    for t in threads:
+        t.start()
+    sent = multiprocessing.Queue()
+    impairment = NetworkImpairment(jitter_ms=args.jitter)
+    sender = multiprocessing.Process(target=_e2e_sender, args=(args.port, args, impairment, 1.0, False, sent))
+    sender.start()
+    send_times, _ = sent.get()
+    sender.join()
+    time.sleep(1.0)
+    receiver.running = False
+    for t in threads:
+        t.join()
+    receiver.socket.close()
+    return shown, dict(presenter.stats), send_times
+
+
+def _pacing_error(shown):
+    """Mean difference in ms between the interval of consecutive shown frames
+    of a stream and the interval of their RTP timestamps"""
+    last = {}
+    errors = []
+    for (ssrc, timestamp), at in shown:
+        if ssrc in last:
+            last_timestamp, last_at = last[ssrc]
+            ticks = (timestamp - last_timestamp) & 0xFFFFFFFF
+            errors.append(abs((at - last_at) - ticks / 90000.0) * 1000.0)
+        last[ssrc] = (timestamp, at)
+    return sum(errors) / len(errors) if errors else float('nan')
+
+
+def bench_display(args):
+    """Display modes of the presenter against displays of different speed:
+    glass-to-glass latency, frames shown and dropped, pacing"""
+    from replay import NetworkImpairment
+
+    print(f"{args.input} x {args.loops} loops x {args.streams} streams paced at 1x to 127.0.0.1:{args.port}, "
+          f"impairment: {NetworkImpairment(jitter_ms=args.jitter)}")
+    print(f"Receiver: jitter buffer {args.jitter_delay} ms, smooth playout delay {args.display_delay} ms\n")
+    print(f"{'mode':<9}{'display ms':>11}{'shown':>7}{'fps':>6}{'dropped':>9}"
+          f"{'p50 ms':>8}{'p95 ms':>8}{'p99 ms':>8}{'max ms':>8}{'pacing ms':>11}")
+    for display_ms in args.display_ms:
+        for mode in args.modes:
+            shown, stats, send_times = _display_run(args, mode, display_ms)
+            latencies = _frame_latencies(send_times, shown)
+            if latencies:
+                p50, p95, p99 = (latencies[min(len(latencies) - 1, int(len(latencies) * q))]
+                                 for q in (0.5, 0.95, 0.99))
+                worst = latencies[-1]
+                seconds = shown[-1][1] - shown[0][1]
+            else:
+                p50 = p95 = p99 = worst = float('nan')
+                seconds = 0.0
+            fps = (len(shown) - 1) / seconds if seconds else 0.0
+            dropped = stats['replaced'] + stats['overflow']
+            print(f"{mode:<9}{display_ms:>11g}{len(shown):>7}{fps:>6.1f}{dropped:>9}"
+                  f"{p50:>8.1f}{p95:>8.1f}{p99:>8.1f}{worst:>8.1f}{_pacing_error(shown):>11.1f}")
+    print("\nlatency: last packet of a picture sent -> frame shown (glass to glass without the camera and "
+          "screen); dropped: frames the presenter skipped; pacing: mean deviation of the intervals between "
+          "shown frames from their RTP timestamp intervals")
+
+
+
+def _fec_pass(schedule, jitter_delay):
+    """One receiver fed a build_streams() schedule in simulated time: each
+    packet arrives at its send time, jitter buffer deadlines expire between
+    packets as in process_packets. Returns the receiver and the frames decoded."""
+    from fec import FEC_PAYLOAD_TYPE
+    from h265_receiver import H265StreamReceiver
+    from metrics import MetricsRegistry
+    from rtp import RTPPacket
+
+    receiver = H265StreamReceiver(jitter_delay_ms=jitter_delay, metrics=MetricsRegistry(enabled=False),
+                                  output='yuv', display_mode='fifo', fec_payload_type=FEC_PAYLOAD_TYPE)
+    presenter = receiver.presenter
+    frames = 0
+
+    def expire(now):
+        for key, deadline in list(receiver.gap_deadlines.items()):
+            if deadline <= now:
+                receiver.process_stream(receiver.demuxer.streams[key], None, None, now)
+
+    start = time.time()
+    for due, index, _, data in schedule:
+        arrival = start + due
+        expire(arrival)
+        receiver.dispatch(arrival, ('127.0.0.1', 40000 + index), RTPPacket(data), arrival)
+        while not presenter.empty():
+            presenter.get_nowait()
+            frames += 1
+    expire(start + schedule[-1][0] + 10.0)
+    while not presenter.empty():
+        presenter.get_nowait()
+        frames += 1
+    return receiver, frames
+
+
+def bench_fec(args):
+    """Frames decoded at 1-10% random loss without FEC and with row / row+column parity.
+
+    A packet is rebuilt only once the parity packet after its row (or block)
+    arrives, so the jitter buffer delay must cover that; rebuilt packets the
+    jitter buffer has given up on count as late.
+    """
+    import contextlib
+    import io
+
+    from fec import parse_config
+    from replay import NetworkImpairment, build_streams, load_datagrams
+
+    datagrams = load_datagrams(args.input, args.capture_port)
+    pictures = len({struct.unpack_from('!I', data, 4)[0] for data in datagrams}) * args.loops * args.streams
+    print(f"{args.input}: {len(datagrams)} packets x {args.loops} loops x {args.streams} streams, "
+          f"{pictures} pictures; jitter buffer {args.jitter_delay} ms, simulated arrival\n")
+    print(f"{'loss %':>7}{'FEC':>6}{'overhead':>10}{'lost':>7}{'recovered':>11}{'unrecov.':>10}"
+          f"{'late':>6}{'frames':>8}{'frames %':>10}")
+    for loss in args.loss:
+        for config in args.fec:
+            fec = None if config == 'none' else parse_config(config)
+            impairment = NetworkImpairment(loss=loss / 100, burst=args.burst)
+            schedule, impairments = build_streams(datagrams, args.streams, args.loops, impairment, args.seed, fec)
+            sent = sum(i.stats['packets'] for i in impairments)
+            media = len(datagrams) * args.loops * args.streams
+            lost = sum(i.stats['dropped'] for i in impairments)
+            with contextlib.redirect_stdout(io.StringIO()):
+                receiver, frames = _fec_pass(schedule, args.jitter_delay)
+            late = receiver._sum_streams(lambda stream: stream.jitter_buffer.stats['late'])
+            recovered = receiver._sum_streams(lambda stream: stream.fec.stats['recovered'])
+            unrecoverable = receiver._sum_streams(lambda stream: stream.fec.stats['unrecoverable'])
+            print(f"{loss:>7g}{config:>6}{(sent - media) * 100.0 / media:>9.0f}%{lost:>7}{recovered:>11}"
+                  f"{unrecoverable:>10}{late:>6}{frames:>8}{frames * 100.0 / pictures:>9.1f}%")
+    print("\nlost: media and parity packets dropped by the impairment; unrecov.: lost media packets a parity "
+          "packet covered but could not rebuild; late: packets (mostly rebuilt ones) that reached the jitter "
+          "buffer after it moved on; frames %: pictures decoded (the receiver skips to the next "
+          "IRAP after an unrepaired loss)")
+
+
+def _timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def _decode_through(index, seconds, decoder_options):
+    """Decode from the first access unit until the picture at seconds"""
+    import av
+
+    codec = decoder_options.create_codec()
+    target = seconds * 90000
+    for data, ticks in index.access_units():
+        packet = av.Packet(data)
+        packet.pts = ticks
+        for frame in codec.decode(packet):
+            if frame.pts >= target:
+                return frame
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the H.265 debug tools')
+    sub = parser.add_subparsers(dest='benchmark', required=True)
+
+    p = sub.add_parser('ingest', help='UDP ingest throughput on loopback')
+    p.add_argument('-p', '--port', type=int, default=15004, help='UDP port (default: 15004)')
+    p.add_argument('-n', '--count', type=int, default=200000, help='Packets per run (default: 200000)')
+    p.add_argument('--size', type=int, default=1200, help='RTP payload size (default: 1200)')
+    p.add_argument('--batch', type=int, nargs='+', default=[16, 64],
+                   help='Batch sizes to compare against recvfrom (default: 16 64)')
+    p.set_defaults(func=bench_ingest)
+
+    p = sub.add_parser('parse', help='RTP header parse cost and allocations')
+    p.add_argument('-n', '--count', type=int, default=100000, help='Packets (default: 100000)')
+    p.add_argument('--size', type=int, default=1200, help='RTP payload size (default: 1200)')
+    p.set_defaults(func=bench_parse)
+
+    p = sub.add_parser('reassembly', help='FU reassembly of a synthetic IDR NAL')
+    p.add_argument('--size', type=int, default=2 * 1024 * 1024, help='Base NAL size (default: 2 MB)')
+    p.add_argument('--scales', type=float, nargs='+', default=[0.125, 0.25, 0.5, 1, 2],
+                   help='Multiples of --size to run (default: 0.125 0.25 0.5 1 2)')
+    p.add_argument('--repeat', type=int, default=3, help='Best of N runs (default: 3)')
+    p.set_defaults(func=bench_reassembly)
+
+    p = sub.add_parser('pcap', help='Capture reading: scapy rdpcap vs streaming pcap_reader')
+    p.add_argument('files', nargs='*', default=['test001.pcapng', 'test003.pcapng', 'test004.pcapng'],
+                   help='Capture files (default: the bundled test00*.pcapng)')
+    p.add_argument('-p', '--port', type=int, default=5004, help='RTP port (default: 5004)')
+    p.add_argument('--repeat', type=int, default=5, help='Best of N runs for pcap_reader (default: 5)')
+    p.set_defaults(func=bench_pcap)
+
+    p = sub.add_parser('assembly', help='Access unit assembly and bytes copied per frame')
+    p.add_argument('-i', '--input', default='stream.h265', help='Annex-B input (default: stream.h265)')
+    p.add_argument('--repeat', type=int, default=5, help='Best of N runs (default: 5)')
+    p.set_defaults(func=bench_assembly)
+
+    p = sub.add_parser('output', help='Per-stage cost of the frame output modes (bgr / lazy / preview / yuv)')
+    p.add_argument('-i', '--input', default='stream.h265', help='Annex-B input; empty to skip (default: stream.h265)')
+    p.add_argument('--synthetic', nargs='*', default=['1920x1080', '3840x2160'],
+                   help='Also encode WxH test patterns with libx265 (default: 1920x1080 3840x2160)')
+    p.add_argument('--frames', type=int, default=60, help='Frames per synthetic input (default: 60)')
+    p.add_argument('--preview-width', type=int, default=960, help='Preview width (default: 960)')
+    p.add_argument('--display-share', type=float, default=0.5,
+                   help='Share of decoded frames that get displayed (default: 0.5)')
+    p.add_argument('--repeat', type=int, default=3, help='Best of N runs (default: 3)')
+    p.set_defaults(func=bench_output)
+
+    p = sub.add_parser('decoder', help='Decoder threading / low-delay / skip settings: throughput and latency')
+    p.add_argument('-i', '--input', default='stream.h265', help='Annex-B input; empty to skip (default: stream.h265)')
+    p.add_argument('--synthetic', nargs='*', default=[],
+                   help='Also encode WxH test patterns with libx265, e.g. 1920x1080')
+    p.add_argument('--frames', type=int, default=60, help='Frames per synthetic input (default: 60)')
+    p.add_argument('--pace', type=float, default=0.0,
+                   help='Feed access units at this frame rate like a live stream; 0 = as fast as possible')
+    p.add_argument('--repeat', type=int, default=3, help='Best of N runs (default: 3)')
+    p.set_defaults(func=bench_decoder)
+
+    p = sub.add_parser('decode-pool', help='Multi-process decode scaling on synthetic multi-stream input')
+    p.add_argument('-i', '--input', default='stream.h265', help='Annex-B input (default: stream.h265)')
+    p.add_argument('--streams', type=int, default=8, help='Concurrent streams (default: 8)')
+    p.add_argument('--loops', type=int, default=1, help='Times each stream repeats the input (default: 1)')
+    p.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8],
+                   help='Worker counts to compare (default: 1 2 4 8)')
+    p.set_defaults(func=bench_decode_pool)
+
+    p = sub.add_parser('engine', help='Threaded vs asyncio receiver: idle CPU and frame latency')
+    p.add_argument('-i', '--input', default='test004.pcapng', help='Capture to replay (default: test004.pcapng)')
+    p.add_argument('--capture-port', type=int, default=5004, help='RTP port in the capture (default: 5004)')
+    p.add_argument('--port', type=int, default=15004, help='Loopback port (default: 15004)')
+    p.add_argument('--speed', type=float, default=1.0, help='Replay speed (default: 1.0)')
+    p.add_argument('--idle', type=float, default=3.0, help='Idle seconds measured before the replay (default: 3)')
+    p.add_argument('--engines', nargs='+', choices=['threads', 'asyncio'], default=['threads', 'asyncio'],
+                   help='Engines to compare (default: both)')
+    p.set_defaults(func=bench_engine)
+
+    p = sub.add_parser('metrics', help='Overhead of the receiver metrics on the packet path')
+    p.add_argument('-i', '--input', default='test004.pcapng', help='Capture to replay (default: test004.pcapng)')
+    p.add_argument('--capture-port', type=int, default=5004, help='RTP port in the capture (default: 5004)')
+    p.add_argument('--repeat', type=int, default=25, help='Off/on run pairs per path (default: 25)')
+    p.add_argument('--loops', type=int, default=10, help='Capture repeats for the packet paths (default: 10)')
+    p.add_argument('--decode-loops', type=int, default=3, help='Capture repeats with decoding (default: 3)')
+    p.set_defaults(func=bench_metrics)
+
+    p = sub.add_parser('record', help='Headless recording (Annex-B / MP4 / TS) vs decode and display')
+    p.add_argument('-i', '--input', default='test004.pcapng', help='Capture to replay (default: test004.pcapng)')
+    p.add_argument('--capture-port', type=int, default=5004, help='RTP port in the capture (default: 5004)')
+    p.add_argument('--streams', type=int, default=4, help='Concurrent copies of the capture (default: 4)')
+    p.add_argument('--loops', type=int, default=2, help='Capture repeats per stream (default: 2)')
+    p.add_argument('--paths', nargs='+', choices=['decode', 'annexb', 'mp4', 'ts'],
+                   default=['decode', 'annexb', 'mp4', 'ts'], help='Paths to compare (default: all)')
+    p.add_argument('--write-buffer', type=int, default=1024, help='KB per file write (default: 1024)')
+    p.add_argument('--repeat', type=int, default=3, help='Best of N runs (default: 3)')
+    p.set_defaults(func=bench_record)
+
+    p = sub.add_parser('monitor', help='Keyframe-only monitoring mosaic vs full decode: CPU per stream')
+    p.add_argument('-i', '--input', default='test004.pcapng', help='Capture to replay (default: test004.pcapng)')
+    p.add_argument('--capture-port', type=int, default=5004, help='RTP port in the capture (default: 5004)')
+    p.add_argument('--streams', type=int, default=8, help='Concurrent copies of the capture (default: 8)')
+    p.add_argument('--loops', type=int, default=1, help='Capture repeats per stream (default: 1)')
+    p.add_argument('--keyframe-rates', type=float, nargs='+', default=[0, 1, 0.2],
+                   help='Monitor keyframe rates to compare; 0 decodes every keyframe (default: 0 1 0.2)')
+    p.add_argument('--thumbnail-width', type=int, default=320, help='Mosaic tile width (default: 320)')
+    p.add_argument('--repeat', type=int, default=3, help='Best of N runs (default: 3)')
+    p.set_defaults(func=bench_monitor)
+
+    p = sub.add_parser('e2e', help='Loopback replay into the receiver: sustainable packet rate, fps, drops, latency')
+    p.add_argument('-i', '--input', default='test004.pcapng',
+                   help='Capture or Annex-B file to replay (default: test004.pcapng)')
+    p.add_argument('--capture-port', type=int, default=5004, help='RTP port in the capture (default: 5004)')
+    p.add_argument('--fps', type=float, default=30.0, help='Frame rate of an Annex-B input (default: 30)')
+    p.add_argument('--port', type=int, default=15004, help='Loopback port (default: 15004)')
+    p.add_argument('--streams', type=int, default=1, help='Parallel streams (default: 1)')
+    p.add_argument('--loops', type=int, default=1, help='Input repeats per stream (default: 1)')
+    p.add_argument('--speeds', type=float, nargs='+', default=[1, 2, 4, 8, 16],
+                   help='Paced replay speeds to run (default: 1 2 4 8 16)')
+    p.add_argument('--no-fast', dest='fast', action='store_false',
+                   help='Skip the as-fast-as-possible run')
+    p.add_argument('--tolerance', type=float, default=0.1,
+                   help='Percent of packets/frames that may be lost or dropped in a sustainable run (default: 0.1)')
+    p.add_argument('--max-latency', type=float, default=200.0,
+                   help='p99 frame latency in ms up to which a run counts as keeping up (default: 200)')
+    p.add_argument('--batch', type=int, default=0, help='Receiver batch size; 0 uses recvfrom (default: 0)')
+    p.add_argument('--jitter-delay', type=int, default=50, help='Receiver jitter buffer delay in ms (default: 50)')
+    p.add_argument('--loss', type=float, default=0.0, help='Injected packet loss in percent (default: 0)')
+    p.add_argument('--burst', type=float, default=1.0, help='Mean loss burst length (default: 1)')
+    p.add_argument('--reorder', type=float, default=0.0, help='Injected reordering in percent (default: 0)')
+    p.add_argument('--duplicate', type=float, default=0.0, help='Injected duplication in percent (default: 0)')
+    p.add_argument('--jitter', type=float, default=0.0, help='Injected jitter in ms (default: 0)')
+    p.add_argument('--seed', type=int, default=1, help='Random seed of the impairments (default: 1)')
+    p.set_defaults(func=bench_e2e)
+
+    p = sub.add_parser('fec', help='FEC parity (fec.py): recovered packets and frames decoded at 1-10%% loss')
+    p.add_argument('-i', '--input', default='test004.pcapng',
+                   help='Capture or Annex-B file to replay (default: test004.pcapng)')
+    p.add_argument('--capture-port', type=int, default=5004, help='RTP port in the capture (default: 5004)')
+    p.add_argument('--streams', type=int, default=1, help='Parallel streams (default: 1)')
+    p.add_argument('--loops', type=int, default=5, help='Input repeats per stream (default: 5)')
+    p.add_argument('--loss', type=float, nargs='+', default=[1, 2, 5, 10],
+                   help='Random packet loss in percent (default: 1 2 5 10)')
+    p.add_argument('--burst', type=float, default=1.0, help='Mean loss burst length (default: 1)')
+    p.add_argument('--fec', nargs='+', default=['none', '10', '5x5'],
+                   help="FEC configurations: 'none', L (rows) or LxD (rows and columns) (default: none 10 5x5)")
+    p.add_argument('--jitter-delay', type=int, default=1000,
+                   help='Receiver jitter buffer delay in ms; must cover an FEC block (default: 1000)')
+    p.add_argument('--seed', type=int, default=1, help='Random seed of the loss (default: 1)')
+    p.set_defaults(func=bench_fec)
+
+    p = sub.add_parser('display', help='Display modes (latency / smooth / fifo) vs display speed: glass-to-glass latency')
+    p.add_argument('-i', '--input', default='test004.pcapng',
+                   help='Capture or Annex-B file to replay (default: test004.pcapng)')
+    p.add_argument('--capture-port', type=int, default=5004, help='RTP port in the capture (default: 5004)')
+    p.add_argument('--fps', type=float, default=30.0, help='Frame rate of an Annex-B input (default: 30)')
+    p.add_argument('--port', type=int, default=15004, help='Loopback port (default: 15004)')
+    p.add_argument('--streams', type=int, default=1, help='Parallel streams (default: 1)')
+    p.add_argument('--loops', type=int, default=1, help='Input repeats per stream (default: 1)')
+    p.add_argument('--modes', nargs='+', default=['fifo', 'latency', 'smooth'],
+                   help='Display modes to compare (default: fifo latency smooth)')
+    p.add_argument('--display-ms', type=float, nargs='+', default=[5, 40],
+                   help='Time the display needs per frame, in ms (default: 5 40)')
+    p.add_argument('--display-delay', type=int, default=40, help='Smooth mode playout delay in ms (default: 40)')
+    p.add_argument('--jitter-delay', type=int, default=50, help='Receiver jitter buffer delay in ms (default: 50)')
+    p.add_argument('--jitter', type=float, default=0.0, help='Injected network jitter in ms (default: 0)')
+    p.add_argument('--seed', type=int, default=1, help='Random seed of the impairment (default: 1)')
+    p.set_defaults(func=bench_display)
+
+    p = sub.add_parser('index', help='NAL index scan speed, IRAP seek latency and parallel segment decoding')
+    p.add_argument('-i', '--input', default='stream.h265', help='Annex-B file (default: stream.h265)')
+    p.add_argument('--copies', type=int, default=20, help='Concatenated copies of the input (default: 20)')
+    p.add_argument('--fps', type=float, default=30.0, help='Frame rate of the input (default: 30)')
+    p.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4],
+                   help='Process counts for parallel decoding (default: 1 2 4)')
+    p.add_argument('--repeat', type=int, default=3, help='Best of N scans (default: 3)')
+    p.set_defaults(func=bench_index)
+
+    p = sub.add_parser('startup', help='Time to first frame on joining a stream: startup gate, parameter-set cache, SDP')
+    p.add_argument('-i', '--input', default='test004.pcapng', help='Capture or Annex-B file (default: test004.pcapng)')
+    p.add_argument('--capture-port', type=int, default=5004, help='RTP port in the capture (default: 5004)')
+    p.add_argument('--fps', type=float, default=30.0, help='Frame rate of an Annex-B input (default: 30)')
+    p.add_argument('--joins', type=int, default=20, help='Join points (default: 20)')
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser('feedback', help='RTCP NACK / PLI / FIR against a live sender with loss: freeze time')
+    p.add_argument('--port', type=int, default=15004, help='Loopback port; RTCP on port + 1 (default: 15004)')
+    p.add_argument('--size', default='640x360', help='Picture size of the live sender (default: 640x360)')
+    p.add_argument('--fps', type=int, default=30, help='Frame rate (default: 30)')
+    p.add_argument('--seconds', type=float, default=10.0, help='Seconds per run (default: 10)')
+    p.add_argument('--keyframe-interval', type=float, default=4.0, help='Seconds between scheduled IDRs (default: 4)')
+    p.add_argument('--loss', type=float, nargs='+', default=[1, 3], help='Packet loss in percent (default: 1 3)')
+    p.add_argument('--jitter-delay', type=int, default=100, help='Receiver jitter buffer delay in ms (default: 100)')
+    p.add_argument('--seed', type=int, default=1, help='Random seed of the loss (default: 1)')
+    p.set_defaults(func=bench_feedback)
+
+    p = sub.add_parser('rtp-batch', help='Vectorized RTP header decoding (rtp_batch.py) vs RTPPacket per packet')
+    p.add_argument('-i', '--input', default='test004.pcapng', help='Capture to replicate (default: test004.pcapng)')
+    p.add_argument('--capture-port', type=int, default=5004, help='RTP port in the capture (default: 5004)')
+    p.add_argument('--streams', type=int, default=4, help='Streams in the synthetic capture (default: 4)')
+    p.add_argument('--loops', type=int, default=100, help='Capture repeats per stream (default: 100)')
+    p.add_argument('--loss', type=float, default=1.0, help='Injected packet loss in percent (default: 1)')
+    p.add_argument('--reorder', type=float, default=1.0, help='Injected reordering in percent (default: 1)')
+    p.add_argument('--repeat', type=int, default=3, help='Best of N runs (default: 3)')
+    p.set_defaults(func=bench_rtp_batch)
+
+    p = sub.add_parser('analyze', help='extract_h265.py --analyze: throughput and memory on long synthetic captures')
+    p.add_argument('-i', '--input', default='test004.pcapng', help='Capture to replicate (default: test004.pcapng)')
+    p.add_argument('--capture-port', type=int, default=5004, help='RTP port in the capture (default: 5004)')
+    p.add_argument('--streams', type=int, default=4, help='Streams in the synthetic capture (default: 4)')
+    p.add_argument('--loops', type=int, nargs='+', default=[50, 200],
+                   help='Capture repeats per stream, one run each (default: 50 200)')
+    p.add_argument('--loss', type=float, default=1.0, help='Injected packet loss in percent (default: 1)')
+    p.add_argument('--reorder', type=float, default=1.0, help='Injected reordering in percent (default: 1)')
+    p.add_argument('--repeat', type=int, default=1, help='Best of N runs (default: 1)')
+    p.add_argument('--batch-size', type=int, default=1 << 16, help='Packets per analysis batch (default: 65536)')
+    p.add_argument('--skip-extract', action='store_true', help='Only measure the analysis')
+    p.set_defaults(func=bench_analyze)
+
+    p = sub.add_parser('extract', help='extract_h265.py peak memory (RSS) on synthetic captures of growing length')
+    p.add_argument('-i', '--input', default='test004.pcapng', help='Capture to replicate (default: test004.pcapng)')
+    p.add_argument('--capture-port', type=int, default=5004, help='RTP port in the capture (default: 5004)')
+    p.add_argument('--streams', type=int, default=2, help='Streams in the synthetic capture (default: 2)')
+    p.add_argument('--loops', type=int, nargs='+', default=[50, 200, 800],
+                   help='Capture repeats per stream, one run each (default: 50 200 800)')
+    p.add_argument('--loss', type=float, default=1.0, help='Injected packet loss in percent (default: 1)')
+    p.add_argument('--no-release', action='store_true',
+                   help='Also run without releasing the capture pages already read')
+    p.set_defaults(func=bench_extract)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Multi-process H.265 decode pool
+One ingest process hands reassembled access units to decoder worker
+processes. Each stream is pinned to one worker, and decoded BGR frames come
+back through per-worker shared-memory slots rather than being pickled.
+"""
+
+import multiprocessing as mp
+import os
+import queue
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from decoder_options import DecoderOptions
+
+# Shared-memory slot size: one 1080p BGR frame. 4K streams need 3840 * 2160 * 3.
+DEFAULT_SLOT_BYTES = 1920 * 1080 * 3
+
+
+def _decode_worker(index, input_queue, result_queue, free_slots, shm_name, slot_size,
+                   processed, cpu_time, decoder_options):
+    """Worker process: decode access units of its streams into shared-memory slots"""
+    import av
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    codecs = {}
+    try:
+        while True:
+            item = input_queue.get()
+            if item is None:
+                break
+            stream_id, access_unit = item
+
+            codec = codecs.get(stream_id)
+            if access_unit is None:
+                # Stream closed by the ingest process: flush the frames the
+                # decoder still holds back, then free it
+                if codec is None:
+                    processed[index] += 1
+                    continue
+                del codecs[stream_id]
+                packet = None
+            else:
+                if codec is None:
+                    codec = codecs[stream_id] = decoder_options.create_codec()
+                packet = av.Packet(access_unit)
+
+            try:
+                for frame in codec.decode(packet):
+                    image = frame.to_ndarray(format='bgr24')
+                    if image.nbytes > slot_size:
+                        result_queue.put(('oversize', index, stream_id, image.nbytes))
+                        continue
+                    try:
+                        slot = free_slots.get_nowait()
+                    except queue.Empty:
+                        # The consumer still holds every slot: drop rather than stall decoding
+                        result_queue.put(('dropped', index, stream_id))
+                        continue
+                    target = np.ndarray(image.shape, dtype=np.uint8, buffer=shm.buf,
+                                        offset=slot * slot_size)
+                    target[...] = image
+                    result_queue.put(('frame', index, stream_id, slot, image.shape))
+            except Exception as e:
+                result_queue.put(('error', index, stream_id, str(e)))
+
+            processed[index] += 1
+            cpu_time[index] = time.process_time()
+    finally:
+        shm.close()
+
+
+class SharedFrame:
+    """A decoded frame living in a worker's shared-memory slot.
+
+    array is only valid until release(); the slot is then reused by the worker.
+    """
+
+    __slots__ = ('stream_id', 'array', '_pool', '_worker', '_slot')
+
+    def __init__(self, pool, worker, slot, stream_id, array):
+        self.stream_id = stream_id
+        self.array = array
+        self._pool = pool
+        self._worker = worker
+        self._slot = slot
+
+    def release(self):
+        if self._slot is not None:
+            self.array = None
+            self._pool._release_slot(self._worker, self._slot)
+            self._slot = None
+
+
+class DecodePool:
+    def __init__(self, workers=None, slots_per_worker=4, max_frame_bytes=DEFAULT_SLOT_BYTES,
+                 queue_depth=64, decoder_options=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.slots_per_worker = slots_per_worker
+        self.slot_size = max_frame_bytes
+        self.queue_depth = queue_depth
+        self.decoder_options = decoder_options or DecoderOptions()
+        self.assignments = {}  # stream_id -> worker index
+        self.submitted = [0] * self.workers
+        self.stats = {
+            'submitted': 0,
+            'submit_dropped': 0,  # worker queue full
+            'frames': 0,
+            'frames_dropped': 0,  # no free shared-memory slot
+            'oversize': 0,        # frame larger than a slot
+            'errors': 0,
+        }
+        self.processes = []
+        self.running = False
+
+    def start(self):
+        ctx = mp.get_context()
+        self.processed = ctx.Array('q', self.workers, lock=False)
+        self.cpu_time = ctx.Array('d', self.workers, lock=False)
+        self.result_queue = ctx.Queue()
+        self.input_queues = []
+        self.free_slots = []
+        self.shms = []
+        for index in range(self.workers):
+            shm = shared_memory.SharedMemory(create=True, size=self.slot_size * self.slots_per_worker)
+            free = ctx.Queue()
+            for slot in range(self.slots_per_worker):
+                free.put(slot)
+            input_queue = ctx.Queue(maxsize=self.queue_depth)
+            process = ctx.Process(target=_decode_worker, daemon=True,
+                                  args=(index, input_queue, self.result_queue, free, shm.name,
+                                        self.slot_size, self.processed, self.cpu_time,
+                                        self.decoder_options))
+            process.start()
+            self.shms.append(shm)
+            self.free_slots.append(free)
+            self.input_queues.append(input_queue)
+            self.processes.append(process)
+        self.running = True
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        for input_queue in self.input_queues:
+            try:
+                input_queue.put(None, timeout=1.0)
+            except queue.Full:
+                pass
+        for process in self.processes:
+            process.join(timeout=2.0)
+            if process.is_alive():
+                process.terminate()
+        for shm in self.shms:
+            try:
+                shm.close()
+                shm.unlink()
+            except (BufferError, FileNotFoundError):
+                pass
+
+    def _worker_for(self, stream_id):
+        worker = self.assignments.get(stream_id)
+        if worker is None:
+            # Pin new streams to the worker with the fewest streams
+            counts = [0] * self.workers
+            for assigned in self.assignments.values():
+                counts[assigned] += 1
+            worker = self.assignments[stream_id] = counts.index(min(counts))
+        return worker
+
+    def submit(self, stream_id, access_unit, block=False):
+        """Queue one access unit (Annex-B bytes) for decoding. Returns False if it was dropped."""
+        worker = self._worker_for(stream_id)
+        try:
+            self.input_queues[worker].put((stream_id, bytes(access_unit)), block=block)
+        except queue.Full:
+            self.stats['submit_dropped'] += 1
+            return False
+        self.submitted[worker] += 1
+        self.stats['submitted'] += 1
+        return True
+
+    def close_stream(self, stream_id):
+        """Flush and free the decoder of a stream that ended"""
+        worker = self.assignments.pop(stream_id, None)
+        if worker is not None:
+            try:
+                self.input_queues[worker].put((stream_id, None), block=False)
+            except queue.Full:
+                # Like submit(): never stall the ingest thread on a busy worker
+                # (the worker keeps the stream's decoder until it exits)
+                self.stats['submit_dropped'] += 1
+                return
+            self.submitted[worker] += 1
+
+    def get_frame(self, timeout=0.1):
+        """Next decoded frame as a SharedFrame, or None if nothing arrived within timeout"""
+        deadline = time.time() + timeout
+        while True:
+            try:
+                message = self.result_queue.get(timeout=max(0.0, deadline - time.time()))
+            except queue.Empty:
+                return None
+            kind = message[0]
+            if kind == 'frame':
+                _, worker, stream_id, slot, shape = message
+                array = np.ndarray(shape, dtype=np.uint8, buffer=self.shms[worker].buf,
+                                   offset=slot * self.slot_size)
+                self.stats['frames'] += 1
+                return SharedFrame(self, worker, slot, stream_id, array)
+            if kind == 'dropped':
+                self.stats['frames_dropped'] += 1
+            elif kind == 'oversize':
+                if not self.stats['oversize']:
+                    print(f"Decode pool: {message[3]:,} byte frame does not fit a {self.slot_size:,} byte "
+                          f"slot, dropped (raise --decode-slot-bytes)")
+                self.stats['oversize'] += 1
+            elif kind == 'error':
+                self.stats['errors'] += 1
+                print(f"Decode error (worker {message[1]}): {message[3]}")
+
+    def _release_slot(self, worker, slot):
+        if self.running:
+            self.free_slots[worker].put(slot)
+
+    def worker_stats(self):
+        """Per-worker queue depth, processed access units, CPU seconds and stream count"""
+        streams = [0] * self.workers
+        for worker in self.assignments.values():
+            streams[worker] += 1
+        return [{
+            'queue_depth': self.submitted[i] - self.processed[i],
+            'processed': self.processed[i],
+            'cpu_time': self.cpu_time[i],
+            'streams': streams[i],
+        } for i in range(self.workers)]
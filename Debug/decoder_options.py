@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+FFmpeg HEVC decoder settings
+Shared by H265Decoder and the decode pool workers, so both build their codec
+contexts the same way
+"""
+
+import av
+
+THREAD_TYPES = ('auto', 'frame', 'slice')
+# AVDiscard levels accepted by skip_loop_filter
+LOOP_FILTER_SKIP = ('none', 'default', 'noref', 'bidir', 'nokey', 'nointra', 'all')
+# Frames dropped by skip_frame while the display is behind
+SKIP_WHEN_BEHIND = ('nonref', 'nonkey')
+
+
+class DecoderOptions:
+    """Threading and speed/quality settings for av.CodecContext('hevc').
+
+    threads=0 lets FFmpeg pick one thread per core. Frame threading adds
+    (threads - 1) frames of latency; slice threading adds none but only helps
+    streams encoded with several slices. low_delay asks the decoder to output
+    frames as soon as possible. skip_loop_filter trades picture quality for
+    speed (e.g. 'all' disables deblocking and SAO).
+    """
+
+    __slots__ = ('threads', 'thread_type', 'low_delay', 'skip_loop_filter')
+
+    def __init__(self, threads=0, thread_type='slice', low_delay=False, skip_loop_filter=None):
+        if thread_type not in THREAD_TYPES:
+            raise ValueError(f"Unknown thread type: {thread_type}")
+        if skip_loop_filter is not None and skip_loop_filter not in LOOP_FILTER_SKIP:
+            raise ValueError(f"Unknown skip_loop_filter level: {skip_loop_filter}")
+        self.threads = threads
+        self.thread_type = thread_type
+        self.low_delay = low_delay
+        self.skip_loop_filter = skip_loop_filter
+
+    def __str__(self):
+        text = f"threads={self.threads or 'auto'} type={self.thread_type}"
+        if self.low_delay:
+            text += " low-delay"
+        if self.skip_loop_filter:
+            text += f" skip-loop-filter={self.skip_loop_filter}"
+        return text
+
+    def create_codec(self):
+        """A new, not yet opened HEVC decoder context with these settings"""
+        codec = av.CodecContext.create('hevc', 'r')
+        if self.skip_loop_filter:
+            codec.options = {'skip_loop_filter': self.skip_loop_filter}
+        codec.thread_count = self.threads
+        if self.thread_type == 'frame':
+            codec.thread_type = 'FRAME'
+        elif self.thread_type == 'slice':
+            codec.thread_type = 'SLICE'
+        else:
+            codec.thread_type = 'AUTO'
+        if self.low_delay:
+            codec.flags |= av.codec.context.Flags.low_delay
+        return codec
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+RTP stream demultiplexing
+Separates the streams of several senders sharing one port, keyed by
+(source address, source port, destination port, SSRC)
+"""
+
+import socket
+import time
+from collections import namedtuple
+
+
+class StreamKey(namedtuple('StreamKey', 'src sport dport ssrc')):
+    """Identifies one RTP stream. src is an address string or a packed address."""
+
+    __slots__ = ()
+
+    @property
+    def src_ip(self):
+        if isinstance(self.src, (bytes, bytearray)):
+            family = socket.AF_INET if len(self.src) == 4 else socket.AF_INET6
+            return socket.inet_ntop(family, self.src)
+        return self.src
+
+    def __str__(self):
+        return f"{self.src_ip}:{self.sport}->{self.dport} ssrc={self.ssrc:08x}"
+
+
+class StreamDemuxer:
+    """Maps packets to per-stream state, created on first sight by create_stream(key).
+
+    At most max_streams streams are tracked; packets of further streams are
+    rejected (lookup returns None) until expire() frees a slot.
+    """
+
+    def __init__(self, create_stream, max_streams=64):
+        self.create_stream = create_stream
+        self.max_streams = max_streams
+        self.streams = {}    # StreamKey -> state
+        self.last_seen = {}  # StreamKey -> time of the last packet
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self.streams)
+
+    def __iter__(self):
+        return iter(self.streams.items())
+
+    def lookup(self, src, sport, dport, ssrc, now=None):
+        # A plain tuple hashes and compares equal to the StreamKey stored in the table
+        key = (src, sport, dport, ssrc)
+        state = self.streams.get(key)
+        if state is None:
+            if len(self.streams) >= self.max_streams:
+                self.rejected += 1
+                return None
+            key = StreamKey(*key)
+            state = self.streams[key] = self.create_stream(key)
+        self.last_seen[key] = time.time() if now is None else now
+        return state
+
+    def expire(self, idle_seconds, now=None):
+        """Forget streams without packets for idle_seconds. Returns the removed keys."""
+        if now is None:
+            now = time.time()
+        expired = [k for k, seen in self.last_seen.items() if now - seen > idle_seconds]
+        for key in expired:
+            del self.streams[key]
+            del self.last_seen[key]
+        return expired
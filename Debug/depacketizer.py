@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+H.265 RTP depacketizer (RFC 7798) shared by h265_receiver.py and extract_h265.py
+"""
+
+import struct
+import time
+
+START_CODE = b'\x00\x00\x00\x01'
+
+# NAL unit types (ITU-T H.265 Table 7-1)
+IRAP_TYPES = range(16, 22)  # BLA_W_LP .. CRA_NUT
+# VPS, SPS, PPS, AUD, EOS, EOB, FD, prefix/suffix SEI: safe to pass while waiting for an IRAP
+NON_VCL_TYPES = range(32, 41)
+# Types below this are VCL (slice data)
+FIRST_NON_VCL_TYPE = 32
+
+
+class FragmentedNAL:
+    """A NAL unit being reassembled from FU packets.
+
+    Fragments are kept as a list of payload views after the 2-byte NAL
+    header; the list is handed out as is when the end bit arrives, so
+    reassembly is linear in the NAL size.
+    """
+
+    __slots__ = ('chunks', 'next_sequence', 'updated')
+
+    def __init__(self, nal_header, first_chunk, sequence):
+        self.chunks = [struct.pack('!H', nal_header), first_chunk]
+        self.next_sequence = (sequence + 1) & 0xFFFF
+        self.updated = time.time()
+
+    def append(self, chunk, sequence):
+        self.chunks.append(chunk)
+        self.next_sequence = (sequence + 1) & 0xFFFF
+        self.updated = time.time()
+
+
+class H265RTPDepacketizer:
+    """keyframes_only drops every VCL NAL that is not part of an IRAP picture
+    by its type in the payload header (each FU fragment carries it), so
+    those FUs are never reassembled; IRAP pictures less than
+    keyframe_interval seconds (by RTP timestamp) after the last one passed
+    are dropped the same way."""
+
+    def __init__(self, wait_for_irap_after_loss=False, keyframes_only=False, keyframe_interval=0.0,
+                 clock_rate=90000):
+        # key: (ssrc, timestamp) -> FragmentedNAL in progress
+        self.fragments = {}
+        self.fragment_timeout = 0.5  # 500ms timeout for fragments
+        # Loss concealment policy: after mark_loss(), drop VCL NALs of the
+        # stream until the next IRAP instead of decoding broken pictures
+        self.wait_for_irap_after_loss = wait_for_irap_after_loss
+        self.waiting_for_irap = set()
+        self.keyframes_only = keyframes_only
+        self.keyframe_ticks = int(keyframe_interval * clock_rate)
+        self.last_keyframe = {}  # ssrc -> RTP timestamp of the last IRAP picture passed
+        self.stats = {
+            'fu_completed': 0,
+            'fu_dropped_gap': 0,        # a fragment in the middle was lost
+            'fu_dropped_incomplete': 0,  # a new start arrived before the end
+            'fu_dropped_orphan': 0,     # continuation without a start
+            'fu_timed_out': 0,
+            'nal_skipped_after_loss': 0,
+            'non_irap_skipped': 0,      # keyframes_only: NAL units of other pictures
+            'irap_rate_limited': 0,     # keyframes_only: IRAP NAL units within keyframe_interval
+            'fu_fragments_skipped': 0,  # keyframes_only: FU packets dropped without reassembly
+        }
+
+    def mark_loss(self, ssrc):
+        """Called when packets of ssrc are known to be lost (e.g. by the jitter buffer)"""
+        # Any NAL in progress spans the gap, so it cannot be completed
+        for key in [k for k in self.fragments if k[0] == ssrc]:
+            del self.fragments[key]
+            self.stats['fu_dropped_gap'] += 1
+        if self.wait_for_irap_after_loss:
+            self.waiting_for_irap.add(ssrc)
+
+    def skip_nal(self, ssrc, nal_type):
+        """True if a NAL of nal_type must be dropped because ssrc is waiting for an IRAP"""
+        if ssrc not in self.waiting_for_irap:
+            return False
+        if nal_type in IRAP_TYPES:
+            self.waiting_for_irap.discard(ssrc)
+            return False
+        if nal_type in NON_VCL_TYPES:
+            return False
+        self.stats['nal_skipped_after_loss'] += 1
+        return True
+
+    def skip_non_keyframe(self, ssrc, timestamp, nal_type):
+        """keyframes_only: True if a VCL NAL of nal_type is not to be decoded"""
+        if nal_type not in IRAP_TYPES:
+            self.stats['non_irap_skipped'] += 1
+            return True
+        last = self.last_keyframe.get(ssrc)
+        # Slices of the picture already passed have its timestamp; a
+        # timestamp before the last one restarts the interval
+        if last is not None and 0 < (timestamp - last) & 0xFFFFFFFF < self.keyframe_ticks:
+            self.stats['irap_rate_limited'] += 1
+            return True
+        self.last_keyframe[ssrc] = timestamp
+        return False
+
+    def process_packet(self, packet):
+        """Depacketize one RTP packet. Returns its complete NAL units as
+        Annex-B bytes, or None."""
+        nals = self.depacketize(packet)
+        if not nals:
+            return None
+        if len(nals) == 1 and len(nals[0]) == 1:
+            return START_CODE + nals[0][0]
+        parts = []
+        for nal in nals:
+            parts.append(START_CODE)
+            parts.extend(nal)
+        return b''.join(parts)
+
+    def depacketize(self, packet):
+        """Depacketize one RTP packet without copying. Returns the complete NAL
+        units it carries, each as a list of buffers starting with the NAL
+        header (no start code), that stay valid as long as the packets do."""
+        if len(packet.payload) < 2:
+            return []
+
+        # Parse H.265 NAL unit header
+        nal_header = struct.unpack('!H', packet.payload[0:2])[0]
+        nal_type = (nal_header >> 9) & 0x3F
+
+        if nal_type == 49:  # Fragmentation Unit (FU)
+            return self.handle_fu(packet)
+        elif nal_type == 48:  # Aggregation Packet (AP)
+            return self.handle_ap(packet)
+        else:  # Single NAL unit
+            return self.handle_single_nal(packet)
+
+    def handle_single_nal(self, packet):
+        # Single NAL unit packet
+        if self.keyframes_only:
+            nal_type = (packet.payload[0] >> 1) & 0x3F
+            if nal_type < FIRST_NON_VCL_TYPE and self.skip_non_keyframe(packet.ssrc, packet.timestamp, nal_type):
+                return []
+        if self.waiting_for_irap and self.skip_nal(packet.ssrc, (packet.payload[0] >> 1) & 0x3F):
+            return []
+        return [[packet.payload]]
+
+    def handle_fu(self, packet):
+        payload = packet.payload
+        if len(payload) < 3:
+            return []
+
+        # Parse FU header
+        fu_header = payload[2]
+        start_bit = (fu_header >> 7) & 0x01
+        end_bit = (fu_header >> 6) & 0x01
+        fu_type = fu_header & 0x3F
+        key = (packet.ssrc, packet.timestamp)
+
+        if self.keyframes_only and fu_type < FIRST_NON_VCL_TYPE:
+            if start_bit:
+                skip = self.skip_non_keyframe(packet.ssrc, packet.timestamp, fu_type)
+            else:
+                # The rest of a NAL whose start was skipped (or lost)
+                skip = fu_type not in IRAP_TYPES or self.last_keyframe.get(packet.ssrc) != packet.timestamp
+            if skip:
+                self.stats['fu_fragments_skipped'] += 1
+                return []
+
+        if start_bit:
+            if self.waiting_for_irap and self.skip_nal(packet.ssrc, fu_type):
+                return []
+
+            # Reconstruct NAL header
+            nal_header = struct.unpack('!H', payload[0:2])[0]
+            nal_header = (nal_header & 0x81FF) | (fu_type << 9)
+
+            if key in self.fragments:
+                # The previous NAL of this picture never saw its end bit
+                self.stats['fu_dropped_incomplete'] += 1
+
+            state = FragmentedNAL(nal_header, payload[3:], packet.sequence)
+            if end_bit:
+                self.fragments.pop(key, None)
+                self.stats['fu_completed'] += 1
+                return [state.chunks]
+            self.fragments[key] = state
+            return []
+
+        state = self.fragments.get(key)
+        if state is None:
+            if packet.ssrc not in self.waiting_for_irap:
+                self.stats['fu_dropped_orphan'] += 1
+            return []
+
+        if packet.sequence != state.next_sequence:
+            # A fragment is missing: the NAL would be corrupt, so drop it
+            # rather than hand a broken slice to the decoder
+            del self.fragments[key]
+            self.stats['fu_dropped_gap'] += 1
+            return []
+
+        state.append(payload[3:], packet.sequence)
+
+        if end_bit:
+            # End of fragmented NAL unit
+            del self.fragments[key]
+            self.stats['fu_completed'] += 1
+            return [state.chunks]
+
+        return []
+
+    def cleanup_old_fragments(self):
+        """Remove fragments that have timed out"""
+        current_time = time.time()
+        keys_to_delete = [
+            k for k, v in self.fragments.items()
+            if current_time - v.updated > self.fragment_timeout
+        ]
+        for key in keys_to_delete:
+            del self.fragments[key]
+        self.stats['fu_timed_out'] += len(keys_to_delete)
+
+    def handle_ap(self, packet):
+        # Aggregation packet - contains multiple NAL units
+        nalus = []
+        payload = packet.payload
+        offset = 2  # Skip NAL header
+
+        while offset < len(payload):
+            if offset + 2 > len(payload):
+                break
+
+            nal_size = struct.unpack('!H', payload[offset:offset+2])[0]
+            offset += 2
+
+            if offset + nal_size > len(payload):
+                break
+
+            nal_data = payload[offset:offset+nal_size]
+            offset += nal_size
+            if not nal_size:
+                continue
+            if self.keyframes_only:
+                nal_type = (nal_data[0] >> 1) & 0x3F
+                if nal_type < FIRST_NON_VCL_TYPE and self.skip_non_keyframe(packet.ssrc, packet.timestamp, nal_type):
+                    continue
+            if self.waiting_for_irap and self.skip_nal(packet.ssrc, (nal_data[0] >> 1) & 0x3F):
+                continue
+            nalus.append([nal_data])
+
+        return nalus
@@ -3,198 +3,309 @@
 Extract H.265 Elementary Stream from RTP packets in PCAP file
 """
 
-import struct
+import os
 import sys
-from scapy.all import *
 import argparse
+from pcap_reader import PcapReader, parse_udp
+from rtp import RTPPacket
+from depacketizer import START_CODE, H265RTPDepacketizer
+from demux import StreamDemuxer
+from nal_index import index_path
 
-class RTPPacket:
-    def __init__(self, data):
-        self.data = data
-        self.parse()
-    
-    def parse(self):
-        if len(self.data) < 12:
-            raise ValueError("Invalid RTP packet size")
-        
-        # Parse RTP header
-        byte0 = self.data[0]
-        self.version = (byte0 >> 6) & 0x03
-        self.padding = (byte0 >> 5) & 0x01
-        self.extension = (byte0 >> 4) & 0x01
-        self.cc = byte0 & 0x0F
-        
-        byte1 = self.data[1]
-        self.marker = (byte1 >> 7) & 0x01
-        self.payload_type = byte1 & 0x7F
-        
-        self.sequence = struct.unpack('!H', self.data[2:4])[0]
-        self.timestamp = struct.unpack('!I', self.data[4:8])[0]
-        self.ssrc = struct.unpack('!I', self.data[8:12])[0]
-        
-        # Calculate payload offset
-        self.header_size = 12 + (self.cc * 4)
-        if self.extension:
-            ext_header_start = self.header_size
-            if ext_header_start + 4 <= len(self.data):
-                ext_length = struct.unpack('!H', self.data[ext_header_start+2:ext_header_start+4])[0]
-                self.header_size += 4 + (ext_length * 4)
-        
-        self.payload = self.data[self.header_size:]
+NAL_NAMES = {
+    32: "VPS", 33: "SPS", 34: "PPS", 35: "AUD", 39: "PREFIX_SEI", 40: "SUFFIX_SEI",
+    16: "BLA_W_LP", 17: "BLA_W_RADL", 18: "BLA_N_LP",
+    19: "IDR_W_RADL", 20: "IDR_N_LP", 21: "CRA_NUT",
+    1: "TRAIL_R", 0: "TRAIL_N", 2: "TSA_N", 3: "TSA_R", 4: "STSA_N", 5: "STSA_R",
+    6: "RADL_N", 7: "RADL_R", 8: "RASL_N", 9: "RASL_R"
+}
 
-class H265RTPDepacketizer:
-    def __init__(self):
-        self.fragments = {}
-        self.packets = []
-        
-    def process_packet(self, packet):
-        if len(packet.payload) < 2:
-            return None
-        
-        # Parse H.265 NAL unit header
-        nal_header = struct.unpack('!H', packet.payload[0:2])[0]
-        nal_type = (nal_header >> 9) & 0x3F
-        
-        if nal_type == 49:  # Fragmentation Unit (FU)
-            return self.handle_fu(packet)
-        elif nal_type == 48:  # Aggregation Packet (AP)
-            return self.handle_ap(packet)
-        else:  # Single NAL unit
-            return self.handle_single_nal(packet)
-    
-    def handle_single_nal(self, packet):
-        # Single NAL unit packet
-        return b'\x00\x00\x00\x01' + packet.payload
-    
-    def handle_fu(self, packet):
-        if len(packet.payload) < 3:
+# Capture pages behind the read position are released from memory this often
+RELEASE_INTERVAL = 8 * 1024 * 1024
+WRITE_BUFFER = 4 * 1024 * 1024
+# FU reassemblies kept open per stream; older ones never saw their end packet
+MAX_OPEN_FRAGMENTS = 16
+
+class ExtractedStream:
+    """Output of one RTP stream: NAL units are written as they are completed"""
+    def __init__(self, key):
+        self.key = key
+        self.depacketizer = H265RTPDepacketizer()
+        self.file = None   # recorder.AnnexBFile, opened at the first NAL unit
+        self.index = None  # nal_index.IndexWriter
+        self.stats = {'writes': 0}
+        self.ignored = False  # a further stream while writing to stdout
+        self.rtp_packet_count = 0
+        self.nal_count = 0
+        self.nal_types = {}
+        # Packet numbers and capture offsets, for resuming an interrupted run
+        self.last_packet = None       # the last packet of the stream
+        self.last_output = None       # the last packet that completed a NAL unit
+        self.fragment_start = None    # the last FU start packet
+        self.last_timestamp = None
+
+    def resume_point(self):
+        """(packet number, capture offset) to resume from so that nothing is
+        written twice: the start of the NAL unit still being reassembled, or
+        the packet after the last one"""
+        if self.last_packet is None:
             return None
-        
-        # Parse FU header
-        fu_header = packet.payload[2]
-        start_bit = (fu_header >> 7) & 0x01
-        end_bit = (fu_header >> 6) & 0x01
-        fu_type = fu_header & 0x3F
-        
-        # Reconstruct NAL header
-        nal_header = struct.unpack('!H', packet.payload[0:2])[0]
-        nal_header = (nal_header & 0x81FF) | (fu_type << 9)
-        
-        if start_bit:
-            # Start of fragmented NAL unit
-            self.fragments[packet.timestamp] = struct.pack('!H', nal_header) + packet.payload[3:]
-        elif packet.timestamp in self.fragments:
-            # Continuation of fragmented NAL unit
-            self.fragments[packet.timestamp] += packet.payload[3:]
-            
-            if end_bit:
-                # End of fragmented NAL unit
-                nal_data = self.fragments.pop(packet.timestamp)
-                return b'\x00\x00\x00\x01' + nal_data
-        
-        return None
+        fragments = self.depacketizer.fragments
+        live = any(timestamp == self.last_timestamp for _, timestamp in fragments)
+        if live and self.fragment_start is not None and (
+                self.last_output is None or self.fragment_start[0] > self.last_output[0]):
+            return self.fragment_start
+        number, offset = self.last_packet
+        return number + 1, offset + 1
+
+def stream_output_path(output_file, key, stream_count):
+    """One stream keeps output_file; several get the stream identity appended"""
+    if stream_count == 1:
+        return output_file
+    base, ext = os.path.splitext(output_file)
+    src = key.src_ip.replace(':', '-')
+    return f"{base}_{src}_{key.sport}_{key.ssrc:08x}{ext or '.h265'}"
+
+def capture_datagrams(reader, port, start_packet=0, start_byte=0):
+    """Reader stage: (packet number, capture offset, UDPDatagram) for the UDP
+    datagrams on port, from the first captured packet at or after
+    start_packet (counting from 0) and capture file offset start_byte"""
+    view = reader.view
+    released = 0
+    for linktype, timestamp, offset, caplen in reader.frames():
+        if offset - released >= RELEASE_INTERVAL:
+            # Everything before offset: queued output may have touched earlier pages again
+            reader.release(offset)
+            released = offset
+        number = reader.packet_count - 1
+        if number < start_packet or offset < start_byte:
+            continue
+        datagram = parse_udp(linktype, view[offset:offset + caplen], timestamp, port)
+        if datagram is not None:
+            yield number, offset, datagram
+
+def rtp_packets(datagrams, demuxer):
+    """Demux stage: (packet number, capture offset, stream, RTPPacket)"""
+    for number, offset, datagram in datagrams:
+        # UDP payload (RTP data), a view into the capture file
+        if len(datagram.payload) < 12:
+            continue
+        try:
+            packet = RTPPacket(datagram.payload)
+        except ValueError as e:
+            print(f"Error processing packet {number}: {e}")
+            continue
+        # Streams from different senders sharing the port are kept apart
+        stream = demuxer.lookup(datagram.src, datagram.sport, datagram.dport, packet.ssrc, datagram.timestamp)
+        if stream is None:
+            continue
+        stream.rtp_packet_count += 1
+        yield number, offset, stream, packet
+
+def nal_units(packets):
+    """Depacketize stage: (stream, NAL unit chunks without start code, RTP
+    timestamp) for every NAL unit completed, uncopied"""
+    for number, offset, stream, packet in packets:
+        depacketizer = stream.depacketizer
+        payload = packet.payload
+        if len(payload) > 2 and (payload[0] >> 1) & 0x3F == 49 and payload[2] & 0x80:
+            stream.fragment_start = (number, offset)
+        nals = depacketizer.depacketize(packet)
+        for nal in nals:
+            yield stream, nal, packet.timestamp
+        if nals:
+            stream.last_output = (number, offset)
+        stream.last_packet = (number, offset)
+        stream.last_timestamp = packet.timestamp
+        fragments = depacketizer.fragments
+        if len(fragments) > MAX_OPEN_FRAGMENTS:
+            # Capture time, not wall time: give up on the oldest reassemblies
+            for key in sorted(fragments, key=lambda k: fragments[k].updated)[:-MAX_OPEN_FRAGMENTS]:
+                del fragments[key]
+                depacketizer.stats['fu_timed_out'] += 1
+
+def _open_output(stream, output_file, outputs, append, buffer_size):
+    """Open the output of a new stream. The first stream writes to
+    output_file; once there are several, each gets its own name and a
+    stream already writing to output_file is renamed."""
+    from nal_index import IndexWriter
+    from recorder import AnnexBFile
     
-    def handle_ap(self, packet):
-        # Aggregation packet - contains multiple NAL units
-        nalus = []
-        offset = 2  # Skip NAL header
-        
-        while offset < len(packet.payload):
-            if offset + 2 > len(packet.payload):
-                break
-            
-            nal_size = struct.unpack('!H', packet.payload[offset:offset+2])[0]
-            offset += 2
-            
-            if offset + nal_size > len(packet.payload):
-                break
-            
-            nal_data = packet.payload[offset:offset+nal_size]
-            nalus.append(b'\x00\x00\x00\x01' + nal_data)
-            offset += nal_size
-        
-        return b''.join(nalus) if nalus else None
+    if outputs and outputs[0].file.path == output_file:
+        first = outputs[0]
+        path = stream_output_path(output_file, first.key, 2)
+        os.replace(output_file, path)
+        first.file.path = path
+        first.index.rename(path)
+    path = stream_output_path(output_file, stream.key, 2)
+    if not outputs and not (append and os.path.exists(path)):
+        path = output_file
+    stream.file = AnnexBFile(path, stream.stats, buffer_size=buffer_size, append=append)
+    stream.index = IndexWriter(path, append=append)
+    outputs.append(stream)
 
-def extract_h265_stream(pcap_file, output_file, port=5004):
-    """Extract H.265 elementary stream from PCAP file"""
+def extract_h265_stream(pcap_file, output_file, port=5004, verbose=False, start_packet=0, start_byte=0,
+                        append=False, buffer_size=WRITE_BUFFER):
+    """Extract one H.265 elementary stream per RTP stream from PCAP file, each
+    with a NAL index sidecar (nal_index.py) holding the RTP timestamps.
+    
+    The capture is read as a pipeline of generators (capture_datagrams ->
+    rtp_packets -> nal_units) and every NAL unit is written as soon as it
+    is complete, through a writer that makes one writev() per buffer_size
+    bytes, so memory does not grow with the capture. output_file '-' writes
+    the first stream to stdout (no sidecar) and the log to stderr.
+    start_packet / start_byte skip the capture before them and append
+    continues existing output files, to resume an interrupted run.
+    Returns the list of files written (empty on failure)."""
     
-    print(f"Reading PCAP file: {pcap_file}")
+    to_stdout = output_file == '-'
+    log = sys.stderr if to_stdout else sys.stdout
+    print(f"Reading PCAP file: {pcap_file}", file=log)
     
     try:
-        packets = rdpcap(pcap_file)
+        reader = PcapReader(pcap_file)
     except Exception as e:
-        print(f"Error reading PCAP file: {e}")
-        return False
+        print(f"Error reading PCAP file: {e}", file=log)
+        return []
     
-    depacketizer = H265RTPDepacketizer()
-    nal_units = []
-    packet_count = 0
-    rtp_packet_count = 0
+    demuxer = StreamDemuxer(ExtractedStream)
+    outputs = []  # streams being written, in order of appearance
+    interrupted = None
     
-    print(f"Processing {len(packets)} packets...")
+    print(f"Processing packets ({reader.format})...", file=log)
+    if start_packet or start_byte:
+        print(f"Starting at packet {start_packet}, capture offset {start_byte}", file=log)
     
-    for pkt in packets:
-        packet_count += 1
-        
-        # Filter UDP packets on specified port
-        if not (pkt.haslayer(UDP) and (pkt[UDP].dport == port or pkt[UDP].sport == port)):
-            continue
-        
-        try:
-            # Extract UDP payload (RTP data)
-            rtp_data = bytes(pkt[UDP].payload)
-            
-            if len(rtp_data) < 12:
-                continue
-            
-            rtp_packet = RTPPacket(rtp_data)
-            rtp_packet_count += 1
+    pipeline = nal_units(rtp_packets(capture_datagrams(reader, port, start_packet, start_byte), demuxer))
+    try:
+        for stream, nal, timestamp in pipeline:
+            if stream.file is None:
+                if stream.ignored:
+                    continue
+                if to_stdout:
+                    if outputs:
+                        stream.ignored = True
+                        print(f"Ignoring stream {stream.key}: only one stream can go to stdout", file=log)
+                        continue
+                    from recorder import AnnexBFile
+                    stream.file = AnnexBFile('<stdout>', stream.stats, buffer_size=buffer_size,
+                                             fd=sys.stdout.fileno())
+                    outputs.append(stream)
+                else:
+                    _open_output(stream, output_file, outputs, append, buffer_size)
             
-            # Process RTP packet to extract NAL units
-            nal_data = depacketizer.process_packet(rtp_packet)
+            size = 4 + sum(map(len, nal))
+            nal_type = (nal[0][0] >> 1) & 0x3F
+            offset = stream.file.size
+            stream.file.write([START_CODE] + nal, size, timestamp, False)
+            if stream.index is not None:
+                stream.index.add(offset, size, nal_type, timestamp)
+            stream.nal_count += 1
+            stream.nal_types[nal_type] = stream.nal_types.get(nal_type, 0) + 1
             
-            if nal_data:
-                nal_units.append(nal_data)
-                
-                # Print NAL unit info
-                if len(nal_data) >= 6:
-                    nal_type = (nal_data[5] >> 1) & 0x3F
-                    nal_names = {
-                        32: "VPS", 33: "SPS", 34: "PPS",
-                        19: "IDR_W_RADL", 20: "IDR_N_LP", 21: "CRA_NUT",
-                        1: "TRAIL_R", 0: "TRAIL_N"
-                    }
-                    nal_name = nal_names.get(nal_type, f"Type_{nal_type}")
-                    print(f"NAL Unit: {nal_name} ({nal_type}), Size: {len(nal_data)} bytes, Timestamp: {rtp_packet.timestamp}")
-                
-        except Exception as e:
-            print(f"Error processing packet {packet_count}: {e}")
-            continue
+            # Print NAL unit info (slow for large captures, so only on request)
+            if verbose:
+                nal_name = NAL_NAMES.get(nal_type, f"Type_{nal_type}")
+                print(f"NAL Unit: {nal_name} ({nal_type}), Size: {size} bytes, Timestamp: {timestamp}", file=log)
+    except (KeyboardInterrupt, BrokenPipeError) as e:
+        interrupted = e
+    finally:
+        pipeline.close()
+        for stream in outputs:
+            try:
+                stream.file.close()
+            except BrokenPipeError as e:
+                interrupted = interrupted or e
+            if stream.index is not None:
+                # After the stream file, so that the sidecar is not older
+                stream.index.close()
+        packet_count = reader.packet_count
+        reader.close()
     
-    print(f"\nProcessed {packet_count} total packets, {rtp_packet_count} RTP packets")
-    print(f"Extracted {len(nal_units)} NAL units")
+    print(f"\nProcessed {packet_count} total packets, "
+          f"{sum(s.rtp_packet_count for _, s in demuxer)} RTP packets", file=log)
+    print(f"Found {len(demuxer)} RTP stream(s)", file=log)
+    if demuxer.rejected:
+        print(f"Ignored {demuxer.rejected} packets beyond {demuxer.max_streams} streams", file=log)
     
-    if not nal_units:
-        print("No H.265 NAL units found!")
-        return False
+    written = []
+    for key, stream in demuxer:
+        print(f"\nStream {key}: {stream.rtp_packet_count} RTP packets", file=log)
+        print(f"Extracted {stream.nal_count} NAL units", file=log)
+        stats = stream.depacketizer.stats
+        dropped = stats['fu_dropped_gap'] + stats['fu_dropped_incomplete'] + stats['fu_timed_out']
+        if dropped:
+            print(f"Dropped {dropped} incomplete fragmented NAL units", file=log)
+        
+        if stream.file is None:
+            continue
+        
+        print(f"H.265 elementary stream saved to: {stream.file.path}", file=log)
+        print(f"Total stream size: {stream.file.size:,} bytes ({stream.stats['writes']} writes)", file=log)
+        print("NAL units: " + ', '.join(f"{NAL_NAMES.get(t, f'Type_{t}')} {c}"
+                                        for t, c in sorted(stream.nal_types.items())), file=log)
+        if stream.index is not None:
+            print(f"NAL index saved to: {index_path(stream.file.path)}", file=log)
+        written.append(stream.file.path)
     
-    # Write elementary stream to file
-    total_size = 0
-    with open(output_file, 'wb') as f:
-        for nal in nal_units:
-            f.write(nal)
-            total_size += len(nal)
+    if interrupted is not None:
+        reason = 'Output closed' if isinstance(interrupted, BrokenPipeError) else 'Interrupted'
+        resume = [p for p in (s.resume_point() for s in outputs) if p is not None]
+        if resume:
+            number, offset = min(resume)
+            print(f"\n{reason}; resume with --start-packet {number} (or --start-byte {offset})"
+                  + ('' if to_stdout else ' --append'), file=log)
+            if len(resume) > 1:
+                print("With several streams this is the earliest point; the others repeat a few NAL units",
+                      file=log)
+        else:
+            print(f"\n{reason}", file=log)
+    elif not written:
+        print("No H.265 NAL units found!", file=log)
     
-    print(f"H.265 elementary stream saved to: {output_file}")
-    print(f"Total stream size: {total_size:,} bytes")
+    return written
+
+def analyze(args):
+    """--analyze: one pass over the capture, aggregated counters only"""
+    from stream_analysis import analyze_capture, print_summary, write_csv, write_html, write_json
     
-    return True
+    try:
+        report = analyze_capture(args.pcap_file, args.port)
+    except (OSError, ValueError) as e:
+        print(f"Error reading PCAP file: {e}")
+        sys.exit(1)
+    print_summary(report)
+    report_file = args.report or f"{os.path.splitext(args.pcap_file)[0]}.report.json"
+    write_json(report, report_file)
+    print(f"\nReport saved to: {report_file}")
+    if args.csv:
+        write_csv(report, args.csv)
+        print(f"Timeline saved to: {args.csv}")
+    if args.html:
+        write_html(report, args.html)
+        print(f"HTML summary saved to: {args.html}")
+    if not report['streams']:
+        sys.exit(1)
 
 def main():
     parser = argparse.ArgumentParser(description='Extract H.265 Elementary Stream from PCAP file')
     parser.add_argument('pcap_file', help='Input PCAP file')
-    parser.add_argument('-o', '--output', default='stream.h265', help='Output H.265 file (default: stream.h265)')
+    parser.add_argument('-o', '--output', default='stream.h265',
+                        help='Output H.265 file, "-" for stdout (default: stream.h265)')
     parser.add_argument('-p', '--port', type=int, default=5004, help='RTP port number (default: 5004)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print every NAL unit')
+    parser.add_argument('--start-packet', type=int, default=0,
+                        help='Skip the captured packets before this one (counting from 0), to resume')
+    parser.add_argument('--start-byte', type=int, default=0,
+                        help='Skip the captured packets before this capture file offset, to resume')
+    parser.add_argument('--append', action='store_true',
+                        help='Append to existing output files (and their NAL index) instead of replacing them')
+    parser.add_argument('--analyze', action='store_true',
+                        help='Write a stream report instead of extracting: per-second bitrate, loss and drift, '
+                             'GOP structure, frame sizes (stream_analysis.py)')
+    parser.add_argument('--report', help='With --analyze: JSON report file (default: <pcap_file>.report.json)')
+    parser.add_argument('--csv', help='With --analyze: also write the per-second timeline as CSV')
+    parser.add_argument('--html', help='With --analyze: also write an HTML summary with charts')
     
     args = parser.parse_args()
     
@@ -202,14 +313,21 @@ def main():
         print(f"Error: PCAP file not found: {args.pcap_file}")
         sys.exit(1)
     
-    success = extract_h265_stream(args.pcap_file, args.output, args.port)
+    if args.analyze:
+        analyze(args)
+        return
     
-    if success:
-        print(f"\nYou can now play the extracted stream with:")
-        print(f"ffplay {args.output}")
-        print(f"vlc {args.output}")
-    else:
+    written = extract_h265_stream(args.pcap_file, args.output, args.port, verbose=args.verbose,
+                                  start_packet=args.start_packet, start_byte=args.start_byte,
+                                  append=args.append)
+    
+    if not written:
         sys.exit(1)
+    if args.output != '-':
+        print(f"\nYou can now play the extracted stream with:")
+        for path in written:
+            print(f"ffplay {path}")
+            print(f"vlc {path}")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Forward error correction with row/column XOR parity
+(RFC 8627 FlexFEC, fixed L/D mode). The sender adds a parity packet after
+every L media packets of a stream (row) and, with D > 1, after every L x D
+block one parity packet for each of its L columns. The receiver keeps a window
+of recent media packets and rebuilds a missing one from any parity packet
+that lacks only that packet; a rebuilt packet can complete further parity
+packets in turn. Packets are XORed as rows of one NumPy array.
+
+FEC header (20 bytes, after the parity packet's own RTP header):
+
+    R=0 F=1 P X CC | M PT recovery | length recovery
+    TS recovery
+    SSRCCount=1 | reserved
+    SSRC of the media stream
+    SN base | L | D
+
+D = 0 protects the L packets from SN base on (row), D > 0 the D packets
+SN base + i * L (column).
+"""
+
+import struct
+from collections import deque
+
+import numpy as np
+
+FEC_PAYLOAD_TYPE = 100
+
+# R/F/P/X/CC, M/PT recovery, length recovery, TS recovery, SSRCCount, reserved,
+# SSRC, SN base, L, D
+FEC_HEADER = struct.Struct('!BBHIB3xIHBB')
+_RTP_HEADER = struct.Struct('!BBHII')
+_F_BIT = 0x40
+
+# Media packets (and parity packets waiting for them) kept for recovery
+DEFAULT_WINDOW = 1024
+
+
+def _xor(buffers, size):
+    """XOR of the buffers, each zero-padded to size bytes"""
+    rows = np.zeros((len(buffers), size), dtype=np.uint8)
+    for row, data in zip(rows, buffers):
+        row[:len(data)] = np.frombuffer(data, dtype=np.uint8)
+    return np.bitwise_xor.reduce(rows, axis=0)
+
+
+def parse_config(text):
+    """(L, D) from 'L' (rows only) or 'LxD' (rows and columns)"""
+    columns, _, rows = text.lower().partition('x')
+    columns, rows = int(columns), int(rows or 0)
+    if not 0 < columns <= 255 or not 0 <= rows <= 255:
+        raise ValueError(f"Invalid FEC configuration: {text}")
+    return columns, rows
+
+
+class FecEncoder:
+    """Parity packets for the media packets of one stream.
+
+    columns (L) consecutive packets form a row; with rows (D) > 1, L x D
+    packets form a block whose columns are protected too. The media
+    sequence numbers must be consecutive; a gap starts a new block.
+    """
+
+    def __init__(self, media_ssrc, columns=10, rows=0, payload_type=FEC_PAYLOAD_TYPE, ssrc=None, sequence=0):
+        self.media_ssrc = media_ssrc
+        self.columns = columns
+        self.rows = rows if rows > 1 else 0
+        self.payload_type = payload_type
+        self.ssrc = media_ssrc ^ 0x80000000 if ssrc is None else ssrc
+        self.sequence = sequence
+        self.block = []
+        self.stats = {
+            'media': 0,
+            'rows': 0,
+            'columns': 0,
+        }
+
+    @property
+    def overhead(self):
+        """Parity packets per media packet"""
+        return 1.0 / self.columns + (1.0 / self.rows if self.rows else 0.0)
+
+    def parity(self, packets, base, d):
+        """The parity packet protecting packets (raw RTP, starting at sequence base)"""
+        size = max(len(p) for p in packets)
+        xored = _xor(packets, size)
+        length = 0
+        for p in packets:
+            length ^= len(p) - 12
+        byte0, byte1, _, timestamp, _ = _RTP_HEADER.unpack_from(xored[:12].tobytes())
+        header = FEC_HEADER.pack(_F_BIT | (byte0 & 0x3F), byte1, length, timestamp, 1,
+                                 self.media_ssrc, base, self.columns, d)
+        last_timestamp = _RTP_HEADER.unpack_from(packets[-1])[3]
+        rtp = _RTP_HEADER.pack(0x80, self.payload_type, self.sequence, last_timestamp, self.ssrc)
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        return rtp + header + xored[12:].tobytes()
+
+    def protect(self, data):
+        """Add one media packet; returns the parity packets to send after it"""
+        sequence = _RTP_HEADER.unpack_from(data)[2]
+        if self.block:
+            first = _RTP_HEADER.unpack_from(self.block[0])[2]
+            if (sequence - first) & 0xFFFF != len(self.block):
+                self.block = []
+        self.block.append(data)
+        self.stats['media'] += 1
+        block = self.block
+        parity = []
+        if len(block) % self.columns == 0:
+            row = block[-self.columns:]
+            parity.append(self.parity(row, _RTP_HEADER.unpack_from(row[0])[2], 0))
+            self.stats['rows'] += 1
+        if len(block) == self.columns * max(1, self.rows):
+            if self.rows:
+                base = _RTP_HEADER.unpack_from(block[0])[2]
+                for column in range(self.columns):
+                    parity.append(self.parity(block[column::self.columns], (base + column) & 0xFFFF, self.rows))
+                    self.stats['columns'] += 1
+            self.block = []
+        return parity
+
+    def protect_stream(self, datagrams):
+        """The datagrams with the parity packets inserted after the packets they protect"""
+        result = []
+        for data in datagrams:
+            result.append(data)
+            result.extend(self.protect(data))
+        return result
+
+
+class _Parity:
+    """A received parity packet: what it protects and its recovery fields"""
+
+    __slots__ = ('sequences', 'byte0', 'byte1', 'length', 'timestamp', 'ssrc', 'repair', 'missing')
+
+    def __init__(self, payload):
+        flags, self.byte1, self.length, self.timestamp, _, self.ssrc, base, l, d = FEC_HEADER.unpack_from(payload)
+        if not flags & _F_BIT or not l:
+            raise ValueError("Not a fixed L/D FEC packet")
+        self.byte0 = flags & 0x3F
+        if d:
+            self.sequences = tuple((base + i * l) & 0xFFFF for i in range(d))
+        else:
+            self.sequences = tuple((base + i) & 0xFFFF for i in range(l))
+        self.repair = payload[FEC_HEADER.size:]
+        self.missing = None
+
+
+def protected_ssrc(packet):
+    """SSRC of the media stream a parity RTPPacket protects"""
+    return FEC_HEADER.unpack_from(packet.payload)[5]
+
+
+class FecDecoder:
+    """Rebuilds lost media packets of one stream from parity packets.
+
+    add_media() and add_fec() return the media packets (raw RTP) they made
+    recoverable. Parity packets missing two or more packets wait until one
+    of them arrives or is rebuilt, as long as their packets are within the
+    last window sequence numbers; packets still missing then count as
+    unrecoverable.
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.window = window
+        self.packets = {}     # sequence -> raw media packet
+        self.order = deque()  # sequences in packets, oldest first
+        self.pending = []     # _Parity missing two or more packets
+        self.missing = set()  # sequences a parity packet protects that never arrived
+        self.highest = None
+        self.stats = {
+            'parity': 0,         # parity packets received
+            'recovered': 0,      # media packets rebuilt
+            'unrecoverable': 0,  # protected media packets that could not be rebuilt
+            'unneeded': 0,       # parity packets whose media packets all arrived
+        }
+
+    def _store(self, sequence, data):
+        if sequence in self.packets:
+            return False
+        self.packets[sequence] = data
+        self.order.append(sequence)
+        if len(self.order) > self.window:
+            del self.packets[self.order.popleft()]
+        if self.highest is None or 0 < (sequence - self.highest) & 0xFFFF < 0x8000:
+            self.highest = sequence
+        return True
+
+    def add_media(self, data, sequence):
+        """A media packet arrived. Returns the packets it made recoverable."""
+        if not self._store(sequence, data):
+            return []
+        recovered = []
+        if sequence in self.missing:
+            self.missing.discard(sequence)
+            recovered = self._retry(sequence)
+        if self.pending:
+            self._expire()
+        return recovered
+
+    def add_fec(self, payload):
+        """A parity packet arrived (its RTP payload). Returns the packets it rebuilt."""
+        try:
+            parity = _Parity(payload)
+        except (ValueError, struct.error):
+            return []
+        self.stats['parity'] += 1
+        parity.missing = [s for s in parity.sequences if s not in self.packets]
+        if not parity.missing:
+            self.stats['unneeded'] += 1
+            return []
+        if self.highest is not None and self._too_old(parity.sequences[-1]):
+            # Its packets have left the window
+            return []
+        if len(parity.missing) > 1:
+            self.pending.append(parity)
+            self.missing.update(parity.missing)
+            return []
+        return self._recover(parity)
+
+    def _too_old(self, sequence):
+        age = (self.highest - sequence) & 0xFFFF
+        return self.window < age < 0x8000
+
+    def _recover(self, parity):
+        """Rebuild the one packet parity lacks, then whatever that completes"""
+        recovered = []
+        work = [parity]
+        while work:
+            parity = work.pop()
+            sequence = parity.missing[0]
+            if sequence in self.packets:
+                continue
+            data = self._rebuild(parity, sequence)
+            if data is None:
+                continue
+            self._store(sequence, data)
+            self.missing.discard(sequence)
+            self.stats['recovered'] += 1
+            recovered.append(data)
+            work.extend(self._ready(sequence))
+        return recovered
+
+    def _retry(self, sequence):
+        return [data for parity in self._ready(sequence) for data in self._recover(parity)]
+
+    def _ready(self, sequence):
+        """Pending parity packets that lack only one packet now that sequence is known"""
+        ready = []
+        still = []
+        for parity in self.pending:
+            if sequence in parity.missing:
+                parity.missing.remove(sequence)
+            if len(parity.missing) == 1:
+                ready.append(parity)
+            elif parity.missing:
+                still.append(parity)
+        self.pending = still
+        return ready
+
+    def _rebuild(self, parity, sequence):
+        others = [self.packets[s] for s in parity.sequences if s != sequence]
+        size = max([12 + len(parity.repair)] + [len(p) for p in others])
+        seed = bytearray(size)
+        _RTP_HEADER.pack_into(seed, 0, parity.byte0, parity.byte1, 0, parity.timestamp, 0)
+        seed[12:12 + len(parity.repair)] = parity.repair
+        xored = _xor([seed] + others, size)
+        length = parity.length
+        for p in others:
+            length ^= len(p) - 12
+        if 12 + length > size:
+            return None
+        data = bytearray(xored[:12 + length].tobytes())
+        # Version 2 and the fields the XOR cannot carry
+        data[0] = 0x80 | (data[0] & 0x3F)
+        struct.pack_into('!H', data, 2, sequence)
+        struct.pack_into('!I', data, 8, parity.ssrc)
+        return bytes(data)
+
+    def _expire(self):
+        still = []
+        for parity in self.pending:
+            if self._too_old(parity.sequences[-1]):
+                self._give_up(parity)
+            else:
+                still.append(parity)
+        self.pending = still
+
+    def _give_up(self, parity):
+        for sequence in parity.missing:
+            if sequence in self.missing:
+                self.missing.discard(sequence)
+                self.stats['unrecoverable'] += 1
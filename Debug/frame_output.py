@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Decoded frame output stage
+Decoded pictures stay AVFrames until something needs the pixels: only frames
+that are displayed or consumed are colour-converted (optionally downscaled),
+consumers can read the YUV 4:2:0 planes without any conversion, and the
+conversion can run on its own threads instead of the decode thread
+"""
+
+import queue
+import sys
+import threading
+import time
+
+import numpy as np
+
+# bgr:  convert every frame to BGR on the decode thread (previous behaviour)
+# lazy: convert when the frame is displayed or consumed
+# yuv:  never convert; the preview shows the luma plane
+OUTPUT_MODES = ('bgr', 'lazy', 'yuv')
+
+YUV420_FORMATS = ('yuv420p', 'yuvj420p', 'yuv420p10le')
+
+
+def preview_size(width, height, max_width):
+    """(width, height) scaled down to at most max_width, keeping the aspect ratio
+    and even dimensions; (None, None) keeps the decoded size"""
+    if not max_width or width <= max_width:
+        return None, None
+    scaled_height = int(height * max_width / width)
+    return max_width & ~1, max(2, scaled_height & ~1)
+
+
+class DecodedFrame:
+    """A decoded picture that is converted on first use.
+
+    Holding a DecodedFrame keeps the decoder's AVFrame alive, so consumers
+    should drop it once they are done.
+    """
+
+    __slots__ = ('frame', 'width', 'height', 'timestamp', 'decoded_at', '_bgr', '_bgr_size')
+
+    def __init__(self, frame, decoded_at=None):
+        self.frame = frame
+        self.width = frame.width
+        self.height = frame.height
+        self.timestamp = frame.pts  # RTP timestamp of the access unit, if the decoder was given one
+        self.decoded_at = time.time() if decoded_at is None else decoded_at
+        self._bgr = None
+        self._bgr_size = None
+
+    def planes(self):
+        """Y, U and V as NumPy views over the AVFrame planes (no copy).
+
+        Each view has the visible width; rows keep the decoder's line size as
+        their stride. 10-bit streams give uint16 views.
+        """
+        name = self.frame.format.name
+        if name not in YUV420_FORMATS:
+            raise ValueError(f"Unsupported pixel format for plane access: {name}")
+        dtype = np.uint16 if name.endswith('10le') else np.uint8
+        views = []
+        for plane in self.frame.planes:
+            rows = np.frombuffer(plane, dtype=dtype)
+            rows = rows.reshape(plane.height, plane.line_size // rows.itemsize)
+            views.append(rows[:, :plane.width])
+        return views
+
+    def luma(self):
+        """The Y plane view, a grayscale image without any conversion"""
+        return self.planes()[0]
+
+    def preview(self, max_width=0):
+        """The Y plane as an 8-bit image for display (output='yuv'): 10-bit
+        luma is shifted down, frames wider than max_width are subsampled by a
+        whole step (no filtering). Pixel formats without plane access fall
+        back to to_bgr()."""
+        if self.frame.format.name not in YUV420_FORMATS:
+            return self.to_bgr(*preview_size(self.width, self.height, max_width))
+        luma = self.luma()
+        if max_width and self.width > max_width:
+            step = -(-self.width // max_width)
+            luma = luma[::step, ::step]
+        if luma.dtype != np.uint8:
+            luma = (luma >> 2).astype(np.uint8)
+        return luma
+
+    def to_bgr(self, width=None, height=None):
+        """BGR24 ndarray, scaled to width x height if given. The result of the
+        last size requested is cached."""
+        size = (width, height)
+        if self._bgr is None or self._bgr_size != size:
+            self._bgr = self.frame.to_ndarray(width=width, height=height, format='bgr24',
+                                              interpolation='FAST_BILINEAR' if width else None)
+            self._bgr_size = size
+        return self._bgr
+
+
+class StageTimer:
+    """Accumulated wall time and call count per pipeline stage, safe to share between threads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}  # name -> [seconds, count]
+
+    def add(self, stage, seconds, count=1):
+        with self.lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                self.stages[stage] = [seconds, count]
+            else:
+                entry[0] += seconds
+                entry[1] += count
+
+    def report(self):
+        """{stage: (milliseconds per call, calls)}"""
+        with self.lock:
+            return {stage: (seconds * 1000.0 / count if count else 0.0, count)
+                    for stage, (seconds, count) in self.stages.items()}
+
+
+class FrameConverter:
+    """Converts DecodedFrames to BGR on worker threads.
+
+    swscale runs without the GIL, so conversions overlap with decoding and
+    with each other. Converted (key, image) pairs are passed to output()
+    along with the frame's RTP timestamp; a
+    frame submitted while every worker is busy and the queue is full is
+    dropped before it is converted.
+    """
+
+    def __init__(self, output, threads=1, max_width=0, queue_size=4, timer=None):
+        self.output = output
+        self.threads = threads
+        self.max_width = max_width
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.timer = timer
+        self.workers = []
+        self.running = False
+        self.stats = {
+            'converted': 0,
+            'dropped': 0,
+            'errors': 0,
+        }
+
+    def start(self):
+        self.running = True
+        for _ in range(self.threads):
+            worker = threading.Thread(target=self._run)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        self.running = False
+        for worker in self.workers:
+            worker.join(timeout=1.0)
+        self.workers = []
+
+    def submit(self, key, frame):
+        """Queue a DecodedFrame for conversion. Returns False if it was dropped."""
+        try:
+            self.queue.put_nowait((key, frame))
+        except queue.Full:
+            self.stats['dropped'] += 1
+            return False
+        return True
+
+    def _run(self):
+        while self.running:
+            try:
+                key, frame = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            start = time.perf_counter()
+            try:
+                image = frame.to_bgr(*preview_size(frame.width, frame.height, self.max_width))
+            except Exception as e:
+                # Keep the worker alive; the frame is lost
+                self.stats['errors'] += 1
+                print(f"Convert error: {e!r}", file=sys.stderr)
+                continue
+            if self.timer is not None:
+                self.timer.add('convert', time.perf_counter() - start)
+            self.stats['converted'] += 1
+            self.output((key, image), frame.timestamp)
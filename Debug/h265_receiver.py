@@ -15,206 +15,436 @@ import av
 from io import BytesIO
 import argparse
 import sys
+from collections import Counter
+from rtp import RTPPacket
+from depacketizer import H265RTPDepacketizer
+from jitter_buffer import JitterBuffer
+from access_unit import AccessUnitAssembler
+from demux import StreamDemuxer
+from udp_batch import DatagramBatchReader
+from decode_pool import DEFAULT_SLOT_BYTES, DecodePool, SharedFrame
+from fec import FEC_PAYLOAD_TYPE, FecDecoder, protected_ssrc
+from decoder_options import LOOP_FILTER_SKIP, SKIP_WHEN_BEHIND, THREAD_TYPES, DecoderOptions
+from frame_output import OUTPUT_MODES, DecodedFrame, FrameConverter, preview_size
+from metrics import JsonLinesWriter, MetricsRegistry, MetricsServer, RtpDelay, StageMetrics
+from monitor import Mosaic, MonitorOptions
+from presenter import PRESENT_MODES, FramePresenter
+from recorder import RECORD_FORMATS, RecordOptions, StreamRecorder
+from parameter_sets import ParameterSetCache, StartupGate
+from rtcp import KEYFRAME_REQUESTS, RtcpSession
 
-class RTPPacket:
-    def __init__(self, data):
-        self.data = data
-        self.parse()
-    
-    def parse(self):
-        if len(self.data) < 12:
-            raise ValueError("Invalid RTP packet size")
-        
-        # Parse RTP header
-        byte0 = self.data[0]
-        self.version = (byte0 >> 6) & 0x03
-        self.padding = (byte0 >> 5) & 0x01
-        self.extension = (byte0 >> 4) & 0x01
-        self.cc = byte0 & 0x0F
-        
-        byte1 = self.data[1]
-        self.marker = (byte1 >> 7) & 0x01
-        self.payload_type = byte1 & 0x7F
-        
-        self.sequence = struct.unpack('!H', self.data[2:4])[0]
-        self.timestamp = struct.unpack('!I', self.data[4:8])[0]
-        self.ssrc = struct.unpack('!I', self.data[8:12])[0]
-        
-        # Calculate payload offset
-        self.header_size = 12 + (self.cc * 4)
-        if self.extension:
-            ext_header_start = self.header_size
-            if ext_header_start + 4 <= len(self.data):
-                ext_length = struct.unpack('!H', self.data[ext_header_start+2:ext_header_start+4])[0]
-                self.header_size += 4 + (ext_length * 4)
-        
-        self.payload = self.data[self.header_size:]
+# Parse, packet queue wait and depacketize are timed for one packet in this many
+PACKET_TIMING_INTERVAL = 64
+# Arrival delay against the RTP timestamp is measured for one picture in this many
+RTP_DELAY_INTERVAL = 8
+# Longest the display loop waits for a frame before it services the window again
+DISPLAY_POLL = 0.01
+# The monitoring mosaic is checked for new thumbnails this often (ms)
+MOSAIC_POLL_MS = 100
 
-class H265RTPDepacketizer:
-    def __init__(self):
-        # key: (ssrc, timestamp, start_seq)
-        self.fragments = {}
-        self.fragment_timeout = 0.5  # 500ms timeout for fragments
-        
-    def process_packet(self, packet):
-        if len(packet.payload) < 2:
-            return None
-        
-        # Parse H.265 NAL unit header
-        nal_header = struct.unpack('!H', packet.payload[0:2])[0]
-        nal_type = (nal_header >> 9) & 0x3F
-        
-        if nal_type == 49:  # Fragmentation Unit (FU)
-            return self.handle_fu(packet)
-        elif nal_type == 48:  # Aggregation Packet (AP)
-            return self.handle_ap(packet)
-        else:  # Single NAL unit
-            return self.handle_single_nal(packet)
-    
-    def handle_single_nal(self, packet):
-        # Single NAL unit packet
-        return b'\x00\x00\x00\x01' + packet.payload
-    
-    def handle_fu(self, packet):
-        if len(packet.payload) < 3:
-            return None
-        
-        # Parse FU header
-        fu_header = packet.payload[2]
-        start_bit = (fu_header >> 7) & 0x01
-        end_bit = (fu_header >> 6) & 0x01
-        fu_type = fu_header & 0x3F
-        
-        # Reconstruct NAL header
-        nal_header = struct.unpack('!H', packet.payload[0:2])[0]
-        nal_header = (nal_header & 0x81FF) | (fu_type << 9)
-        
-        if start_bit:
-            # Start of fragmented NAL unit - use composite key
-            key = (packet.ssrc, packet.timestamp, packet.sequence)
-            self.fragments[key] = {
-                'data': struct.pack('!H', nal_header) + packet.payload[3:],
-                'last_seq': packet.sequence,
-                'timestamp': time.time()
-            }
-            return None
-        
-        # Find matching fragment for continuation/end
-        candidates = [(k, v) for k, v in self.fragments.items()
-                      if k[0] == packet.ssrc and k[1] == packet.timestamp]
-        
-        if not candidates:
-            return None
-        
-        # Get the fragment with closest sequence number
-        key, state = min(candidates, key=lambda kv: abs(packet.sequence - kv[1]['last_seq'] - 1))
-        
-        state['data'] += packet.payload[3:]
-        state['last_seq'] = packet.sequence
-        state['timestamp'] = time.time()
-        
-        if end_bit:
-            # End of fragmented NAL unit
-            nal_data = state['data']
-            del self.fragments[key]
-            return b'\x00\x00\x00\x01' + nal_data
+class H265Decoder:
+    """Decodes access units. output='bgr' converts every frame to a BGR
+    ndarray here; otherwise frames are returned as DecodedFrame and converted
+    only when used (see frame_output.py).
+
+    skip_when_behind ('nonref' or 'nonkey') makes the decoder skip frames
+    while update_backlog() reports that the display is behind. 'nonkey'
+    decodes only IRAP pictures and resumes full decoding at the next IRAP,
+    since the pictures in between reference skipped ones.
+    """
+    def __init__(self, output='bgr', preview_width=0, timer=None, options=None,
+                 skip_when_behind=None):
+        self.options = options or DecoderOptions()
+        self.codec = self.options.create_codec()
+        self.skip_when_behind = skip_when_behind
+        self.behind = False
+        self.skipping = False
+        self.access_units_skipped = 0
+        self.output = output
+        self.preview_width = preview_width
+        self.timer = timer
+        # NAL units are collected as buffers and joined once per access unit
+        self.assembler = AccessUnitAssembler()
+        self.errors = 0
         
-        return None
-    
-    def cleanup_old_fragments(self):
-        """Remove fragments that have timed out"""
-        current_time = time.time()
-        keys_to_delete = [
-            k for k, v in self.fragments.items()
-            if current_time - v['timestamp'] > self.fragment_timeout
-        ]
-        for key in keys_to_delete:
-            del self.fragments[key]
-    
-    def handle_ap(self, packet):
-        # Aggregation packet - contains multiple NAL units
-        nalus = []
-        offset = 2  # Skip NAL header
+    def decode_nal_units(self, nal_units, timestamp=None, marker=False):
+        """Decode the NAL units of one RTP packet (H265RTPDepacketizer.depacketize() output)"""
+        # Decode at access unit boundaries: the marker bit, or a NAL/timestamp
+        # that starts the next picture when the marker packet was lost
+        frames = []
+        for access_unit in self.assembler.push_packet(nal_units, timestamp, marker):
+            frames.extend(self.decode_access_unit(access_unit))
+        return frames
+    
+    def update_backlog(self, depth, capacity):
+        """Report the fill level of the queue after the decoder. Behind above
+        3/4 of capacity, caught up again below 1/4."""
+        if depth >= capacity * 3 // 4:
+            self.behind = True
+        elif depth <= capacity // 4:
+            self.behind = False
+    
+    def _update_skip(self, access_unit):
+        if self.behind and not self.skipping:
+            self.codec.skip_frame = 'NONREF' if self.skip_when_behind == 'nonref' else 'NONKEY'
+            self.skipping = True
+        elif not self.behind and self.skipping:
+            if self.skip_when_behind == 'nonref' or access_unit.irap:
+                self.codec.skip_frame = 'DEFAULT'
+                self.skipping = False
+    
+    def decode_access_unit(self, access_unit):
+        frames = []
+        if self.skip_when_behind:
+            self._update_skip(access_unit)
+            if self.skipping:
+                self.access_units_skipped += 1
+        start = time.perf_counter()
+        try:
+            packet = av.Packet(access_unit.join())
+            # The RTP timestamp comes back as frame.pts, through reordering
+            packet.pts = access_unit.timestamp
+            # av.Packet copies the data once more
+            self.assembler.stats['bytes_copied'] += access_unit.size
+            decoded = self.codec.decode(packet)
+        except Exception as e:
+            self.errors += 1
+            print(f"Decode error: {e}")
+            decoded = []
+        decode_end = time.perf_counter()
         
-        while offset < len(packet.payload):
-            if offset + 2 > len(packet.payload):
-                break
-            
-            nal_size = struct.unpack('!H', packet.payload[offset:offset+2])[0]
-            offset += 2
-            
-            if offset + nal_size > len(packet.payload):
-                break
-            
-            nal_data = packet.payload[offset:offset+nal_size]
-            nalus.append(b'\x00\x00\x00\x01' + nal_data)
-            offset += nal_size
+        for frame in decoded:
+            if self.output == 'bgr':
+                width, height = preview_size(frame.width, frame.height, self.preview_width)
+                frames.append(DecodedFrame(frame).to_bgr(width, height))
+            else:
+                frames.append(DecodedFrame(frame))
         
-        return b''.join(nalus) if nalus else None
+        if self.timer is not None:
+            self.timer.add('decode', decode_end - start)
+            if self.output == 'bgr' and frames:
+                self.timer.add('convert', time.perf_counter() - decode_end, len(frames))
+        return frames
+    
+    def reset_access_unit(self):
+        """Discard a partially collected access unit (e.g. after packet loss)"""
+        self.assembler.reset()
+    
 
-class H265Decoder:
-    def __init__(self):
-        self.codec = av.CodecContext.create('hevc', 'r')
-        self.frame_buffer = b''
-        self.sps_received = False
-        self.pps_received = False
-        self.vps_received = False
+class StreamContext:
+    """Receive state of one sender: its own jitter buffer, depacketizer and decoder.
+
+    With a DecodePool, access units are collected here and decoded by a worker
+    process instead of the in-process H265Decoder. With a StreamRecorder they
+    are written to disk and never decoded.
+    
+    With a ParameterSetCache (parameter_sets) a StartupGate keeps access units
+    the decoder cannot decode yet away from it (see parameter_sets.py).
+    
+    keyframes_only passes only IRAP pictures, at most one per
+    keyframe_interval seconds, to the decoder (monitor.py).
+    """
+    def __init__(self, key, jitter_delay_ms=50, adaptive_jitter=False, wait_for_irap=True,
+                 pool=None, output='bgr', preview_width=0, timer=None, decoder_options=None,
+                 skip_when_behind=None, recorder=None, parameter_sets=None, keyframes_only=False,
+                 keyframe_interval=0.0):
+        self.key = key
+        # Reorders packets between receive and depacketize; 0 ms and not adaptive disables it
+        self.jitter_buffer = None
+        if jitter_delay_ms > 0 or adaptive_jitter:
+            self.jitter_buffer = JitterBuffer(playout_delay_ms=jitter_delay_ms, adaptive=adaptive_jitter)
+        self.depacketizer = H265RTPDepacketizer(wait_for_irap_after_loss=wait_for_irap,
+                                                keyframes_only=keyframes_only,
+                                                keyframe_interval=keyframe_interval)
+        self.keyframes_only = keyframes_only
+        self.pool = pool
+        self.recorder = recorder
+        self.decoder = None
+        if pool is None and recorder is None:
+            self.decoder = H265Decoder(output=output, preview_width=preview_width, timer=timer,
+                                       options=decoder_options, skip_when_behind=skip_when_behind)
+        self.timer = timer
+        # In pool and record mode access units are assembled here
+        self.assembler = self.decoder.assembler if self.decoder is not None else AccessUnitAssembler()
+        # The recorder skips to the first IRAP and keeps its own parameter sets
+        self.startup = None
+        if parameter_sets is not None and recorder is None:
+            self.startup = StartupGate(parameter_sets, getattr(key, 'ssrc', 0))
+        # RTCP reception statistics, NACK and keyframe request state (rtcp.StreamFeedback)
+        self.feedback = None
+        # Rebuilds lost packets from the sender's parity packets (fec.FecDecoder)
+        self.fec = None
+        self.first_arrival = None
+        self.time_to_first_frame = None  # seconds from the first packet to the first decoded frame
+        self.frames_decoded = 0
+        self.packets_depacketized = 0
+        self.pictures_received = 0
+        self.last_sequence = -1
+        # Arrival and display times against the RTP timestamps
+        self.rtp_delay = RtpDelay()
+    
+    def receive(self, packet, arrival, now):
+        """Feed one packet (None: only release what the jitter buffer gave up
+        waiting for); returns (lost_before, packet) pairs ready for handle_packet()"""
+        if self.first_arrival is None and packet is not None:
+            self.first_arrival = arrival
+        if self.jitter_buffer is None:
+            return [(0, packet)] if packet is not None else []
+        if packet is not None:
+            self.jitter_buffer.push(packet, arrival)
+        return self.jitter_buffer.pop(now)
+    
+    def sequence_gap(self, sequence):
+        """Packets skipped before sequence in arrival order (0 for reordering)"""
+        diff = 0
+        if self.last_sequence != -1:
+            # Calculate difference accounting for wraparound
+            diff = (sequence - self.last_sequence - 1) & 0xFFFF
+            # Only count as loss if significantly ahead (not reordering)
+            if diff >= 100:
+                diff = 0
+        self.last_sequence = sequence
+        return diff
+    
+    def depacketize(self, packet, lost_before=0):
+        """Depacketize one in-order packet into NAL units (views into the packet payloads)"""
+        if lost_before:
+            # The current picture is broken: let the depacketizer
+            # apply its loss policy and drop the partial access unit
+            self.depacketizer.mark_loss(packet.ssrc)
+            self.assembler.reset()
+            if self.startup is not None:
+                self.startup.mark_loss()
         
-    def decode_nal_unit(self, nal_data, marker=False):
-        if not nal_data:
+        self.packets_depacketized += 1
+        if self.timer is None or self.packets_depacketized % PACKET_TIMING_INTERVAL:
+            return self.depacketizer.depacketize(packet)
+        start = time.perf_counter()
+        nal_units = self.depacketizer.depacketize(packet)
+        self.timer.add('depacketize', time.perf_counter() - start)
+        return nal_units
+    
+    def assemble(self, packet, lost_before=0):
+        """Depacketize one in-order packet. Returns the access units it completes."""
+        nal_units = self.depacketize(packet, lost_before)
+        if not nal_units:
+            return []
+        access_units = self.assembler.push_packet(nal_units, packet.timestamp, packet.marker)
+        if self.startup is not None and access_units:
+            access_units = [au for au in access_units if self.startup.admit(au)]
+        if self.keyframes_only and access_units:
+            # What is left of the other pictures (parameter sets, SEI) is not decoded
+            access_units = [au for au in access_units if au.irap]
+        return access_units
+    
+    def count_frames(self, count, now):
+        """Count decoded frames; the first one sets time_to_first_frame"""
+        self.frames_decoded += count
+        if count and self.time_to_first_frame is None and self.first_arrival is not None:
+            self.time_to_first_frame = now - self.first_arrival
+    
+    def handle_packet(self, packet, lost_before=0):
+        """Depacketize and decode one in-order packet. Returns decoded frames."""
+        if self.recorder is not None:
+            for access_unit in self.assemble(packet, lost_before):
+                self.recorder.write(access_unit)
             return []
         
-        # Accumulate NAL units
-        self.frame_buffer += nal_data
-        
-        # Check NAL unit type
-        if len(nal_data) > 5:
-            nal_type = (nal_data[4] >> 1) & 0x3F
-            
-            # VPS (32), SPS (33), PPS (34)
-            if nal_type == 32:
-                self.vps_received = True
-            elif nal_type == 33:
-                self.sps_received = True
-            elif nal_type == 34:
-                self.pps_received = True
+        if self.pool is not None:
+            # Hand complete access units to the stream's worker; frames come
+            # back through DecodePool.get_frame()
+            for access_unit in self.assemble(packet, lost_before):
+                if not self.pool.submit(self.key, access_unit.join()):
+                    # The worker is behind and the picture was dropped: later
+                    # pictures reference it, so wait for the next IRAP
+                    self.depacketizer.waiting_for_irap.add(packet.ssrc)
+                    if self.startup is not None:
+                        self.startup.mark_loss()
+            return []
         
+        # Decode at access unit boundaries: the marker bit, or a NAL/timestamp
+        # that starts the next picture when the marker packet was lost
         frames = []
-        # Decode when marker indicates access unit boundary
-        if marker and self.frame_buffer:
-            try:
-                packet = av.Packet(self.frame_buffer)
-                for frame in self.codec.decode(packet):
-                    frames.append(frame.to_ndarray(format='bgr24'))
-            except Exception as e:
-                print(f"Decode error: {e}")
-            finally:
-                # Clear buffer regardless of success to prevent accumulation
-                self.frame_buffer = b''
-        
+        for access_unit in self.assemble(packet, lost_before):
+            frames.extend(self.decoder.decode_access_unit(access_unit))
+        self.count_frames(len(frames), time.time())
         return frames
     
 
 class H265StreamReceiver:
-    def __init__(self, port=5004):
+    def __init__(self, port=5004, batch_size=0, jitter_delay_ms=50, adaptive_jitter=False,
+                 wait_for_irap=True, max_streams=16, stream_timeout=10.0, decode_workers=0,
+                 output='lazy', convert_threads=0, preview_width=0, decoder_options=None,
+                 skip_when_behind=None, metrics=None, record=None, parameter_sets=None,
+                 startup_gate=True, rtcp=None, display_mode='latency', display_delay_ms=40,
+                 monitor=None, fec_payload_type=None, decode_slot_bytes=DEFAULT_SLOT_BYTES):
         self.port = port
+        # batch_size > 0 selects the batched (recvmmsg) ingest loop
+        self.batch_size = batch_size
         self.socket = None
         self.running = False
-        self.packet_queue = queue.Queue(maxsize=1000)
-        self.frame_queue = queue.Queue(maxsize=30)  # Queue for decoded frames
-        self.depacketizer = H265RTPDepacketizer()
-        self.decoder = H265Decoder()
-        self.stats_lock = threading.Lock()
-        self.stats = {
-            'packets_received': 0,
-            'bytes_received': 0,
-            'frames_decoded': 0,
-            'last_sequence': -1,
-            'lost_packets': 0
-        }
+        self.packet_queue = queue.Queue(maxsize=1000)  # (arrival time, source address, RTPPacket)
+        # Frames waiting for the display (BGR ndarray, DecodedFrame or SharedFrame), by StreamKey
+        self.presenter = FramePresenter(display_mode, delay_ms=display_delay_ms)
+        self.jitter_delay_ms = jitter_delay_ms
+        self.adaptive_jitter = adaptive_jitter
+        self.wait_for_irap = wait_for_irap
+        # One StreamContext per (source ip, source port, port, SSRC)
+        self.demuxer = StreamDemuxer(self.create_stream, max_streams=max_streams)
+        self.stream_timeout = stream_timeout
+        # decode_workers > 0 decodes in a pool of worker processes
+        self.decoder_options = decoder_options or DecoderOptions()
+        self.skip_when_behind = skip_when_behind
+        self.decode_pool = None
+        # record (RecordOptions): headless, access units are written to disk instead of decoded
+        self.record = record
+        self.recorders = {}  # StreamKey -> StreamRecorder
+        self.recorded = Counter()  # stats of the recorders of closed streams
+        # Parameter sets per SSRC (seeded from an SDP, if given); without the
+        # startup gate every access unit goes to the decoder as it arrives
+        self.parameter_sets = parameter_sets if parameter_sets is not None else ParameterSetCache()
+        self.startup_gate = startup_gate
+        # rtcp (RtcpSession on port + 1): receiver reports, NACKs and keyframe requests
+        self.rtcp = rtcp
+        # Packets of this payload type are FEC parity packets, not media
+        if fec_payload_type is not None and jitter_delay_ms <= 0 and not adaptive_jitter:
+            raise ValueError("FEC needs the jitter buffer: rebuilt packets arrive out of order")
+        self.fec_payload_type = fec_payload_type
+        # monitor (MonitorOptions): only keyframes are decoded, and shown as
+        # thumbnails in one mosaic window
+        self.monitor = monitor if record is None else None
+        self.mosaic = Mosaic(monitor) if self.monitor is not None else None
+        if self.mosaic is not None:
+            # Thumbnails are scaled straight from the decoded frame
+            output, convert_threads, decode_workers = 'lazy', 0, 0
+        if decode_workers > 0 and record is None:
+            self.decode_pool = DecodePool(workers=decode_workers, max_frame_bytes=decode_slot_bytes,
+                                          decoder_options=self.decoder_options)
+        # Output stage: when frames are converted, and how large the preview is
+        self.output = output
+        self.preview_width = preview_width
+        # Counters, stage histograms and queue gauges (metrics.py); a disabled
+        # registry also turns the stage timing off
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.timer = StageMetrics(self.metrics) if self.metrics.enabled else None
+        self.converter = None
+        if convert_threads > 0 and output == 'lazy' and record is None:
+            # Only lazy output leaves DecodedFrames to convert; bgr frames are
+            # converted on the decode thread already
+            self.converter = FrameConverter(self.queue_frame, threads=convert_threads,
+                                            max_width=preview_width, timer=self.timer)
+        # StreamKey -> time the stream's jitter buffer gives up on a missing packet
+        self.gap_deadlines = {}
+        # Written by the receive thread only, so plain ints need no lock
+        self.packets_received = 0
+        self.bytes_received = 0
+        self.packets_processed = 0
+        self.register_metrics()
         self.last_cleanup_time = time.time()
+    
+    def register_metrics(self):
+        m = self.metrics
+        m.counter('h265_packets_received_total', 'RTP packets received', fn=lambda: self.packets_received)
+        m.counter('h265_bytes_received_total', 'UDP payload bytes received', fn=lambda: self.bytes_received)
+        self.parse_errors = m.counter('h265_parse_errors_total', 'Datagrams that are not valid RTP')
+        # Sequence gaps over all packets: the only loss figure without jitter buffers
+        self.sequence_gaps = m.counter('h265_sequence_gaps_total', 'Forward RTP sequence number jumps per stream')
+        self.frames_decoded = m.counter('h265_frames_decoded_total', 'Decoded frames')
+        m.counter('h265_packets_lost_total', 'Packets the jitter buffers gave up on',
+                  fn=lambda: self._sum_streams(lambda s: s.jitter_buffer.stats['lost'] if s.jitter_buffer else 0))
         
-    def start(self):
+        dropped = 'Items dropped per stage (packets, NAL units, access units or frames)'
+        self.packet_queue_dropped = m.counter('h265_dropped_total', dropped, stage='packet_queue')
+        m.counter('h265_dropped_total', dropped, stage='depacketize', fn=lambda: self._sum_streams(
+            lambda s: sum(s.depacketizer.stats[k] for k in ('fu_dropped_gap', 'fu_dropped_incomplete', 'fu_timed_out'))))
+        if self.decode_pool is not None:
+            m.counter('h265_dropped_total', dropped, stage='decode_queue',
+                      fn=lambda: self.decode_pool.stats['submit_dropped'])
+            m.counter('h265_dropped_total', dropped, stage='decode_slot',
+                      fn=lambda: self.decode_pool.stats['frames_dropped'])
+            m.counter('h265_dropped_total', dropped, stage='decode_oversize',
+                      fn=lambda: self.decode_pool.stats['oversize'])
+        if self.converter is not None:
+            m.counter('h265_dropped_total', dropped, stage='convert_queue',
+                      fn=lambda: self.converter.stats['dropped'])
+            m.counter('h265_dropped_total', dropped, stage='convert_error',
+                      fn=lambda: self.converter.stats['errors'])
+        self.frame_queue_dropped = m.counter('h265_dropped_total', dropped, stage='frame_queue',
+                                             fn=lambda: self.presenter.dropped)
+        if self.startup_gate and self.record is None:
+            m.counter('h265_dropped_total', dropped, stage='startup', fn=lambda: self._sum_streams(
+                lambda s: s.startup.stats['dropped_leading'] + s.startup.stats['dropped_rasl'] if s.startup else 0))
+            m.counter('h265_parameter_sets_injected_total', 'IRAPs given cached parameter sets',
+                      fn=lambda: self._sum_streams(
+                          lambda s: s.startup.stats['parameter_sets_injected'] if s.startup else 0))
+        
+        depth = 'Items waiting in a queue'
+        m.gauge('h265_queue_depth', depth, self.packet_queue.qsize, queue='packet_queue')
+        if self.converter is not None:
+            m.gauge('h265_queue_depth', depth, self.converter.queue.qsize, queue='convert_queue')
+        m.gauge('h265_queue_depth', depth, self.presenter.qsize, queue='frame_queue')
+        m.gauge('h265_streams', 'Active streams', lambda: len(self.demuxer.streams))
+        if self.record is not None:
+            m.counter('h265_recorded_access_units_total', 'Access units written to disk',
+                      fn=lambda: self._sum_recorders('access_units'))
+            m.counter('h265_recorded_bytes_total', 'Access unit bytes written to disk',
+                      fn=lambda: self._sum_recorders('bytes'))
+            m.counter('h265_record_segments_total', 'Recording files opened',
+                      fn=lambda: self._sum_recorders('segments'))
+        if self.rtcp is not None:
+            for kind in ('rr', 'nack', 'pli', 'fir'):
+                m.counter('h265_rtcp_sent_total', 'RTCP packets sent', fn=lambda kind=kind: self.rtcp.stats[f'sent_{kind}'],
+                          type=kind)
+            m.counter('h265_retransmissions_recovered_total', 'NACKed packets that arrived',
+                      fn=lambda: self._sum_streams(lambda s: s.feedback.stats['recovered'] if s.feedback else 0))
+        if self.fec_payload_type is not None:
+            m.counter('h265_fec_recovered_total', 'Lost packets rebuilt from FEC parity packets',
+                      fn=lambda: self._sum_streams(lambda s: s.fec.stats['recovered']))
+            m.counter('h265_fec_unrecoverable_total', 'Lost packets FEC could not rebuild',
+                      fn=lambda: self._sum_streams(lambda s: s.fec.stats['unrecoverable']))
+        
+        delay = 'Delay against the RTP timestamp, relative to the fastest packet of the stream'
+        self.receive_delay = m.histogram('h265_rtp_delay_seconds', delay, point='receive')
+        self.display_delay = m.histogram('h265_rtp_delay_seconds', delay, point='display')
+        self.presenter.wait_histogram = m.histogram('h265_display_wait_seconds',
+                                                    'Time shown frames waited for the display')
+    
+    def _sum_streams(self, value):
+        return sum(value(stream) for stream in list(self.demuxer.streams.values()))
+    
+    def _sum_recorders(self, stat):
+        # Includes streams that timed out
+        return self.recorded[stat] + sum(r.stats[stat] for r in list(self.recorders.values()))
+    
+    def create_stream(self, key):
+        print(f"New stream: {key}")
+        recorder = None
+        if self.record is not None:
+            recorder = self.recorders[key] = StreamRecorder(key, self.record)
+        context = StreamContext(key, jitter_delay_ms=self.jitter_delay_ms,
+                                adaptive_jitter=self.adaptive_jitter,
+                                wait_for_irap=self.wait_for_irap,
+                                pool=self.decode_pool, output=self.output,
+                                preview_width=self.preview_width, timer=self.timer,
+                                decoder_options=self.decoder_options,
+                                skip_when_behind=self.skip_when_behind,
+                                recorder=recorder,
+                                parameter_sets=self.parameter_sets if self.startup_gate else None,
+                                keyframes_only=self.monitor is not None,
+                                keyframe_interval=self.monitor.keyframe_interval if self.monitor else 0.0)
+        if self.rtcp is not None:
+            context.feedback = self.rtcp.add_stream(key)
+        if self.fec_payload_type is not None:
+            context.fec = FecDecoder()
+        return context
+    
+    def close_recorder(self, key):
+        recorder = self.recorders.pop(key, None)
+        if recorder is not None:
+            recorder.close()
+            self.recorded.update(recorder.stats)
+        
+    def bind(self):
         # Create UDP socket
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -222,11 +452,23 @@ class H265StreamReceiver:
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4*1024*1024)
         self.socket.bind(('0.0.0.0', self.port))
         self.socket.settimeout(0.1)
-        
+        if self.rtcp is not None:
+            self.rtcp.start()
+    
+    def start(self):
+        self.bind()
+        if self.decode_pool is not None:
+            self.decode_pool.start()
+            print(f"Decode pool: {self.decode_pool.workers} worker processes")
+        if self.converter is not None:
+            self.converter.start()
         self.running = True
         
         # Start receiver thread
-        receiver_thread = threading.Thread(target=self.receive_packets)
+        if self.batch_size > 0:
+            receiver_thread = threading.Thread(target=self.receive_packets_batched)
+        else:
+            receiver_thread = threading.Thread(target=self.receive_packets)
         receiver_thread.daemon = True
         receiver_thread.start()
         
@@ -235,96 +477,322 @@ class H265StreamReceiver:
         processor_thread.daemon = True
         processor_thread.start()
         
+        if self.record is not None:
+            print(f"Receiver started on port {self.port}, recording {self.record} (no decoding)")
+            print("Press Ctrl+C to stop")
+            self.run_headless(processor_thread)
+            return
+        
+        if self.decode_pool is not None:
+            collector_thread = threading.Thread(target=self.collect_frames)
+            collector_thread.daemon = True
+            collector_thread.start()
+        
         print(f"Receiver started on port {self.port}")
+        print(f"Decoder: {self.decoder_options}")
+        if self.mosaic is not None:
+            print(f"Monitoring: {self.monitor}")
         print("Waiting for H.265 stream...")
         print("Press 'q' to quit, 's' for statistics")
         
         # Display loop
-        self.display_stream()
+        if self.mosaic is not None:
+            self.display_mosaic()
+        else:
+            self.display_stream()
     
     def receive_packets(self):
         while self.running:
             try:
                 data, addr = self.socket.recvfrom(65535)
-                
-                with self.stats_lock:
-                    self.stats['packets_received'] += 1
-                    self.stats['bytes_received'] += len(data)
-                
-                try:
-                    packet = RTPPacket(data)
-                    
-                    # Check for packet loss (more tolerant of reordering)
-                    if self.stats['last_sequence'] != -1:
-                        expected = (self.stats['last_sequence'] + 1) & 0xFFFF
-                        if packet.sequence != expected:
-                            # Calculate difference accounting for wraparound
-                            diff = (packet.sequence - expected) & 0xFFFF
-                            # Only count as loss if significantly ahead (not reordering)
-                            if diff > 0 and diff < 100:  # Forward jump within reasonable range
-                                with self.stats_lock:
-                                    self.stats['lost_packets'] += diff
-                            elif diff > 0xFFF0:  # Small backward jump - likely reordering
-                                pass  # Don't count as loss
-                    
-                    with self.stats_lock:
-                        self.stats['last_sequence'] = packet.sequence
-                    
-                    if not self.packet_queue.full():
-                        self.packet_queue.put(packet)
-                    
-                except Exception as e:
-                    print(f"Packet parse error: {e}")
-                    
             except socket.timeout:
                 continue
             except Exception as e:
                 if self.running:
                     print(f"Receive error: {e}")
+                continue
+            self.handle_datagram(data, addr)
+    
+    def handle_datagram(self, data, addr):
+        """Count, parse and queue one datagram (receive thread)"""
+        self.packets_received += 1
+        self.bytes_received += len(data)
+        
+        try:
+            if self.timer is not None and not self.packets_received % PACKET_TIMING_INTERVAL:
+                start = time.perf_counter()
+                packet = RTPPacket(data)
+                self.timer.add('parse', time.perf_counter() - start)
+            else:
+                packet = RTPPacket(data)
+        except Exception as e:
+            self.parse_errors.inc()
+            print(f"Packet parse error: {e}")
+            return
+        
+        if self.packet_queue.full():
+            self.packet_queue_dropped.inc()
+        else:
+            self.packet_queue.put((time.time(), addr, packet))
+    
+    def receive_packets_batched(self):
+        """Batched ingest: many datagrams per syscall, counters updated once per batch"""
+        reader = DatagramBatchReader(self.socket, batch_size=self.batch_size)
+        print(f"Batched ingest: {reader.mode}, batch size {self.batch_size}")
+        
+        while self.running:
+            try:
+                count = reader.read()
+            except Exception as e:
+                if self.running:
+                    print(f"Receive error: {e}")
+                continue
+            
+            if count == 0:
+                continue
+            
+            arrival = time.time()
+            batch_bytes = 0
+            batch_dropped = 0
+            for i in range(count):
+                # Copy out of the ring: the slot is reused by the next read
+                data = bytes(reader.datagram(i))
+                batch_bytes += len(data)
+                
+                try:
+                    if i == 0 and self.timer is not None:
+                        # One parse timing sample per batch
+                        start = time.perf_counter()
+                        packet = RTPPacket(data)
+                        self.timer.add('parse', time.perf_counter() - start)
+                    else:
+                        packet = RTPPacket(data)
+                except Exception as e:
+                    self.parse_errors.inc()
+                    print(f"Packet parse error: {e}")
+                    continue
+                
+                if self.packet_queue.full():
+                    batch_dropped += 1
+                else:
+                    self.packet_queue.put((arrival, reader.address(i), packet))
+            
+            self.packets_received += count
+            self.bytes_received += batch_bytes
+            if batch_dropped:
+                self.packet_queue_dropped.inc(batch_dropped)
     
     def process_packets(self):
         while self.running:
             try:
-                packet = self.packet_queue.get(timeout=0.1)
+                timeout = 0.1
+                if self.gap_deadlines:
+                    # Wake up in time to give up on a missing packet
+                    timeout = min(timeout, max(0.0, min(self.gap_deadlines.values()) - time.time()))
+                
+                try:
+                    arrival, addr, packet = self.packet_queue.get(timeout=timeout)
+                except queue.Empty:
+                    packet = None
                 
-                # Cleanup old fragments periodically
                 current_time = time.time()
-                if current_time - self.last_cleanup_time > 0.5:
-                    self.depacketizer.cleanup_old_fragments()
-                    self.last_cleanup_time = current_time
+                if packet is not None:
+                    self.dispatch(arrival, addr, packet, current_time)
                 
-                # Depacketize RTP to NAL units
-                nal_data = self.depacketizer.process_packet(packet)
+                # Streams whose gap deadline passed release what they hold
+                expired = [key for key, deadline in self.gap_deadlines.items() if deadline <= current_time]
+                for key in expired:
+                    stream = self.demuxer.streams.get(key)
+                    if stream is None:
+                        del self.gap_deadlines[key]
+                    else:
+                        self.process_stream(stream, None, None, current_time)
                 
-                if nal_data:
-                    # Try to decode with marker bit
-                    frames = self.decoder.decode_nal_unit(nal_data, marker=packet.marker)
-                    
-                    # Handle all returned frames
-                    for frame in frames:
-                        with self.stats_lock:
-                            self.stats['frames_decoded'] += 1
-                        
-                        # Queue frame for display in main thread
-                        if not self.frame_queue.full():
-                            self.frame_queue.put(frame)
+                # Cleanup old fragments and idle streams periodically
+                if current_time - self.last_cleanup_time > 0.5:
+                    for key, stream in self.demuxer:
+                        stream.depacketizer.cleanup_old_fragments()
+                    for key in self.demuxer.expire(self.stream_timeout, current_time):
+                        self.gap_deadlines.pop(key, None)
+                        if self.rtcp is not None:
+                            self.rtcp.remove_stream(key)
+                        if self.decode_pool is not None:
+                            self.decode_pool.close_stream(key)
+                        self.close_recorder(key)
+                        self.presenter.remove(key)
+                        if self.mosaic is not None:
+                            self.mosaic.remove(key)
+                        print(f"Stream timed out: {key}")
+                    self.last_cleanup_time = current_time
+                if self.rtcp is not None:
+                    self.rtcp.tick(current_time)
                         
-            except queue.Empty:
-                continue
             except Exception as e:
                 print(f"Process error: {e}")
     
+    def dispatch(self, arrival, addr, packet, now):
+        """Hand one packet from the packet queue to its stream (process thread)"""
+        self.packets_processed += 1
+        if self.timer is not None and not self.packets_processed % PACKET_TIMING_INTERVAL:
+            self.timer.add('packet_queue', now - arrival)
+        if packet.payload_type == self.fec_payload_type:
+            self.dispatch_fec(addr, packet, arrival, now)
+            return
+        stream = self.demuxer.lookup(addr[0], addr[1], self.port, packet.ssrc, now)
+        if stream is not None:
+            gap = stream.sequence_gap(packet.sequence)
+            if gap:
+                self.sequence_gaps.inc(gap)
+            if packet.marker and self.timer is not None:
+                # Last packet of a picture
+                stream.pictures_received += 1
+                if not stream.pictures_received % RTP_DELAY_INTERVAL:
+                    self.receive_delay.record(stream.rtp_delay.observe(packet.timestamp, arrival))
+            if stream.feedback is not None:
+                stream.feedback.on_packet(packet, arrival)
+            self.process_stream(stream, packet, arrival, now)
+            if stream.fec is not None:
+                # Kept for recovery; it may also complete a parity packet that lacked two
+                self.process_recovered(stream, stream.fec.add_media(packet.data, packet.sequence), arrival, now)
+    
+    def dispatch_fec(self, addr, packet, arrival, now):
+        """Hand a parity packet to the FEC decoder of the stream it protects
+        (same sender address; it has an SSRC of its own)"""
+        try:
+            ssrc = protected_ssrc(packet)
+        except struct.error:
+            return
+        stream = self.demuxer.streams.get((addr[0], addr[1], self.port, ssrc))
+        if stream is not None and stream.fec is not None:
+            self.process_recovered(stream, stream.fec.add_fec(packet.payload), arrival, now)
+    
+    def process_recovered(self, stream, recovered, arrival, now):
+        """Feed media packets rebuilt by FEC as if they had just arrived"""
+        for data in recovered:
+            packet = RTPPacket(data)
+            if stream.feedback is not None:
+                stream.feedback.on_packet(packet, arrival)
+            self.process_stream(stream, packet, arrival, now)
+    
+    def process_stream(self, stream, packet, arrival, now):
+        if stream.decoder is not None and self.skip_when_behind:
+            if self.converter is not None:
+                stream.decoder.update_backlog(self.converter.queue.qsize(), self.converter.queue.maxsize)
+            else:
+                stream.decoder.update_backlog(*self.presenter.backlog(stream.key))
+        
+        for lost_before, ready in stream.receive(packet, arrival, now):
+            frames = stream.handle_packet(ready, lost_before)
+            
+            # Handle all returned frames
+            for frame in frames:
+                self.frames_decoded.inc()
+                
+                if self.mosaic is not None:
+                    self.mosaic.update(stream.key, frame)
+                elif self.converter is not None:
+                    # Convert on the converter threads, then queue for display
+                    # (FrameConverter counts the frames it drops)
+                    self.converter.submit(stream.key, frame)
+                else:
+                    self.queue_frame((stream.key, frame))
+        
+        if stream.jitter_buffer is not None:
+            deadline = stream.jitter_buffer.deadline
+            if deadline is None:
+                self.gap_deadlines.pop(stream.key, None)
+            else:
+                self.gap_deadlines[stream.key] = deadline
+        
+        if stream.feedback is not None:
+            # NACK what the jitter buffer can still wait for; request a
+            # keyframe once loss is past repair
+            window = stream.jitter_buffer.delay_ms / 1000.0 if stream.jitter_buffer is not None else 0.0
+            dp = stream.depacketizer.stats
+            self.rtcp.check(stream.feedback, now, window,
+                            dp['fu_dropped_gap'] + dp['fu_dropped_incomplete'] + dp['fu_timed_out'])
+    
+    def queue_frame(self, item, timestamp=None):
+        """Hand (StreamKey, frame) to the display in the main thread; the
+        presenter drops what the display cannot show in time"""
+        key, frame = item
+        if timestamp is None:
+            timestamp = getattr(frame, 'timestamp', None)
+        return self.presenter.offer(key, frame, timestamp)
+    
+    def collect_frames(self):
+        """Move frames decoded by the worker processes to the display queue"""
+        while self.running:
+            frame = self.decode_pool.get_frame(timeout=0.1)
+            if frame is None:
+                continue
+            
+            stream = self.demuxer.streams.get(frame.stream_id)
+            if stream is not None:
+                stream.count_frames(1, time.time())
+            self.frames_decoded.inc()
+            # A frame the display skips gives its slot straight back to the worker
+            self.presenter.offer(frame.stream_id, frame)
+    
+    def record_display_delay(self, stream_key, timestamp):
+        stream = self.demuxer.streams.get(stream_key)
+        if stream is not None and timestamp is not None:
+            delay = stream.rtp_delay.delay(timestamp, time.time())
+            if delay is not None:
+                self.display_delay.record(delay)
+    
+    def run_headless(self, processor_thread):
+        """Main loop without a window: statistics every 5 seconds until Ctrl+C,
+        then the recordings are closed once the processor thread has stopped"""
+        try:
+            while self.running:
+                time.sleep(5)
+                self.print_statistics()
+        finally:
+            self.running = False
+            processor_thread.join(timeout=2.0)
+            for key in list(self.recorders):
+                self.close_recorder(key)
+            if self.rtcp is not None:
+                self.rtcp.stop()
+            if self.socket:
+                self.socket.close()
+    
     def display_stream(self):
         cv2.namedWindow('H.265 Stream', cv2.WINDOW_NORMAL)
+        # The first stream uses the main window, further streams get their own
+        windows = {}
         last_stats_time = time.time()
         
         while self.running:
-            # Display frames from queue (main thread)
-            try:
-                frame = self.frame_queue.get_nowait()
-                cv2.imshow('H.265 Stream', frame)
-            except queue.Empty:
-                pass
+            # Sleep until a frame is due (main thread), but service the window regularly
+            self.presenter.wait(DISPLAY_POLL)
+            for stream_key, frame, timestamp in self.presenter.take():
+                window = windows.get(stream_key)
+                if window is None:
+                    window = 'H.265 Stream' if not windows else f'H.265 Stream {stream_key}'
+                    if windows:
+                        cv2.namedWindow(window, cv2.WINDOW_NORMAL)
+                    windows[stream_key] = window
+                if isinstance(frame, SharedFrame):
+                    # imshow copies the image, so the slot can be reused right away
+                    cv2.imshow(window, frame.array)
+                    frame.release()
+                    continue
+                if isinstance(frame, DecodedFrame):
+                    # Lazy output: only frames that are shown get converted
+                    start = time.perf_counter()
+                    if self.output == 'yuv':
+                        frame = frame.preview(self.preview_width)
+                    else:
+                        frame = frame.to_bgr(*preview_size(frame.width, frame.height, self.preview_width))
+                    if self.timer is not None:
+                        self.timer.add('convert', time.perf_counter() - start)
+                start = time.perf_counter()
+                cv2.imshow(window, frame)
+                if self.timer is not None:
+                    self.timer.add('display', time.perf_counter() - start)
+                self.record_display_delay(stream_key, timestamp)
             
             key = cv2.waitKey(1) & 0xFF
             
@@ -338,39 +806,344 @@ class H265StreamReceiver:
             if time.time() - last_stats_time > 5:
                 self.print_statistics()
                 last_stats_time = time.time()
+                
+                # Close the windows of streams that timed out
+                for stream_key in [k for k in windows if k not in self.demuxer.streams]:
+                    if windows[stream_key] != 'H.265 Stream':
+                        cv2.destroyWindow(windows[stream_key])
+                    del windows[stream_key]
+        
+        self.stop_display()
+    
+    def display_mosaic(self):
+        """Display loop of the monitoring mode: one window with a thumbnail per stream"""
+        cv2.namedWindow('H.265 Monitor', cv2.WINDOW_NORMAL)
+        last_stats_time = time.time()
+        
+        while self.running:
+            if self.mosaic.due():
+                cv2.imshow('H.265 Monitor', self.mosaic.render())
+            
+            key = cv2.waitKey(MOSAIC_POLL_MS) & 0xFF
+            
+            if key == ord('q'):
+                self.running = False
+                break
+            elif key == ord('s'):
+                self.print_statistics()
+            
+            if time.time() - last_stats_time > 5:
+                self.print_statistics()
+                last_stats_time = time.time()
         
+        self.stop_display()
+    
+    def stop_display(self):
         cv2.destroyAllWindows()
+        if self.converter is not None:
+            self.converter.stop()
+        if self.decode_pool is not None:
+            self.decode_pool.stop()
+        if self.rtcp is not None:
+            self.rtcp.stop()
         if self.socket:
             self.socket.close()
     
     def print_statistics(self):
-        with self.stats_lock:
-            print("\n--- Statistics ---")
-            print(f"Packets received: {self.stats['packets_received']}")
-            print(f"Bytes received: {self.stats['bytes_received']:,}")
-            print(f"Frames decoded: {self.stats['frames_decoded']}")
-            print(f"Lost packets: {self.stats['lost_packets']}")
-            if self.stats['packets_received'] > 0:
-                loss_rate = (self.stats['lost_packets'] / 
-                           (self.stats['packets_received'] + self.stats['lost_packets'])) * 100
+        print("\n--- Statistics ---")
+        packets = self.packets_received
+        print(f"Packets received: {packets}")
+        print(f"Bytes received: {self.bytes_received:,}")
+        if self.record is None:
+            print(f"Frames decoded: {self.frames_decoded.value}")
+        if self.converter is not None and self.converter.stats['dropped']:
+            print(f"Frames dropped (conversion behind): {self.converter.stats['dropped']}")
+        if self.converter is not None and self.converter.stats['errors']:
+            print(f"Frames lost to conversion errors: {self.converter.stats['errors']}")
+        if self.mosaic is not None:
+            ms = self.mosaic.stats
+            print(f"Monitor: {len(self.mosaic.tiles)} streams, {ms['thumbnails']} keyframe thumbnails, "
+                  f"{ms['renders']} mosaic renders")
+        ds = self.presenter.stats
+        if ds['offered']:
+            print(f"Display ({self.presenter.mode}): {ds['shown']} frames shown, {ds['replaced']} replaced by newer "
+                  f"frames, {ds['overflow']} dropped (buffer full)")
+        if self.packet_queue_dropped.value:
+            print(f"Packets dropped (processing behind): {self.packet_queue_dropped.value}")
+        if self.jitter_delay_ms <= 0 and not self.adaptive_jitter:
+            lost = self.sequence_gaps.value
+            print(f"Lost packets: {lost}")
+            if packets > 0:
+                loss_rate = lost / (packets + lost) * 100
                 print(f"Packet loss rate: {loss_rate:.2f}%")
-            print("-----------------\n")
+        if self.demuxer.rejected:
+            print(f"Packets from streams over the limit: {self.demuxer.rejected}")
+        print(f"Queue depth: packets {self.packet_queue.qsize()}, frames {self.presenter.qsize()}")
+        
+        for key, stream in list(self.demuxer):
+            print(f"[{key}]")
+            if stream.recorder is None:
+                print(f"  Frames decoded: {stream.frames_decoded}")
+                if stream.time_to_first_frame is not None:
+                    print(f"  Time to first frame: {stream.time_to_first_frame * 1000:.0f} ms")
+            if stream.startup is not None:
+                st = stream.startup.stats
+                print(f"  Startup: {st['dropped_leading']} access units dropped before the first IRAP, "
+                      f"{st['dropped_rasl']} RASL dropped, {st['parameter_sets_injected']} IRAPs given cached "
+                      f"parameter sets, {st['irap_without_parameter_sets']} IRAPs without them")
+            if stream.jitter_buffer is not None:
+                jb = stream.jitter_buffer.stats
+                print(f"  Lost packets: {jb['lost']}")
+                if jb['released'] + jb['lost'] > 0:
+                    loss_rate = jb['lost'] / (jb['released'] + jb['lost']) * 100
+                    print(f"  Packet loss rate: {loss_rate:.2f}%")
+                print(f"  Late / duplicate / reordered: {jb['late']} / {jb['duplicate']} / {jb['reordered']}")
+                print(f"  Jitter: {stream.jitter_buffer.jitter_ms:.1f} ms "
+                      f"(playout delay {stream.jitter_buffer.delay_ms:.0f} ms)")
+            if stream.recorder is not None:
+                rs = stream.recorder.stats
+                print(f"  Recorded: {rs['access_units']} access units, {rs['bytes']:,} bytes in "
+                      f"{rs['segments']} files ({rs['writes']} writes, {rs['skipped']} skipped before the first IRAP)")
+            if stream.decoder is not None and stream.decoder.errors:
+                print(f"  Decode errors: {stream.decoder.errors}")
+            if stream.decoder is not None and stream.decoder.access_units_skipped:
+                print(f"  Access units decoded in skip mode (behind): {stream.decoder.access_units_skipped}")
+            au = stream.assembler.stats
+            print(f"  Access units: {au['access_units']} ({stream.assembler.bytes_copied_per_frame:,.0f} bytes copied "
+                  f"per frame, {au['split_by_header'] + au['split_by_timestamp']} ended without marker)")
+            if stream.feedback is not None:
+                fs = stream.feedback.stats
+                print(f"  RTCP: {fs['reports']} reports, {fs['nacked_packets']} packets NACKed in {fs['nacks']} NACKs, "
+                      f"{fs['recovered']} recovered, {fs['expired']} given up, {fs['keyframe_requests']} keyframe "
+                      f"requests ({fs['keyframes']} answered), RTT {stream.feedback.rtt * 1000:.1f} ms")
+            if stream.fec is not None:
+                fs = stream.fec.stats
+                print(f"  FEC: {fs['parity']} parity packets, {fs['recovered']} packets recovered, "
+                      f"{fs['unrecoverable']} unrecoverable, {fs['unneeded']} parity packets unneeded")
+            dp = stream.depacketizer.stats
+            print(f"  Dropped NAL units: {dp['fu_dropped_gap'] + dp['fu_dropped_incomplete'] + dp['fu_timed_out']}"
+                  f" (skipped until IRAP: {dp['nal_skipped_after_loss']})")
+            if stream.keyframes_only:
+                print(f"  Keyframes only: {dp['non_irap_skipped']} other NAL units skipped ({dp['fu_fragments_skipped']} "
+                      f"FU packets not reassembled), {dp['irap_rate_limited']} IRAP NAL units over the rate")
+        
+        if self.timer is not None:
+            stages = self.timer.report()
+            if stages:
+                print("Stage timing (ms: mean, p99; calls):")
+                for stage in ('parse', 'packet_queue', 'depacketize', 'decode', 'convert', 'display'):
+                    if stage in stages:
+                        ms, calls = stages[stage]
+                        p99 = self.timer.summary(stage)['p99'] * 1000.0
+                        print(f"  {stage:<13}{ms:8.3f}{p99:9.3f}  {calls}")
+            for point, histogram in (('receive', self.receive_delay), ('display', self.display_delay)):
+                summary = histogram.summary()
+                if summary['count']:
+                    print(f"RTP timestamp delay at {point}: {summary['p50'] * 1000:.1f} ms median, "
+                          f"{summary['p99'] * 1000:.1f} ms p99")
+            summary = self.presenter.wait_histogram.summary()
+            if summary['count']:
+                print(f"Display wait: {summary['p50'] * 1000:.1f} ms median, {summary['p99'] * 1000:.1f} ms p99")
+        
+        if self.decode_pool is not None:
+            ps = self.decode_pool.stats
+            print(f"Decode pool: {ps['submitted']} access units submitted, {ps['submit_dropped']} dropped "
+                  f"(worker busy), {ps['frames_dropped']} frames dropped (no free slot), {ps['oversize']} "
+                  f"frames dropped (larger than a {self.decode_pool.slot_size:,} byte slot)")
+            for index, worker in enumerate(self.decode_pool.worker_stats()):
+                print(f"  Worker {index}: {worker['streams']} streams, queue depth {worker['queue_depth']}, "
+                      f"CPU {worker['cpu_time']:.1f} s")
+        print("-----------------\n")
+
+def start_metrics_exporters(registry, args):
+    """Start the --metrics-port / --metrics-log exporters; returns them for stop()"""
+    exporters = []
+    if args.metrics_port:
+        server = MetricsServer(registry, port=args.metrics_port)
+        server.start()
+        print(f"Metrics: http://127.0.0.1:{args.metrics_port}/metrics")
+        exporters.append(server)
+    if args.metrics_log:
+        writer = JsonLinesWriter(registry, args.metrics_log, interval=args.metrics_interval)
+        writer.start()
+        exporters.append(writer)
+    return exporters
 
 def main():
     parser = argparse.ArgumentParser(description='H.265 RTP Stream Receiver')
     parser.add_argument('-p', '--port', type=int, default=5004,
                        help='UDP port to listen on (default: 5004)')
+    parser.add_argument('-b', '--batch', type=int, default=0,
+                       help='Read up to N datagrams per syscall (recvmmsg); 0 disables (default: 0)')
+    parser.add_argument('-j', '--jitter-delay', type=int, default=50,
+                       help='Jitter buffer playout delay in ms; 0 disables (default: 50)')
+    parser.add_argument('--adaptive-jitter', action='store_true',
+                       help='Adapt the playout delay to the measured interarrival jitter')
+    parser.add_argument('--no-wait-irap', action='store_true',
+                       help='Keep decoding after packet loss instead of waiting for the next IRAP')
+    parser.add_argument('--sdp', default=None,
+                       help='SDP file whose sprop-vps/sps/pps (or config=) parameter sets seed the decoders, '
+                            'so a stream can start at an IRAP that lost its own')
+    parser.add_argument('--no-startup-gate', action='store_true',
+                       help='Feed every access unit to the decoder, including those before the first IRAP')
+    parser.add_argument('--rtcp', action='store_true',
+                       help='Send RTCP receiver reports, NACKs and keyframe requests from port + 1')
+    parser.add_argument('--rtcp-interval', type=float, default=1.0,
+                       help='Seconds between RTCP receiver reports (default: 1.0)')
+    parser.add_argument('--no-nack', action='store_true',
+                       help='With --rtcp: do not request retransmissions')
+    parser.add_argument('--keyframe-request', choices=KEYFRAME_REQUESTS + ('none',), default='pli',
+                       help='With --rtcp: how to ask for a keyframe after unrepairable loss (default: pli)')
+    parser.add_argument('--fec', action='store_true',
+                       help='Rebuild lost packets from row/column XOR parity packets (replay.py --fec) '
+                            'of payload type --fec-pt; needs the jitter buffer')
+    parser.add_argument('--fec-pt', type=int, default=FEC_PAYLOAD_TYPE,
+                       help=f'Payload type of the FEC parity packets (default: {FEC_PAYLOAD_TYPE})')
+    parser.add_argument('--max-streams', type=int, default=16,
+                       help='Maximum number of senders decoded at once (default: 16)')
+    parser.add_argument('--output', choices=OUTPUT_MODES, default='lazy',
+                       help='bgr: convert every frame on the decode thread; lazy: convert only displayed frames; '
+                            'yuv: no colour conversion, preview shows luma (default: lazy)')
+    parser.add_argument('--convert-threads', type=int, default=0,
+                       help='Convert frames on N threads instead of the display thread; --output lazy only '
+                            '(default: 0)')
+    parser.add_argument('--preview-width', type=int, default=0,
+                       help='Downscale the preview to at most this width while converting (--output yuv: '
+                            'subsample by a whole step); 0 keeps the size')
+    parser.add_argument('--display-mode', choices=PRESENT_MODES, default='latency',
+                       help='latency: always show the newest frame; smooth: pace frames by their RTP timestamps; '
+                            'fifo: every frame through a 30-frame queue (default: latency)')
+    parser.add_argument('--display-delay', type=int, default=40,
+                       help='Playout delay of --display-mode smooth after the fastest frame, in ms (default: 40)')
+    parser.add_argument('--monitor', action='store_true',
+                       help='Decode only keyframes (IRAP) and show all streams as thumbnails in one mosaic')
+    parser.add_argument('--keyframe-rate', type=float, default=1.0,
+                       help='--monitor: keyframes decoded per second and stream at most; 0 decodes every one (default: 1)')
+    parser.add_argument('--thumbnail-width', type=int, default=320,
+                       help='--monitor: width of a mosaic tile (default: 320)')
+    parser.add_argument('--columns', type=int, default=0,
+                       help='--monitor: tiles per mosaic row; 0 picks a square grid (default: 0)')
+    parser.add_argument('--engine', choices=('threads', 'asyncio'), default='threads',
+                       help='threads: receive/process/display threads; asyncio: event loop engine '
+                            '(async_receiver.py, no polling; --batch, --decode-workers, '
+                            '--convert-threads, --record, --rtcp, --display-mode, --monitor and --fec do not apply) (default: threads)')
+    parser.add_argument('--threads', type=int, default=0,
+                       help='Decoder threads; 0 lets FFmpeg choose (default: 0)')
+    parser.add_argument('--thread-type', choices=THREAD_TYPES, default='slice',
+                       help='Decoder threading: frame adds (threads-1) frames of latency (default: slice)')
+    parser.add_argument('--low-delay', action='store_true',
+                       help='Set the decoder low-delay flag')
+    parser.add_argument('--skip-loop-filter', choices=LOOP_FILTER_SKIP, default=None,
+                       help='Skip deblocking/SAO for these frames (faster, lower quality)')
+    parser.add_argument('--skip-when-behind', choices=SKIP_WHEN_BEHIND, default=None,
+                       help='Skip non-reference (nonref) or all non-IRAP (nonkey) frames while the display is behind')
+    parser.add_argument('--decode-workers', type=int, default=0,
+                       help='Decode in N worker processes, each stream pinned to one; 0 decodes in-process (default: 0)')
+    parser.add_argument('--decode-slot-bytes', type=int, default=DEFAULT_SLOT_BYTES,
+                       help='Largest decoded BGR frame a --decode-workers slot holds; 4K needs 24883200 '
+                            f'(default: {DEFAULT_SLOT_BYTES}, 1080p)')
+    parser.add_argument('--record', metavar='DIR', default=None,
+                       help='Headless: write each stream to files in DIR instead of decoding and displaying it')
+    parser.add_argument('--record-format', choices=RECORD_FORMATS, default='annexb',
+                       help='annexb: raw .h265; mp4: fragmented MP4; ts: MPEG-TS, with RTP timestamps as PTS '
+                            '(default: annexb)')
+    parser.add_argument('--rotate-size', type=float, default=0,
+                       help='Start a new file at the next IRAP after this many MB; 0 disables (default: 0)')
+    parser.add_argument('--rotate-seconds', type=float, default=0,
+                       help='Start a new file at the next IRAP after this many seconds; 0 disables (default: 0)')
+    parser.add_argument('--write-buffer', type=int, default=1024,
+                       help='KB collected per stream before each file write (default: 1024)')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                       help='Serve Prometheus metrics on http://127.0.0.1:PORT/metrics; 0 disables (default: 0)')
+    parser.add_argument('--metrics-log', default=None,
+                       help='Append a JSON line of all metrics to this file every --metrics-interval ("-" for stdout)')
+    parser.add_argument('--metrics-interval', type=float, default=1.0,
+                       help='Seconds between --metrics-log lines (default: 1.0)')
     
     args = parser.parse_args()
+    if args.fec and args.jitter_delay <= 0 and not args.adaptive_jitter:
+        # Rebuilt packets arrive after later ones; only the jitter buffer puts them back in order
+        parser.error('--fec needs the jitter buffer (-j > 0 or --adaptive-jitter)')
+    
+    record = None
+    if args.record:
+        record = RecordOptions(args.record, format=args.record_format,
+                               rotate_bytes=int(args.rotate_size * 1e6),
+                               rotate_seconds=args.rotate_seconds,
+                               buffer_size=args.write_buffer * 1024)
+    
+    monitor = None
+    if args.monitor:
+        monitor = MonitorOptions(keyframe_rate=args.keyframe_rate, thumbnail_width=args.thumbnail_width,
+                                 columns=args.columns)
+    
+    decoder_options = DecoderOptions(threads=args.threads, thread_type=args.thread_type,
+                                     low_delay=args.low_delay, skip_loop_filter=args.skip_loop_filter)
+    
+    parameter_sets = None
+    if args.sdp:
+        parameter_sets = ParameterSetCache.from_sdp(args.sdp)
+        print(f"Parameter sets from {args.sdp}: {parameter_sets}")
+    
+    if args.engine == 'asyncio':
+        import asyncio
+        from async_receiver import AsyncH265Receiver, run
+        receiver = AsyncH265Receiver(port=args.port, jitter_delay_ms=args.jitter_delay,
+                                     adaptive_jitter=args.adaptive_jitter,
+                                     wait_for_irap=not args.no_wait_irap,
+                                     max_streams=args.max_streams, output=args.output,
+                                     preview_width=args.preview_width,
+                                     decoder_options=decoder_options,
+                                     parameter_sets=parameter_sets,
+                                     startup_gate=not args.no_startup_gate)
+        exporters = start_metrics_exporters(receiver.metrics, args)
+        try:
+            asyncio.run(run(receiver))
+        except KeyboardInterrupt:
+            print("\nShutting down...")
+        finally:
+            for exporter in exporters:
+                exporter.stop()
+        return
+    
+    exporters = []
+    
+    rtcp = None
+    if args.rtcp:
+        rtcp = RtcpSession(args.port + 1, report_interval=args.rtcp_interval, nack=not args.no_nack,
+                           keyframe_request=None if args.keyframe_request == 'none' else args.keyframe_request)
     
     try:
-        receiver = H265StreamReceiver(port=args.port)
+        receiver = H265StreamReceiver(port=args.port, batch_size=args.batch,
+                                      jitter_delay_ms=args.jitter_delay,
+                                      adaptive_jitter=args.adaptive_jitter,
+                                      wait_for_irap=not args.no_wait_irap,
+                                      max_streams=args.max_streams,
+                                      decode_workers=args.decode_workers,
+                                      decode_slot_bytes=args.decode_slot_bytes,
+                                      output=args.output,
+                                      convert_threads=args.convert_threads,
+                                      preview_width=args.preview_width,
+                                      decoder_options=decoder_options,
+                                      skip_when_behind=args.skip_when_behind,
+                                      record=record,
+                                      parameter_sets=parameter_sets,
+                                      startup_gate=not args.no_startup_gate,
+                                      rtcp=rtcp,
+                                      display_mode=args.display_mode,
+                                      display_delay_ms=args.display_delay,
+                                      monitor=monitor,
+                                      fec_payload_type=args.fec_pt if args.fec else None)
+        exporters = start_metrics_exporters(receiver.metrics, args)
         receiver.start()
     except KeyboardInterrupt:
         print("\nShutting down...")
     except Exception as e:
         print(f"Error: {e}")
         sys.exit(1)
+    finally:
+        for exporter in exporters:
+            exporter.stop()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+RTP jitter buffer
+Reorders packets by sequence number (with 16-bit wraparound) and declares a
+packet lost once it has been missing for longer than the playout delay
+"""
+
+import time
+
+
+class JitterBuffer:
+    """Bounded, sequence-indexed reordering buffer for one RTP stream.
+
+    In-order packets are released immediately. When a packet is missing the
+    buffer holds everything after it for up to playout_delay_ms, then reports
+    the missing packets as lost and moves on. With adaptive=True the delay
+    follows the RFC 3550 interarrival jitter estimate.
+
+    pop() returns (lost_before, packet) pairs in sequence order, where
+    lost_before is the number of packets declared lost just before packet,
+    so the consumer sees each gap at the point where it happened. A packet
+    that arrives after it was declared lost is counted as late and dropped.
+    """
+
+    def __init__(self, capacity=1024, playout_delay_ms=50, adaptive=False,
+                 min_delay_ms=10, max_delay_ms=500, jitter_multiplier=4, clock_rate=90000):
+        self.capacity = capacity
+        self.playout_delay_ms = playout_delay_ms
+        self.adaptive = adaptive
+        self.min_delay_ms = min_delay_ms
+        self.max_delay_ms = max_delay_ms
+        self.jitter_multiplier = jitter_multiplier
+        self.clock_rate = clock_rate
+        self.stats = {
+            'received': 0,
+            'released': 0,
+            'lost': 0,
+            'late': 0,
+            'duplicate': 0,
+            'reordered': 0,
+            'overflow': 0,
+        }
+        self.reset()
+
+    def reset(self):
+        """Forget the current stream (e.g. after an SSRC change)"""
+        # (extended_seq, packet); packet is None once released, so that a
+        # second copy can still be told apart from a late packet
+        self.slots = [None] * self.capacity
+        self.ssrc = None
+        self.count = 0
+        self.next_out = None   # extended sequence number of the next packet to release
+        self.max_ext = None    # highest extended sequence number seen
+        self.gap_started = None
+        self.pending_lost = 0
+        self.forced = []       # packets pushed out of the ring by an overflow
+        self.jitter = 0.0      # RFC 3550 J, in timestamp units
+        self.last_transit = None
+
+    @property
+    def jitter_ms(self):
+        return self.jitter * 1000.0 / self.clock_rate
+
+    @property
+    def delay_ms(self):
+        if not self.adaptive:
+            return self.playout_delay_ms
+        target = self.jitter_ms * self.jitter_multiplier
+        return min(self.max_delay_ms, max(self.min_delay_ms, target))
+
+    def _extend(self, sequence):
+        """Map a 16-bit sequence number onto the extended (unwrapped) sequence space"""
+        delta = (sequence - self.max_ext) & 0xFFFF
+        if delta < 0x8000:
+            return self.max_ext + delta
+        return self.max_ext - (0x10000 - delta)
+
+    def _update_jitter(self, packet, arrival):
+        # RFC 3550 A.8
+        transit = int(arrival * self.clock_rate) - packet.timestamp
+        if self.last_transit is not None:
+            d = abs((transit - self.last_transit + 0x80000000) % 0x100000000 - 0x80000000)
+            self.jitter += (d - self.jitter) / 16.0
+        self.last_transit = transit
+
+    def push(self, packet, arrival=None):
+        """Insert a packet. Returns False if it was dropped as late or duplicate."""
+        if arrival is None:
+            arrival = time.time()
+        if packet.ssrc != self.ssrc:
+            self.reset()
+            self.ssrc = packet.ssrc
+            self.max_ext = packet.sequence
+            self.next_out = packet.sequence
+        self.stats['received'] += 1
+
+        ext = self._extend(packet.sequence)
+        slot = self.slots[ext % self.capacity]
+        if slot is not None and slot[0] == ext:
+            self.stats['duplicate'] += 1
+            return False
+        if ext < self.next_out:
+            # Already given up on as lost
+            self.stats['late'] += 1
+            return False
+
+        if ext >= self.next_out + self.capacity:
+            # Too far ahead for the ring: give up on the oldest missing packets
+            self.stats['overflow'] += 1
+            self._skip_to(ext - self.capacity + 1)
+
+        if ext < self.max_ext:
+            self.stats['reordered'] += 1
+        else:
+            self.max_ext = ext
+
+        self._update_jitter(packet, arrival)
+        self.slots[ext % self.capacity] = (ext, packet)
+        self.count += 1
+        return True
+
+    def _skip_to(self, target):
+        """Advance next_out to target: buffered packets are queued for the next pop(), empty slots are lost"""
+        while self.next_out < target:
+            index = self.next_out % self.capacity
+            slot = self.slots[index]
+            if slot is not None and slot[0] == self.next_out:
+                self.slots[index] = (self.next_out, None)
+                self.count -= 1
+                self.forced.append((self.pending_lost, slot[1]))
+                self.pending_lost = 0
+            else:
+                self.pending_lost += 1
+                self.stats['lost'] += 1
+            self.next_out += 1
+        self.gap_started = None
+
+    def pop(self, now=None):
+        """Release every packet that is ready. Returns a list of (lost_before, packet)."""
+        if now is None:
+            now = time.time()
+        released = self.forced
+        self.forced = []
+        while self.count:
+            index = self.next_out % self.capacity
+            slot = self.slots[index]
+            if slot is not None and slot[0] == self.next_out:
+                self.slots[index] = (self.next_out, None)
+                self.count -= 1
+                self.next_out += 1
+                released.append((self.pending_lost, slot[1]))
+                self.pending_lost = 0
+                self.gap_started = None
+                continue
+
+            # Head is missing: wait for it up to the playout delay
+            if self.gap_started is None:
+                self.gap_started = now
+            if (now - self.gap_started) * 1000.0 < self.delay_ms:
+                break
+
+            # Declare every consecutive missing packet lost
+            while True:
+                slot = self.slots[self.next_out % self.capacity]
+                if slot is not None and slot[0] == self.next_out:
+                    break
+                self.pending_lost += 1
+                self.stats['lost'] += 1
+                self.next_out += 1
+            self.gap_started = None
+
+        self.stats['released'] += len(released)
+        return released
+
+    @property
+    def deadline(self):
+        """Time at which pop() gives up on the current gap, or None if there is none"""
+        if self.gap_started is None or not self.count:
+            return None
+        return self.gap_started + self.delay_ms / 1000.0
+
+    def time_to_deadline(self, now=None):
+        """Seconds until pop() would give up on the current gap, or None if there is none"""
+        deadline = self.deadline
+        if deadline is None:
+            return None
+        if now is None:
+            now = time.time()
+        return max(0.0, deadline - now)
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the iOS sender, with RTCP
+Encodes a moving test pattern live with libx265, packetizes it like
+RTPPacketizer.swift and answers RTCP feedback the way the app does: NACKed
+packets are resent from a retransmission history, PLI/FIR make the next
+frame an IDR, and Sender Reports go out every second from RTP port + 1 so
+the receiver knows where to send its feedback
+"""
+
+import argparse
+import random
+import select
+import socket
+import time
+from fractions import Fraction
+
+from replay import CLOCK_RATE, packetize_nal
+from rtcp import ntp_middle, parse, sender_report
+
+
+class RetransmissionHistory:
+    """The last capacity packets sent, by sequence number (as RTPPacketizer.swift keeps them)"""
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.slots = [None] * capacity
+
+    def add(self, sequence, data):
+        self.slots[sequence % self.capacity] = (sequence, data)
+
+    def get(self, sequence):
+        slot = self.slots[sequence % self.capacity]
+        if slot is None or slot[0] != sequence:
+            return None
+        return slot[1]
+
+
+class LiveSender:
+    """libx265 test pattern sent over RTP, with RTCP on the source port + 1.
+
+    loss drops that fraction of the packets (retransmissions included)
+    before they reach the socket. frame_times maps the RTP timestamp of
+    every frame sent to its send time.
+    """
+
+    def __init__(self, host='127.0.0.1', port=5004, width=640, height=360, fps=30,
+                 keyframe_interval=4.0, loss=0.0, seed=None, history=1024, rtp_port=0):
+        import av
+        import numpy as np
+
+        self.destination = (host, port)
+        self.fps = fps
+        self.width = width
+        self.height = height
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.ssrc = self.random.getrandbits(32)
+        self.sequence = self.random.getrandbits(16)
+        self.timestamp_base = self.random.getrandbits(32)
+        self.history = RetransmissionHistory(history)
+        self.force_keyframe = False
+        self.fir_sequences = {}  # requesting SSRC -> last FIR command sequence number
+        self.rtt = None
+        self.frame_times = {}
+        self.last_timestamp = 0
+        self.stats = {
+            'frames': 0,
+            'keyframes': 0,
+            'forced_keyframes': 0,
+            'packets': 0,
+            'octets': 0,
+            'dropped': 0,            # by the injected loss
+            'nacks': 0,
+            'retransmitted': 0,
+            'not_in_history': 0,
+            'pli': 0,
+            'fir': 0,
+            'receiver_reports': 0,
+            'sender_reports': 0,
+        }
+
+        keyint = max(1, int(keyframe_interval * fps))
+        self.encoder = av.CodecContext.create('libx265', 'w')
+        self.encoder.width = width
+        self.encoder.height = height
+        self.encoder.pix_fmt = 'yuv420p'
+        self.encoder.time_base = Fraction(1, fps)
+        # Like the app: no B-frames, parameter sets in front of every IDR
+        self.encoder.options = {
+            'preset': 'ultrafast',
+            'tune': 'zerolatency',
+            'forced-idr': '1',
+            'x265-params': f'log-level=error:keyint={keyint}:min-keyint={keyint}:scenecut=0:bframes=0:'
+                           'open-gop=0:repeat-headers=1',
+        }
+        self.columns = np.arange(width, dtype=np.uint16)
+        self.rows = np.arange(height, dtype=np.uint16)[:, None]
+        # Scrolling noise, so that P-frames span several packets like camera video
+        self.texture = np.random.default_rng(seed).integers(0, 256, (height, width * 2), dtype=np.uint8) // 2
+        self.planes = np.empty((height * 3 // 2, width), dtype=np.uint8)
+
+        self.rtp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.rtp.bind(('0.0.0.0', rtp_port))
+        self.rtcp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.rtcp.bind(('0.0.0.0', self.rtp.getsockname()[1] + 1))
+        self.rtcp.setblocking(False)
+        self.rtcp_destination = (host, port + 1)
+
+    def picture(self, index):
+        import av.video.frame
+
+        offset = index * 3 % self.width
+        self.planes[:self.height] = self.texture[:, offset:offset + self.width]
+        self.planes[:self.height] += (((self.columns + self.rows + index * 8) & 0xFF) >> 1).astype(self.planes.dtype)
+        self.planes[self.height:] = 128
+        frame = av.VideoFrame.from_ndarray(self.planes, format='yuv420p')
+        frame.pts = index
+        if self.force_keyframe:
+            frame.pict_type = av.video.frame.PictureType.I
+        return frame
+
+    def send(self, data):
+        if self.loss and self.random.random() < self.loss:
+            self.stats['dropped'] += 1
+            return
+        try:
+            self.rtp.sendto(data, self.destination)
+        except OSError:
+            pass
+
+    def send_frame(self, index):
+        from access_unit import split_nal_units
+
+        forced = self.force_keyframe
+        frame = self.picture(index)
+        self.force_keyframe = False
+        nals = []
+        for packet in self.encoder.encode(frame):
+            nals.extend(split_nal_units(bytes(packet)))
+        if not nals:
+            return
+        timestamp = (self.timestamp_base + index * CLOCK_RATE // self.fps) & 0xFFFFFFFF
+        keyframe = any(16 <= (nal[0] >> 1) & 0x3F <= 21 for nal in nals)
+        self.stats['frames'] += 1
+        if keyframe:
+            self.stats['keyframes'] += 1
+            if forced:
+                self.stats['forced_keyframes'] += 1
+        for position, nal in enumerate(nals):
+            packets = packetize_nal(nal, self.sequence, timestamp, self.ssrc, marker=position == len(nals) - 1)
+            for data in packets:
+                self.history.add(self.sequence, data)
+                self.sequence = (self.sequence + 1) & 0xFFFF
+                self.stats['packets'] += 1
+                self.stats['octets'] += len(data) - 12
+                self.send(data)
+        self.frame_times[timestamp] = time.time()
+        self.last_timestamp = timestamp
+
+    def send_sender_report(self, now):
+        if not self.stats['frames']:
+            return
+        report = sender_report(self.ssrc, now, self.last_timestamp, self.stats['packets'], self.stats['octets'])
+        self.stats['sender_reports'] += 1
+        try:
+            self.rtcp.sendto(report, self.rtcp_destination)
+        except OSError:
+            pass
+
+    def handle_rtcp(self):
+        """Answer the RTCP packets that are waiting"""
+        while True:
+            try:
+                data, addr = self.rtcp.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            now = time.time()
+            try:
+                packets = parse(data)
+            except ValueError:
+                continue
+            for packet in packets:
+                kind = packet['type']
+                if kind == 'rr':
+                    self.stats['receiver_reports'] += 1
+                    for block in packet['reports']:
+                        if block['ssrc'] == self.ssrc and block['lsr']:
+                            rtt = ((ntp_middle(now) - block['lsr'] - block['dlsr']) & 0xFFFFFFFF) / 65536.0
+                            if rtt < 10.0:
+                                self.rtt = rtt
+                elif kind == 'nack' and packet['media_ssrc'] == self.ssrc:
+                    self.stats['nacks'] += 1
+                    for sequence in packet['sequences']:
+                        data = self.history.get(sequence)
+                        if data is None:
+                            self.stats['not_in_history'] += 1
+                        else:
+                            self.stats['retransmitted'] += 1
+                            self.send(data)
+                elif kind == 'pli' and packet['media_ssrc'] == self.ssrc:
+                    self.stats['pli'] += 1
+                    self.force_keyframe = True
+                elif kind == 'fir':
+                    for ssrc, sequence in packet['entries']:
+                        # A repeated FIR (same command sequence number) is not a new request
+                        if ssrc == self.ssrc and self.fir_sequences.get(packet['ssrc']) != sequence:
+                            self.fir_sequences[packet['ssrc']] = sequence
+                            self.stats['fir'] += 1
+                            self.force_keyframe = True
+
+    def run(self, seconds):
+        """Send seconds of video in real time, answering RTCP between frames"""
+        frames = int(seconds * self.fps)
+        start = time.monotonic()
+        last_report = None
+        for index in range(frames):
+            self.send_frame(index)
+            now = time.time()
+            if last_report is None or now - last_report >= 1.0:
+                self.send_sender_report(now)
+                last_report = now
+            due = start + (index + 1) / self.fps
+            while True:
+                remaining = due - time.monotonic()
+                if remaining <= 0:
+                    break
+                readable, _, _ = select.select([self.rtcp], [], [], remaining)
+                if readable:
+                    self.handle_rtcp()
+        for packet in self.encoder.encode(None):
+            pass
+
+    def close(self):
+        self.rtp.close()
+        self.rtcp.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Live test-pattern RTP sender that answers RTCP NACK/PLI/FIR')
+    parser.add_argument('--host', default='127.0.0.1', help='Receiver address (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=5004, help='Receiver RTP port; RTCP goes to port + 1 (default: 5004)')
+    parser.add_argument('--size', default='640x360', help='Picture size (default: 640x360)')
+    parser.add_argument('--fps', type=int, default=30, help='Frame rate (default: 30)')
+    parser.add_argument('--seconds', type=float, default=30.0, help='How long to send (default: 30)')
+    parser.add_argument('--keyframe-interval', type=float, default=4.0,
+                        help='Seconds between scheduled IDRs (default: 4)')
+    parser.add_argument('--loss', type=float, default=0.0, help='Packet loss in percent (default: 0)')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed of the loss')
+    parser.add_argument('--history', type=int, default=1024, help='Packets kept for retransmission (default: 1024)')
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.size.split('x'))
+    sender = LiveSender(args.host, args.port, width, height, args.fps, args.keyframe_interval,
+                        args.loss / 100, args.seed, args.history)
+    print(f"Sending {width}x{height}@{args.fps} SSRC {sender.ssrc:08x} to {args.host}:{args.port}, "
+          f"RTCP on port {sender.rtcp.getsockname()[1]}")
+    try:
+        sender.run(args.seconds)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sender.close()
+    s = sender.stats
+    print(f"Frames: {s['frames']} ({s['keyframes']} keyframes, {s['forced_keyframes']} forced), "
+          f"packets: {s['packets']} ({s['dropped']} dropped)")
+    print(f"RTCP: {s['receiver_reports']} RRs, {s['nacks']} NACKs -> {s['retransmitted']} retransmitted "
+          f"({s['not_in_history']} no longer in history), {s['pli']} PLIs, {s['fir']} FIRs"
+          + (f", RTT {sender.rtt * 1000:.1f} ms" if sender.rtt is not None else ''))
+
+
+if __name__ == '__main__':
+    main()
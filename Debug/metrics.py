@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+"""
+Receiver metrics
+Counters, latency histograms and queue-depth gauges for the pipeline stages,
+exported as JSON lines or in the Prometheus text format over HTTP. Counters
+and histograms keep one cell per thread, so recording never takes a lock;
+the cells are summed when the metrics are read.
+"""
+
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram resolution: values below 2 * 2^SUB_BUCKET_BITS microseconds are
+# exact, above that each power of two is split into 2^SUB_BUCKET_BITS
+# buckets (within ~6%), up to 2^32 us
+SUB_BUCKET_BITS = 4
+HISTOGRAM_BUCKETS = (33 - SUB_BUCKET_BITS) << SUB_BUCKET_BITS
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+_LINEAR_LIMIT = 2 << SUB_BUCKET_BITS
+
+
+def _bucket_index(microseconds):
+    if microseconds < _LINEAR_LIMIT:
+        return microseconds if microseconds > 0 else 0
+    shift = microseconds.bit_length() - SUB_BUCKET_BITS - 1
+    index = (shift << SUB_BUCKET_BITS) + (microseconds >> shift)
+    return index if index < HISTOGRAM_BUCKETS else HISTOGRAM_BUCKETS - 1
+
+
+def _bucket_value(index):
+    """Midpoint of a bucket, in microseconds"""
+    if index < _LINEAR_LIMIT:
+        return index
+    shift = (index >> SUB_BUCKET_BITS) - 1
+    mantissa = index - (shift << SUB_BUCKET_BITS)
+    return (mantissa << shift) + (1 << (shift - 1))
+
+
+class Counter:
+    """Monotonic counter; inc() from any thread without locking"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._local = threading.local()
+        self._cells = []
+        self._lock = threading.Lock()  # only taken the first time a thread counts
+
+    def _new_cell(self):
+        cell = self._local.cell = [0]
+        with self._lock:
+            self._cells.append(cell)
+        return cell
+
+    def inc(self, amount=1):
+        try:
+            self._local.cell[0] += amount
+        except AttributeError:
+            self._new_cell()[0] += amount
+
+    @property
+    def value(self):
+        with self._lock:
+            return sum(cell[0] for cell in self._cells)
+
+
+class CallbackMetric:
+    """Counter or gauge whose value is read from fn() at export time, for
+    values the pipeline already keeps (queue sizes, per-stream stats)"""
+
+    def __init__(self, kind, name, help, labels, fn):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.fn = fn
+
+    @property
+    def value(self):
+        return self.fn()
+
+
+class Histogram:
+    """HDR-style latency histogram: log-linear microsecond buckets, per-thread
+    counts merged on read. Exported as a Prometheus summary."""
+
+    kind = 'summary'
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._local = threading.local()
+        self._cells = []
+        self._lock = threading.Lock()
+
+    def _new_cell(self):
+        cell = self._local.cell = [[0] * HISTOGRAM_BUCKETS, 0.0]  # counts, sum
+        with self._lock:
+            self._cells.append(cell)
+        return cell
+
+    def record(self, seconds, count=1):
+        """Add count observations of seconds"""
+        try:
+            cell = self._local.cell
+        except AttributeError:
+            cell = self._new_cell()
+        # _bucket_index(), inlined: this runs on the hot path
+        value = int(seconds * 1000000.0)
+        if value < _LINEAR_LIMIT:
+            index = value if value > 0 else 0
+        else:
+            shift = value.bit_length() - SUB_BUCKET_BITS - 1
+            index = (shift << SUB_BUCKET_BITS) + (value >> shift)
+            if index >= HISTOGRAM_BUCKETS:
+                index = HISTOGRAM_BUCKETS - 1
+        cell[0][index] += count
+        cell[1] += seconds * count
+
+    def summary(self):
+        """{'count', 'sum', 'mean', quantiles..., 'max'} with times in seconds"""
+        counts = [0] * HISTOGRAM_BUCKETS
+        total = 0.0
+        observations = 0
+        with self._lock:
+            for cell_counts, cell_sum in self._cells:
+                for index, value in enumerate(cell_counts):
+                    if value:
+                        counts[index] += value
+                        observations += value
+                total += cell_sum
+
+        result = {'count': observations, 'sum': total,
+                  'mean': total / observations if observations else 0.0}
+        targets = [(q, q * observations) for q in QUANTILES]
+        seen = 0
+        highest = 0
+        for index, value in enumerate(counts):
+            if not value:
+                continue
+            seen += value
+            highest = index
+            while targets and seen >= targets[0][1]:
+                result[f"p{targets.pop(0)[0] * 100:g}"] = _bucket_value(index) / 1e6
+        for q, _ in targets:
+            result[f"p{q * 100:g}"] = 0.0
+        result['max'] = _bucket_value(highest) / 1e6 if observations else 0.0
+        return result
+
+
+class _NullMetric:
+    """Stands in for every counter and histogram of a disabled registry"""
+
+    value = 0
+
+    def inc(self, amount=1):
+        pass
+
+    def record(self, seconds, count=1):
+        pass
+
+    def summary(self):
+        return {'count': 0, 'sum': 0.0, 'mean': 0.0}
+
+
+_NULL = _NullMetric()
+
+
+class MetricsRegistry:
+    """The metrics of one receiver. A disabled registry hands out no-op
+    metrics and exports nothing."""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def _add(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, fn=None, **labels):
+        """A Counter, or a counter read from fn() if given"""
+        if not self.enabled:
+            return _NULL
+        if fn is not None:
+            return self._add(CallbackMetric('counter', name, help, labels, fn))
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, fn, **labels):
+        if not self.enabled:
+            return _NULL
+        return self._add(CallbackMetric('gauge', name, help, labels, fn))
+
+    def histogram(self, name, help, **labels):
+        if not self.enabled:
+            return _NULL
+        return self._add(Histogram(name, help, labels))
+
+    def snapshot(self):
+        """{'time': unix time, 'metrics': {'name{labels}': value or histogram summary}}"""
+        values = {}
+        with self.lock:
+            metrics = list(self.metrics)
+        for metric in metrics:
+            key = metric.name + _format_labels(metric.labels)
+            if metric.kind == 'summary':
+                values[key] = metric.summary()
+            else:
+                try:
+                    values[key] = metric.value
+                except Exception:
+                    continue
+        return {'time': time.time(), 'metrics': values}
+
+    def prometheus_text(self):
+        """All metrics in the Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        families = {}  # the samples of one metric name must be contiguous
+        with self.lock:
+            for metric in self.metrics:
+                families.setdefault(metric.name, []).append(metric)
+        for name, metrics in families.items():
+            lines.append(f"# HELP {name} {metrics[0].help}")
+            lines.append(f"# TYPE {name} {metrics[0].kind}")
+            for metric in metrics:
+                lines.extend(_prometheus_samples(metric))
+        return '\n'.join(lines) + '\n'
+
+
+def _prometheus_samples(metric):
+    """Sample lines of one metric"""
+    if metric.kind == 'summary':
+        summary = metric.summary()
+        lines = []
+        for q in QUANTILES:
+            labels = _format_labels(dict(metric.labels, quantile=f"{q:g}"))
+            lines.append(f"{metric.name}{labels} {summary[f'p{q * 100:g}']:.6g}")
+        labels = _format_labels(metric.labels)
+        lines.append(f"{metric.name}_sum{labels} {summary['sum']:.6g}")
+        lines.append(f"{metric.name}_count{labels} {summary['count']}")
+        return lines
+    try:
+        value = metric.value
+    except Exception:
+        return []
+    return [f"{metric.name}{_format_labels(metric.labels)} {value}"]
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+class StageMetrics:
+    """The StageTimer interface (add / report) backed by one histogram per stage"""
+
+    def __init__(self, registry, name='h265_stage_seconds', help='Time spent per call in each pipeline stage'):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def _histogram(self, stage):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = self.registry.histogram(self.name, self.help, stage=stage)
+            return histogram
+
+    def add(self, stage, seconds, count=1):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self._histogram(stage)
+        if count == 1:
+            histogram.record(seconds)
+        elif count:
+            histogram.record(seconds / count, count)
+
+    def summary(self, stage):
+        histogram = self.histograms.get(stage)
+        return histogram.summary() if histogram is not None else None
+
+    def report(self):
+        """{stage: (milliseconds per call, calls)}"""
+        report = {}
+        for stage, histogram in list(self.histograms.items()):
+            summary = histogram.summary()
+            if summary['count']:
+                report[stage] = (summary['mean'] * 1000.0, summary['count'])
+        return report
+
+
+# RTP timestamp jumps larger than this many seconds restart RtpDelay
+MAX_RTP_JUMP = 10
+
+
+class RtpDelay:
+    """Delay of wall-clock events against the RTP timestamps of one stream.
+
+    Without RTCP sender reports the sender's clock offset is unknown, so the
+    fastest packet seen by observe() counts as zero delay; delay() then also
+    works for later points of the pipeline (e.g. display).
+    """
+
+    def __init__(self, clock_rate=90000):
+        self.clock_rate = clock_rate
+        # (latest RTP timestamp, its unwrapped RTP time since the first one),
+        # replaced as a whole so delay() can run on another thread
+        self.reference = None
+        self.min_offset = None
+        self.max_jump = clock_rate * MAX_RTP_JUMP
+
+    def _offset(self, timestamp, wall):
+        last, extended = self.reference
+        diff = (timestamp - last) & 0xFFFFFFFF
+        if diff >= 0x80000000:
+            diff -= 0x100000000
+        return wall - (extended + diff) / self.clock_rate, diff
+
+    def observe(self, timestamp, wall):
+        """Delay of a packet arriving at wall, updating the reference"""
+        reference = self.reference
+        if reference is not None:
+            # _offset(), inlined: this runs once per picture
+            last, extended = reference
+            diff = (timestamp - last) & 0xFFFFFFFF
+            if diff >= 0x80000000:
+                diff -= 0x100000000
+            if -self.max_jump <= diff <= self.max_jump:
+                extended += diff
+                if diff > 0:
+                    self.reference = (timestamp, extended)
+                offset = wall - extended / self.clock_rate
+                if offset < self.min_offset:
+                    self.min_offset = offset
+                return offset - self.min_offset
+        # First packet, or a timestamp discontinuity (e.g. a sender that
+        # stamps its parameter sets with 0): start over from this packet
+        self.reference = (timestamp, 0)
+        self.min_offset = wall
+        return 0.0
+
+    def delay(self, timestamp, wall):
+        """Delay of a later event for timestamp (None before any observe())"""
+        if self.min_offset is None:
+            return None
+        return self._offset(timestamp, wall)[0] - self.min_offset
+
+
+class JsonLinesWriter:
+    """Appends a registry snapshot as one JSON line every interval seconds
+    (path '-' writes to stdout)"""
+
+    def __init__(self, registry, path, interval=1.0):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=2.0)
+
+    def _run(self):
+        out = sys.stdout if self.path == '-' else open(self.path, 'a')
+        try:
+            while not self.stop_event.wait(self.interval):
+                out.write(json.dumps(self.registry.snapshot()) + '\n')
+                out.flush()
+            out.write(json.dumps(self.registry.snapshot()) + '\n')
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+
+class MetricsServer:
+    """Serves /metrics (Prometheus text) and /metrics.json on a local HTTP port"""
+
+    def __init__(self, registry, port=9100, host='127.0.0.1'):
+        self.registry = registry
+        self.port = port
+        self.host = host
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body = registry.prometheus_text().encode()
+                    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+                elif self.path == '/metrics.json':
+                    body = json.dumps(registry.snapshot()).encode()
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
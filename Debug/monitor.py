@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Keyframe-only monitoring
+Watches many senders at a fraction of the cost of full decoding: only IRAP
+pictures are reassembled and decoded (at most keyframe_rate per second and
+stream, see H265RTPDepacketizer keyframes_only), each is scaled straight to a
+thumbnail, and the thumbnails of all streams are tiled into one mosaic
+"""
+
+import math
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from frame_output import preview_size
+
+# A tile whose stream sent no keyframe for this long is dimmed
+STALE_SECONDS = 6.0
+
+_LABEL_FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+
+class MonitorOptions:
+    """How streams are monitored.
+
+    keyframe_rate caps the IRAP pictures decoded per second and stream (0:
+    every IRAP); thumbnails are thumbnail_width wide; columns 0 picks a
+    square-ish grid.
+    """
+
+    __slots__ = ('keyframe_rate', 'thumbnail_width', 'columns')
+
+    def __init__(self, keyframe_rate=1.0, thumbnail_width=320, columns=0):
+        self.keyframe_rate = keyframe_rate
+        self.thumbnail_width = thumbnail_width
+        self.columns = columns
+
+    @property
+    def keyframe_interval(self):
+        """Seconds of RTP time between decoded keyframes of a stream"""
+        return 1.0 / self.keyframe_rate if self.keyframe_rate > 0 else 0.0
+
+    def __str__(self):
+        rate = f"{self.keyframe_rate:g} keyframes/s" if self.keyframe_rate > 0 else 'every keyframe'
+        return f"{rate}, {self.thumbnail_width} px thumbnails"
+
+
+class Mosaic:
+    """Latest keyframe thumbnail of every stream, tiled into one BGR image.
+
+    update() runs on the decode thread, render() on the display thread.
+    """
+
+    def __init__(self, options=None):
+        self.options = options or MonitorOptions()
+        self.tile_width = self.options.thumbnail_width & ~1
+        self.tile_height = (self.tile_width * 9 // 16) & ~1
+        self.lock = threading.Lock()
+        self.tiles = {}  # key -> [thumbnail, time updated]
+        self.changed = False
+        self.rendered_at = 0.0
+        self.stats = {
+            'thumbnails': 0,
+            'renders': 0,
+        }
+
+    def update(self, key, frame, now=None):
+        """Make a DecodedFrame (or BGR ndarray) the thumbnail of stream key"""
+        if hasattr(frame, 'to_bgr'):
+            width, height = self._fit(frame.width, frame.height)
+            thumbnail = frame.to_bgr(width, height)
+        else:
+            width, height = self._fit(frame.shape[1], frame.shape[0])
+            thumbnail = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+        with self.lock:
+            self.tiles[key] = [thumbnail, time.time() if now is None else now]
+            self.changed = True
+            self.stats['thumbnails'] += 1
+
+    def _fit(self, width, height):
+        # The largest size with the frame's aspect ratio that fits a tile
+        scaled = preview_size(width, height, self.tile_width)
+        if scaled[0] is not None:
+            width, height = scaled
+        if height > self.tile_height:
+            width, height = max(2, (width * self.tile_height // height) & ~1), self.tile_height
+        return width, height
+
+    def remove(self, key):
+        with self.lock:
+            if self.tiles.pop(key, None) is not None:
+                self.changed = True
+
+    def due(self, now=None):
+        """True if a thumbnail changed, or once a second for the age labels"""
+        now = time.time() if now is None else now
+        return self.changed or now - self.rendered_at >= 1.0
+
+    def render(self, now=None):
+        """The mosaic: one tile per stream labelled with its SSRC and the age of its keyframe"""
+        now = time.time() if now is None else now
+        with self.lock:
+            tiles = sorted(self.tiles.items(), key=lambda item: str(item[0]))
+            self.changed = False
+        self.rendered_at = now
+        self.stats['renders'] += 1
+        count = max(1, len(tiles))
+        columns = self.options.columns or math.ceil(math.sqrt(count))
+        rows = math.ceil(count / columns)
+        tw, th = self.tile_width, self.tile_height
+        image = np.zeros((rows * th, columns * tw, 3), dtype=np.uint8)
+        for index, (key, (thumbnail, updated)) in enumerate(tiles):
+            y = index // columns * th
+            x = index % columns * tw
+            height, width = thumbnail.shape[:2]
+            top = y + (th - height) // 2
+            left = x + (tw - width) // 2
+            age = now - updated
+            tile = image[top:top + height, left:left + width]
+            if age > STALE_SECONDS:
+                # No keyframe for a while: dim it, so a frozen phone stands out
+                np.right_shift(thumbnail, 2, out=tile)
+            else:
+                tile[:] = thumbnail
+            label = f"{getattr(key, 'ssrc', 0):08x}  {age:.0f} s"
+            colour = (0, 0, 255) if age > STALE_SECONDS else (255, 255, 255)
+            cv2.putText(image, label, (x + 4, y + th - 6), _LABEL_FONT, 0.4, (0, 0, 0), 3, cv2.LINE_AA)
+            cv2.putText(image, label, (x + 4, y + th - 6), _LABEL_FONT, 0.4, colour, 1, cv2.LINE_AA)
+        return image
@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+"""
+Annex-B NAL unit index
+Scans an H.265 elementary stream for start codes over an mmap (vectorized
+with NumPy, or with bytes.find) into a compact structured array, kept as a
+sidecar file next to the stream. The index gives random access: decoding can
+start at the IRAP at or before any time, and a file can be decoded by
+several processes at once in segments split at IRAPs
+"""
+
+import argparse
+import mmap
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from access_unit import AU_START_TYPES
+from depacketizer import IRAP_TYPES
+
+# offset/size cover the NAL unit with its start code, so data[offset:offset + size]
+# is valid Annex-B on its own; timestamp is the RTP timestamp (90 kHz)
+INDEX_DTYPE = np.dtype([
+    ('offset', '<u8'),
+    ('size', '<u4'),
+    ('type', 'u1'),
+    ('irap', '?'),
+    ('timestamp', '<u4'),
+])
+INDEX_SUFFIX = '.idx'
+CLOCK_RATE = 90000
+SCAN_BLOCK = 32 * 1024 * 1024
+PARAMETER_SET_TYPES = (32, 33, 34)  # VPS, SPS, PPS
+# Non-VCL NAL types that belong to the picture after them
+_PREFIX_TYPES = np.array(sorted(t for t in AU_START_TYPES if t < 48), dtype=np.uint8)
+
+
+def find_start_codes_numpy(data, block=SCAN_BLOCK):
+    """Offsets of the 00 00 01 start code prefixes in data, NumPy-vectorized in blocks"""
+    array = np.frombuffer(data, dtype=np.uint8)
+    found = []
+    end_all = len(array) - 2
+    for start in range(0, max(end_all, 0), block):
+        end = min(start + block, end_all)
+        window = array[start:end + 2]
+        # Bytes equal to 1 are rare in compressed data: check the two zeros only there
+        ones = np.flatnonzero(window[2:] == 1)
+        hits = ones[(window[ones] == 0) & (window[ones + 1] == 0)]
+        found.append(hits.astype(np.uint64) + start)
+    return np.concatenate(found) if found else np.empty(0, dtype=np.uint64)
+
+
+def find_start_codes_find(data):
+    """Offsets of the 00 00 01 start code prefixes in data, with bytes.find"""
+    offsets = []
+    position = data.find(b'\x00\x00\x01')
+    while position != -1:
+        offsets.append(position)
+        position = data.find(b'\x00\x00\x01', position + 3)
+    return np.array(offsets, dtype=np.uint64)
+
+
+SCAN_METHODS = {
+    'numpy': find_start_codes_numpy,
+    'find': find_start_codes_find,
+}
+
+
+def scan(data, fps=30.0, method='numpy'):
+    """Index of the NAL units in data (bytes, mmap or any buffer).
+
+    Timestamps are synthetic, one frame interval at fps per access unit;
+    extract_h265.py replaces them with the RTP timestamps it knows.
+    """
+    array = np.frombuffer(data, dtype=np.uint8)
+    prefixes = SCAN_METHODS[method](data)
+    prefixes = prefixes[prefixes + 3 < len(array)]
+    index = np.zeros(len(prefixes), dtype=INDEX_DTYPE)
+    if not len(prefixes):
+        return index
+
+    # A zero byte before the prefix makes it a 4-byte start code
+    starts = prefixes.copy()
+    has_zero = prefixes > 0
+    has_zero[has_zero] = array[prefixes[has_zero] - 1] == 0
+    starts[has_zero] -= 1
+    index['offset'] = starts
+    index['size'] = np.diff(np.append(starts, len(array)))
+    types = (array[prefixes + 3] >> 1) & 0x3F
+    index['type'] = types
+    index['irap'] = (types >= IRAP_TYPES.start) & (types < IRAP_TYPES.stop)
+
+    first = access_unit_starts(array, index, prefixes)
+    pictures = np.maximum(np.cumsum(first) - 1, 0)
+    index['timestamp'] = (pictures * (CLOCK_RATE / fps)).astype(np.uint32)
+    return index
+
+
+def _first_slice(array, prefixes, types):
+    """first_slice_segment_in_pic_flag of the VCL NAL units (False for the others)"""
+    vcl = types < 32
+    flag_offsets = prefixes + 5
+    vcl &= flag_offsets < len(array)
+    first = np.zeros(len(prefixes), dtype=bool)
+    first[vcl] = (array[flag_offsets[vcl]] & 0x80) != 0
+    return first
+
+
+def access_unit_starts(array, index, prefixes=None):
+    """Boolean array: NAL units that start an access unit (the prefix NAL units
+    before a first slice, or the first slice itself)"""
+    types = index['type']
+    if prefixes is None:
+        # Offset of the 00 00 01 prefix: after the leading zero of a 4-byte start code
+        offsets = index['offset']
+        prefixes = offsets + (array[offsets + 2] == 0)
+    first = _first_slice(array, prefixes, types)
+    prefix = np.isin(types, _PREFIX_TYPES)
+    starts = np.zeros(len(index), dtype=bool)
+    if not len(index):
+        return starts
+    # A prefix NAL unit starts the access unit if the NAL before it does not
+    # also belong to that access unit; a first slice does if no prefix NAL
+    # units precede it
+    previous_prefix = np.concatenate(([False], prefix[:-1]))
+    starts[prefix & ~previous_prefix] = True
+    starts[first & ~previous_prefix] = True
+    return starts
+
+
+def apply_timestamps(index, chunk_sizes, timestamps):
+    """Give each entry the timestamp of the chunk it starts in, for data that was
+    written as consecutive chunks (e.g. depacketized RTP payloads)"""
+    chunk_starts = np.cumsum(np.asarray(chunk_sizes, dtype=np.uint64)) - np.asarray(chunk_sizes, dtype=np.uint64)
+    chunk = np.searchsorted(chunk_starts, index['offset'], side='right') - 1
+    index['timestamp'] = np.asarray(timestamps, dtype=np.uint32)[np.maximum(chunk, 0)]
+    return index
+
+
+def index_path(path):
+    return path + INDEX_SUFFIX
+
+
+def save_index(path, index):
+    """Write the sidecar of path"""
+    with open(index_path(path), 'wb') as f:
+        np.save(f, index)
+
+
+class IndexWriter:
+    """Sidecar index built while the stream is written, one NAL unit at a time.
+
+    Entries are spooled to a temporary file in blocks, so memory does not grow
+    with the stream; close() writes the sidecar. With append, the entries of
+    the existing file come first (from its sidecar if current, else a scan).
+    """
+
+    BLOCK = 1 << 12
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self.entries = []
+        self.count = 0
+        self.spool = open(index_path(path) + '.part', 'w+b')
+        if append and os.path.exists(path) and os.path.getsize(path):
+            index = None
+            if os.path.exists(index_path(path)):
+                index = np.load(index_path(path), mmap_mode='r')
+                if index.dtype != INDEX_DTYPE or not _index_current(path, index):
+                    index = None
+            if index is None:
+                with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    index = scan(data)
+            for start in range(0, len(index), self.BLOCK):
+                self.spool.write(np.ascontiguousarray(index[start:start + self.BLOCK]).tobytes())
+            self.count = len(index)
+            del index
+
+    def add(self, offset, size, nal_type, timestamp):
+        self.entries.append((offset, size, nal_type, IRAP_TYPES.start <= nal_type < IRAP_TYPES.stop, timestamp))
+        if len(self.entries) >= self.BLOCK:
+            self.flush()
+
+    def flush(self):
+        if self.entries:
+            self.spool.write(np.array(self.entries, dtype=INDEX_DTYPE).tobytes())
+            self.count += len(self.entries)
+            self.entries = []
+
+    def rename(self, path):
+        """The stream file was renamed to path"""
+        self.flush()
+        self.spool.close()
+        os.replace(index_path(self.path) + '.part', index_path(path) + '.part')
+        self.path = path
+        self.spool = open(index_path(path) + '.part', 'a+b')
+
+    def close(self):
+        """Write the sidecar (an .npy file, as save_index does)"""
+        self.flush()
+        self.spool.seek(0)
+        with open(index_path(self.path), 'wb') as f:
+            np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(INDEX_DTYPE),
+                                                     'fortran_order': False, 'shape': (self.count,)})
+            while True:
+                block = self.spool.read(self.BLOCK * INDEX_DTYPE.itemsize)
+                if not block:
+                    break
+                f.write(block)
+        self.spool.close()
+        os.remove(index_path(self.path) + '.part')
+
+
+def _index_current(path, index):
+    if not len(index):
+        return False
+    end = int(index['offset'][-1]) + int(index['size'][-1])
+    return end == os.path.getsize(path) and os.path.getmtime(index_path(path)) >= os.path.getmtime(path)
+
+
+class NalIndex:
+    """A stream file with its NAL unit index, memory-mapped.
+
+    The sidecar is loaded when it matches the file (same size, not older),
+    otherwise the file is scanned and the sidecar rewritten.
+    """
+
+    def __init__(self, path, fps=30.0, method='numpy', rebuild=False):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.array = np.frombuffer(self.data, dtype=np.uint8)
+        self.loaded = False
+        index = None
+        if not rebuild and os.path.exists(index_path(path)):
+            index = np.load(index_path(path), mmap_mode='r')
+            if index.dtype != INDEX_DTYPE or not _index_current(path, index):
+                index = None
+        if index is None:
+            index = scan(self.data, fps=fps, method=method)
+            save_index(path, index)
+        else:
+            self.loaded = True
+        self.index = index
+        self._au_starts = None
+        self._ticks = None
+
+    def close(self):
+        self.index = None
+        self.array = None
+        self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def au_starts(self):
+        """Entry numbers of the NAL units that start an access unit"""
+        if self._au_starts is None:
+            self._au_starts = np.flatnonzero(access_unit_starts(self.array, self.index))
+        return self._au_starts
+
+    @property
+    def ticks(self):
+        """Timestamps of the entries, unwrapped to int64 ticks from the first picture.
+
+        Parameter sets and SEI get the timestamp of their picture: the iOS
+        sender sends parameter sets with timestamp 0.
+        """
+        if self._ticks is None:
+            vcl = np.flatnonzero(self.index['type'] < 32)
+            ticks = np.zeros(len(self.index), dtype=np.int64)
+            if len(vcl):
+                stamps = self.index['timestamp'][vcl].astype(np.int64)
+                steps = np.diff(stamps)
+                # Signed 32-bit difference: unwraps the RTP timestamp
+                steps = (steps + 0x80000000) % 0x100000000 - 0x80000000
+                ticks[vcl] = np.concatenate(([0], np.cumsum(steps)))
+                # Non-VCL entries take the next picture's time (the last picture's at the end)
+                following = np.minimum(np.searchsorted(vcl, np.arange(len(self.index))), len(vcl) - 1)
+                ticks = ticks[vcl][following]
+            self._ticks = ticks
+        return self._ticks
+
+    @property
+    def duration(self):
+        return float(self.ticks[-1]) / CLOCK_RATE if len(self.index) else 0.0
+
+    @property
+    def irap_starts(self):
+        """Entry numbers of the access unit starts of the IRAP pictures"""
+        starts = self.au_starts
+        ends = np.append(starts[1:], len(self.index))
+        irap = np.cumsum(np.concatenate(([0], self.index['irap'].astype(np.int64))))
+        has_irap = irap[ends] > irap[starts]
+        return starts[has_irap]
+
+    def nearest_irap(self, seconds):
+        """Entry number of the IRAP access unit at or before seconds (the first IRAP if none)"""
+        iraps = self.irap_starts
+        if not len(iraps):
+            raise ValueError("No IRAP picture in the stream")
+        times = self.ticks[iraps]
+        position = np.searchsorted(times, seconds * CLOCK_RATE, side='right') - 1
+        return int(iraps[max(position, 0)])
+
+    def parameter_sets_before(self, entry):
+        """Annex-B bytes of the latest VPS/SPS/PPS before entry that entry's access unit lacks"""
+        types = self.index['type']
+        end = entry
+        while end < len(types) and types[end] >= 32:
+            end += 1
+        present = set(types[entry:end].tolist())
+        chunks = []
+        for nal_type in PARAMETER_SET_TYPES:
+            if nal_type in present:
+                continue
+            found = np.flatnonzero(types[:entry] == nal_type)
+            if len(found):
+                chunks.append(self.entry_bytes(int(found[-1])))
+        return b''.join(chunks)
+
+    def entry_bytes(self, entry, count=1):
+        """Annex-B bytes of count entries from entry"""
+        start = int(self.index['offset'][entry])
+        last = min(entry + count, len(self.index)) - 1
+        end = int(self.index['offset'][last]) + int(self.index['size'][last])
+        return self.data[start:end]
+
+    def access_units(self, first_entry=0, end_entry=None):
+        """(Annex-B bytes, ticks) of the access units starting in [first_entry, end_entry)"""
+        if end_entry is None:
+            end_entry = len(self.index)
+        starts = self.au_starts
+        starts = starts[(starts >= first_entry) & (starts < end_entry)]
+        offsets = self.index['offset']
+        end = len(self.data) if end_entry >= len(self.index) else int(offsets[end_entry])
+        bounds = np.append(offsets[starts].astype(np.int64), end)
+        ticks = self.ticks[starts]
+        for i in range(len(starts)):
+            yield self.data[bounds[i]:bounds[i + 1]], int(ticks[i])
+
+    def segments(self, count):
+        """Split the file at IRAPs into up to count [first entry, end entry) ranges of similar size"""
+        iraps = self.irap_starts
+        if not len(iraps):
+            return [(0, len(self.index))]
+        offsets = self.index['offset'][iraps].astype(np.int64)
+        bounds = [int(iraps[0])]
+        if len(iraps) > 1:
+            # The IRAP nearest to each equal-size cut
+            targets = np.arange(1, count) * (len(self.data) / count)
+            nearest = np.clip(np.searchsorted(offsets, targets), 1, len(offsets) - 1)
+            nearest -= targets - offsets[nearest - 1] < offsets[nearest] - targets
+            bounds = sorted(set(bounds + iraps[nearest].tolist()))
+        return list(zip(bounds, bounds[1:] + [len(self.index)]))
+
+
+def decode_from(index, seconds, frames=1, decoder_options=None):
+    """Decode from the IRAP at or before seconds; returns up to frames
+    av.VideoFrames from seconds on (pts in ticks from the first picture)"""
+    import av
+    from decoder_options import DecoderOptions
+
+    codec = (decoder_options or DecoderOptions()).create_codec()
+    entry = index.nearest_irap(seconds)
+    target = seconds * CLOCK_RATE
+    output = []
+    prefix = index.parameter_sets_before(entry)
+    for data, ticks in index.access_units(entry):
+        packet = av.Packet(prefix + data if prefix else data)
+        prefix = b''
+        packet.pts = ticks
+        for frame in codec.decode(packet):
+            if frame.pts is None or frame.pts >= target:
+                output.append(frame)
+        if len(output) >= frames:
+            return output[:frames]
+    output.extend(f for f in codec.decode(None) if f.pts is None or f.pts >= target)
+    return output[:frames]
+
+
+def _decode_segment(path, first_entry, end_entry, threads):
+    """Worker process: decode one IRAP-aligned segment. Returns (frames, CPU seconds)."""
+    import av
+    from decoder_options import DecoderOptions
+
+    start = time.process_time()
+    frames = 0
+    with NalIndex(path) as index:
+        codec = DecoderOptions(threads=threads).create_codec()
+        prefix = index.parameter_sets_before(first_entry)
+        for data, ticks in index.access_units(first_entry, end_entry):
+            packet = av.Packet(prefix + data if prefix else data)
+            prefix = b''
+            frames += len(codec.decode(packet))
+        frames += len(codec.decode(None))
+    return frames, time.process_time() - start
+
+
+def decode_parallel(path, workers, threads=1):
+    """Decode the whole file in up to workers processes, one IRAP-aligned segment
+    each. Returns [(first entry, frames, CPU seconds)] per segment."""
+    with NalIndex(path) as index:
+        segments = index.segments(workers)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_decode_segment, path, first, end, threads) for first, end in segments]
+        return [(first,) + future.result() for (first, _), future in zip(segments, futures)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Index an Annex-B H.265 file for seeking and parallel decoding')
+    parser.add_argument('input', help='Annex-B .h265 file')
+    parser.add_argument('--fps', type=float, default=30.0,
+                        help='Frame rate for the timestamps of files without a sidecar index (default: 30)')
+    parser.add_argument('--method', choices=sorted(SCAN_METHODS), default='numpy',
+                        help='Start code search (default: numpy)')
+    parser.add_argument('--rebuild', action='store_true', help='Rescan even if the sidecar index is current')
+    parser.add_argument('--seek', type=float, default=None, help='Decode the frame at this many seconds')
+    parser.add_argument('--save', default=None, help='With --seek: write the frame to this image file')
+    parser.add_argument('--decode-workers', type=int, default=0,
+                        help='Decode the file in N processes, in segments split at IRAPs')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.input):
+        print(f"Error: file not found: {args.input}")
+        sys.exit(1)
+
+    start = time.perf_counter()
+    with NalIndex(args.input, fps=args.fps, method=args.method, rebuild=args.rebuild) as index:
+        elapsed = time.perf_counter() - start
+        source = 'loaded' if index.loaded else f"built ({args.method})"
+        print(f"Index {index_path(args.input)} {source} in {elapsed * 1000:.1f} ms")
+        size = len(index.data)
+        print(f"{size:,} bytes, {len(index.index)} NAL units, {len(index.au_starts)} access units, "
+              f"{len(index.irap_starts)} IRAPs, {index.duration:.2f} s")
+        counts = np.bincount(index.index['type'], minlength=64)
+        print("NAL types: " + ', '.join(f"{t}: {c}" for t, c in enumerate(counts) if c))
+
+        if args.seek is not None:
+            entry = index.nearest_irap(args.seek)
+            start = time.perf_counter()
+            frames = decode_from(index, args.seek)
+            elapsed = time.perf_counter() - start
+            if not frames:
+                print(f"No frame at {args.seek} s")
+            else:
+                frame = frames[0]
+                print(f"Frame at {frame.pts / CLOCK_RATE:.3f} s ({frame.width}x{frame.height}), decoded from the "
+                      f"IRAP at {index.ticks[entry] / CLOCK_RATE:.3f} s in {elapsed * 1000:.1f} ms")
+                if args.save:
+                    import cv2
+                    cv2.imwrite(args.save, frame.to_ndarray(format='bgr24'))
+                    print(f"Saved {args.save}")
+
+    if args.decode_workers:
+        start = time.perf_counter()
+        results = decode_parallel(args.input, args.decode_workers)
+        elapsed = time.perf_counter() - start
+        frames = sum(r[1] for r in results)
+        print(f"Decoded {frames} frames in {len(results)} segments with {args.decode_workers} processes "
+              f"in {elapsed:.2f} s ({frames / elapsed:.1f} fps)")
+        for first, count, cpu in results:
+            print(f"  segment from entry {first}: {count} frames, {cpu:.2f} s CPU")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+H.265 parameter sets
+Caches the latest VPS/SPS/PPS of each SSRC, optionally seeded out of band
+from an SDP (sprop-vps/sps/pps or a config= blob), and decides per stream
+which access units can reach the decoder: nothing before the first IRAP that
+has parameter sets, and the cached ones put in front of the IRAP decoding
+(re)starts at
+"""
+
+import base64
+
+from access_unit import split_nal_units
+from depacketizer import START_CODE
+
+PARAMETER_SET_TYPES = (32, 33, 34)  # VPS, SPS, PPS
+SPROP_TYPES = {'sprop-vps': 32, 'sprop-sps': 33, 'sprop-pps': 34}
+# IRAPs that may be followed by RASL pictures referencing pictures before them
+CRA_BLA_TYPES = (16, 17, 18, 21)
+RASL_TYPES = (8, 9)
+# TRAIL, TSA, STSA: the first of these ends the leading pictures of an IRAP
+TRAILING_TYPES = range(0, 6)
+
+
+def parameter_sets(chunks):
+    """{nal type: Annex-B bytes} of the VPS/SPS/PPS among the chunks of an access unit"""
+    found = {}
+    current = None
+    for chunk in chunks:
+        if chunk is START_CODE:
+            current = None
+        elif current is None:
+            # First buffer after a start code: the NAL header
+            nal_type = (chunk[0] >> 1) & 0x3F
+            if nal_type in PARAMETER_SET_TYPES:
+                current = found[nal_type] = [START_CODE, chunk]
+            else:
+                current = False
+        elif current:
+            current.append(chunk)
+    return {nal_type: b''.join(nal) for nal_type, nal in found.items()}
+
+
+def first_vcl_type(chunks):
+    """NAL type of the first slice among the chunks of an access unit, or None"""
+    header = False
+    for chunk in chunks:
+        if chunk is START_CODE:
+            header = True
+        elif header:
+            nal_type = (chunk[0] >> 1) & 0x3F
+            if nal_type < 32:
+                return nal_type
+            header = False
+    return None
+
+
+def _hvcc_nal_units(data):
+    """NAL units of an HEVCDecoderConfigurationRecord (ISO/IEC 14496-15 hvcC)"""
+    nals = []
+    offset = 23
+    for _ in range(data[22]):
+        count = int.from_bytes(data[offset + 1:offset + 3], 'big')
+        offset += 3
+        for _ in range(count):
+            size = int.from_bytes(data[offset:offset + 2], 'big')
+            nals.append(data[offset + 2:offset + 2 + size])
+            offset += 2 + size
+    return nals
+
+
+def split_config(data):
+    """NAL units of a config= blob: Annex-B with start codes, an hvcC record,
+    or parameter sets concatenated without separators (split at their NAL
+    headers; pieces too short to be a parameter set stay with the one before)"""
+    if b'\x00\x00\x01' in data:
+        return split_nal_units(data)
+    if len(data) > 23 and data[0] == 1:
+        try:
+            return _hvcc_nal_units(data)
+        except IndexError:
+            pass
+    starts = [i for i in range(len(data) - 1)
+              if data[i + 1] == 0x01 and data[i] in (32 << 1, 33 << 1, 34 << 1)]
+    if not starts or starts[0] != 0:
+        return []
+    nals = []
+    for start, end in zip(starts, starts[1:] + [len(data)]):
+        if nals and end - start < 4:
+            nals[-1] += data[start:end]
+        else:
+            nals.append(data[start:end])
+    return nals
+
+
+def parse_sdp(text):
+    """{payload type: [parameter set NAL units]} from the a=fmtp lines of an SDP.
+    Payload types mapped to another codec by a=rtpmap are ignored."""
+    codecs = {}
+    fmtp = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('a=rtpmap:'):
+            payload_type, _, encoding = line[9:].partition(' ')
+            codecs[int(payload_type)] = encoding.split('/')[0].upper()
+        elif line.startswith('a=fmtp:'):
+            payload_type, _, params = line[7:].partition(' ')
+            fmtp[int(payload_type)] = params
+    result = {}
+    for payload_type, params in fmtp.items():
+        if codecs.get(payload_type, 'H265') != 'H265':
+            continue
+        nals = []
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            name = name.lower()
+            if name in SPROP_TYPES:
+                nals.extend(base64.b64decode(v) for v in value.split(',') if v)
+            elif name == 'config':
+                nals.extend(split_config(bytes.fromhex(value)))
+        if nals:
+            result[payload_type] = nals
+    return result
+
+
+def sdp_text(nal_units, address='127.0.0.1', port=5004, payload_type=96):
+    """An SDP for an H.265 RTP stream announcing nal_units as sprop-vps/sps/pps"""
+    sprops = {}
+    for nal in nal_units:
+        nal_type = (nal[0] >> 1) & 0x3F
+        for name, sprop_type in SPROP_TYPES.items():
+            if nal_type == sprop_type:
+                sprops.setdefault(name, []).append(base64.b64encode(bytes(nal)).decode('ascii'))
+    fmtp = ';'.join(f"{name}={','.join(values)}" for name, values in sprops.items())
+    return '\n'.join([
+        'v=0',
+        f'o=- 0 0 IN IP4 {address}',
+        's=H265 Stream',
+        f'c=IN IP4 {address}',
+        't=0 0',
+        f'm=video {port} RTP/AVP {payload_type}',
+        f'a=rtpmap:{payload_type} H265/90000',
+        f'a=fmtp:{payload_type} {fmtp}',
+        '',
+    ])
+
+
+class ParameterSetCache:
+    """Latest VPS/SPS/PPS (Annex-B bytes) per SSRC.
+
+    Parameter sets from seed() (the SDP) apply to every SSRC until the stream
+    sends its own. The cache belongs to the receiver, so it outlives streams
+    that time out and come back.
+    """
+
+    def __init__(self):
+        self.seeded = {}   # nal type -> Annex-B bytes
+        self.streams = {}  # SSRC -> {nal type: Annex-B bytes}
+
+    @classmethod
+    def from_sdp(cls, path):
+        cache = cls()
+        with open(path) as f:
+            for nal_units in parse_sdp(f.read()).values():
+                cache.seed(nal_units)
+        return cache
+
+    def seed(self, nal_units):
+        """Add out-of-band parameter sets (NAL units without start codes)"""
+        for nal in nal_units:
+            nal_type = (nal[0] >> 1) & 0x3F
+            if nal_type in PARAMETER_SET_TYPES:
+                self.seeded[nal_type] = START_CODE + bytes(nal)
+
+    def update(self, ssrc, found):
+        self.streams.setdefault(ssrc, {}).update(found)
+
+    def get(self, ssrc):
+        """{nal type: Annex-B bytes} known for ssrc"""
+        known = dict(self.seeded)
+        known.update(self.streams.get(ssrc, {}))
+        return known
+
+    def __str__(self):
+        names = {32: 'VPS', 33: 'SPS', 34: 'PPS'}
+        seeded = '/'.join(names[t] for t in PARAMETER_SET_TYPES if t in self.seeded) or 'none'
+        return f"seeded: {seeded}, {len(self.streams)} SSRCs"
+
+
+class StartupGate:
+    """Decides which access units of one stream are handed to the decoder.
+
+    Until an IRAP with a complete VPS/SPS/PPS (in band or cached) arrives the
+    decoder has nothing to decode, so the access units before it are dropped
+    here instead of making FFmpeg log errors. The IRAP decoding starts at,
+    and the first one after mark_loss(), gets the cached parameter sets it
+    lacks put in front. RASL pictures after a CRA/BLA start are dropped too,
+    as they reference pictures from before it.
+    """
+
+    def __init__(self, cache, ssrc):
+        self.cache = cache
+        self.ssrc = ssrc
+        self.started = False
+        self.resync = True
+        self.skip_rasl = False
+        self.stats = {
+            'dropped_leading': 0,        # before the first decodable IRAP
+            'dropped_rasl': 0,
+            'irap_without_parameter_sets': 0,
+            'parameter_sets_injected': 0,  # IRAPs that got cached parameter sets
+        }
+
+    def mark_loss(self):
+        self.resync = True
+
+    def admit(self, access_unit):
+        """True if access_unit should be decoded; may add parameter sets to it"""
+        found = parameter_sets(access_unit.chunks)
+        if found:
+            self.cache.update(self.ssrc, found)
+        vcl_type = first_vcl_type(access_unit.chunks)
+        if access_unit.irap:
+            if self.resync and not self._inject(access_unit, found):
+                self.stats['irap_without_parameter_sets'] += 1
+                if not self.started:
+                    self.stats['dropped_leading'] += 1
+                    return False
+            self.skip_rasl = self.resync and vcl_type in CRA_BLA_TYPES
+            self.started = True
+            self.resync = False
+            return True
+        if not self.started:
+            self.stats['dropped_leading'] += 1
+            return False
+        if vcl_type in RASL_TYPES:
+            if self.skip_rasl:
+                self.stats['dropped_rasl'] += 1
+                return False
+        elif vcl_type in TRAILING_TYPES:
+            self.skip_rasl = False
+        return True
+
+    def _inject(self, access_unit, found):
+        """Put the cached parameter sets access_unit lacks in front of it.
+        False if VPS, SPS and PPS are not all known."""
+        known = self.cache.get(self.ssrc)
+        if any(t not in known for t in PARAMETER_SET_TYPES):
+            return False
+        missing = [known[t] for t in PARAMETER_SET_TYPES if t not in found]
+        if missing:
+            access_unit.chunks = missing + access_unit.chunks
+            access_unit.size += sum(map(len, missing))
+            self.stats['parameter_sets_injected'] += 1
+        return True
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+Streaming pcap / pcapng reader
+Walks an mmap of the capture and decodes only the link, IP and UDP headers,
+so memory use does not depend on the capture size
+"""
+
+import mmap
+import struct
+
+# Link-layer header types (https://www.tcpdump.org/linktypes.html)
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86DD
+ETHERTYPE_VLAN = (0x8100, 0x88A8, 0x9100)
+
+IPPROTO_UDP = 17
+IPV6_EXTENSION_HEADERS = (0, 43, 60)  # hop-by-hop, routing, destination options
+IPV6_FRAGMENT = 44
+
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_IDB = 0x00000001
+PCAPNG_PB = 0x00000002
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+_UDP_HEADER = struct.Struct('!HHH')
+_U16 = struct.Struct('!H')
+
+
+class UDPDatagram:
+    """One UDP datagram from a capture. payload is a memoryview into the capture file."""
+
+    __slots__ = ('timestamp', 'src', 'sport', 'dst', 'dport', 'payload')
+
+    def __init__(self, timestamp, src, sport, dst, dport, payload):
+        self.timestamp = timestamp
+        self.src = src      # packed IPv4/IPv6 address (bytes)
+        self.sport = sport
+        self.dst = dst
+        self.dport = dport
+        self.payload = payload
+
+
+def _ip_offset(linktype, frame):
+    """Return (ip_version, offset of the IP header) for a link-layer frame, or None"""
+    if linktype == LINKTYPE_ETHERNET:
+        if len(frame) < 14:
+            return None
+        offset = 12
+        ethertype = _U16.unpack_from(frame, offset)[0]
+        while ethertype in ETHERTYPE_VLAN and len(frame) >= offset + 6:
+            offset += 4
+            ethertype = _U16.unpack_from(frame, offset)[0]
+        offset += 2
+    elif linktype == LINKTYPE_LINUX_SLL:
+        if len(frame) < 16:
+            return None
+        ethertype = _U16.unpack_from(frame, 14)[0]
+        offset = 16
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        if len(frame) < 20:
+            return None
+        ethertype = _U16.unpack_from(frame, 0)[0]
+        offset = 20
+    elif linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        # 4-byte address family; NULL uses the capturing host's byte order
+        if len(frame) < 4:
+            return None
+        family = frame[0] | frame[3]
+        return (4 if family == 2 else 6), 4
+    elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+        if not len(frame):
+            return None
+        return frame[0] >> 4, 0
+    else:
+        return None
+
+    if ethertype == ETHERTYPE_IPV4:
+        return 4, offset
+    if ethertype == ETHERTYPE_IPV6:
+        return 6, offset
+    return None
+
+
+def parse_udp(linktype, frame, timestamp=0.0, port=None):
+    """Decode a captured frame down to UDP. Returns a UDPDatagram, or None if it is
+    not an unfragmented UDP packet (on port, if given)."""
+    found = _ip_offset(linktype, frame)
+    if found is None:
+        return None
+    version, offset = found
+    size = len(frame)
+
+    if version == 4:
+        if size < offset + 20:
+            return None
+        ihl = (frame[offset] & 0x0F) * 4
+        if frame[offset + 9] != IPPROTO_UDP:
+            return None
+        # Non-first fragments and fragmented datagrams cannot be used
+        if _U16.unpack_from(frame, offset + 6)[0] & 0x3FFF:
+            return None
+        src = frame[offset + 12:offset + 16]
+        dst = frame[offset + 16:offset + 20]
+        offset += ihl
+    elif version == 6:
+        if size < offset + 40:
+            return None
+        next_header = frame[offset + 6]
+        src = frame[offset + 8:offset + 24]
+        dst = frame[offset + 24:offset + 40]
+        offset += 40
+        while next_header in IPV6_EXTENSION_HEADERS and size >= offset + 2:
+            next_header = frame[offset]
+            offset += (frame[offset + 1] + 1) * 8
+        if next_header != IPPROTO_UDP:
+            return None
+    else:
+        return None
+
+    if size < offset + 8:
+        return None
+    sport, dport, length = _UDP_HEADER.unpack_from(frame, offset)
+    if port is not None and sport != port and dport != port:
+        return None
+    end = offset + length
+    if length < 8 or end > size:
+        # Truncated by the capture snaplen
+        return None
+    return UDPDatagram(timestamp, bytes(src), sport, bytes(dst), dport, frame[offset + 8:end])
+
+
+class PcapReader:
+    """Iterates over the records of a pcap or pcapng file without loading it."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            self.file.close()
+            raise ValueError(f"Empty capture file: {path}")
+        self.view = memoryview(self.map)
+        self.packet_count = 0
+
+        magic = bytes(self.view[:4])
+        if magic in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1'):
+            self.format = 'pcap'
+            self.endian = '<'
+        elif magic in (b'\xa1\xb2\xc3\xd4', b'\xa1\xb2\x3c\x4d'):
+            self.format = 'pcap'
+            self.endian = '>'
+        elif magic == b'\x0a\x0d\x0d\x0a':
+            self.format = 'pcapng'
+            self.endian = None
+        else:
+            self.close()
+            raise ValueError(f"Not a pcap/pcapng file: {path}")
+        self.nanosecond = magic in (b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        return self.records()
+
+    def close(self):
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # Payload views are still held by the caller; the map is
+            # released when they are garbage collected
+            pass
+        self.file.close()
+
+    def release(self, end):
+        """Drop the pages of the capture before offset end from the resident
+        set, for long sequential reads. Views into them stay valid: the pages
+        are read back from the file if touched again."""
+        end -= end % mmap.PAGESIZE
+        if end > 0 and hasattr(self.map, 'madvise') and hasattr(mmap, 'MADV_DONTNEED'):
+            self.map.madvise(mmap.MADV_DONTNEED, 0, end)
+
+    def records(self):
+        """Yield (linktype, timestamp, frame memoryview) for every captured packet"""
+        view = self.view
+        for linktype, timestamp, offset, caplen in self.frames():
+            yield linktype, timestamp, view[offset:offset + caplen]
+
+    def frames(self):
+        """Yield (linktype, timestamp, offset, caplen) for every captured packet:
+        where its frame is in the file, for readers that decode many at once"""
+        if self.format == 'pcap':
+            return self._pcap_frames()
+        return self._pcapng_frames()
+
+    def udp_datagrams(self, port=None):
+        """Yield a UDPDatagram for every UDP packet with source or destination port"""
+        for linktype, timestamp, frame in self.records():
+            datagram = parse_udp(linktype, frame, timestamp, port)
+            if datagram is not None:
+                yield datagram
+
+    def _pcap_frames(self):
+        view = self.view
+        size = len(view)
+        linktype = struct.unpack_from(self.endian + 'I', view, 20)[0] & 0x0FFFFFFF
+        record = struct.Struct(self.endian + 'IIII')
+        scale = 1e-9 if self.nanosecond else 1e-6
+        offset = 24
+        while offset + 16 <= size:
+            ts_sec, ts_frac, caplen, _ = record.unpack_from(view, offset)
+            offset += 16
+            if offset + caplen > size:
+                break
+            self.packet_count += 1
+            yield linktype, ts_sec + ts_frac * scale, offset, caplen
+            offset += caplen
+
+    def _pcapng_frames(self):
+        view = self.view
+        size = len(view)
+        endian = '<'
+        interfaces = []  # (linktype, timestamp resolution, timestamp offset)
+        offset = 0
+        while offset + 12 <= size:
+            block_type = struct.unpack_from(endian + 'I', view, offset)[0]
+            if block_type == PCAPNG_SHB:
+                # The byte-order magic decides the endianness of this section
+                magic = struct.unpack_from('<I', view, offset + 8)[0]
+                endian = '<' if magic == PCAPNG_BYTE_ORDER_MAGIC else '>'
+                interfaces = []
+            block_length = struct.unpack_from(endian + 'I', view, offset + 4)[0]
+            if block_length < 12 or offset + block_length > size:
+                break
+            body = offset + 8
+
+            if block_type == PCAPNG_EPB or block_type == PCAPNG_PB:
+                if block_type == PCAPNG_EPB:
+                    interface_id, ts_high, ts_low, caplen = struct.unpack_from(endian + 'IIII', view, body)
+                else:
+                    interface_id, ts_high, ts_low, caplen = struct.unpack_from(endian + 'H2xIII', view, body)
+                if interface_id < len(interfaces):
+                    linktype, resolution, ts_offset = interfaces[interface_id]
+                    self.packet_count += 1
+                    timestamp = ((ts_high << 32) | ts_low) * resolution + ts_offset
+                    yield linktype, timestamp, body + 20, caplen
+            elif block_type == PCAPNG_SPB:
+                if interfaces:
+                    packet_length = struct.unpack_from(endian + 'I', view, body)[0]
+                    caplen = min(packet_length, block_length - 16)
+                    self.packet_count += 1
+                    yield interfaces[0][0], 0.0, body + 4, caplen
+            elif block_type == PCAPNG_IDB:
+                linktype = struct.unpack_from(endian + 'H', view, body)[0]
+                resolution, ts_offset = self._idb_options(view, body + 8, offset + block_length - 4, endian)
+                interfaces.append((linktype, resolution, ts_offset))
+
+            offset += block_length
+
+    @staticmethod
+    def _idb_options(view, offset, end, endian):
+        resolution = 1e-6
+        ts_offset = 0
+        while offset + 4 <= end:
+            code, length = struct.unpack_from(endian + 'HH', view, offset)
+            offset += 4
+            if code == 0:  # opt_endofopt
+                break
+            if code == 9 and length >= 1:  # if_tsresol
+                value = view[offset]
+                resolution = 2.0 ** -(value & 0x7F) if value & 0x80 else 10.0 ** -value
+            elif code == 14 and length >= 8:  # if_tsoffset
+                ts_offset = struct.unpack_from(endian + 'q', view, offset)[0]
+            offset += (length + 3) & ~3
+        return resolution, ts_offset
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Frame presenter
+Hands decoded frames from the decode (or convert) threads to the display.
+Instead of a FIFO that shows every frame however old it has become, each
+stream has a latest-value slot, or a short buffer whose frames are shown when
+their RTP timestamps are due, so the display never falls behind the stream
+"""
+
+import queue
+import threading
+import time
+from collections import deque
+
+from metrics import RtpDelay
+
+# latency: show the newest frame of each stream as soon as the display is free
+# smooth:  show frames at the pace of their RTP timestamps, a playout delay
+#          after the fastest frame of the stream
+# fifo:    every frame in arrival order, new frames dropped when full (the
+#          former 30-frame display queue)
+PRESENT_MODES = ('latency', 'smooth', 'fifo')
+
+# Frames a mode holds per stream (fifo: in total)
+DEFAULT_DEPTH = {'latency': 1, 'smooth': 4, 'fifo': 30}
+
+# Frames superseded in a row, out of this many, that count as a full backlog
+# for H265Decoder.update_backlog() in latency mode
+REPLACED_CAPACITY = 4
+
+# The smooth mode's reference point (the fastest frame) moves later by this
+# much per second, so it follows a sender clock that runs slower than ours
+DRIFT_ALLOWANCE = 0.001
+
+
+class _StreamFrames:
+    """Frames of one stream waiting for the display: [(due, offered at, timestamp, frame)]"""
+
+    __slots__ = ('frames', 'clock', 'observed', 'replaced')
+
+    def __init__(self, clock_rate):
+        self.frames = deque()
+        self.clock = RtpDelay(clock_rate)
+        self.observed = None
+        self.replaced = 0  # frames superseded since one was shown
+
+
+def _release(frame):
+    # A SharedFrame's slot goes back to its decode worker
+    release = getattr(frame, 'release', None)
+    if release is not None:
+        release()
+
+
+class FramePresenter:
+    """Decoded frames waiting for the display, by stream.
+
+    offer() is called from any thread; the display calls take() for the
+    frames due now and wait() in between. get() / get_nowait() / empty()
+    hand out one frame at a time like the queue this replaces. Frames without
+    an RTP timestamp (output='bgr', the decode pool) are due when they
+    arrive. Frames that are never shown are counted and, if they are
+    SharedFrames, released.
+
+    delay_ms is the smooth mode's playout delay after the fastest frame;
+    wait_histogram (optional) records how long shown frames waited.
+    """
+
+    def __init__(self, mode='latency', depth=None, delay_ms=40, clock_rate=90000, wait_histogram=None):
+        if mode not in PRESENT_MODES:
+            raise ValueError(f"Unknown display mode: {mode}")
+        self.mode = mode
+        self.depth = depth or DEFAULT_DEPTH[mode]
+        self.delay = delay_ms / 1000.0
+        self.clock_rate = clock_rate
+        self.wait_histogram = wait_histogram
+        self.condition = threading.Condition()
+        self.streams = {}  # key -> _StreamFrames
+        self.fifo = deque()  # fifo mode: (key, offered at, timestamp, frame)
+        self.ready = deque()  # taken by get(), not handed out yet
+        self.stats = {
+            'offered': 0,
+            'shown': 0,
+            'replaced': 0,   # a newer frame of the stream came first
+            'overflow': 0,   # the stream's buffer (fifo: the queue) was full
+        }
+
+    @property
+    def dropped(self):
+        return self.stats['replaced'] + self.stats['overflow']
+
+    def offer(self, key, frame, timestamp=None, now=None):
+        """Hand a frame to the display. Returns False if it was dropped at once."""
+        if now is None:
+            now = time.time()
+        with self.condition:
+            self.stats['offered'] += 1
+            if self.mode == 'fifo':
+                if len(self.fifo) >= self.depth:
+                    self.stats['overflow'] += 1
+                    _release(frame)
+                    return False
+                self.fifo.append((key, now, timestamp, frame))
+                self.condition.notify()
+                return True
+
+            stream = self.streams.get(key)
+            if stream is None:
+                stream = self.streams[key] = _StreamFrames(self.clock_rate)
+            frames = stream.frames
+            due = now
+            if self.mode == 'latency':
+                if frames:
+                    _release(frames.pop()[3])
+                    self.stats['replaced'] += 1
+                    stream.replaced += 1
+            else:
+                if timestamp is not None:
+                    clock = stream.clock
+                    if stream.observed is not None:
+                        clock.min_offset += (now - stream.observed) * DRIFT_ALLOWANCE
+                    stream.observed = now
+                    due = now - clock.observe(timestamp, now) + self.delay
+                if len(frames) >= self.depth:
+                    _release(frames.popleft()[3])
+                    self.stats['overflow'] += 1
+            frames.append((due, now, timestamp, frame))
+            self.condition.notify()
+            return True
+
+    def _take(self, now):
+        if self.mode == 'fifo':
+            if not self.fifo:
+                return []
+            key, offered, timestamp, frame = self.fifo.popleft()
+            taken = [(key, offered, timestamp, frame)]
+        else:
+            taken = []
+            for key, stream in self.streams.items():
+                frames = stream.frames
+                if not frames or frames[0][0] > now:
+                    continue
+                # Only the newest frame that is due gets shown
+                due, offered, timestamp, frame = frames.popleft()
+                while frames and frames[0][0] <= now:
+                    _release(frame)
+                    self.stats['replaced'] += 1
+                    due, offered, timestamp, frame = frames.popleft()
+                stream.replaced = 0
+                taken.append((key, offered, timestamp, frame))
+        self.stats['shown'] += len(taken)
+        if self.wait_histogram is not None:
+            for _, offered, _, _ in taken:
+                self.wait_histogram.record(now - offered)
+        return [(key, frame, timestamp) for key, _, timestamp, frame in taken]
+
+    def take(self, now=None):
+        """[(key, frame, RTP timestamp or None)] to show now, at most one per stream"""
+        with self.condition:
+            return self._take(time.time() if now is None else now)
+
+    def _until_due(self, now):
+        """Seconds until the next frame is due (0 if one is due now, None if none waits)"""
+        if self.ready:
+            return 0.0
+        if self.mode == 'fifo':
+            return 0.0 if self.fifo else None
+        due = min((s.frames[0][0] for s in self.streams.values() if s.frames), default=None)
+        return None if due is None else max(0.0, due - now)
+
+    def wait(self, timeout):
+        """Block until a frame is due or offered, at most timeout seconds"""
+        with self.condition:
+            until_due = self._until_due(time.time())
+            if until_due is not None:
+                timeout = min(timeout, until_due)
+            if timeout > 0:
+                self.condition.wait(timeout)
+
+    def backlog(self, key):
+        """(depth, capacity) of the frames waiting for the display, for
+        H265Decoder.update_backlog(): frames superseded in a row in latency
+        mode, the stream's buffer in smooth mode, the queue in fifo mode"""
+        with self.condition:
+            if self.mode == 'fifo':
+                return len(self.fifo), self.depth
+            stream = self.streams.get(key)
+            if stream is None:
+                return 0, self.depth
+            if self.mode == 'latency':
+                return min(stream.replaced, REPLACED_CAPACITY), REPLACED_CAPACITY
+            return len(stream.frames), self.depth
+
+    def remove(self, key):
+        """Forget a stream that ended, releasing its frames"""
+        with self.condition:
+            stream = self.streams.pop(key, None)
+            if stream is not None:
+                for entry in stream.frames:
+                    _release(entry[3])
+
+    def qsize(self):
+        """Frames waiting, due or not"""
+        with self.condition:
+            return len(self.ready) + len(self.fifo) + sum(len(s.frames) for s in self.streams.values())
+
+    def empty(self):
+        """True if no frame is due now"""
+        with self.condition:
+            return self._until_due(time.time()) != 0.0
+
+    def get(self, timeout=None):
+        """(key, frame) of the next frame due, like queue.Queue.get()"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while not self.ready:
+                self.ready.extend(self._take(time.time()))
+                if self.ready:
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                until_due = self._until_due(time.time())
+                if until_due is not None:
+                    remaining = until_due if remaining is None else min(remaining, until_due)
+                self.condition.wait(remaining)
+            key, frame, _ = self.ready.popleft()
+            return key, frame
+
+    def get_nowait(self):
+        return self.get(timeout=0)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Headless stream recording
+Writes reassembled access units to disk without decoding them: as the raw
+Annex-B byte stream, or remuxed into fragmented MP4 / MPEG-TS with the RTP
+timestamps as PTS. Files are written in batches and rotated by size or age
+at the next IRAP, so every segment can be played on its own
+"""
+
+import os
+import time
+from fractions import Fraction
+
+import av
+
+from parameter_sets import PARAMETER_SET_TYPES, parameter_sets
+
+# annexb: raw .h265 byte stream; mp4: fragmented MP4; ts: MPEG-TS
+RECORD_FORMATS = ('annexb', 'mp4', 'ts')
+EXTENSIONS = {'annexb': '.h265', 'mp4': '.mp4', 'ts': '.ts'}
+
+RTP_CLOCK_RATE = 90000
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+class AnnexBFile:
+    """Annex-B segment file.
+
+    Access units are queued as their uncopied chunks and written with one
+    writev() per buffer_size bytes (or after max_delay seconds), instead of
+    one write per NAL unit. fd writes to an open descriptor (e.g. a pipe)
+    instead of path, which it leaves open; append continues an existing file.
+    """
+
+    def __init__(self, path, stats, buffer_size=1024 * 1024, max_delay=1.0, fd=None, append=False):
+        self.path = path
+        self.stats = stats  # 'writes' counts the system calls
+        self.buffer_size = buffer_size
+        self.max_delay = max_delay
+        self.owns_fd = fd is None
+        if fd is None:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | (os.O_APPEND if append else os.O_TRUNC), 0o644)
+        self.fd = fd
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_since = 0.0
+        self.bytes_written = os.fstat(fd).st_size if append and self.owns_fd else 0
+
+    @property
+    def size(self):
+        return self.bytes_written + self.pending_bytes
+
+    def write(self, chunks, size, timestamp, keyframe):
+        if not self.pending:
+            self.pending_since = time.monotonic()
+        self.pending.extend(chunks)
+        self.pending_bytes += size
+        if (self.pending_bytes >= self.buffer_size
+                or time.monotonic() - self.pending_since >= self.max_delay):
+            self.flush()
+
+    def flush(self):
+        chunks = self.pending
+        if not hasattr(os, 'writev'):
+            chunks = [b''.join(chunks)]
+        for start in range(0, len(chunks), IOV_MAX):
+            batch = chunks[start:start + IOV_MAX]
+            written = os.writev(self.fd, batch) if len(batch) > 1 else os.write(self.fd, batch[0])
+            self.stats['writes'] += 1
+            expected = sum(map(len, batch))
+            if written < expected:
+                # Short write: finish the batch with plain writes
+                rest = memoryview(b''.join(batch))[written:]
+                while rest:
+                    rest = rest[os.write(self.fd, rest):]
+                    self.stats['writes'] += 1
+        self.bytes_written += self.pending_bytes
+        self.pending = []
+        self.pending_bytes = 0
+
+    def close(self):
+        if self.fd is not None:
+            try:
+                self.flush()
+            finally:
+                if self.owns_fd:
+                    os.close(self.fd)
+                self.fd = None
+
+
+class RemuxFile:
+    """Fragmented MP4 or MPEG-TS segment, muxed by PyAV without a codec.
+
+    PTS and DTS are the unwrapped RTP timestamps relative to the first access
+    unit (the sender does not reorder frames, so both are equal). The muxer
+    takes the HEVC configuration from the parameter sets in the first packet,
+    which is why segments start with an IRAP carrying VPS/SPS/PPS.
+    """
+
+    def __init__(self, path, container_format, width, height, buffer_size=1024 * 1024):
+        self.path = path
+        self.file = open(path, 'wb', buffering=buffer_size)
+        options = {}
+        if container_format == 'mp4':
+            # Fragment at every IRAP so a recording cut short stays playable
+            options['movflags'] = 'frag_keyframe+empty_moov+default_base_moof'
+        self.container = av.open(self.file, 'w', format=container_format, options=options,
+                                 buffer_size=64 * 1024)
+        self.stream = self.container.add_mux_stream('hevc', width=width, height=height)
+        self.stream.time_base = Fraction(1, RTP_CLOCK_RATE)
+        self.last_timestamp = None
+        self.pts = 0
+        self.packets = 0
+        self.bytes_muxed = 0
+
+    @property
+    def size(self):
+        return self.bytes_muxed
+
+    def write(self, chunks, size, timestamp, keyframe):
+        if self.last_timestamp is not None:
+            delta = (timestamp - self.last_timestamp) & 0xFFFFFFFF
+            if delta >= 0x80000000:
+                delta -= 0x100000000
+            # Timestamps must increase; a repeated or older one gets the next tick
+            self.pts += max(1, delta)
+        self.last_timestamp = timestamp
+        packet = av.Packet(b''.join(chunks))
+        packet.stream = self.stream
+        packet.time_base = self.stream.time_base
+        packet.pts = packet.dts = self.pts
+        packet.is_keyframe = keyframe
+        self.container.mux(packet)
+        self.packets += 1
+        self.bytes_muxed += size
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.container is not None:
+            self.container.close()
+            self.file.close()
+            self.container = None
+
+
+def picture_size(data):
+    """(width, height) from the SPS in data, using the HEVC parser (no decoding)"""
+    codec = av.CodecContext.create('hevc', 'r')
+    codec.parse(data)
+    # The parser only completes the access unit (and reads its SPS) when flushed
+    codec.parse(None)
+    return codec.width, codec.height
+
+
+class RecordOptions:
+    """Where and how streams are recorded.
+
+    rotate_bytes / rotate_seconds start a new file at the first IRAP once the
+    current one is that large or old; 0 disables either limit.
+    """
+
+    __slots__ = ('directory', 'format', 'rotate_bytes', 'rotate_seconds', 'buffer_size')
+
+    def __init__(self, directory='.', format='annexb', rotate_bytes=0, rotate_seconds=0.0,
+                 buffer_size=1024 * 1024):
+        if format not in RECORD_FORMATS:
+            raise ValueError(f"Unknown record format: {format}")
+        self.directory = directory
+        self.format = format
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.buffer_size = buffer_size
+
+    def __str__(self):
+        text = f"{self.format} to {self.directory}"
+        if self.rotate_bytes:
+            text += f", rotate at {self.rotate_bytes / 1e6:.0f} MB"
+        if self.rotate_seconds:
+            text += f", rotate after {self.rotate_seconds:.0f} s"
+        return text
+
+
+class StreamRecorder:
+    """Writes the access units of one stream to rotating segment files.
+
+    Recording starts at the first IRAP; access units before it cannot be
+    decoded and are skipped. The latest VPS/SPS/PPS are cached and put in
+    front of an IRAP that starts a segment without them.
+    """
+
+    def __init__(self, key, options):
+        self.key = key
+        self.options = options
+        self.file = None
+        self.file_opened = 0.0
+        self.parameter_sets = {}
+        self.stats = {
+            'access_units': 0,
+            'bytes': 0,
+            'segments': 0,
+            'writes': 0,   # write system calls (Annex-B only)
+            'skipped': 0,  # before the first IRAP
+        }
+        os.makedirs(options.directory, exist_ok=True)
+
+    def segment_path(self):
+        ssrc = getattr(self.key, 'ssrc', 0)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        name = f"{ssrc:08x}_{stamp}_{self.stats['segments']:04d}{EXTENSIONS[self.options.format]}"
+        return os.path.join(self.options.directory, name)
+
+    def needs_rotation(self):
+        options = self.options
+        if options.rotate_bytes and self.file.size >= options.rotate_bytes:
+            return True
+        return bool(options.rotate_seconds) and time.time() - self.file_opened >= options.rotate_seconds
+
+    def write(self, access_unit):
+        chunks = access_unit.chunks
+        size = access_unit.size
+        if access_unit.irap:
+            found = parameter_sets(chunks)
+            self.parameter_sets.update(found)
+            if self.file is None or self.needs_rotation():
+                if len(found) < len(self.parameter_sets):
+                    prefix = [self.parameter_sets[t] for t in PARAMETER_SET_TYPES
+                              if t in self.parameter_sets and t not in found]
+                    chunks = prefix + chunks
+                    size += sum(map(len, prefix))
+                self.open_segment(chunks)
+        elif self.file is None:
+            self.stats['skipped'] += 1
+            return
+        self.file.write(chunks, size, access_unit.timestamp, access_unit.irap)
+        self.stats['access_units'] += 1
+        self.stats['bytes'] += size
+
+    def open_segment(self, chunks):
+        self.close()
+        path = self.segment_path()
+        options = self.options
+        if options.format == 'annexb':
+            self.file = AnnexBFile(path, self.stats, buffer_size=options.buffer_size)
+        else:
+            width, height = picture_size(b''.join(chunks))
+            self.file = RemuxFile(path, 'mp4' if options.format == 'mp4' else 'mpegts',
+                                  width, height, buffer_size=options.buffer_size)
+        self.file_opened = time.time()
+        self.stats['segments'] += 1
+        print(f"Recording {self.key} to {path}")
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""
+Loopback RTP replay
+Sends the RTP stream of a capture, or an Annex-B file packetized like
+RTPPacketizer.swift, to a receiver over UDP. Packets are paced by their RTP
+timestamps or sent as fast as possible, optionally with injected loss,
+reordering, duplication and jitter, as N parallel streams, optionally
+protected by FEC parity packets (fec.py)
+"""
+
+import argparse
+import heapq
+import random
+import socket
+import struct
+import time
+
+from metrics import MAX_RTP_JUMP
+
+MAX_PAYLOAD = 1200  # RTPPacketizer.swift maxPayloadSize
+FU_TYPE = 49
+PAYLOAD_TYPE = 98
+CLOCK_RATE = 90000
+
+# sequence, timestamp, SSRC
+_SEQ_TS_SSRC = struct.Struct('!HII')
+
+
+def make_rtp_packet(sequence, timestamp, ssrc, payload, marker=False, payload_type=PAYLOAD_TYPE):
+    """Build an RTP packet the way RTPPacketizer.swift does"""
+    byte1 = (0x80 if marker else 0) | payload_type
+    return struct.pack('!BBHII', 0x80, byte1, sequence & 0xFFFF, timestamp & 0xFFFFFFFF, ssrc) + payload
+
+
+def packetize_nal(nal, sequence, timestamp, ssrc, marker=True, max_payload=MAX_PAYLOAD):
+    """Split one NAL unit (without start code) into RTP packets like RTPPacketizer.swift"""
+    if len(nal) <= max_payload:
+        return [make_rtp_packet(sequence, timestamp, ssrc, nal, marker)]
+
+    nal_header = (nal[0] << 8) | nal[1]
+    nal_type = (nal_header >> 9) & 0x3F
+    payload_header = struct.pack('!H', (nal_header & 0x81FF) | (FU_TYPE << 9))
+    body = nal[2:]
+    step = max_payload - 3
+    packets = []
+    for offset in range(0, len(body), step):
+        is_start = offset == 0
+        is_end = offset + step >= len(body)
+        fu_header = nal_type | (0x80 if is_start else 0) | (0x40 if is_end else 0)
+        payload = payload_header + bytes([fu_header]) + body[offset:offset + step]
+        packets.append(make_rtp_packet(sequence + len(packets), timestamp, ssrc, payload,
+                                       marker and is_end))
+    return packets
+
+
+def annexb_datagrams(path, fps=30.0, ssrc=0x12345678, max_payload=MAX_PAYLOAD):
+    """RTP packets of an Annex-B file, one RTP timestamp per access unit and the
+    marker on the last packet of each, as RTPPacketizer.swift sends them"""
+    from access_unit import AccessUnitAssembler, split_nal_units
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    assembler = AccessUnitAssembler()
+    access_units = []
+    for nal in split_nal_units(data):
+        access_units.extend(assembler.push([nal]))
+    access_units.extend(assembler.flush())
+
+    datagrams = []
+    sequence = 0
+    for index, access_unit in enumerate(access_units):
+        timestamp = int(index * CLOCK_RATE / fps)
+        nals = [nal for nal in split_nal_units(access_unit.join()) if nal]
+        for i, nal in enumerate(nals):
+            packets = packetize_nal(nal, sequence, timestamp, ssrc, marker=i == len(nals) - 1,
+                                    max_payload=max_payload)
+            sequence += len(packets)
+            datagrams.extend(packets)
+    return datagrams
+
+
+def capture_datagrams(path, port=None):
+    """RTP payloads of the UDP datagrams in a pcap/pcapng capture"""
+    from pcap_reader import PcapReader
+
+    with PcapReader(path) as reader:
+        return [bytes(d.payload) for d in reader.udp_datagrams(port)]
+
+
+def load_datagrams(path, capture_port=None, fps=30.0):
+    """capture_datagrams() for .pcap/.pcapng files, annexb_datagrams() otherwise"""
+    if path.endswith(('.pcap', '.pcapng')):
+        return capture_datagrams(path, capture_port)
+    return annexb_datagrams(path, fps=fps)
+
+
+def stream_parameter_sets(datagrams):
+    """The first VPS, SPS and PPS (NAL units without start codes) in the datagrams"""
+    from depacketizer import H265RTPDepacketizer
+    from parameter_sets import PARAMETER_SET_TYPES
+    from rtp import RTPPacket
+
+    depacketizer = H265RTPDepacketizer()
+    found = {}
+    for data in datagrams:
+        for nal in depacketizer.depacketize(RTPPacket(data)):
+            nal_type = (nal[0][0] >> 1) & 0x3F
+            if nal_type in PARAMETER_SET_TYPES and nal_type not in found:
+                found[nal_type] = b''.join(nal)
+        if len(found) == len(PARAMETER_SET_TYPES):
+            break
+    return [found[t] for t in PARAMETER_SET_TYPES if t in found]
+
+
+def _timestamp_diff(a, b):
+    """a - b for 32-bit RTP timestamps, across the wrap"""
+    diff = (a - b) & 0xFFFFFFFF
+    return diff - 0x100000000 if diff >= 0x80000000 else diff
+
+
+def rewrite_stream(datagrams, ssrc, loops=1, timestamp_offset=0):
+    """The datagrams loops times over as one stream with the given SSRC:
+    sequence numbers and RTP timestamps continue across the repeats"""
+    # One frame (at 30 fps) after the last picture
+    span = int(rtp_schedule(datagrams)[-1][0] * CLOCK_RATE) + CLOCK_RATE // 30
+    rewritten = []
+    for loop in range(loops):
+        for data in datagrams:
+            sequence, timestamp, _ = _SEQ_TS_SSRC.unpack_from(data, 2)
+            header = _SEQ_TS_SSRC.pack((sequence + loop * len(datagrams)) & 0xFFFF,
+                                       (timestamp + timestamp_offset + loop * span) & 0xFFFFFFFF, ssrc)
+            rewritten.append(data[:2] + header + data[12:])
+    return rewritten
+
+
+def rtp_schedule(datagrams, clock_rate=CLOCK_RATE):
+    """Send times (seconds from the first packet) from the RTP timestamps.
+
+    Times never go backwards. A timestamp more than MAX_RTP_JUMP seconds away
+    (the iOS sender's timestamp-0 parameter sets) is sent with the packet
+    before it; when the next packet confirms the jump, the clock restarts there.
+    """
+    schedule = []
+    anchor_ts = None
+    anchor_time = 0.0
+    last_time = 0.0
+    candidate = None  # timestamp after a jump, not yet confirmed by the next packet
+    for data in datagrams:
+        timestamp = _SEQ_TS_SSRC.unpack_from(data, 2)[1]
+        if anchor_ts is None:
+            anchor_ts = timestamp
+        due = anchor_time + _timestamp_diff(timestamp, anchor_ts) / clock_rate
+        if abs(due - last_time) > MAX_RTP_JUMP:
+            if candidate is not None and abs(_timestamp_diff(timestamp, candidate)) <= MAX_RTP_JUMP * clock_rate:
+                anchor_ts, anchor_time = candidate, last_time
+                due = anchor_time + _timestamp_diff(timestamp, candidate) / clock_rate
+                candidate = None
+            else:
+                candidate = timestamp
+                due = last_time
+        else:
+            candidate = None
+        last_time = max(last_time, due)
+        schedule.append((last_time, data))
+    return schedule
+
+
+class NetworkImpairment:
+    """Loss, reordering, duplication and jitter applied to a send schedule.
+
+    loss is the packet loss probability, in bursts of burst packets on
+    average (Gilbert model). A reordered packet is sent after the next 1 to
+    reorder_depth packets. jitter_ms delays packets by up to that much
+    without changing their order.
+    """
+
+    def __init__(self, loss=0.0, burst=1.0, reorder=0.0, reorder_depth=3, duplicate=0.0,
+                 jitter_ms=0.0, seed=None):
+        self.loss = loss
+        self.burst = max(1.0, burst)
+        self.reorder = reorder
+        self.reorder_depth = reorder_depth
+        self.duplicate = duplicate
+        self.jitter_ms = jitter_ms
+        self.random = random.Random(seed)
+        self.stats = {
+            'packets': 0,
+            'dropped': 0,
+            'reordered': 0,
+            'duplicated': 0,
+        }
+
+    def copy(self, seed=None):
+        """The same impairment with its own random generator and statistics"""
+        return NetworkImpairment(self.loss, self.burst, self.reorder, self.reorder_depth,
+                                 self.duplicate, self.jitter_ms, seed=seed)
+
+    def __bool__(self):
+        return bool(self.loss or self.reorder or self.duplicate or self.jitter_ms)
+
+    def __str__(self):
+        parts = []
+        if self.loss:
+            parts.append(f"loss {self.loss * 100:g}%" + (f" (bursts of {self.burst:g})" if self.burst > 1 else ''))
+        if self.reorder:
+            parts.append(f"reorder {self.reorder * 100:g}%")
+        if self.duplicate:
+            parts.append(f"duplicate {self.duplicate * 100:g}%")
+        if self.jitter_ms:
+            parts.append(f"jitter {self.jitter_ms:g} ms")
+        return ', '.join(parts) or 'none'
+
+    def apply(self, schedule):
+        """Impaired copy of a [(time, datagram)] schedule, sorted by time"""
+        rng = self.random
+        # Gilbert model: enter a burst with p_enter, stay in it with p_stay
+        p_stay = 1.0 - 1.0 / self.burst
+        p_enter = self.loss / (self.burst * (1.0 - self.loss)) if self.loss < 1.0 else 1.0
+        in_burst = False
+        jitter = self.jitter_ms / 1000.0
+        last_due = 0.0
+        result = []
+        for index, (due, data) in enumerate(schedule):
+            self.stats['packets'] += 1
+            in_burst = rng.random() < (p_stay if in_burst else p_enter)
+            if in_burst:
+                self.stats['dropped'] += 1
+                continue
+            if jitter:
+                due = last_due = max(last_due, due + rng.uniform(0.0, jitter))
+            if self.reorder and rng.random() < self.reorder:
+                later = min(len(schedule) - 1, index + rng.randint(1, self.reorder_depth))
+                if later > index:
+                    self.stats['reordered'] += 1
+                    due = max(due, schedule[later][0]) + 1e-6
+            result.append((due, data))
+            if self.duplicate and rng.random() < self.duplicate:
+                self.stats['duplicated'] += 1
+                result.append((due + 1e-6, data))
+        result.sort(key=lambda item: item[0])
+        return result
+
+
+def build_streams(datagrams, streams=1, loops=1, impairment=None, seed=None, fec=None):
+    """Schedules of streams parallel copies of datagrams, each with its own SSRC
+    and random RTP timestamp offset, started a fraction of a frame apart.
+    fec (L, D) adds parity packets (fec.FecEncoder) before the impairment.
+
+    Returns ([(time, stream index, (ssrc, timestamp), datagram)] sorted by
+    time, [NetworkImpairment per stream]).
+    """
+    rng = random.Random(seed)
+    schedules = []
+    impairments = []
+    for index in range(streams):
+        ssrc = 0x5E000000 + index
+        stream = rewrite_stream(datagrams, ssrc, loops, timestamp_offset=rng.getrandbits(32))
+        if fec is not None:
+            from fec import FecEncoder
+            stream = FecEncoder(ssrc, *fec).protect_stream(stream)
+        schedule = rtp_schedule(stream)
+        offset = index / streams / 30.0
+        schedule = [(due + offset, data) for due, data in schedule]
+        if impairment:
+            stream_impairment = impairment.copy(None if seed is None else seed + index)
+            schedule = stream_impairment.apply(schedule)
+            impairments.append(stream_impairment)
+        schedules.append([(due, index, (ssrc, _SEQ_TS_SSRC.unpack_from(data, 2)[1]), data)
+                          for due, data in schedule])
+    return list(heapq.merge(*schedules, key=lambda item: item[0])), impairments
+
+
+def send(schedule, host='127.0.0.1', port=5004, speed=1.0, fast=False, streams=1):
+    """Send a build_streams() schedule, each stream from its own socket.
+
+    Paced sends follow the schedule at speed; fast sends everything back to
+    back. Returns ({(ssrc, RTP timestamp): time.time() its last packet was
+    sent}, stats).
+    """
+    socks = []
+    for _ in range(streams):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 * 1024)
+        socks.append(sock)
+    destination = (host, port)
+    send_times = {}
+    late = 0.0
+    max_late = 0.0
+    clock = time.perf_counter
+    started = time.time()
+    start = clock()
+    for due, index, key, data in schedule:
+        if not fast:
+            target = start + due / speed
+            wait = target - clock()
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                late -= wait
+                max_late = max(max_late, -wait)
+        socks[index].sendto(data, destination)
+        send_times[key] = time.time()
+    elapsed = clock() - start
+    for sock in socks:
+        sock.close()
+    stats = {
+        'packets': len(schedule),
+        'started': started,
+        'seconds': elapsed,
+        'rate': len(schedule) / elapsed if elapsed else 0.0,
+        'mean_late_ms': late / len(schedule) * 1000.0 if schedule else 0.0,
+        'max_late_ms': max_late * 1000.0,
+    }
+    return send_times, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay an RTP capture or Annex-B file to a receiver over UDP')
+    parser.add_argument('input', help='pcap/pcapng capture, or an Annex-B .h265 file to packetize')
+    parser.add_argument('--host', default='127.0.0.1', help='Receiver address (default: 127.0.0.1)')
+    parser.add_argument('-p', '--port', type=int, default=5004, help='Receiver port (default: 5004)')
+    parser.add_argument('--capture-port', type=int, default=5004,
+                        help='RTP port in the capture; 0 takes every UDP datagram (default: 5004)')
+    parser.add_argument('--fps', type=float, default=30.0, help='Frame rate of an Annex-B input (default: 30)')
+    parser.add_argument('--speed', type=float, default=1.0, help='Pacing speed factor (default: 1.0)')
+    parser.add_argument('--fast', action='store_true', help='Send as fast as possible, without pacing')
+    parser.add_argument('--streams', type=int, default=1, help='Parallel streams, each with its own SSRC (default: 1)')
+    parser.add_argument('--loops', type=int, default=1, help='Times each stream repeats the input (default: 1)')
+    parser.add_argument('--loss', type=float, default=0.0, help='Packet loss in percent (default: 0)')
+    parser.add_argument('--burst', type=float, default=1.0, help='Mean loss burst length in packets (default: 1)')
+    parser.add_argument('--reorder', type=float, default=0.0, help='Reordered packets in percent (default: 0)')
+    parser.add_argument('--duplicate', type=float, default=0.0, help='Duplicated packets in percent (default: 0)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random delay of up to this many ms (default: 0)')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed for repeatable impairments')
+    parser.add_argument('--fec', default=None, metavar='L[xD]',
+                        help='Add a parity packet per L packets, and with xD per column of each L x D block '
+                             '(h265_receiver.py --fec)')
+    parser.add_argument('--sdp', default=None,
+                        help="Write an SDP with the input's parameter sets (sprop-vps/sps/pps) to this file")
+    args = parser.parse_args()
+
+    datagrams = load_datagrams(args.input, args.capture_port or None, args.fps)
+    if not datagrams:
+        print(f"No RTP packets in {args.input}")
+        return
+    if args.sdp:
+        from parameter_sets import sdp_text
+        with open(args.sdp, 'w') as f:
+            f.write(sdp_text(stream_parameter_sets(datagrams), address=args.host, port=args.port,
+                             payload_type=datagrams[0][1] & 0x7F))
+        print(f"SDP written to {args.sdp}")
+    impairment = NetworkImpairment(loss=args.loss / 100, burst=args.burst, reorder=args.reorder / 100,
+                                   duplicate=args.duplicate / 100, jitter_ms=args.jitter)
+    fec = None
+    if args.fec:
+        from fec import parse_config
+        fec = parse_config(args.fec)
+    schedule, impairments = build_streams(datagrams, args.streams, args.loops, impairment, args.seed, fec)
+    pacing = 'as fast as possible' if args.fast else f"paced at {args.speed:g}x"
+    print(f"{args.input}: {len(datagrams)} packets x {args.loops} loops x {args.streams} streams, "
+          f"{pacing}, impairment: {impairment}" + (f", FEC {args.fec}" if fec else ''))
+    print(f"Sending {len(schedule)} packets to {args.host}:{args.port}...")
+
+    send_times, stats = send(schedule, args.host, args.port, speed=args.speed, fast=args.fast,
+                             streams=args.streams)
+    print(f"Sent {stats['packets']} packets in {stats['seconds']:.2f} s ({stats['rate']:.0f} packets/s)")
+    if not args.fast:
+        print(f"Pacing: {stats['mean_late_ms']:.3f} ms late on average, {stats['max_late_ms']:.1f} ms max")
+    if impairments:
+        totals = {k: sum(i.stats[k] for i in impairments) for k in ('dropped', 'reordered', 'duplicated')}
+        print(f"Injected: {totals['dropped']} dropped, {totals['reordered']} reordered, "
+              f"{totals['duplicated']} duplicated")
+
+
+if __name__ == '__main__':
+    main()
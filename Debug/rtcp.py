@@ -0,0 +1,507 @@
+#!/usr/bin/env python3
+"""
+RTCP feedback (RFC 3550, RFC 4585, RFC 5104)
+Receiver Reports with loss and jitter, generic NACKs for packets that can
+still arrive within the jitter buffer's playout delay, and PLI/FIR keyframe
+requests after loss that cannot be repaired. RTCP runs on the RTP port + 1
+"""
+
+import random
+import socket
+import struct
+import threading
+import time
+
+PT_SR = 200
+PT_RR = 201
+PT_SDES = 202
+PT_BYE = 203
+PT_RTPFB = 205  # transport layer feedback
+PT_PSFB = 206   # payload-specific feedback
+FMT_NACK = 1    # RTPFB generic NACK
+FMT_PLI = 1     # PSFB picture loss indication
+FMT_FIR = 4     # PSFB full intra request
+SDES_CNAME = 1
+
+KEYFRAME_REQUESTS = ('pli', 'fir')
+
+# Seconds from 1900 (NTP) to 1970 (Unix)
+NTP_EPOCH_OFFSET = 2208988800
+# A jump in sequence numbers larger than this restarts the statistics (RFC 3550 A.1)
+MAX_DROPOUT = 3000
+# Gaps larger than this are not NACKed packet by packet
+MAX_NACK_GAP = 256
+
+_HEADER = struct.Struct('!BBH')
+_SSRC = struct.Struct('!I')
+_SENDER_INFO = struct.Struct('!IIIII')     # NTP seconds, NTP fraction, RTP timestamp, packets, octets
+_REPORT_BLOCK = struct.Struct('!IIIIII')   # SSRC, fraction lost + cumulative lost, highest seq, jitter, LSR, DLSR
+_FEEDBACK = struct.Struct('!II')           # sender SSRC, media SSRC
+_NACK_ITEM = struct.Struct('!HH')          # PID, BLP
+_FIR_ITEM = struct.Struct('!IB3x')         # SSRC, command sequence number
+
+
+def ntp_timestamp(now):
+    """(seconds, fraction) of the 64-bit NTP timestamp for a Unix time"""
+    seconds = int(now)
+    return (seconds + NTP_EPOCH_OFFSET) & 0xFFFFFFFF, int((now - seconds) * (1 << 32)) & 0xFFFFFFFF
+
+
+def ntp_middle(now):
+    """The middle 32 bits of the NTP timestamp (the LSR / DLSR time base, 1/65536 s)"""
+    seconds, fraction = ntp_timestamp(now)
+    return ((seconds & 0xFFFF) << 16) | (fraction >> 16)
+
+
+def _packet(packet_type, count, body):
+    """RTCP header + body (a multiple of 4 bytes); count is RC, SC or FMT"""
+    return _HEADER.pack(0x80 | count, packet_type, len(body) // 4) + body
+
+
+def report_block(ssrc, fraction_lost, cumulative_lost, highest_sequence, jitter, lsr=0, dlsr=0):
+    cumulative_lost = max(-0x800000, min(0x7FFFFF, cumulative_lost)) & 0xFFFFFF
+    return _REPORT_BLOCK.pack(ssrc, (fraction_lost << 24) | cumulative_lost,
+                              highest_sequence & 0xFFFFFFFF, int(jitter) & 0xFFFFFFFF, lsr, dlsr)
+
+
+def sender_report(ssrc, now, rtp_timestamp, packets, octets, blocks=()):
+    seconds, fraction = ntp_timestamp(now)
+    body = _SSRC.pack(ssrc) + _SENDER_INFO.pack(seconds, fraction, rtp_timestamp & 0xFFFFFFFF,
+                                                packets & 0xFFFFFFFF, octets & 0xFFFFFFFF)
+    return _packet(PT_SR, len(blocks), body + b''.join(blocks))
+
+
+def receiver_report(ssrc, blocks=()):
+    return _packet(PT_RR, len(blocks), _SSRC.pack(ssrc) + b''.join(blocks))
+
+
+def source_description(ssrc, cname):
+    """SDES with one CNAME chunk"""
+    cname = cname.encode('utf-8')[:255]
+    chunk = _SSRC.pack(ssrc) + bytes([SDES_CNAME, len(cname)]) + cname
+    # The item list ends with at least one null octet, padded to 32 bits
+    chunk += b'\x00' * (4 - len(chunk) % 4)
+    return _packet(PT_SDES, 1, chunk)
+
+
+def bye(ssrc):
+    return _packet(PT_BYE, 1, _SSRC.pack(ssrc))
+
+
+def generic_nack(sender_ssrc, media_ssrc, sequences):
+    """Generic NACK (RFC 4585 6.2.1) for sequences in ascending order (across
+    the wrap): each item is a PID plus a bitmask of the 16 sequence numbers
+    after it"""
+    items = []
+    for sequence in sequences:
+        sequence &= 0xFFFF
+        if items:
+            pid, mask = items[-1]
+            offset = (sequence - pid) & 0xFFFF
+            if offset == 0:
+                continue
+            if offset <= 16:
+                items[-1] = (pid, mask | (1 << (offset - 1)))
+                continue
+        items.append((sequence, 0))
+    body = _FEEDBACK.pack(sender_ssrc, media_ssrc) + b''.join(_NACK_ITEM.pack(*item) for item in items)
+    return _packet(PT_RTPFB, FMT_NACK, body)
+
+
+def picture_loss_indication(sender_ssrc, media_ssrc):
+    return _packet(PT_PSFB, FMT_PLI, _FEEDBACK.pack(sender_ssrc, media_ssrc))
+
+
+def full_intra_request(sender_ssrc, media_ssrc, sequence_number):
+    """FIR (RFC 5104 4.3.1); the media SSRC goes in the FCI entry"""
+    body = _FEEDBACK.pack(sender_ssrc, 0) + _FIR_ITEM.pack(media_ssrc, sequence_number & 0xFF)
+    return _packet(PT_PSFB, FMT_FIR, body)
+
+
+def nack_sequences(items):
+    """The sequence numbers of (PID, BLP) NACK items"""
+    sequences = []
+    for pid, mask in items:
+        sequences.append(pid)
+        sequences.extend((pid + bit + 1) & 0xFFFF for bit in range(16) if mask & (1 << bit))
+    return sequences
+
+
+def _report_blocks(data, offset, count):
+    blocks = []
+    for _ in range(count):
+        ssrc, lost, highest, jitter, lsr, dlsr = _REPORT_BLOCK.unpack_from(data, offset)
+        cumulative = lost & 0xFFFFFF
+        if cumulative & 0x800000:
+            cumulative -= 0x1000000
+        blocks.append({'ssrc': ssrc, 'fraction_lost': lost >> 24, 'lost': cumulative,
+                       'highest_sequence': highest, 'jitter': jitter, 'lsr': lsr, 'dlsr': dlsr})
+        offset += _REPORT_BLOCK.size
+    return blocks
+
+
+def parse(data):
+    """The packets of a compound RTCP packet as dicts with a 'type' of 'sr',
+    'rr', 'sdes', 'bye', 'nack', 'pli', 'fir' or 'other'. Raises ValueError
+    if data is not RTCP."""
+    packets = []
+    offset = 0
+    while offset + 4 <= len(data):
+        first, packet_type, length = _HEADER.unpack_from(data, offset)
+        end = offset + 4 * (length + 1)
+        if first >> 6 != 2 or end > len(data):
+            raise ValueError("Invalid RTCP packet")
+        count = first & 0x1F
+        body = offset + 4
+        try:
+            if packet_type == PT_SR:
+                ssrc, = _SSRC.unpack_from(data, body)
+                seconds, fraction, rtp_timestamp, sent_packets, octets = _SENDER_INFO.unpack_from(data, body + 4)
+                packets.append({'type': 'sr', 'ssrc': ssrc, 'ntp': ((seconds & 0xFFFF) << 16) | (fraction >> 16),
+                                'rtp_timestamp': rtp_timestamp, 'packets': sent_packets, 'octets': octets,
+                                'reports': _report_blocks(data, body + 24, count)})
+            elif packet_type == PT_RR:
+                ssrc, = _SSRC.unpack_from(data, body)
+                packets.append({'type': 'rr', 'ssrc': ssrc, 'reports': _report_blocks(data, body + 4, count)})
+            elif packet_type == PT_BYE:
+                packets.append({'type': 'bye', 'sources': [_SSRC.unpack_from(data, body + 4 * i)[0]
+                                                          for i in range(count)]})
+            elif packet_type == PT_RTPFB and count == FMT_NACK:
+                sender, media = _FEEDBACK.unpack_from(data, body)
+                items = [_NACK_ITEM.unpack_from(data, position) for position in range(body + 8, end, 4)]
+                packets.append({'type': 'nack', 'ssrc': sender, 'media_ssrc': media,
+                                'sequences': nack_sequences(items)})
+            elif packet_type == PT_PSFB and count == FMT_PLI:
+                sender, media = _FEEDBACK.unpack_from(data, body)
+                packets.append({'type': 'pli', 'ssrc': sender, 'media_ssrc': media})
+            elif packet_type == PT_PSFB and count == FMT_FIR:
+                sender, _ = _FEEDBACK.unpack_from(data, body)
+                entries = [_FIR_ITEM.unpack_from(data, position) for position in range(body + 8, end, 8)]
+                packets.append({'type': 'fir', 'ssrc': sender, 'entries': entries})
+            elif packet_type == PT_SDES:
+                packets.append({'type': 'sdes'})
+            else:
+                packets.append({'type': 'other', 'packet_type': packet_type})
+        except struct.error:
+            raise ValueError("Truncated RTCP packet")
+        offset = end
+    if not packets:
+        raise ValueError("Empty RTCP packet")
+    return packets
+
+
+class ReceptionStats:
+    """Per-source reception statistics for report blocks (RFC 3550 A.1, A.3, A.8)"""
+
+    def __init__(self, clock_rate=90000):
+        self.clock_rate = clock_rate
+        self.base_sequence = None
+        self.max_sequence = 0
+        self.cycles = 0
+        self.received = 0
+        self.expected_prior = 0
+        self.received_prior = 0
+        self.jitter = 0.0  # in timestamp units
+        self.last_transit = None
+        self.lsr = 0              # middle 32 bits of the last SR's NTP timestamp
+        self.sr_arrival = None    # when it arrived
+
+    def _restart(self, sequence):
+        self.base_sequence = sequence
+        self.max_sequence = sequence
+        self.cycles = 0
+        self.received = 0
+        self.expected_prior = 0
+        self.received_prior = 0
+
+    @property
+    def extended_max(self):
+        return self.cycles + self.max_sequence
+
+    def update(self, sequence, timestamp, arrival):
+        """Count one packet; returns its extended sequence number"""
+        if self.base_sequence is None:
+            self._restart(sequence)
+            extended = sequence
+        else:
+            delta = (sequence - self.max_sequence) & 0xFFFF
+            if delta < MAX_DROPOUT:
+                if sequence < self.max_sequence:
+                    self.cycles += 0x10000
+                self.max_sequence = sequence
+                extended = self.extended_max
+            elif delta >= 0x10000 - 100:
+                # Reordered or duplicate
+                extended = self.extended_max - (0x10000 - delta)
+            else:
+                # The sender restarted its sequence numbers
+                self._restart(sequence)
+                extended = sequence
+        self.received += 1
+
+        transit = int(arrival * self.clock_rate) - timestamp
+        if self.last_transit is not None:
+            d = abs((transit - self.last_transit + 0x80000000) % 0x100000000 - 0x80000000)
+            self.jitter += (d - self.jitter) / 16.0
+        self.last_transit = transit
+        return extended
+
+    def sender_report(self, ntp, arrival):
+        self.lsr = ntp
+        self.sr_arrival = arrival
+
+    def report_block(self, ssrc, now):
+        """Report block for ssrc; starts the next fraction-lost interval"""
+        expected = self.extended_max - self.base_sequence + 1
+        lost = expected - self.received
+        expected_interval = expected - self.expected_prior
+        received_interval = self.received - self.received_prior
+        self.expected_prior = expected
+        self.received_prior = self.received
+        lost_interval = expected_interval - received_interval
+        fraction = 0
+        if expected_interval > 0 and lost_interval > 0:
+            fraction = min(255, (lost_interval << 8) // expected_interval)
+        dlsr = 0
+        if self.sr_arrival is not None:
+            dlsr = int((now - self.sr_arrival) * 65536) & 0xFFFFFFFF
+        return report_block(ssrc, fraction, lost, self.extended_max, self.jitter, self.lsr, dlsr)
+
+
+class StreamFeedback:
+    """NACK and keyframe request state of one received stream.
+
+    Gaps are seen in arrival order, before the jitter buffer. A missing
+    packet is NACKed while a retransmission can still arrive before the
+    jitter buffer gives up on it (window seconds after the gap was seen,
+    less one round trip), at most retries times. Once it expires, or the
+    depacketizer drops a NAL, the stream needs a keyframe: a PLI/FIR goes
+    out right away and is repeated every keyframe_retry seconds until an
+    IRAP arrives.
+    """
+
+    def __init__(self, key, clock_rate=90000, nack=True, retries=2, keyframe_request='pli',
+                 keyframe_retry=0.5):
+        self.key = key
+        self.ssrc = key.ssrc
+        self.reception = ReceptionStats(clock_rate)
+        self.nack = nack
+        self.retries = retries
+        self.keyframe_request = keyframe_request
+        self.keyframe_retry = keyframe_retry
+        self.missing = {}  # extended sequence -> [seen, last NACK or None, NACKs sent]
+        self.highest = None
+        self.rtt = 0.02    # round trip estimate, from NACK to retransmission
+        self.needs_keyframe = False
+        self.keyframe_requested = None  # time of the last PLI/FIR, until an IRAP arrives
+        self.fir_sequence = 0
+        self.drops_seen = 0
+        self.stats = {
+            'reports': 0,
+            'nacks': 0,
+            'nacked_packets': 0,
+            'recovered': 0,    # NACKed packets that arrived
+            'expired': 0,      # missing packets given up on
+            'keyframe_requests': 0,
+            'keyframes': 0,    # IRAPs that answered a request
+        }
+
+    def on_packet(self, packet, arrival):
+        """Count a packet at arrival (before the jitter buffer)"""
+        extended = self.reception.update(packet.sequence, packet.timestamp, arrival)
+        if self.highest is None or extended > self.highest:
+            if self.highest is not None and 1 < extended - self.highest <= MAX_NACK_GAP:
+                for missing in range(self.highest + 1, extended):
+                    self.missing[missing] = [arrival, None, 0]
+            elif self.highest is not None and extended - self.highest > MAX_NACK_GAP:
+                self.needs_keyframe = True
+            self.highest = extended
+        elif self.missing:
+            entry = self.missing.pop(extended, None)
+            if entry is not None and entry[1] is not None:
+                self.stats['recovered'] += 1
+                self.rtt += (arrival - entry[1] - self.rtt) / 8.0
+        if self.keyframe_requested is not None and _starts_irap(packet.payload):
+            self.keyframe_requested = None
+            self.stats['keyframes'] += 1
+
+    def poll(self, now, window, dropped=0):
+        """(sequence numbers to NACK, whether to request a keyframe) at now.
+        window: seconds the jitter buffer waits for a missing packet;
+        dropped: NAL units the depacketizer has dropped so far."""
+        nacks = []
+        for extended, entry in list(self.missing.items()):
+            seen, last, count = entry
+            remaining = seen + window - now
+            if remaining <= 0:
+                del self.missing[extended]
+                self.stats['expired'] += 1
+                self.needs_keyframe = True
+            elif (self.nack and count < self.retries and remaining > self.rtt
+                  and (last is None or now - last >= self.rtt * 1.5)):
+                entry[1] = now
+                entry[2] += 1
+                nacks.append(extended & 0xFFFF)
+        if dropped > self.drops_seen:
+            self.drops_seen = dropped
+            self.needs_keyframe = True
+
+        request = False
+        if self.keyframe_request:
+            if self.needs_keyframe and self.keyframe_requested is None:
+                request = True
+            elif self.keyframe_requested is not None and now - self.keyframe_requested >= self.keyframe_retry:
+                request = True
+            if request:
+                self.keyframe_requested = now
+                self.stats['keyframe_requests'] += 1
+        self.needs_keyframe = False
+        if nacks:
+            self.stats['nacks'] += 1
+            self.stats['nacked_packets'] += len(nacks)
+        return nacks, request
+
+
+def _starts_irap(payload):
+    """True for a packet that carries an IRAP NAL or the start of one"""
+    if len(payload) < 3:
+        return False
+    nal_type = (payload[0] >> 1) & 0x3F
+    if nal_type == 49:
+        return bool(payload[2] & 0x80) and 16 <= (payload[2] & 0x3F) <= 21
+    return 16 <= nal_type <= 21
+
+
+class RtcpSession:
+    """The receiver's RTCP socket (RTP port + 1) and the feedback of its streams.
+
+    Receiver Reports go out every report_interval seconds from tick().
+    NACKs and keyframe requests go out from check() as soon as they are due,
+    each in a compound packet led by a Receiver Report (RFC 4585). Reports
+    are sent to where the sender's Sender Reports come from, or to its RTP
+    source port + 1 until one has arrived.
+    """
+
+    def __init__(self, port, report_interval=1.0, nack=True, keyframe_request='pli', clock_rate=90000):
+        if keyframe_request not in KEYFRAME_REQUESTS + (None,):
+            raise ValueError(f"Unknown keyframe request: {keyframe_request}")
+        self.port = port
+        self.report_interval = report_interval
+        self.nack = nack
+        self.keyframe_request = keyframe_request
+        self.clock_rate = clock_rate
+        self.ssrc = random.getrandbits(32)
+        self.cname = f"h265_receiver@{socket.gethostname()}"
+        self.streams = {}   # StreamKey -> StreamFeedback
+        self.senders = {}   # media SSRC -> RTCP address of its SRs
+        self.socket = None
+        self.thread = None
+        self.running = False
+        self.last_report = 0.0
+        self.stats = {
+            'sent_rr': 0,
+            'sent_nack': 0,
+            'sent_pli': 0,
+            'sent_fir': 0,
+            'received_sr': 0,
+            'received_bye': 0,
+            'errors': 0,
+        }
+
+    def start(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('0.0.0.0', self.port))
+        self.socket.settimeout(0.2)
+        self.running = True
+        self.thread = threading.Thread(target=self.receive_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.socket is None:
+            return
+        for feedback in list(self.streams.values()):
+            self._send(feedback, [bye(self.ssrc)])
+        self.running = False
+        self.thread.join(timeout=1.0)
+        self.socket.close()
+        self.socket = None
+
+    def add_stream(self, key):
+        feedback = self.streams[key] = StreamFeedback(key, clock_rate=self.clock_rate, nack=self.nack,
+                                                      keyframe_request=self.keyframe_request)
+        return feedback
+
+    def remove_stream(self, key):
+        self.streams.pop(key, None)
+
+    def receive_loop(self):
+        """Sender Reports (for LSR/DLSR and the sender's RTCP address) and BYEs"""
+        while self.running:
+            try:
+                data, addr = self.socket.recvfrom(2048)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            now = time.time()
+            try:
+                packets = parse(data)
+            except ValueError:
+                self.stats['errors'] += 1
+                continue
+            for packet in packets:
+                if packet['type'] == 'sr':
+                    self.stats['received_sr'] += 1
+                    self.senders[packet['ssrc']] = addr
+                    for feedback in list(self.streams.values()):
+                        if feedback.ssrc == packet['ssrc']:
+                            feedback.reception.sender_report(packet['ntp'], now)
+                elif packet['type'] == 'bye':
+                    self.stats['received_bye'] += 1
+
+    def _address(self, feedback):
+        address = self.senders.get(feedback.ssrc)
+        if address is None:
+            address = (feedback.key.src_ip, feedback.key.sport + 1)
+        return address
+
+    def _send(self, feedback, packets):
+        try:
+            self.socket.sendto(b''.join(packets), self._address(feedback))
+        except OSError:
+            self.stats['errors'] += 1
+
+    def _report(self, feedback, now):
+        feedback.stats['reports'] += 1
+        self.stats['sent_rr'] += 1
+        return [receiver_report(self.ssrc, [feedback.reception.report_block(feedback.ssrc, now)]),
+                source_description(self.ssrc, self.cname)]
+
+    def check(self, feedback, now, window, dropped=0):
+        """Send the NACK and keyframe request of one stream that are due"""
+        nacks, keyframe = feedback.poll(now, window, dropped)
+        if not nacks and not keyframe:
+            return
+        packets = self._report(feedback, now)
+        if nacks:
+            packets.append(generic_nack(self.ssrc, feedback.ssrc, nacks))
+            self.stats['sent_nack'] += 1
+        if keyframe:
+            if self.keyframe_request == 'fir':
+                feedback.fir_sequence = (feedback.fir_sequence + 1) & 0xFF
+                packets.append(full_intra_request(self.ssrc, feedback.ssrc, feedback.fir_sequence))
+                self.stats['sent_fir'] += 1
+            else:
+                packets.append(picture_loss_indication(self.ssrc, feedback.ssrc))
+                self.stats['sent_pli'] += 1
+        self._send(feedback, packets)
+
+    def tick(self, now):
+        """Send the periodic Receiver Reports when they are due"""
+        if now - self.last_report < self.report_interval:
+            return
+        self.last_report = now
+        for feedback in list(self.streams.values()):
+            if feedback.reception.base_sequence is not None:
+                self._send(feedback, self._report(feedback, now))
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+RTP packet parsing shared by h265_receiver.py and extract_h265.py
+"""
+
+import struct
+
+# V/P/X/CC, M/PT, sequence, timestamp, SSRC
+RTP_HEADER = struct.Struct('!BBHII')
+RTP_EXTENSION_HEADER = struct.Struct('!HH')
+_SEQUENCE = struct.Struct('!H')
+_WORD = struct.Struct('!I')
+
+
+class RTPPacket:
+    """Parsed RTP packet.
+
+    Only data and a memoryview of the payload are kept: the header fields
+    are decoded from data when they are read (with precompiled structs), so
+    a queued packet holds no per-field objects and no bytes are copied.
+    data may be bytes, bytearray or a memoryview; it must not be modified
+    while the packet is in use.
+    """
+
+    __slots__ = ('data', 'payload')
+
+    def __init__(self, data):
+        self.data = data
+        size = len(data)
+        if size < 12:
+            raise ValueError("Invalid RTP packet size")
+
+        byte0 = data[0]
+        header_size = 12 + (byte0 & 0x0F) * 4
+        if byte0 & 0x10 and header_size + 4 <= size:
+            header_size += 4 + RTP_EXTENSION_HEADER.unpack_from(data, header_size)[1] * 4
+
+        # The last padding octet holds the padding length, itself included
+        end = size
+        if byte0 & 0x20:
+            padding_size = data[size - 1]
+            if padding_size == 0 or header_size + padding_size > size:
+                raise ValueError("Invalid RTP padding length")
+            end -= padding_size
+
+        view = data if isinstance(data, memoryview) else memoryview(data)
+        self.payload = view[header_size:end]
+
+    @property
+    def version(self):
+        return self.data[0] >> 6
+
+    @property
+    def padding(self):
+        return (self.data[0] >> 5) & 0x01
+
+    @property
+    def extension(self):
+        return (self.data[0] >> 4) & 0x01
+
+    @property
+    def cc(self):
+        return self.data[0] & 0x0F
+
+    @property
+    def marker(self):
+        return self.data[1] >> 7
+
+    @property
+    def payload_type(self):
+        return self.data[1] & 0x7F
+
+    @property
+    def sequence(self):
+        return _SEQUENCE.unpack_from(self.data, 2)[0]
+
+    @property
+    def timestamp(self):
+        return _WORD.unpack_from(self.data, 4)[0]
+
+    @property
+    def ssrc(self):
+        return _WORD.unpack_from(self.data, 8)[0]
+
+    @property
+    def padding_size(self):
+        return self.data[-1] if self.padding else 0
+
+    @property
+    def header_size(self):
+        return len(self.data) - self.padding_size - len(self.payload)
@@ -0,0 +1,560 @@
+#!/usr/bin/env python3
+"""
+Vectorized RTP header decoding for offline analysis
+Decodes the link, IP, UDP and RTP headers of many captured packets at once
+with NumPy into a structured array (one row per packet), and computes loss,
+reordering, packets per frame and interarrival jitter as array operations
+instead of one RTPPacket at a time
+"""
+
+import argparse
+import struct
+import sys
+import time
+
+import numpy as np
+
+from pcap_reader import (ETHERTYPE_IPV4, ETHERTYPE_IPV6, ETHERTYPE_VLAN, IPPROTO_UDP,
+                         LINKTYPE_ETHERNET, LINKTYPE_IPV4, LINKTYPE_IPV6, LINKTYPE_LINUX_SLL,
+                         LINKTYPE_LINUX_SLL2, LINKTYPE_LOOP, LINKTYPE_NULL, LINKTYPE_RAW,
+                         PCAPNG_BYTE_ORDER_MAGIC, PCAPNG_EPB, PCAPNG_IDB, PCAPNG_PB, PCAPNG_SHB,
+                         PCAPNG_SPB, PcapReader, parse_udp)
+
+# offset/size: where the UDP payload (the RTP packet) is in the buffer it was
+# decoded from. nal_type is the type in the payload header (48 AP, 49 FU);
+# fu_type the type of the fragmented NAL unit. valid is False for datagrams
+# that are not RTP version 2 or are too short for their header.
+RTP_DTYPE = np.dtype([
+    ('arrival', '<f8'),
+    ('offset', '<u8'),
+    ('size', '<u4'),
+    ('src', 'u1', (16,)),
+    ('sport', '<u2'),
+    ('dport', '<u2'),
+    ('sequence', '<u2'),
+    ('timestamp', '<u4'),
+    ('ssrc', '<u4'),
+    ('marker', '?'),
+    ('payload_type', 'u1'),
+    ('header_size', '<u2'),
+    ('payload_size', '<u4'),
+    ('nal_type', 'u1'),
+    ('fu_start', '?'),
+    ('fu_end', '?'),
+    ('fu_type', 'u1'),
+    ('valid', '?'),
+])
+FU_TYPE = 49
+CLOCK_RATE = 90000
+BATCH_SIZE = 1 << 18
+# Jitter is computed in blocks this long, so that 16/15 ** BLOCK stays exact enough
+_JITTER_BLOCK = 256
+# Offset of the IP header per link type; None: decided per packet
+_LINK_HEADER = {
+    LINKTYPE_ETHERNET: 14,
+    LINKTYPE_LINUX_SLL: 16,
+    LINKTYPE_LINUX_SLL2: 20,
+    LINKTYPE_NULL: 4,
+    LINKTYPE_LOOP: 4,
+    LINKTYPE_RAW: 0,
+    LINKTYPE_IPV4: 0,
+    LINKTYPE_IPV6: 0,
+}
+
+
+def _u8(buffer, positions):
+    # Positions past the end (of a short packet, masked out later) read the last byte
+    return buffer[np.minimum(positions, len(buffer) - 1)].astype(np.uint32)
+
+
+def _u16(buffer, positions, little=False):
+    if little:
+        return _u8(buffer, positions) | (_u8(buffer, positions + 1) << 8)
+    return (_u8(buffer, positions) << 8) | _u8(buffer, positions + 1)
+
+
+def _u32(buffer, positions, little=False):
+    if little:
+        return _u16(buffer, positions, True) | (_u16(buffer, positions + 2, True) << 16)
+    return (_u16(buffer, positions) << 16) | _u16(buffer, positions + 2)
+
+
+def pack(datagrams):
+    """(buffer, offsets) of datagrams packed back to back: datagram i is
+    buffer[offsets[i]:offsets[i + 1]]"""
+    sizes = np.fromiter((len(d) for d in datagrams), dtype=np.int64, count=len(datagrams))
+    offsets = np.zeros(len(datagrams) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    buffer = np.frombuffer(b''.join(datagrams), dtype=np.uint8)
+    return buffer, offsets
+
+
+def decode_headers(buffer, starts, ends, out=None):
+    """RTP_DTYPE rows for the RTP packets buffer[starts[i]:ends[i]].
+
+    buffer is a uint8 array (or any buffer); out, if given, is an RTP_DTYPE
+    array whose arrival/src/port fields are kept.
+    """
+    buffer = np.frombuffer(buffer, dtype=np.uint8) if not isinstance(buffer, np.ndarray) else buffer
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    packets = np.zeros(len(starts), dtype=RTP_DTYPE) if out is None else out
+    if not len(starts):
+        return packets
+    sizes = ends - starts
+    valid = sizes >= 12
+    base = np.where(valid, starts, 0)
+    byte0 = _u8(buffer, base)
+    valid &= (byte0 >> 6) == 2
+    byte1 = _u8(buffer, base + 1)
+
+    header = 12 + (byte0 & 0x0F).astype(np.int64) * 4
+    extension = (byte0 & 0x10) != 0
+    has_extension = valid & extension & (header + 4 <= sizes)
+    extension_length = _u16(buffer, np.where(has_extension, base + header + 2, 0))
+    header = header + np.where(has_extension, 4 + extension_length.astype(np.int64) * 4, 0)
+    padding = np.where(valid & ((byte0 & 0x20) != 0), _u8(buffer, np.maximum(ends - 1, 0)), 0).astype(np.int64)
+    payload_size = sizes - header - padding
+    valid &= payload_size > 0
+
+    payload = np.where(valid, starts + header, 0)
+    nal_type = (_u8(buffer, payload) >> 1) & 0x3F
+    fu = valid & (nal_type == FU_TYPE) & (payload_size >= 3)
+    fu_header = np.where(fu, _u8(buffer, payload + 2), 0)
+
+    packets['offset'] = starts
+    packets['size'] = sizes
+    packets['sequence'] = _u16(buffer, base + 2)
+    packets['timestamp'] = _u32(buffer, base + 4)
+    packets['ssrc'] = _u32(buffer, base + 8)
+    packets['marker'] = (byte1 & 0x80) != 0
+    packets['payload_type'] = byte1 & 0x7F
+    packets['header_size'] = np.where(valid, header, 0)
+    packets['payload_size'] = np.where(valid, payload_size, 0)
+    packets['nal_type'] = np.where(valid, nal_type, 0)
+    packets['fu_start'] = (fu_header & 0x80) != 0
+    packets['fu_end'] = (fu_header & 0x40) != 0
+    packets['fu_type'] = fu_header & 0x3F
+    packets['valid'] = valid
+    return packets
+
+
+def decode_packed(buffer, offsets):
+    """RTP_DTYPE rows for the datagrams of pack()"""
+    offsets = np.asarray(offsets, dtype=np.int64)
+    return decode_headers(buffer, offsets[:-1], offsets[1:])
+
+
+def _udp_payloads(data, linktypes, frames, caplens, port):
+    """(frame indices, payload starts, payload ends, src, sport, dport) of the
+    UDP datagrams among the frames, decoded for all of them at once. Frames
+    whose headers the vectorized path does not cover (stacked VLAN tags, IPv6
+    extension headers, unknown link types) come back in the last element for
+    parse_udp."""
+    count = len(frames)
+    last = len(data) - 1
+    link = np.zeros(count, dtype=np.int64)
+    known = np.zeros(count, dtype=bool)
+    for linktype, size in _LINK_HEADER.items():
+        match = linktypes == linktype
+        link[match] = size
+        known |= match
+    frames = frames.astype(np.int64)
+    caplens = caplens.astype(np.int64)
+    ok = known & (caplens >= link + 28)
+    at = lambda offset: np.minimum(np.where(ok, frames + offset, 0), last - 3)
+
+    # IP version from the link header, or from the first nibble of raw IP
+    ethertype = np.zeros(count, dtype=np.uint32)
+    ethernet = linktypes == LINKTYPE_ETHERNET
+    ethertype[ethernet] = _u16(data, at(12))[ethernet]
+    vlan = ethernet & np.isin(ethertype, ETHERTYPE_VLAN)
+    link[vlan] += 4
+    ethertype[vlan] = _u16(data, at(16))[vlan]
+    sll = linktypes == LINKTYPE_LINUX_SLL
+    ethertype[sll] = _u16(data, at(14))[sll]
+    sll2 = linktypes == LINKTYPE_LINUX_SLL2
+    ethertype[sll2] = _u16(data, at(0))[sll2]
+    version = np.zeros(count, dtype=np.uint32)
+    version[ethertype == ETHERTYPE_IPV4] = 4
+    version[ethertype == ETHERTYPE_IPV6] = 6
+    null = (linktypes == LINKTYPE_NULL) | (linktypes == LINKTYPE_LOOP)
+    family = _u8(data, at(0)) | _u8(data, at(3))
+    version[null] = np.where(family == 2, 4, 6)[null]
+    raw = np.isin(linktypes, (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6))
+    version[raw] = (_u8(data, at(0)) >> 4)[raw]
+    # Double-tagged Ethernet goes to parse_udp
+    fallback = vlan & ~np.isin(ethertype, (ETHERTYPE_IPV4, ETHERTYPE_IPV6))
+
+    ip = frames + link
+    ip_at = lambda offset: np.minimum(np.where(ok, ip + offset, 0), last - 3)
+    v4 = ok & (version == 4)
+    v6 = ok & (version == 6)
+    ihl = (_u8(data, ip_at(0)) & 0x0F).astype(np.int64) * 4
+    udp4 = v4 & (_u8(data, ip_at(9)) == IPPROTO_UDP) & ((_u16(data, ip_at(6)) & 0x3FFF) == 0)
+    next_header = _u8(data, ip_at(6))
+    udp6 = v6 & (next_header == IPPROTO_UDP) & (caplens >= link + 48)
+    fallback |= v6 & np.isin(next_header, (0, 43, 60))
+    fallback |= ~known
+
+    udp = np.where(udp4, ip + ihl, ip + 40)
+    is_udp = (udp4 | udp6) & (udp + 8 <= frames + caplens)
+    udp_at = np.minimum(np.where(is_udp, udp, 0), last - 7)
+    sport = _u16(data, udp_at)
+    dport = _u16(data, udp_at + 2)
+    length = _u16(data, udp_at + 4).astype(np.int64)
+    is_udp &= (length >= 8) & (udp + length <= frames + caplens)
+    if port is not None:
+        is_udp &= (sport == port) | (dport == port)
+
+    selected = np.flatnonzero(is_udp)
+    src = np.zeros((len(selected), 16), dtype=np.uint8)
+    ip_selected = ip[selected]
+    selected_v4 = v4[selected]
+    width = np.where(selected_v4, 4, 16)
+    source = np.where(selected_v4, ip_selected + 12, ip_selected + 8)
+    for byte in range(16):
+        present = byte < width
+        src[present, byte] = data[np.minimum(source[present] + byte, last)]
+    starts = udp[selected] + 8
+    return (selected, starts, udp[selected] + length[selected], src, sport[selected], dport[selected],
+            np.flatnonzero(fallback & ~is_udp))
+
+
+def _pcap_batches(reader, data, batch_size):
+    """(linktypes, arrivals, frame offsets, caplens) per batch of pcap records.
+    The Python loop only follows the record lengths; the record headers are
+    read for the whole batch at once."""
+    view = reader.map
+    size = len(view)
+    little = reader.endian == '<'
+    caplen_at = struct.Struct(reader.endian + 'I').unpack_from
+    linktype = struct.unpack_from(reader.endian + 'I', view, 20)[0] & 0x0FFFFFFF
+    scale = 1e-9 if reader.nanosecond else 1e-6
+    offset = 24
+    while offset + 16 <= size:
+        frames = []
+        append = frames.append
+        while offset + 16 <= size and len(frames) < batch_size:
+            caplen = caplen_at(view, offset + 8)[0]
+            if offset + 16 + caplen > size:
+                offset = size
+                break
+            append(offset + 16)
+            offset += 16 + caplen
+        if not frames:
+            break
+        frames = np.array(frames, dtype=np.int64)
+        reader.packet_count += len(frames)
+        arrivals = _u32(data, frames - 16, little) + _u32(data, frames - 12, little) * scale
+        yield (np.full(len(frames), linktype, dtype=np.uint32), arrivals, frames,
+               _u32(data, frames - 8, little).astype(np.int64))
+
+
+def _pcapng_blocks(reader, batch_size):
+    """(endian, interfaces, block offsets, block types) per batch of pcapng
+    packet blocks; a batch never spans two sections"""
+    view = reader.map
+    size = len(view)
+    endian = '<'
+    header = struct.Struct('<II').unpack_from
+    interfaces = []
+    offsets = []
+    types = []
+    offset = 0
+    while offset + 12 <= size:
+        block_type, block_length = header(view, offset)
+        if block_type == PCAPNG_SHB:
+            if offsets:
+                yield endian, interfaces, offsets, types
+                offsets, types = [], []
+            magic = struct.unpack_from('<I', view, offset + 8)[0]
+            endian = '<' if magic == PCAPNG_BYTE_ORDER_MAGIC else '>'
+            header = struct.Struct(endian + 'II').unpack_from
+            block_length = header(view, offset)[1]
+            interfaces = []
+        if block_length < 12 or offset + block_length > size:
+            break
+        if block_type == PCAPNG_EPB or block_type == PCAPNG_SPB or block_type == PCAPNG_PB:
+            offsets.append(offset)
+            types.append(block_type)
+            if len(offsets) == batch_size:
+                yield endian, interfaces, offsets, types
+                offsets, types = [], []
+        elif block_type == PCAPNG_IDB:
+            linktype = struct.unpack_from(endian + 'H', view, offset + 8)[0]
+            resolution, ts_offset = reader._idb_options(view, offset + 16, offset + block_length - 4, endian)
+            # A new list, so that batches already yielded keep theirs
+            interfaces = interfaces + [(linktype, resolution, ts_offset)]
+        offset += block_length
+    if offsets:
+        yield endian, interfaces, offsets, types
+
+
+def _pcapng_batches(reader, data, batch_size):
+    """(linktypes, arrivals, frame offsets, caplens) per batch of pcapng packets"""
+    for endian, interfaces, offsets, types in _pcapng_blocks(reader, batch_size):
+        if not interfaces:
+            continue
+        little = endian == '<'
+        offsets = np.array(offsets, dtype=np.int64)
+        types = np.array(types, dtype=np.uint32)
+        body = offsets + 8
+        simple = types == PCAPNG_SPB
+        obsolete = types == PCAPNG_PB
+        interface = _u32(data, body, little)
+        interface[obsolete] = _u16(data, body, little)[obsolete]
+        interface[simple] = 0
+        known = interface < len(interfaces)
+        reader.packet_count += int(np.count_nonzero(known))
+        ticks = (_u32(data, body + 4, little).astype(np.uint64) << np.uint64(32)) | _u32(data, body + 8, little)
+        caplens = _u32(data, body + 12, little).astype(np.int64)
+        block_lengths = _u32(data, offsets + 4, little).astype(np.int64)
+        caplens[simple] = np.minimum(_u32(data, body, little)[simple], block_lengths[simple] - 16)
+        frames = body + 20
+        frames[simple] = body[simple] + 4
+        interface = np.where(known, interface, 0)
+        linktypes = np.array([i[0] for i in interfaces], dtype=np.uint32)[interface]
+        resolution = np.array([i[1] for i in interfaces])[interface]
+        ts_offset = np.array([i[2] for i in interfaces], dtype=np.float64)[interface]
+        arrivals = np.where(simple, 0.0, ticks * resolution + ts_offset)
+        yield linktypes[known], arrivals[known], frames[known], caplens[known]
+
+
+def capture_batches(path, port=None, batch_size=BATCH_SIZE):
+    """Yield (RTP_DTYPE array, uint8 view of the capture) for batches of up to
+    batch_size captured packets that are UDP datagrams (on port, if given) of
+    a pcap/pcapng capture. offset/size index the capture file, which stays
+    mapped, not copied."""
+    with PcapReader(path) as reader:
+        data = np.frombuffer(reader.map, dtype=np.uint8)
+        walk = _pcap_batches if reader.format == 'pcap' else _pcapng_batches
+        try:
+            for linktypes, arrivals, offsets, caplens in walk(reader, data, batch_size):
+                yield _decode_frames(reader, data, linktypes, arrivals, offsets, caplens, port), data
+        finally:
+            del data
+
+
+def _decode_frames(reader, data, linktypes, arrivals, offsets, caplens, port):
+    selected, starts, ends, src, sport, dport, fallback = _udp_payloads(data, linktypes, offsets,
+                                                                        caplens, port)
+    if len(fallback):
+        # Rare layouts: parse_udp, then locate the payload in the capture
+        base = data.ctypes.data
+        extra = []
+        for index in fallback.tolist():
+            offset, caplen = int(offsets[index]), int(caplens[index])
+            datagram = parse_udp(int(linktypes[index]), reader.view[offset:offset + caplen], 0.0, port)
+            if datagram is not None:
+                start = np.frombuffer(datagram.payload, dtype=np.uint8).ctypes.data - base
+                address = np.zeros(16, dtype=np.uint8)
+                address[:len(datagram.src)] = np.frombuffer(datagram.src, dtype=np.uint8)
+                extra.append((index, start, start + len(datagram.payload), address, datagram.sport,
+                              datagram.dport))
+        if extra:
+            indices, extra_starts, extra_ends, addresses, sports, dports = zip(*extra)
+            order = np.argsort(np.concatenate([selected, indices]), kind='stable')
+            selected = np.concatenate([selected, indices])[order]
+            starts = np.concatenate([starts, extra_starts])[order]
+            ends = np.concatenate([ends, extra_ends])[order]
+            src = np.concatenate([src, np.array(addresses)])[order]
+            sport = np.concatenate([sport, sports])[order]
+            dport = np.concatenate([dport, dports])[order]
+    packets = np.zeros(len(selected), dtype=RTP_DTYPE)
+    packets['arrival'] = arrivals[selected]
+    packets['src'] = src
+    packets['sport'] = sport
+    packets['dport'] = dport
+    return decode_headers(data, starts, ends, out=packets)
+
+
+def read_capture(path, port=None, batch_size=BATCH_SIZE):
+    """RTP_DTYPE rows of all UDP datagrams (on port) of a capture, valid RTP only"""
+    batches = [packets[packets['valid']] for packets, _ in capture_batches(path, port, batch_size)]
+    return np.concatenate(batches) if batches else np.zeros(0, dtype=RTP_DTYPE)
+
+
+def split_streams(packets):
+    """{(src bytes, sport, ssrc): row indices in arrival order} of the RTP streams
+    in packets, the way demux.StreamDemuxer tells streams apart"""
+    if not len(packets):
+        return {}
+    keys = np.empty(len(packets), dtype=[('src', 'u1', (16,)), ('sport', '<u2'), ('ssrc', '<u4')])
+    keys['src'] = packets['src']
+    keys['sport'] = packets['sport']
+    keys['ssrc'] = packets['ssrc']
+    unique, inverse = np.unique(keys.view(np.dtype((np.void, keys.dtype.itemsize))), return_inverse=True)
+    order = np.argsort(inverse.ravel(), kind='stable')
+    bounds = np.flatnonzero(np.diff(inverse.ravel()[order])) + 1
+    streams = {}
+    for rows in np.split(order, bounds):
+        first = keys[rows[0]]
+        address = bytes(first['src'])
+        address = address[:4] if not any(address[4:]) else address
+        streams[(address, int(first['sport']), int(first['ssrc']))] = rows
+    return streams
+
+
+def extended_sequences(sequence):
+    """Sequence numbers unwrapped across 0xFFFF -> 0, in arrival order (int64);
+    each step is taken as the shortest distance, so reordering stays local"""
+    sequence = np.asarray(sequence, dtype=np.int64)
+    if not len(sequence):
+        return sequence
+    steps = (np.diff(sequence) + 0x8000) % 0x10000 - 0x8000
+    extended = np.empty(len(sequence), dtype=np.int64)
+    extended[0] = sequence[0]
+    np.cumsum(steps, out=extended[1:])
+    extended[1:] += sequence[0]
+    return extended
+
+
+def extended_timestamps(timestamp):
+    """RTP timestamps unwrapped across 2**32, in arrival order (int64)"""
+    timestamp = np.asarray(timestamp, dtype=np.int64)
+    if not len(timestamp):
+        return timestamp
+    steps = (np.diff(timestamp) + 0x80000000) % 0x100000000 - 0x80000000
+    extended = np.empty(len(timestamp), dtype=np.int64)
+    extended[0] = timestamp[0]
+    np.cumsum(steps, out=extended[1:])
+    extended[1:] += timestamp[0]
+    return extended
+
+
+def sequence_stats(extended):
+    """Loss and reordering of one stream from its extended sequence numbers
+    in arrival order. lost counts sequence numbers never received (RFC 3550
+    expected - received, without duplicates); a packet is reordered (late)
+    if a higher sequence number arrived before it; gaps[i] is the number of
+    sequence numbers skipped just before packet i."""
+    if not len(extended):
+        return {'expected': 0, 'received': 0, 'lost': 0, 'duplicates': 0, 'reordered': 0,
+                'gaps': np.zeros(0, dtype=np.int64), 'late': np.zeros(0, dtype=bool)}
+    highest = np.maximum.accumulate(extended)
+    _, first = np.unique(extended, return_index=True)
+    duplicate = np.ones(len(extended), dtype=bool)
+    duplicate[first] = False
+    late = np.zeros(len(extended), dtype=bool)
+    late[1:] = extended[1:] < highest[:-1]
+    late &= ~duplicate
+    gaps = np.zeros(len(extended), dtype=np.int64)
+    gaps[1:] = np.maximum(extended[1:] - highest[:-1] - 1, 0)
+    unique = len(first)
+    expected = int(highest[-1] - extended.min() + 1)
+    return {
+        'expected': expected,
+        'received': len(extended),
+        'lost': expected - unique,
+        'duplicates': len(extended) - unique,
+        'reordered': int(np.count_nonzero(late)),
+        'gaps': gaps,
+        'late': late,
+    }
+
+
+def frame_packet_counts(timestamp):
+    """(RTP timestamps, packets) of the frames of one stream: consecutive
+    packets with the same timestamp, in arrival order"""
+    timestamp = np.asarray(timestamp)
+    if not len(timestamp):
+        return timestamp, np.zeros(0, dtype=np.int64)
+    starts = np.concatenate(([0], np.flatnonzero(timestamp[1:] != timestamp[:-1]) + 1))
+    counts = np.diff(np.append(starts, len(timestamp)))
+    return timestamp[starts], counts
+
+
+def interarrival_jitter(arrival, timestamp, clock_rate=CLOCK_RATE, initial=0.0):
+    """RFC 3550 interarrival jitter estimate after every packet, in timestamp
+    units: J += (|D| - J) / 16, evaluated in closed form one block at a time.
+    initial is the estimate at the first packet (to continue an earlier run)."""
+    arrival = np.asarray(arrival, dtype=np.float64)
+    timestamp = extended_timestamps(timestamp)
+    jitter = np.full(len(arrival), initial, dtype=np.float64)
+    if len(arrival) < 2:
+        return jitter
+    transit = arrival * clock_rate - timestamp
+    d = np.abs(np.diff(transit))
+    decay = 15.0 / 16.0
+    growth = decay ** -np.arange(1, _JITTER_BLOCK + 1)
+    current = initial
+    for start in range(0, len(d), _JITTER_BLOCK):
+        block = d[start:start + _JITTER_BLOCK]
+        n = len(block)
+        # J_i = decay^i * (J_0 + sum_k<=i |D_k| * decay^-k / 16)
+        values = (current + np.cumsum(block * growth[:n]) / 16.0) / growth[:n]
+        jitter[start + 1:start + 1 + n] = values
+        current = values[-1]
+    return jitter
+
+
+def summarize(packets, clock_rate=CLOCK_RATE):
+    """{stream key: statistics} for the RTP packets of a capture"""
+    summary = {}
+    for key, rows in split_streams(packets).items():
+        stream = packets[rows]
+        stats = sequence_stats(extended_sequences(stream['sequence']))
+        _, counts = frame_packet_counts(stream['timestamp'])
+        jitter = interarrival_jitter(stream['arrival'], stream['timestamp'], clock_rate)
+        nal_types = np.where(stream['nal_type'] == FU_TYPE, stream['fu_type'], stream['nal_type'])
+        # A fragmented NAL counts once, at its first fragment
+        whole = (stream['nal_type'] != FU_TYPE) | stream['fu_start']
+        types = np.bincount(nal_types[whole], minlength=64)
+        summary[key] = {
+            'packets': len(stream),
+            'bytes': int(stream['payload_size'].sum()),
+            'duration': float(stream['arrival'][-1] - stream['arrival'][0]),
+            'expected': stats['expected'],
+            'lost': stats['lost'],
+            'duplicates': stats['duplicates'],
+            'reordered': stats['reordered'],
+            'frames': len(counts),
+            'packets_per_frame_mean': float(counts.mean()) if len(counts) else 0.0,
+            'packets_per_frame_max': int(counts.max()) if len(counts) else 0,
+            'markers': int(np.count_nonzero(stream['marker'])),
+            'fu_starts': int(np.count_nonzero(stream['fu_start'])),
+            'fu_ends': int(np.count_nonzero(stream['fu_end'])),
+            'jitter_ms': float(jitter[-1]) * 1000.0 / clock_rate,
+            'nal_types': {t: int(c) for t, c in enumerate(types.tolist()) if c},
+        }
+    return summary
+
+
+def address_text(address):
+    """Dotted IPv4 or colon-grouped IPv6 text of a raw address"""
+    if len(address) == 4:
+        return '.'.join(str(b) for b in address)
+    return address.hex(':', 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Vectorized RTP statistics of a pcap/pcapng capture')
+    parser.add_argument('pcap_file', help='Input capture')
+    parser.add_argument('-p', '--port', type=int, default=5004, help='RTP port number (default: 5004)')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        packets = read_capture(args.pcap_file, args.port)
+    except (OSError, ValueError) as e:
+        print(f"Error reading PCAP file: {e}")
+        sys.exit(1)
+    summary = summarize(packets)
+    elapsed = time.perf_counter() - start
+    print(f"{args.pcap_file}: {len(packets)} RTP packets, {len(summary)} stream(s) in {elapsed * 1000:.0f} ms")
+    for (address, sport, ssrc), s in summary.items():
+        print(f"\nStream {address_text(address)}:{sport} ssrc={ssrc:08x}: {s['packets']} packets, "
+              f"{s['bytes']:,} payload bytes, {s['duration']:.1f} s")
+        loss = s['lost'] * 100.0 / max(1, s['expected'])
+        print(f"  Lost: {s['lost']} of {s['expected']} ({loss:.2f}%), duplicates {s['duplicates']}, "
+              f"reordered {s['reordered']}")
+        print(f"  Frames: {s['frames']} ({s['packets_per_frame_mean']:.1f} packets per frame, "
+              f"max {s['packets_per_frame_max']}), markers {s['markers']}")
+        print(f"  FU: {s['fu_starts']} starts, {s['fu_ends']} ends")
+        print(f"  Jitter: {s['jitter_ms']:.2f} ms")
+        print("  NAL units: " + ', '.join(f"{t}: {c}" for t, c in sorted(s['nal_types'].items())))
+
+
+if __name__ == '__main__':
+    main()
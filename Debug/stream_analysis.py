@@ -0,0 +1,546 @@
+#!/usr/bin/env python3
+"""
+Streaming capture analysis
+One pass over a pcap/pcapng capture in rtp_batch batches, keeping only
+aggregated counters per RTP stream: a per-second timeline (bitrate, frames,
+IRAPs, missing and late packets, jitter, RTP timestamp drift against the
+capture clock), GOP structure, frame sizes by NAL type and packets per
+frame. Memory grows with the capture duration (one timeline row per
+second), not with its size. Written as JSON, CSV (the timeline) and HTML
+"""
+
+import csv
+import html
+import json
+
+import numpy as np
+
+from extract_h265 import NAL_NAMES
+from metrics import HISTOGRAM_BUCKETS, SUB_BUCKET_BITS
+from rtp_batch import (CLOCK_RATE, FU_TYPE, address_text, capture_batches, extended_sequences,
+                       extended_timestamps, interarrival_jitter, split_streams)
+
+AP_TYPE = 48
+
+# One row per second of capture time. bytes are RTP payload bytes; missing
+# are sequence numbers skipped, late packets that arrived after a higher
+# sequence number; jitter is the largest RFC 3550 estimate in the second,
+# drift the smallest (arrival - RTP time) offset of a media packet
+TIMELINE_DTYPE = np.dtype([
+    ('packets', '<i8'),
+    ('bytes', '<i8'),
+    ('frames', '<i8'),
+    ('iraps', '<i8'),
+    ('missing', '<i8'),
+    ('late', '<i8'),
+    ('jitter', '<f8'),
+    ('drift', '<f8'),
+])
+TIMELINE_FIELDS = ('second', 'packets', 'bytes', 'kbps', 'frames', 'iraps', 'missing', 'late',
+                   'jitter_ms', 'drift_ms')
+# Frames of more packets than this share the last packets-per-frame bucket
+MAX_FRAME_PACKETS = 1024
+QUANTILES = (0.5, 0.9, 0.99)
+# Packets decoded at once; peak memory is about 300 bytes per packet of a
+# batch, and larger batches are not faster
+BATCH_SIZE = 1 << 16
+
+_LINEAR_LIMIT = 2 << SUB_BUCKET_BITS
+_NO_VCL = np.iinfo(np.int64).max
+
+
+def _size_buckets(sizes):
+    """Log-linear histogram bucket of each size (metrics.Histogram's layout)"""
+    sizes = np.maximum(np.asarray(sizes, dtype=np.int64), 0)
+    _, bits = np.frexp(sizes.astype(np.float64))
+    shift = np.maximum(bits.astype(np.int64) - SUB_BUCKET_BITS - 1, 0)
+    index = np.where(sizes < _LINEAR_LIMIT, sizes, (shift << SUB_BUCKET_BITS) + (sizes >> shift))
+    return np.minimum(index, HISTOGRAM_BUCKETS - 1)
+
+
+def _bucket_values(indices):
+    """Midpoint of each histogram bucket"""
+    indices = np.asarray(indices, dtype=np.int64)
+    shift = np.maximum((indices >> SUB_BUCKET_BITS) - 1, 1)
+    mantissa = indices - (shift << SUB_BUCKET_BITS)
+    return np.where(indices < _LINEAR_LIMIT, indices, (mantissa << shift) + (1 << (shift - 1)))
+
+
+def _quantiles(buckets, count):
+    cumulative = np.cumsum(buckets)
+    positions = np.searchsorted(cumulative, [q * count for q in QUANTILES])
+    values = _bucket_values(np.minimum(positions, len(buckets) - 1))
+    return {f"p{int(q * 100)}": int(v) for q, v in zip(QUANTILES, values.tolist())}
+
+
+def _nal_name(nal_type):
+    return NAL_NAMES.get(nal_type, f"Type_{nal_type}")
+
+
+class FrameSizes:
+    """Exact count/sum/min/max and a size histogram of the frames of one NAL type"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+        self.buckets = np.zeros(HISTOGRAM_BUCKETS, dtype=np.int64)
+
+    def add(self, sizes):
+        self.count += len(sizes)
+        self.total += int(sizes.sum())
+        low = int(sizes.min())
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = max(self.max, int(sizes.max()))
+        self.buckets += np.bincount(_size_buckets(sizes), minlength=HISTOGRAM_BUCKETS)
+
+    def report(self):
+        report = {'count': self.count, 'bytes': self.total,
+                  'mean': round(self.total / self.count, 1) if self.count else 0.0,
+                  'min': self.min or 0, 'max': self.max}
+        # Bucket midpoints, kept within the exact range
+        report.update({k: min(max(v, report['min']), self.max)
+                       for k, v in _quantiles(self.buckets, self.count).items()})
+        return report
+
+
+class StreamAnalysis:
+    """Aggregated statistics of one RTP stream, fed one batch of its packets
+    (RTP_DTYPE rows in arrival order) at a time.
+
+    A frame is a run of consecutive packets with the same RTP timestamp
+    that carries at least one VCL NAL unit; its type is that of its first
+    VCL NAL unit and its size the NAL unit bytes without start codes. The
+    run still open at the end of a batch is held back until the next one.
+    Runs without VCL (parameter sets sent on their own) are counted apart.
+    Jitter and drift only use media (VCL) packets, because the sender gives
+    parameter sets the previous frame's timestamp. Duplicates are only
+    recognized within a batch.
+    """
+
+    def __init__(self, key, start, clock_rate=CLOCK_RATE):
+        self.key = key
+        self.start = start  # capture time of second 0 of the timeline
+        self.clock_rate = clock_rate
+        self.timeline = np.zeros(0, dtype=TIMELINE_DTYPE)
+        self.seconds = 0
+        self.packets = 0
+        self.bytes = 0
+        self.first_arrival = None
+        self.last_arrival = None
+        # Sequence numbers
+        self.lowest = None
+        self.last_sequence = None  # (raw, extended) of the last packet
+        self.highest = None
+        self.received = 0
+        self.duplicates = 0
+        self.late = 0
+        self.missing = 0
+        # Media packets: (raw, extended) timestamp of the last one, jitter after it
+        self.media_arrival = None
+        self.media_timestamp = None
+        self.media_reference = None  # extended timestamp of the first media packet
+        self.jitter = 0.0
+        # Frames
+        self.pending = None
+        self.frame_timestamp = None  # (raw, extended) of the last frame
+        self.frames = 0
+        self.non_vcl_runs = 0
+        self.frame_sizes = {}  # NAL type -> FrameSizes
+        self.frame_packets = np.zeros(MAX_FRAME_PACKETS + 1, dtype=np.int64)
+        # GOP: frames and seconds from one IRAP to the next
+        self.last_irap = None  # (frame number, extended timestamp)
+        self.irap_types = {}
+        self.gop_frames = {}
+        self.irap_intervals = []  # count, sum, min, max in seconds
+
+    def _grow(self, seconds):
+        if seconds <= len(self.timeline):
+            self.seconds = max(self.seconds, seconds)
+            return
+        timeline = np.zeros(max(seconds, 2 * len(self.timeline), 64), dtype=TIMELINE_DTYPE)
+        timeline['drift'] = np.inf
+        timeline[:len(self.timeline)] = self.timeline
+        self.timeline = timeline
+        self.seconds = seconds
+
+    @staticmethod
+    def _continue(unwrap, raw, last):
+        """unwrap(raw) in continuation of last = (raw, extended) of the previous batch"""
+        if last is None:
+            return unwrap(raw)
+        extended = unwrap(np.concatenate(([last[0]], raw)).astype(np.int64))
+        return extended[1:] - extended[0] + last[1]
+
+    def add(self, rows):
+        if len(rows):
+            self._add_packets(rows)
+        self._add_frames(rows, final=False)
+
+    def finish(self):
+        self._add_frames(rows=None, final=True)
+
+    def _add_packets(self, rows):
+        arrival = rows['arrival']
+        second = np.maximum((arrival - self.start).astype(np.int64), 0)
+        self._grow(int(second.max()) + 1)
+        timeline = self.timeline
+        size = rows['payload_size'].astype(np.int64)
+        timeline['packets'][:self.seconds] += np.bincount(second, minlength=self.seconds)[:self.seconds]
+        timeline['bytes'][:self.seconds] += np.bincount(second, weights=size,
+                                                        minlength=self.seconds)[:self.seconds].astype(np.int64)
+        self.packets += len(rows)
+        self.bytes += int(size.sum())
+        if self.first_arrival is None:
+            self.first_arrival = float(arrival[0])
+        self.last_arrival = float(arrival[-1])
+
+        # Sequence numbers: gaps before a packet past the highest so far, late otherwise
+        extended = self._continue(extended_sequences, rows['sequence'], self.last_sequence)
+        self.last_sequence = (int(rows['sequence'][-1]), int(extended[-1]))
+        lowest = int(extended.min())
+        self.lowest = lowest if self.lowest is None else min(self.lowest, lowest)
+        previous = np.empty(len(extended), dtype=np.int64)
+        previous[0] = extended[0] - 1 if self.highest is None else self.highest
+        np.maximum.accumulate(extended[:-1], out=previous[1:])
+        np.maximum(previous[1:], previous[0], out=previous[1:])
+        _, first = np.unique(extended, return_index=True)
+        duplicate = np.ones(len(extended), dtype=bool)
+        duplicate[first] = False
+        late = (extended < previous) & ~duplicate
+        gaps = np.maximum(extended - previous - 1, 0)
+        self.highest = int(max(previous[-1], extended[-1]))
+        self.received += len(extended)
+        self.duplicates += len(extended) - len(first)
+        self.late += int(np.count_nonzero(late))
+        self.missing += int(gaps.sum())
+        timeline['missing'][:self.seconds] += np.bincount(second, weights=gaps,
+                                                          minlength=self.seconds)[:self.seconds].astype(np.int64)
+        timeline['late'][:self.seconds] += np.bincount(second[late], minlength=self.seconds)[:self.seconds]
+
+        # Jitter and drift over the media packets
+        types = np.where(rows['nal_type'] == FU_TYPE, rows['fu_type'], rows['nal_type'])
+        media = types < 32
+        if not media.any():
+            return
+        arrival = arrival[media]
+        raw = rows['timestamp'][media]
+        second = second[media]
+        timestamps = self._continue(extended_timestamps, raw, self.media_timestamp)
+        if self.media_reference is None:
+            self.media_reference = int(timestamps[0])
+        if self.media_arrival is None:
+            jitter = interarrival_jitter(arrival, raw, self.clock_rate)
+        else:
+            jitter = interarrival_jitter(np.concatenate(([self.media_arrival], arrival)),
+                                         np.concatenate(([self.media_timestamp[0]], raw)),
+                                         self.clock_rate, initial=self.jitter)[1:]
+        self.jitter = float(jitter[-1])
+        self.media_arrival = float(arrival[-1])
+        self.media_timestamp = (int(raw[-1]), int(timestamps[-1]))
+        np.maximum.at(timeline['jitter'], second, jitter)
+        # Positive drift: the packet arrived later than its RTP time says
+        offset = (arrival - self.start) - (timestamps - self.media_reference) / self.clock_rate
+        np.minimum.at(timeline['drift'], second, offset)
+
+    def _add_frames(self, rows, final):
+        if self.pending is not None:
+            rows = self.pending if rows is None else np.concatenate((self.pending, rows))
+            self.pending = None
+        if rows is None or not len(rows):
+            return
+        timestamp = rows['timestamp']
+        starts = np.concatenate(([0], np.flatnonzero(timestamp[1:] != timestamp[:-1]) + 1))
+        if not final:
+            # The last run may continue in the next batch
+            self.pending = rows[starts[-1]:].copy()
+            rows = rows[:starts[-1]]
+            starts = starts[:-1]
+            if not len(starts):
+                return
+        counts = np.diff(np.append(starts, len(rows)))
+
+        nal_type = rows['nal_type']
+        fu = nal_type == FU_TYPE
+        types = np.where(fu, rows['fu_type'], nal_type).astype(np.int64)
+        # NAL unit bytes: FU payload minus its 3 header bytes, plus the
+        # reconstructed 2-byte NAL header at the start; AP minus its header
+        size = rows['payload_size'].astype(np.int64)
+        size = np.where(fu, size - 3 + 2 * rows['fu_start'], np.where(nal_type == AP_TYPE, size - 2, size))
+        sizes = np.add.reduceat(size, starts)
+        positions = np.where(types < 32, np.arange(len(rows)), _NO_VCL)
+        first_vcl = np.minimum.reduceat(positions, starts)
+        irap = np.maximum.reduceat((types >= 16) & (types <= 21), starts)
+
+        vcl = first_vcl != _NO_VCL
+        self.non_vcl_runs += int(np.count_nonzero(~vcl))
+        if not vcl.any():
+            return
+        starts, counts, sizes, irap = starts[vcl], counts[vcl], sizes[vcl], irap[vcl]
+        frame_types = types[first_vcl[vcl]]
+
+        second = np.maximum((rows['arrival'][starts] - self.start).astype(np.int64), 0)
+        self.timeline['frames'][:self.seconds] += np.bincount(second, minlength=self.seconds)[:self.seconds]
+        self.timeline['iraps'][:self.seconds] += np.bincount(second[irap], minlength=self.seconds)[:self.seconds]
+        self.frame_packets += np.bincount(np.minimum(counts, MAX_FRAME_PACKETS),
+                                          minlength=MAX_FRAME_PACKETS + 1)
+        for nal_type in np.unique(frame_types).tolist():
+            self.frame_sizes.setdefault(nal_type, FrameSizes()).add(sizes[frame_types == nal_type])
+
+        timestamps = self._continue(extended_timestamps, timestamp[starts], self.frame_timestamp)
+        self.frame_timestamp = (int(timestamp[starts[-1]]), int(timestamps[-1]))
+        numbers = self.frames + np.arange(len(starts))
+        self.frames += len(starts)
+        if not irap.any():
+            return
+        for nal_type, count in zip(*np.unique(frame_types[irap], return_counts=True)):
+            name = _nal_name(int(nal_type))
+            self.irap_types[name] = self.irap_types.get(name, 0) + int(count)
+        irap_numbers = numbers[irap]
+        irap_timestamps = timestamps[irap]
+        if self.last_irap is not None:
+            irap_numbers = np.concatenate(([self.last_irap[0]], irap_numbers))
+            irap_timestamps = np.concatenate(([self.last_irap[1]], irap_timestamps))
+        self.last_irap = (int(irap_numbers[-1]), int(irap_timestamps[-1]))
+        if len(irap_numbers) < 2:
+            return
+        for length, count in zip(*np.unique(np.diff(irap_numbers), return_counts=True)):
+            self.gop_frames[int(length)] = self.gop_frames.get(int(length), 0) + int(count)
+        intervals = np.diff(irap_timestamps) / self.clock_rate
+        if self.irap_intervals:
+            count, total, low, high = self.irap_intervals
+        else:
+            count, total, low, high = 0, 0.0, float('inf'), float('-inf')
+        self.irap_intervals = [count + len(intervals), total + float(intervals.sum()),
+                               min(low, float(intervals.min())), max(high, float(intervals.max()))]
+
+    def timeline_rows(self):
+        """Per-second rows (dicts of TIMELINE_FIELDS) from the first second with packets"""
+        timeline = self.timeline[:self.seconds]
+        active = np.flatnonzero(timeline['packets'])
+        if not len(active):
+            return []
+        timeline = timeline[active[0]:]
+        drift = timeline['drift']
+        finite = np.isfinite(drift)
+        reference = drift[finite][0] if finite.any() else 0.0
+        rows = []
+        for index, row in enumerate(timeline.tolist()):
+            packets, size, frames, iraps, missing, late, jitter, offset = row
+            rows.append({
+                'second': int(active[0]) + index,
+                'packets': packets,
+                'bytes': size,
+                'kbps': round(size * 8 / 1000, 1),
+                'frames': frames,
+                'iraps': iraps,
+                'missing': missing,
+                'late': late,
+                'jitter_ms': round(jitter * 1000 / self.clock_rate, 3),
+                'drift_ms': round((offset - reference) * 1000, 3) if np.isfinite(offset) else None,
+            })
+        return rows
+
+    def drift(self):
+        """Linear fit of the per-second drift: ppm (positive: the RTP clock runs slow
+        against the capture clock) and the total change in ms"""
+        timeline = self.timeline[:self.seconds]
+        seconds = np.flatnonzero(np.isfinite(timeline['drift']))
+        if len(seconds) < 2:
+            return {'ppm': 0.0, 'total_ms': 0.0}
+        offsets = timeline['drift'][seconds]
+        slope = np.polyfit(seconds.astype(np.float64), offsets, 1)[0]
+        return {'ppm': round(float(slope) * 1e6, 1), 'total_ms': round(float(offsets[-1] - offsets[0]) * 1000, 3)}
+
+    def report(self):
+        address, sport, ssrc = self.key
+        duration = (self.last_arrival - self.first_arrival) if self.packets else 0.0
+        expected = self.highest - self.lowest + 1 if self.packets else 0
+        lost = max(0, expected - (self.received - self.duplicates))
+        frame_counts = np.flatnonzero(self.frame_packets)
+        frames_total = int(self.frame_packets.sum())
+        mean_packets = float((np.arange(len(self.frame_packets)) * self.frame_packets).sum()) / max(1, frames_total)
+        gop_lengths = sorted(self.gop_frames)
+        gop_total = sum(self.gop_frames.values())
+        intervals = self.irap_intervals
+        return {
+            'stream': {'src': address_text(address), 'sport': sport, 'ssrc': f"{ssrc:08x}"},
+            'packets': self.packets,
+            'bytes': self.bytes,
+            'duration': round(duration, 3),
+            'kbps': round(self.bytes * 8 / 1000 / duration, 1) if duration > 0 else 0.0,
+            'sequence': {
+                'expected': expected,
+                'received': self.received,
+                'lost': lost,
+                'loss_percent': round(lost * 100 / expected, 3) if expected else 0.0,
+                'duplicates': self.duplicates,
+                'late': self.late,
+            },
+            'frames': self.frames,
+            'non_vcl_runs': self.non_vcl_runs,
+            'packets_per_frame': {
+                'mean': round(mean_packets, 2),
+                'max': int(frame_counts[-1]) if len(frame_counts) else 0,
+                'histogram': {int(n): int(self.frame_packets[n]) for n in frame_counts},
+            },
+            'frame_sizes': {_nal_name(t): self.frame_sizes[t].report() for t in sorted(self.frame_sizes)},
+            'gop': {
+                'iraps': sum(self.irap_types.values()),
+                'irap_types': self.irap_types,
+                'frames': {
+                    'min': gop_lengths[0] if gop_lengths else 0,
+                    'max': gop_lengths[-1] if gop_lengths else 0,
+                    'mean': round(sum(n * c for n, c in self.gop_frames.items()) / gop_total, 1) if gop_total else 0.0,
+                    'histogram': {n: self.gop_frames[n] for n in gop_lengths},
+                },
+                'interval_seconds': {
+                    'min': round(intervals[2], 3) if intervals else 0.0,
+                    'max': round(intervals[3], 3) if intervals else 0.0,
+                    'mean': round(intervals[1] / intervals[0], 3) if intervals else 0.0,
+                },
+            },
+            'jitter_ms': round(self.jitter * 1000 / self.clock_rate, 3),
+            'drift': self.drift(),
+            'timeline': self.timeline_rows(),
+        }
+
+
+def analyze_capture(path, port=None, batch_size=BATCH_SIZE, max_streams=64):
+    """{'capture', 'packets', 'streams': [stream report]} for the RTP streams of
+    a capture, in one pass. Streams beyond max_streams are ignored (counted)."""
+    streams = {}
+    start = None
+    udp_packets = 0
+    ignored = 0
+    for packets, _ in capture_batches(path, port, batch_size):
+        udp_packets += len(packets)
+        packets = packets[packets['valid']]
+        if not len(packets):
+            continue
+        if start is None:
+            start = float(packets['arrival'][0])
+        for key, rows in split_streams(packets).items():
+            stream = streams.get(key)
+            if stream is None:
+                if len(streams) >= max_streams:
+                    ignored += len(rows)
+                    continue
+                stream = streams[key] = StreamAnalysis(key, start)
+            stream.add(packets[rows])
+    for stream in streams.values():
+        stream.finish()
+    return {
+        'capture': path,
+        'port': port,
+        'udp_packets': udp_packets,
+        'ignored_packets': ignored,
+        'streams': [stream.report() for stream in streams.values()],
+    }
+
+
+def write_json(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
+
+
+def write_csv(report, path):
+    """The per-second timelines of all streams, one row per stream and second"""
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(('src', 'sport', 'ssrc') + TIMELINE_FIELDS)
+        for stream in report['streams']:
+            identity = (stream['stream']['src'], stream['stream']['sport'], stream['stream']['ssrc'])
+            for row in stream['timeline']:
+                writer.writerow(identity + tuple('' if row[k] is None else row[k] for k in TIMELINE_FIELDS))
+
+
+def _svg_chart(title, rows, field, color, width=900, height=140):
+    """Inline SVG line chart of one timeline field"""
+    points = [(row['second'], row[field]) for row in rows if row[field] is not None]
+    if len(points) < 2:
+        return ''
+    first, last = points[0][0], points[-1][0]
+    values = [v for _, v in points]
+    low, high = min(min(values), 0), max(values)
+    span_x = max(1, last - first)
+    span_y = (high - low) or 1
+    coordinates = ' '.join(f"{(x - first) * width / span_x:.1f},{height - (v - low) * height / span_y:.1f}"
+                           for x, v in points)
+    return (f'<figure><figcaption>{html.escape(title)} (min {min(values):g}, max {max(values):g})</figcaption>'
+            f'<svg width="{width}" height="{height}" viewBox="-2 -2 {width + 4} {height + 4}">'
+            f'<rect x="0" y="0" width="{width}" height="{height}" fill="none" stroke="#ccc"/>'
+            f'<polyline points="{coordinates}" fill="none" stroke="{color}" stroke-width="1"/></svg>'
+            f'<div class="axis">{first} s &ndash; {last} s</div></figure>')
+
+
+def _html_table(header, rows):
+    head = ''.join(f'<th>{html.escape(str(h))}</th>' for h in header)
+    body = ''.join('<tr>' + ''.join(f'<td>{html.escape(str(v))}</td>' for v in row) + '</tr>' for row in rows)
+    return f'<table><tr>{head}</tr>{body}</table>'
+
+
+def write_html(report, path):
+    """Self-contained HTML summary: tables and SVG charts, no scripts"""
+    parts = [f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>{html.escape(report["capture"])}</title>'
+             '<style>body{font-family:sans-serif;margin:2em}table{border-collapse:collapse;margin:1em 0}'
+             'td,th{border:1px solid #ccc;padding:2px 8px;text-align:right}figure{margin:1em 0}'
+             '.axis{font-size:small;color:#666}</style></head><body>',
+             f'<h1>{html.escape(report["capture"])}</h1>']
+    for stream in report['streams']:
+        identity = stream['stream']
+        sequence = stream['sequence']
+        gop = stream['gop']
+        parts.append(f'<h2>{html.escape(identity["src"])}:{identity["sport"]} ssrc={identity["ssrc"]}</h2>')
+        parts.append(_html_table(('', ''), [
+            ('Duration', f'{stream["duration"]:.1f} s'),
+            ('Packets', stream['packets']),
+            ('Bitrate', f'{stream["kbps"]} kbps'),
+            ('Lost', f'{sequence["lost"]} of {sequence["expected"]} ({sequence["loss_percent"]}%)'),
+            ('Late / duplicates', f'{sequence["late"]} / {sequence["duplicates"]}'),
+            ('Frames', f'{stream["frames"]} ({stream["packets_per_frame"]["mean"]} packets per frame, '
+                       f'max {stream["packets_per_frame"]["max"]})'),
+            ('IRAPs', ', '.join(f'{k} {v}' for k, v in gop['irap_types'].items()) or '0'),
+            ('GOP frames', f'{gop["frames"]["min"]} / {gop["frames"]["mean"]} / {gop["frames"]["max"]}'),
+            ('IRAP interval', f'{gop["interval_seconds"]["min"]} / {gop["interval_seconds"]["mean"]} / '
+                              f'{gop["interval_seconds"]["max"]} s'),
+            ('Jitter', f'{stream["jitter_ms"]} ms'),
+            ('Drift', f'{stream["drift"]["ppm"]} ppm ({stream["drift"]["total_ms"]} ms)'),
+        ]))
+        parts.append(_html_table(('NAL type', 'frames', 'mean', 'min', 'p50', 'p90', 'p99', 'max'), [
+            (name, s['count'], s['mean'], s['min'], s['p50'], s['p90'], s['p99'], s['max'])
+            for name, s in stream['frame_sizes'].items()]))
+        timeline = stream['timeline']
+        parts.append(_svg_chart('Bitrate (kbps)', timeline, 'kbps', '#1f77b4'))
+        parts.append(_svg_chart('Frames per second', timeline, 'frames', '#2ca02c'))
+        parts.append(_svg_chart('Missing packets per second', timeline, 'missing', '#d62728'))
+        parts.append(_svg_chart('Late packets per second', timeline, 'late', '#ff7f0e'))
+        parts.append(_svg_chart('Jitter (ms)', timeline, 'jitter_ms', '#9467bd'))
+        parts.append(_svg_chart('Drift (ms)', timeline, 'drift_ms', '#8c564b'))
+    parts.append('</body></html>')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(parts))
+
+
+def print_summary(report):
+    print(f"{report['capture']}: {report['udp_packets']} UDP packets, {len(report['streams'])} RTP stream(s)")
+    if report['ignored_packets']:
+        print(f"Ignored {report['ignored_packets']} packets of further streams")
+    for stream in report['streams']:
+        identity = stream['stream']
+        sequence = stream['sequence']
+        gop = stream['gop']
+        print(f"\nStream {identity['src']}:{identity['sport']} ssrc={identity['ssrc']}: {stream['packets']} packets, "
+              f"{stream['duration']:.1f} s, {stream['kbps']} kbps")
+        print(f"  Lost: {sequence['lost']} of {sequence['expected']} ({sequence['loss_percent']}%), "
+              f"late {sequence['late']}, duplicates {sequence['duplicates']}")
+        print(f"  Frames: {stream['frames']} ({stream['packets_per_frame']['mean']} packets per frame, "
+              f"max {stream['packets_per_frame']['max']})")
+        print(f"  IRAPs: {gop['iraps']}, every {gop['frames']['mean']} frames / "
+              f"{gop['interval_seconds']['mean']} s")
+        for name, sizes in stream['frame_sizes'].items():
+            print(f"  {name}: {sizes['count']} frames, mean {sizes['mean']:.0f} bytes, "
+                  f"p50 {sizes['p50']}, p99 {sizes['p99']}, max {sizes['max']}")
+        print(f"  Jitter: {stream['jitter_ms']} ms, drift {stream['drift']['ppm']} ppm "
+              f"({stream['drift']['total_ms']} ms)")
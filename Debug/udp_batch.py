@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Batched UDP datagram reader
+Reads many datagrams per wake-up into a preallocated buffer ring, using
+recvmmsg(2) where libc provides it and recvfrom_into() otherwise
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import socket
+import struct
+
+SOCKADDR_SIZE = 128  # sizeof(struct sockaddr_storage)
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t),
+    ]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(_IOVec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', _MsgHdr),
+        ('msg_len', ctypes.c_uint),
+    ]
+
+
+def _load_recvmmsg():
+    """Return libc's recvmmsg, or None where it does not exist (macOS)"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = libc.recvmmsg
+    except (OSError, AttributeError, TypeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint,
+                     ctypes.c_int, ctypes.c_void_p]
+    func.restype = ctypes.c_int
+    return func
+
+
+_recvmmsg = _load_recvmmsg()
+
+
+_FAMILY = struct.Struct('=H')
+_SOCKADDR_IN = struct.Struct('!HI')
+_ipv4_cache = {}
+
+
+def _decode_sockaddr(buf, offset):
+    family = _FAMILY.unpack_from(buf, offset)[0]
+    if family == socket.AF_INET:
+        # Senders are few, so decoded IPv4 addresses are cached by (port, address)
+        raw = _SOCKADDR_IN.unpack_from(buf, offset + 2)
+        addr = _ipv4_cache.get(raw)
+        if addr is None:
+            if len(_ipv4_cache) > 1024:
+                _ipv4_cache.clear()
+            addr = _ipv4_cache[raw] = (socket.inet_ntoa(struct.pack('!I', raw[1])), raw[0])
+        return addr
+    if family == socket.AF_INET6:
+        port = struct.unpack_from('!H', buf, offset + 2)[0]
+        return (socket.inet_ntop(socket.AF_INET6, bytes(buf[offset + 8:offset + 24])), port)
+    return None
+
+
+class DatagramBatchReader:
+    """Reads up to batch_size datagrams per call into a reusable buffer ring.
+
+    Slot contents are only valid until the next read(); callers that keep a
+    datagram around must copy it out with bytes(reader.datagram(i)).
+    """
+
+    def __init__(self, sock, batch_size=64, slot_size=2048, timeout=0.1, use_recvmmsg=True):
+        self.sock = sock
+        self.batch_size = batch_size
+        self.slot_size = slot_size
+        self.timeout = timeout
+        self.buffer = bytearray(batch_size * slot_size)
+        self.view = memoryview(self.buffer)
+        self.names = bytearray(batch_size * SOCKADDR_SIZE)
+        self.lengths = [0] * batch_size
+        self.addresses = [None] * batch_size
+        self.truncated = 0
+        self.use_recvmmsg = use_recvmmsg and _recvmmsg is not None
+
+        # The socket is drained with non-blocking reads after select() reports
+        # it readable, so a single wake-up picks up everything queued.
+        self.sock.setblocking(False)
+
+        if self.use_recvmmsg:
+            self._setup_mmsghdr()
+
+    def _setup_mmsghdr(self):
+        self._buffer_c = (ctypes.c_char * len(self.buffer)).from_buffer(self.buffer)
+        buf_addr = ctypes.addressof(self._buffer_c)
+        self._names_c = (ctypes.c_char * len(self.names)).from_buffer(self.names)
+        names_addr = ctypes.addressof(self._names_c)
+        self._iovecs = (_IOVec * self.batch_size)()
+        self._msgs = (_MMsgHdr * self.batch_size)()
+        for i in range(self.batch_size):
+            self._iovecs[i].iov_base = buf_addr + i * self.slot_size
+            self._iovecs[i].iov_len = self.slot_size
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = names_addr + i * SOCKADDR_SIZE
+            hdr.msg_namelen = SOCKADDR_SIZE
+            hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+            hdr.msg_iovlen = 1
+
+    @property
+    def mode(self):
+        return 'recvmmsg' if self.use_recvmmsg else 'recvfrom_into'
+
+    def read(self):
+        """Wait up to timeout for data, then read a batch. Returns the datagram count."""
+        readable, _, _ = select.select([self.sock], [], [], self.timeout)
+        if not readable:
+            return 0
+        if self.use_recvmmsg:
+            return self._read_recvmmsg()
+        return self._read_recvfrom_into()
+
+    def _read_recvmmsg(self):
+        count = _recvmmsg(self.sock.fileno(), self._msgs, self.batch_size, socket.MSG_DONTWAIT, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return 0
+            raise OSError(err, os.strerror(err))
+
+        for i in range(count):
+            msg = self._msgs[i]
+            length = msg.msg_len
+            if msg.msg_hdr.msg_flags & socket.MSG_TRUNC:
+                self.truncated += 1
+                length = min(length, self.slot_size)
+            self.lengths[i] = length
+            self.addresses[i] = None
+            # The kernel overwrites namelen/flags; reset them for the next call
+            msg.msg_hdr.msg_namelen = SOCKADDR_SIZE
+            msg.msg_hdr.msg_flags = 0
+        return count
+
+    def _read_recvfrom_into(self):
+        count = 0
+        while count < self.batch_size:
+            start = count * self.slot_size
+            try:
+                length, addr = self.sock.recvfrom_into(self.view[start:start + self.slot_size])
+            except (BlockingIOError, InterruptedError):
+                break
+            self.lengths[count] = length
+            self.addresses[count] = addr
+            count += 1
+        return count
+
+    def datagram(self, i):
+        """Memoryview of the i-th datagram of the last batch (no copy)"""
+        start = i * self.slot_size
+        return self.view[start:start + self.lengths[i]]
+
+    def address(self, i):
+        """Source (host, port) of the i-th datagram of the last batch"""
+        addr = self.addresses[i]
+        if addr is None and self.use_recvmmsg:
+            addr = _decode_sockaddr(self.names, i * SOCKADDR_SIZE)
+            self.addresses[i] = addr
+        return addr
@@ -25,9 +25,26 @@ class CameraStreamManager: NSObject, ObservableObject {
         super.init()
         setupCamera()
         encoder.delegate = self
+        setupFeedback()
         startPreview()
     }
     
+    private func setupFeedback() {
+        // RTCP from the receiver: resend NACKed packets, answer PLI/FIR with a keyframe
+        udpSender.onNack = { [weak self] sequenceNumbers in
+            guard let self = self else { return }
+            let packets = self.rtpPacketizer.retransmissions(for: sequenceNumbers)
+            print("NACK for \(sequenceNumbers.count) packets, resending \(packets.count)")
+            self.udpSender.sendBatch(packets)
+        }
+        udpSender.onKeyFrameRequest = { [weak self] in
+            self?.encoder.requestKeyFrame()
+        }
+        udpSender.senderReportInfo = { [weak self] in
+            self?.rtpPacketizer.senderReportInfo() ?? (0, 0, 0, 0)
+        }
+    }
+    
     private func setupCamera() {
         captureSession.beginConfiguration()
         
@@ -24,6 +24,9 @@ class H265Encoder {
     private var keyFrameInterval: Int32 = 30
     
     private var frameCount: Int64 = 0
+    // Set by an RTCP PLI/FIR from the receiver: the next frame is encoded as a keyframe
+    private var keyFrameRequested = false
+    private let keyFrameLock = NSLock()
     private var lastParameterSetTime: Date = Date()
     
     // File saving properties
@@ -160,7 +163,14 @@ class H265Encoder {
         let duration = CMSampleBufferGetDuration(sampleBuffer)
         
         var flags: VTEncodeInfoFlags = []
-        let shouldForceKeyFrame = (frameCount % Int64(keyFrameInterval)) == 0
+        keyFrameLock.lock()
+        let requested = keyFrameRequested
+        keyFrameRequested = false
+        keyFrameLock.unlock()
+        let shouldForceKeyFrame = requested || (frameCount % Int64(keyFrameInterval)) == 0
+        if requested {
+            print("Keyframe requested by receiver")
+        }
         
         var properties: CFDictionary?
         if shouldForceKeyFrame {
@@ -347,6 +357,12 @@ class H265Encoder {
         }
     }
     
+    func requestKeyFrame() {
+        keyFrameLock.lock()
+        keyFrameRequested = true
+        keyFrameLock.unlock()
+    }
+    
     func stop() {
         stopRecording()
         
@@ -4,10 +4,20 @@ class RTPPacketizer {
     private let maxPayloadSize = 1200
     private var sequenceNumber: UInt16 = 0
     private var timestamp: UInt32 = 0
-    private let ssrc: UInt32 = UInt32.random(in: 0..<UInt32.max)
+    let ssrc: UInt32 = UInt32.random(in: 0..<UInt32.max)
     private let payloadType: UInt8 = 98
     private let clockRate: UInt32 = 90000
     
+    // Sent packets kept for retransmission after an RTCP NACK, by sequence number
+    private let historySize = 1024
+    private lazy var history = [(sequenceNumber: UInt16, packet: Data)?](repeating: nil, count: historySize)
+    private let historyLock = NSLock()
+    
+    // Sender Report counters
+    private(set) var packetCount: UInt32 = 0
+    private(set) var octetCount: UInt32 = 0
+    private(set) var lastTimestamp: UInt32 = 0
+    
     enum NALUnitType: UInt8 {
         case VPS = 32
         case SPS = 33
@@ -39,6 +49,7 @@ class RTPPacketizer {
         packet.append(rtpHeader)
         packet.append(nalUnit)
         
+        remember(packet, timestamp: timestamp)
         sequenceNumber = sequenceNumber &+ 1
         
         return packet
@@ -93,6 +104,7 @@ class RTPPacketizer {
             packet.append(fragmentData)
             
             packets.append(packet)
+            remember(packet, timestamp: timestamp)
             sequenceNumber = sequenceNumber &+ 1
             offset += fragmentSize
         }
@@ -100,6 +112,34 @@ class RTPPacketizer {
         return packets
     }
     
+    private func remember(_ packet: Data, timestamp: UInt32) {
+        historyLock.lock()
+        history[Int(sequenceNumber) % historySize] = (sequenceNumber, packet)
+        lastTimestamp = timestamp
+        packetCount = packetCount &+ 1
+        octetCount = octetCount &+ UInt32(packet.count - 12)
+        historyLock.unlock()
+    }
+    
+    /// The packets with these sequence numbers that are still in the history,
+    /// resent unchanged (same sequence number and SSRC)
+    func retransmissions(for sequenceNumbers: [UInt16]) -> [Data] {
+        historyLock.lock()
+        defer { historyLock.unlock() }
+        return sequenceNumbers.compactMap { sequenceNumber in
+            guard let entry = history[Int(sequenceNumber) % historySize],
+                  entry.sequenceNumber == sequenceNumber else { return nil }
+            return entry.packet
+        }
+    }
+    
+    /// (SSRC, RTP timestamp, packet count, octet count) for an RTCP Sender Report
+    func senderReportInfo() -> (ssrc: UInt32, rtpTimestamp: UInt32, packets: UInt32, octets: UInt32) {
+        historyLock.lock()
+        defer { historyLock.unlock() }
+        return (ssrc, lastTimestamp, packetCount, octetCount)
+    }
+    
     private func createRTPHeader(marker: Bool, timestamp: UInt32) -> Data {
         var header = Data(count: 12)
         
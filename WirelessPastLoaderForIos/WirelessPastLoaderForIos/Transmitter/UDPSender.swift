@@ -6,6 +6,18 @@ class UDPSender {
     private let queue = DispatchQueue(label: "udp.sender.queue")
     private var isConnected = false
     
+    // RTCP (RFC 3550 / 4585 / 5104) with the receiver on port + 1: Sender
+    // Reports out, Receiver Reports and NACK / PLI / FIR feedback in
+    private var rtcpConnection: NWConnection?
+    private var reportTimer: DispatchSourceTimer?
+    private var lastFIRSequence: [UInt32: UInt8] = [:]
+    /// Sequence numbers the receiver asked to be resent (generic NACK)
+    var onNack: (([UInt16]) -> Void)?
+    /// The receiver cannot repair its picture (PLI or FIR): send a keyframe
+    var onKeyFrameRequest: (() -> Void)?
+    /// (SSRC, RTP timestamp, packets, octets) of the stream, for Sender Reports
+    var senderReportInfo: (() -> (ssrc: UInt32, rtpTimestamp: UInt32, packets: UInt32, octets: UInt32))?
+    
     init() {}
     
     func connect(host: String, port: UInt16) {
@@ -31,6 +43,131 @@ class UDPSender {
         }
         
         connection?.start(queue: queue)
+        
+        connectRTCP(host: hostEndpoint, port: port &+ 1)
+    }
+    
+    private func connectRTCP(host: NWEndpoint.Host, port: UInt16) {
+        let rtcp = NWConnection(host: host, port: NWEndpoint.Port(rawValue: port)!, using: .udp)
+        rtcp.stateUpdateHandler = { [weak self] state in
+            if case .ready = state {
+                print("RTCP connection ready")
+                self?.receiveRTCP()
+            }
+        }
+        rtcp.start(queue: queue)
+        rtcpConnection = rtcp
+        
+        // The receiver sends its feedback to where the Sender Reports come from,
+        // so the first one goes out right away
+        let timer = DispatchSource.makeTimerSource(queue: queue)
+        timer.schedule(deadline: .now() + 0.1, repeating: 1.0)
+        timer.setEventHandler { [weak self] in
+            self?.sendSenderReport()
+        }
+        timer.resume()
+        reportTimer = timer
+    }
+    
+    private func receiveRTCP() {
+        rtcpConnection?.receiveMessage { [weak self] data, _, _, error in
+            guard let self = self else { return }
+            if let data = data, !data.isEmpty {
+                self.handleRTCP([UInt8](data))
+            }
+            if error == nil {
+                self.receiveRTCP()
+            }
+        }
+    }
+    
+    private func handleRTCP(_ bytes: [UInt8]) {
+        let ssrc = senderReportInfo?().ssrc
+        var offset = 0
+        while offset + 4 <= bytes.count {
+            let version = bytes[offset] >> 6
+            let count = bytes[offset] & 0x1F
+            let packetType = bytes[offset + 1]
+            let length = ((Int(bytes[offset + 2]) << 8 | Int(bytes[offset + 3])) + 1) * 4
+            guard version == 2, offset + length <= bytes.count else { return }
+            let body = offset + 4
+            let end = offset + length
+            
+            switch (packetType, count) {
+            case (201, _) where count > 0 && body + 28 <= end:
+                // Receiver Report: round trip time from LSR / DLSR of the first block
+                let lsr = readUInt32(bytes, body + 20)
+                let dlsr = readUInt32(bytes, body + 24)
+                if lsr != 0 {
+                    let rtt = Double(ntpMiddle(Date()) &- lsr &- dlsr) / 65536.0
+                    print(String(format: "RTCP RR: %.1f%% lost, RTT %.1f ms",
+                                 Double(bytes[body + 8]) / 2.56, rtt * 1000))
+                }
+            case (205, 1) where body + 8 <= end:
+                // Generic NACK: PID + bitmask of the 16 following sequence numbers
+                guard ssrc == nil || readUInt32(bytes, body + 4) == ssrc else { break }
+                var sequenceNumbers: [UInt16] = []
+                var item = body + 8
+                while item + 4 <= end {
+                    let pid = UInt16(bytes[item]) << 8 | UInt16(bytes[item + 1])
+                    let mask = UInt16(bytes[item + 2]) << 8 | UInt16(bytes[item + 3])
+                    sequenceNumbers.append(pid)
+                    for bit in 0..<16 where mask & (1 << bit) != 0 {
+                        sequenceNumbers.append(pid &+ UInt16(bit + 1))
+                    }
+                    item += 4
+                }
+                onNack?(sequenceNumbers)
+            case (206, 1) where body + 8 <= end:
+                guard ssrc == nil || readUInt32(bytes, body + 4) == ssrc else { break }
+                print("RTCP PLI")
+                onKeyFrameRequest?()
+            case (206, 4) where body + 8 <= end:
+                // FIR: a repeated command sequence number is the same request
+                let requester = readUInt32(bytes, body)
+                var entry = body + 8
+                while entry + 8 <= end {
+                    let sequence = bytes[entry + 4]
+                    if (ssrc == nil || readUInt32(bytes, entry) == ssrc) && lastFIRSequence[requester] != sequence {
+                        lastFIRSequence[requester] = sequence
+                        print("RTCP FIR")
+                        onKeyFrameRequest?()
+                    }
+                    entry += 8
+                }
+            default:
+                break
+            }
+            offset = end
+        }
+    }
+    
+    private func sendSenderReport() {
+        guard let info = senderReportInfo?(), info.packets > 0 else { return }
+        let now = Date().timeIntervalSince1970 + 2_208_988_800  // NTP epoch (1900)
+        let seconds = UInt32(truncatingIfNeeded: UInt64(now))
+        let fraction = UInt32(truncatingIfNeeded: UInt64((now - floor(now)) * 4_294_967_296.0))
+        var packet: [UInt8] = [0x80, 200, 0, 6]
+        for value in [info.ssrc, seconds, fraction, info.rtpTimestamp, info.packets, info.octets] {
+            packet += [UInt8(value >> 24), UInt8((value >> 16) & 0xFF), UInt8((value >> 8) & 0xFF), UInt8(value & 0xFF)]
+        }
+        rtcpConnection?.send(content: Data(packet), completion: .contentProcessed { error in
+            if let error = error {
+                print("RTCP send error: \(error)")
+            }
+        })
+    }
+    
+    private func ntpMiddle(_ date: Date) -> UInt32 {
+        let now = date.timeIntervalSince1970 + 2_208_988_800
+        let seconds = UInt32(truncatingIfNeeded: UInt64(now)) & 0xFFFF
+        let fraction = UInt32((now - floor(now)) * 65536.0) & 0xFFFF
+        return seconds << 16 | fraction
+    }
+    
+    private func readUInt32(_ bytes: [UInt8], _ offset: Int) -> UInt32 {
+        return UInt32(bytes[offset]) << 24 | UInt32(bytes[offset + 1]) << 16
+            | UInt32(bytes[offset + 2]) << 8 | UInt32(bytes[offset + 3])
     }
     
     func send(_ data: Data) {
@@ -57,6 +194,10 @@ class UDPSender {
     }
     
     func disconnect() {
+        reportTimer?.cancel()
+        reportTimer = nil
+        rtcpConnection?.cancel()
+        rtcpConnection = nil
         connection?.cancel()
         connection = nil
         isConnected = false